@@ -659,6 +659,65 @@ cloudphish_submit_command_parser.add_argument('-c', '--context', default=None,
             If this parameter starts with a @ then it is taken as the name of a JSON file to load.""")
 cloudphish_submit_command_parser.set_defaults(func=_cli_cloudphish_submit)
 
+def cloudphish_submit_batch(urls, reprocess=False, ignore_filters=False, context={}, *args, **kwargs):
+    """Submit a list of URLs for Cloudphish to analyze in a single request.
+
+    :param list urls: The list of URLs.
+    :param bool reprocess: (optional) If True, re-analyze the URLs and ignore the cache.
+    :param bool ignore_filters: (optional) Ignore URL filtering (forces download and analysis.)
+    :param dict context: (optional) Additional context to associated to the analysis.
+    :return: A dict that maps each URL to the same result returned by cloudphish_submit. Like this:
+        {'results': {'http://example.com/': {'result': 'OK', 'status': 'ANALYZED', ...}}}
+    :rtype: dict
+    """
+    # make sure the following keys are not in the context
+    for key in [ 'url', 'urls', 'reprocess', 'ignore_filters' ]:
+        if key in context:
+            raise ValueError("context cannot contain the keys url, urls, reprocess or ignore_filters")
+
+    data = {
+        'urls': json.dumps(list(urls)),
+        'r': '1' if reprocess else '0',
+        'ignore_filters': '1' if ignore_filters else '0'
+    }
+
+    data.update(context)
+
+    return _execute_api_call('cloudphish/submit_batch', data=data, method=METHOD_POST, *args, **kwargs).json()
+
+def _cli_cloudphish_submit_batch(args):
+    if args.context:
+        if args.context.startswith('@'):
+            with open(args.context[1:], 'r') as fp:
+                args.context = json.load(fp)
+
+    urls = args.urls
+    if args.from_file:
+        with open(args.from_file, 'r') as fp:
+            urls.extend([_.strip() for _ in fp if _.strip()])
+
+    return cloudphish_submit_batch(remote_host=args.remote_host,
+                                   ssl_verification=args.ssl_verification,
+                                   urls=urls,
+                                   reprocess=args.reprocess,
+                                   ignore_filters=args.ignore_filters,
+                                   context=args.context if args.context else {})
+
+cloudphish_submit_batch_command_parser = _api_command(subparsers.add_parser('cloudphish-submit-batch',
+    help="""Submit multiple URLs for Cloudphish to analyze in a single request."""))
+cloudphish_submit_batch_command_parser.add_argument('urls', nargs='*', default=[],
+    help="The URLs to download and analyze.")
+cloudphish_submit_batch_command_parser.add_argument('-f', '--from-file', default=None,
+    help="Read the URLs to submit from the given file (one per line.)")
+cloudphish_submit_batch_command_parser.add_argument('-r', '--reprocess', default=False, action='store_true',
+    help="Forces cloudphish to re-analyze the given urls (bypassing the cache.)")
+cloudphish_submit_batch_command_parser.add_argument('-i', '--ignore-filters', default=False, action='store_true',
+    help="Forces cloudphish to analyze the given urls (bypassing any filtering it does.)")
+cloudphish_submit_batch_command_parser.add_argument('-c', '--context', default=None,
+    help="""Optional additional context to add to the request. This is a free-form JSON dict.
+            If this parameter starts with a @ then it is taken as the name of a JSON file to load.""")
+cloudphish_submit_batch_command_parser.set_defaults(func=_cli_cloudphish_submit_batch)
+
 def cloudphish_download(url=None, sha256=None, output_path=None, output_fp=None, *args, **kwargs):
     """Download content from Cloudphish. 
     Note: either the url OR the sha256 of the url is expected to passed.
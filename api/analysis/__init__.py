@@ -17,6 +17,7 @@ from saq import LOCAL_TIMEZONE
 from saq.analysis import RootAnalysis, _JSONEncoder
 from saq.database import get_db_connection, ALERT
 from saq.error import report_exception
+from saq.hashing import copy_with_digests
 from saq.constants import *
 from saq.util import parse_event_time, storage_dir_from_uuid, validate_uuid, workload_storage_dir
 
@@ -165,10 +166,13 @@ def submit():
                             abort(400)
 
                     logging.debug("saving file {}".format(full_path))
-                    f.save(full_path)
+                    # the file is hashed as it is written so nothing needs to read it again to hash it
+                    digests = copy_with_digests(f.stream, full_path)
 
                     # add this as a F_FILE type observable
-                    root.add_observable(F_FILE, os.path.relpath(full_path, start=root.storage_dir))
+                    file_observable = root.add_observable(F_FILE, os.path.relpath(full_path, start=root.storage_dir))
+                    if file_observable:
+                        file_observable.set_digests(digests)
 
                 except Exception as e:
                     logging.error("unable to copy file from {} to {} for root {}: {}".format(
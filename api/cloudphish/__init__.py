@@ -70,6 +70,52 @@ def submit():
     logging.debug("returning result {} for {}".format(result, url))
     return json_result(result.json())
 
+@cloudphish_bp.route('/submit_batch', methods=['POST'])
+def submit_batch():
+    # the urls are passed as a JSON encoded list
+    try:
+        urls = json.loads(request.values.get('urls', '[]'))
+    except Exception as e:
+        return "Invalid request (urls is not valid JSON): {}".format(e), 400
+
+    if not isinstance(urls, list) or not all([isinstance(_, str) and _ for _ in urls]):
+        return "Invalid request (urls must be a list of strings)", 400
+
+    if not urls:
+        return "Invalid request (missing urls)", 400
+
+    if len(urls) > saq.CONFIG['cloudphish'].getint('batch_size_limit'):
+        return "Invalid request (more than {} urls)".format(saq.CONFIG['cloudphish']['batch_size_limit']), 400
+
+    reprocess = True if request.values.get('r', None) == '1' else False
+    ignore_filters = True if request.values.get('ignore_filters', None) == '1' else False
+    details = {}
+
+    # see submit()
+    for key in request.values.keys():
+        if key not in [ 'a', 'r', 'url', 'urls' ]:
+            details[key] = request.values.get(key)
+
+    results = {}
+    valid_urls = []
+    for url in urls:
+        try:
+            url.encode('ascii')
+            valid_urls.append(url)
+        except Exception:
+            error_message = "(encoded) url {} has non-ascii characters".format(url.encode('unicode_escape'))
+            logging.info(error_message)
+            results[url] = CloudphishAnalysisResult(RESULT_ERROR, error_message).json()
+
+    logging.info("received batch submission for {} urls reprocess {} details {}".format(
+                 len(valid_urls), reprocess, details))
+
+    if valid_urls:
+        for url, result in analyze_urls(valid_urls, reprocess, ignore_filters, details).items():
+            results[url] = result.json()
+
+    return json_result({'results': results})
+
 @cloudphish_bp.route('/download', methods=['GET'])
 def download():
     url, sha256_url = _get_url_and_hash()
@@ -132,6 +178,7 @@ def clear_alert():
                                                  WHERE sha256_url = UNHEX(%s)""", 
                                       (sha256_url,), commit=True)
 
+    invalidate_cached_result(sha256_url)
     logging.info("request to clear cloudphish alert for {} row_count {}".format(url if url else sha256_url, row_count))
 
     response = make_response(json.dumps({'result': 'OK', 'row_count': row_count}))
@@ -1,6 +1,7 @@
 # vim: sw=4:ts=4:et
 
 import hashlib
+import json
 import logging
 import os, os.path
 import threading
@@ -343,3 +344,96 @@ class CloudphishAPITestCase(CloudphishTestCase, ACEEngineTestCase):
         # we should get a redirect back to the other node
         result = self.client.get(url_for('cloudphish.download', s=submission_result[KEY_SHA256_URL]))
         self.assertEquals(result.status_code, 302)
+
+    @use_db
+    def test_result_cache(self, db, c):
+        from saq.cloudphish import get_result_cache
+
+        saq.CONFIG['cloudphish']['result_cache_enabled'] = 'yes'
+        saq.CONFIG['cloudphish']['result_cache_backend'] = 'local'
+        saq.CONFIG['cloudphish']['lookup_flush_size'] = '1000'
+        saq.CONFIG['cloudphish']['lookup_flush_interval'] = '3600'
+        clear_result_cache()
+
+        # results that are not finalized are never cached
+        result = self.client.get(url_for('cloudphish.submit', url=TEST_URL, ignore_filters='1')).get_json()
+        self.assertEquals(result[KEY_STATUS], STATUS_NEW)
+        self.assertEquals(len(get_result_cache().local_cache), 0)
+
+        engine = TestEngine(analysis_pools={ANALYSIS_MODE_CLOUDPHISH: 1}, local_analysis_modes=[ANALYSIS_MODE_CLOUDPHISH])
+        engine.enable_module('analysis_module_crawlphish', ANALYSIS_MODE_CLOUDPHISH)
+        engine.enable_module('analysis_module_cloudphish_request_analyzer', ANALYSIS_MODE_CLOUDPHISH)
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        # the first lookup of the finalized result goes to the database
+        result = self.client.get(url_for('cloudphish.submit', url=TEST_URL, ignore_filters='1')).get_json()
+        self.assertEquals(result[KEY_STATUS], STATUS_ANALYZED)
+        self.assertEquals(result[KEY_ANALYSIS_RESULT], SCAN_RESULT_CLEAR)
+        self.assertEquals(get_result_cache().hits, 0)
+        self.assertEquals(len(get_result_cache().local_cache), 1)
+
+        # the second lookup comes from the cache
+        cached_result = self.client.get(url_for('cloudphish.submit', url=TEST_URL, ignore_filters='1')).get_json()
+        self.assertEquals(get_result_cache().hits, 1)
+        self.assertEquals(cached_result, result)
+
+        # the last_lookup updates are pending until they are flushed
+        c.execute("UPDATE cloudphish_url_lookup SET last_lookup = '2000-01-01 00:00:00' WHERE sha256_url = UNHEX(%s)", 
+                  (result[KEY_SHA256_URL],))
+        db.commit()
+        flush_url_lookups()
+        db.commit()
+        c.execute("SELECT last_lookup FROM cloudphish_url_lookup WHERE sha256_url = UNHEX(%s)", (result[KEY_SHA256_URL],))
+        self.assertTrue(c.fetchone()[0].year > 2000)
+
+        # clearing the alert invalidates the cached result
+        self.client.get(url_for('cloudphish.clear_alert', url=TEST_URL))
+        self.assertEquals(len(get_result_cache().local_cache), 0)
+
+    @use_db
+    def test_submit_batch(self, db, c):
+        # one url that gets analyzed, one that gets filtered and one that is not valid
+        with open(self.blacklist_path, 'w') as fp:
+            fp.write('blacklisted.local\n')
+
+        urls = [ TEST_URL, 'http://blacklisted.local/test.pdf' ]
+        result = self.client.post(url_for('cloudphish.submit_batch'), data={'urls': json.dumps(urls)})
+        self.assertEquals(result.status_code, 200)
+        result = result.get_json()
+        self.assertTrue('results' in result)
+        self.assertEquals(len(result['results']), 2)
+
+        self.assertEquals(result['results'][TEST_URL][KEY_RESULT], RESULT_OK)
+        self.assertEquals(result['results'][TEST_URL][KEY_STATUS], STATUS_NEW)
+        self.assertEquals(result['results'][urls[1]][KEY_RESULT], RESULT_OK)
+        self.assertEquals(result['results'][urls[1]][KEY_STATUS], STATUS_ANALYZED)
+        self.assertEquals(result['results'][urls[1]][KEY_ANALYSIS_RESULT], SCAN_RESULT_PASS)
+
+        # only the url that was not filtered should have an entry
+        c.execute("SELECT HEX(sha256_url), uuid FROM cloudphish_analysis_results")
+        rows = c.fetchall()
+        self.assertEquals(len(rows), 1)
+        self.assertEquals(rows[0][0].lower(), hash_url(TEST_URL))
+        self.assertEquals(rows[0][1], result['results'][TEST_URL][KEY_UUID])
+
+        # and a single workload entry
+        c.execute("SELECT uuid FROM workload")
+        self.assertEquals(len(c.fetchall()), 1)
+
+        # submitting again returns the existing analysis
+        second_result = self.client.post(url_for('cloudphish.submit_batch'), data={'urls': json.dumps(urls)})
+        second_result = second_result.get_json()
+        self.assertEquals(second_result['results'][TEST_URL][KEY_UUID], result['results'][TEST_URL][KEY_UUID])
+        db.commit()
+        c.execute("SELECT uuid FROM workload")
+        self.assertEquals(len(c.fetchall()), 1)
+
+    def test_submit_batch_invalid(self):
+        result = self.client.post(url_for('cloudphish.submit_batch'), data={'urls': 'not json'})
+        self.assertEquals(result.status_code, 400)
+        result = self.client.post(url_for('cloudphish.submit_batch'), data={'urls': json.dumps([])})
+        self.assertEquals(result.status_code, 400)
+        result = self.client.post(url_for('cloudphish.submit_batch'), data={'urls': json.dumps({'a': 'b'})})
+        self.assertEquals(result.status_code, 400)
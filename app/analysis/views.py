@@ -28,7 +28,6 @@ from operator import attrgetter
 from subprocess import Popen, PIPE, DEVNULL
 from urllib.parse import urlparse
 
-import businesstime
 import pandas as pd
 import requests
 from pymongo import MongoClient
@@ -39,6 +38,8 @@ import vxstreamlib
 import splunklib
 
 from saq import SAQ_HOME
+from saq.alert_search import get_alert_search_index
+from saq.cold_storage import is_packed, unpack_storage_dir, open_storage_file, storage_file_exists, extract_storage_file
 from saq.constants import *
 from saq.crits import update_status
 from saq.analysis import Tag
@@ -47,11 +48,12 @@ from saq.database import User, UserAlertMetrics, Comment, get_db_connection, Eve
                          MalwareMapping, Company, CompanyMapping, Campaign, Alert, \
                          Workload, DelayedAnalysis, \
                          acquire_lock, release_lock, \
-                         get_available_nodes, use_db, set_dispositions, add_workload, \
+                         get_available_nodes, use_db, set_dispositions, update_sla, add_workload, \
                          add_observable_tag_mapping, remove_observable_tag_mapping
-from saq.email import search_archive, get_email_archive_sections
+from saq.email import search_archive, get_email_archive_sections, find_archive_path, read_archive
 from saq.error import report_exception
 from saq.gui import GUIAlert
+from saq.metrics import AlertMetrics, get_alert_metrics, PERIOD_DAY, PERIOD_HOUR
 from saq.performance import record_execution_time
 from saq.util import abs_path
 
@@ -60,7 +62,8 @@ import ace_api
 from app import db
 from app.analysis import *
 from flask import jsonify, render_template, redirect, request, url_for, flash, session, \
-                  make_response, g, send_from_directory, send_file
+                  make_response, g, send_from_directory, send_file, Response, stream_with_context, \
+                  after_this_request
 from flask_login import login_user, logout_user, login_required, current_user
 
 from sqlalchemy import and_, or_, func, distinct
@@ -308,6 +311,11 @@ def email_file():
         flash("internal error")
         return redirect("/analysis?direct=" + alert.uuid)
 
+    # the compressed and encrypted copies are written next to the file
+    storage_dir = os.path.join(SAQ_HOME, alert.storage_dir)
+    if is_packed(storage_dir):
+        unpack_storage_dir(storage_dir)
+
     # get the full path to the file to expose
     full_path = os.path.join(SAQ_HOME, alert.storage_dir, file_observable.value)
     if not os.path.exists(full_path):
@@ -416,6 +424,22 @@ def download_file():
 
     # get the full path to the file to expose
     full_path = os.path.join(SAQ_HOME, alert.storage_dir, file_observable.value)
+
+    # files of alerts in cold storage are copied out of the container for the duration of the request
+    # (malicious files are linked to where they are so the alert is unpacked instead)
+    storage_dir = os.path.join(SAQ_HOME, alert.storage_dir)
+    if not os.path.exists(full_path) and storage_file_exists(storage_dir, file_observable.value):
+        if mode == 'malicious':
+            unpack_storage_dir(storage_dir)
+        else:
+            temp_dir = tempfile.mkdtemp(dir=saq.TEMP_DIR)
+            full_path = extract_storage_file(storage_dir, file_observable.value, temp_dir)
+
+            @after_this_request
+            def _remove_temp_dir(response):
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                return response
+
     if not os.path.exists(full_path):
         logging.error("file path {0} does not exist for alert {1} user {2}".format(full_path, alert, current_user))
         flash("internal error")
@@ -843,6 +867,7 @@ def assign_ownership():
             owner_id=int(request.form['selected_user_id']),
             owner_time=datetime.datetime.now()))
         db.session.commit()
+        update_sla(alert_uuids, session=db.session)
 
     flash("assigned ownership of {0} alert{1}".format(len(alert_uuids), "" if len(alert_uuids) == 1 else "s"))
     if analysis_page:
@@ -883,6 +908,7 @@ def take_ownership():
             owner_id=current_user.id,
             owner_time=datetime.datetime.now()))
         db.session.commit()
+        update_sla(alert_uuids, session=db.session)
 
     flash("took ownership of {0} alert{1}".format(len(alert_uuids), "" if len(alert_uuids) == 1 else "s"))
     if analysis_page:
@@ -1325,7 +1351,31 @@ def search():
             daterange_end = datetime.datetime.now()
             daterange_start = daterange_end - datetime.timedelta(days=7)
 
-        for alert in db.session.query(GUIAlert).filter(GUIAlert.insert_date.between(daterange_start, daterange_end)):
+        alert_search_index = get_alert_search_index()
+        if alert_search_index is not None and not search_all:
+            # use the full text index of the alert content
+            try:
+                matches = list(alert_search_index.search(query, details=bool(search_details)))
+            except Exception as e:
+                logging.error("alert search index query failed: {}".format(e))
+                flash("search failed: {}".format(e))
+                return render_template('analysis/search.html', observable_types=VALID_OBSERVABLE_TYPES)
+
+            logging.debug("alert search index found {} alerts matching {}".format(len(matches), query))
+
+            # then limit them to the date range
+            for i in range(0, len(matches), 1000):
+                for alert_uuid, in db.session.query(GUIAlert.uuid).filter(
+                                   GUIAlert.uuid.in_(matches[i:i + 1000]),
+                                   GUIAlert.insert_date.between(daterange_start, daterange_end)):
+                    uuids.append(alert_uuid)
+
+        # the index only contains the json files, so searching every file still scans the alerts
+        alerts_to_scan = []
+        if alert_search_index is None or search_all:
+            alerts_to_scan = db.session.query(GUIAlert).filter(GUIAlert.insert_date.between(daterange_start, daterange_end))
+
+        for alert in alerts_to_scan:
             args = [
                 'find', '-L',
                 alert.storage_dir,
@@ -1556,16 +1606,13 @@ def manage():
     campaigns = db.session.query(Campaign).order_by(Campaign.name.asc()).all()
 
     # we want to display alerts that are either approaching or exceeding SLA
-    sla_ids = [] # list of alert IDs that need to be displayed
+    # (the SLA times are stored with the alert, see saq.database.Alert.update_sla)
+    sla_filter = and_(GUIAlert.disposition == None, GUIAlert.sla_warning_time <= datetime.datetime.now())
+    in_sla = False
     if saq.GLOBAL_SLA_SETTINGS.enabled or any([s.enabled for s in saq.OTHER_SLA_SETTINGS]):
-        _query = db.session.query(GUIAlert).filter(GUIAlert.disposition == None)
-        for alert_type in saq.EXCLUDED_SLA_ALERT_TYPES:
-            _query = _query.filter(GUIAlert.alert_type != alert_type)
-        for alert in _query:
-            if alert.is_over_sla or alert.is_approaching_sla:
-                sla_ids.append(alert.id)
+        in_sla = db.session.query(GUIAlert.id).filter(sla_filter).first() is not None
 
-    logging.debug("{} alerts in breach of SLA".format(len(sla_ids)))
+    logging.debug("alerts in breach of SLA: {}".format(in_sla))
 
     # object representations of the filters to define types and value verification routines
     # this later gets augmented with the dynamic filters
@@ -1760,7 +1807,7 @@ def manage():
             filter_item.reset()
 
         # if there are alerts in SLA then a reset defaults to only showing core alerts past sla
-        if sla_ids:
+        if in_sla:
             filters[FILTER_CB_ONLY_SLA].value = True
             filters[FILTER_S_SEARCH_COMPANY].value = 'Core'
             filters[FILTER_CB_USE_SEARCH_COMPANY].value = True
@@ -1785,7 +1832,7 @@ def manage():
         display_disposition = False
 
     if filters[FILTER_CB_ONLY_SLA].value:
-        query = query.filter(GUIAlert.id.in_(sla_ids))
+        query = query.filter(sla_filter)
         filter_english.append("only alerts past SLA")
         filters[FILTER_CB_UNOWNED].value = False
 
@@ -2052,7 +2099,7 @@ def manage():
     total_alerts = db.session.execute(count_query).scalar()
 
     # if alerts are in breach of SLA then we sort by date ascending
-    if reset_filter and sla_ids:
+    if reset_filter and in_sla:
         sort_instructions = {SORT_FIELD_DATE: SORT_DIRECTION_ASC}
 
     # finally sort the results
@@ -2221,7 +2268,7 @@ def manage():
         sort_arrow_html=sort_arrow_html,
         filter_english=' AND '.join(filter_english),
         observable_types=VALID_OBSERVABLE_TYPES,
-        has_sla=len(sla_ids) > 0,
+        has_sla=in_sla,
         display_disposition=display_disposition,
         total_alerts=total_alerts,
         alert_limit=alert_limit,
@@ -2230,106 +2277,51 @@ def manage():
 
 
 # begin helper functions for metrics
-def businessHourCycleTimes(df):
-    # return pd.Series(timedelta) of alert cycle times in business hours
-    business_hours = (datetime.time(6), datetime.time(18))
-    _bt = businesstime.BusinessTime(business_hours=business_hours)
-    
-    bh_cycle_time = []
-    for alert in df.itertuples():
-        open_hours = _bt.open_hours.seconds / 3600
-        btd = _bt.businesstimedelta(alert.insert_date, alert.disposition_time)
-        btd_hours = btd.seconds / 3600
-        bh_cycle_time.append(datetime.timedelta(hours=(btd.days * open_hours + btd_hours)))
-        
-    return pd.Series(data=bh_cycle_time)
-
-
-def alert_stats_for_month(df, business_hours=False):
-    # df = dataframe of all alerts during one month
-    # output: dataframe of alert cycle_time & quantity stats by disposition
-
-    df.set_index('disposition', inplace=True)
-    dispositions = df.index.get_level_values('disposition').unique()
-
-    dispo_data = {}
-    for dispo in dispositions:
-        if business_hours: # could just pass df or a copy of df - here a copy with just data needed
-            alert_cycle_times = businessHourCycleTimes(df.loc[[dispo],['disposition_time', 'insert_date']])
-        else:
-            alert_cycle_times = df.loc[dispo, 'disposition_time'] - df.loc[dispo, 'insert_date'] 
-
-        try:
-            dispo_data[dispo] = {
-                'Total' : alert_cycle_times.sum(),
-                'Cycle-Time' : alert_cycle_times.mean(),
-                'Min' : alert_cycle_times.min(),
-                'Max' : alert_cycle_times.max(),
-                'Stdev' : alert_cycle_times.std(),
-                'Quantity' : len(df.loc[dispo])
-            }
-        except AttributeError: # this occures when there was only ONE alert of this dispo type
-            dispo_data[dispo] = {
-                'Total' : alert_cycle_times,
-                'Cycle-Time' : alert_cycle_times,
-                'Min' : alert_cycle_times,
-                'Max' : alert_cycle_times,
-                'Stdev' : pd.Timedelta(datetime.timedelta()),
-                'Quantity' : 1
-            }
-
-    dispo_df = pd.DataFrame(data=dispo_data, columns=dispositions)
-        
-    return dispo_df
+# (these work on the rollups returned by saq.metrics.get_alert_metrics)
+
+METRICS_DISPOSITIONS = [ 'FALSE_POSITIVE','GRAYWARE','POLICY_VIOLATION','RECONNAISSANCE','WEAPONIZATION','DELIVERY','EXPLOITATION','INSTALLATION','COMMAND_AND_CONTROL','EXFIL','DAMAGE' ]
+
+def alert_metrics_to_df(alert_metrics):
+    # Input: dict of AlertMetrics keyed by (bucket_start, alert_type, company_id, disposition, disposition_user_id)
+    # Output: dataframe with one row per rollup with these columns:
+    #   ['month', 'bucket_start', 'alert_type', 'disposition', 'disposition_user_id',
+    #    'quantity', 'cycle_time', 'business_cycle_time'] (cycle times are the totals in seconds)
+    rows = []
+    for (bucket_start, alert_type, company_id, disposition, disposition_user_id), metrics in alert_metrics.items():
+        rows.append({ 'month': bucket_start.strftime('%Y%m'),
+                      'bucket_start': bucket_start,
+                      'alert_type': alert_type,
+                      'disposition': disposition,
+                      'disposition_user_id': disposition_user_id,
+                      'quantity': metrics.dispositioned_count,
+                      'cycle_time': metrics.cycle_time,
+                      'business_cycle_time': metrics.business_cycle_time })
+
+    return pd.DataFrame(rows, columns=[ 'month', 'bucket_start', 'alert_type', 'disposition', 'disposition_user_id',
+                                        'quantity', 'cycle_time', 'business_cycle_time' ])
 
 
 def statistic_by_dispo(df, stat, business_hours=False):
     # Input: 
-    #    df - dataframe of alerts with these columns: 
-    #        ['month', 'insert_date', 'disposition', 'disposition_time', 'owner_id', 'owner_time']
-    #    stat - a specific statistic we're interested in (Cycle-Time    Max Min Quantity    Stdev   Total)
+    #    df - dataframe of alert rollups (see alert_metrics_to_df)
+    #    stat - a specific statistic we're interested in (Cycle-Time Quantity)
     #   business_hours - bool to tell us if we're calculating in Business hours or real time
-    # Output: List of dataframes, indexed by disposition, where each dataframe contains the
-    #         alert 'stat' statisics for each month
-    
-    months = df.index.get_level_values('month').unique()
-    #dispositions = list(df['disposition'].unique())
-    dispositions = [ 'FALSE_POSITIVE','GRAYWARE','POLICY_VIOLATION','RECONNAISSANCE','WEAPONIZATION','DELIVERY','EXPLOITATION','INSTALLATION','COMMAND_AND_CONTROL','EXFIL','DAMAGE' ]
-
-    stat_data = {}
-    for dispo in dispositions:
-        
-        #have to handle months where a specific disposition never happend
-        #converting timedelta objects to minutes for astetic and graphing purposes
-        fp = deliv = exp = c2 = damage = exfil = recon = wepon = gray = pv = instal = 0
-        month_data = {}
+    # Output: dataframe, indexed by month, where each column contains the
+    #         alert 'stat' statisics for each disposition
 
-        for month in months:
-            month_df = df.loc[month] # <- select the month
-            # 1 dispo type during month means DataFrame selection gives a Series
-            # alert_stats_for_month expects a DataFrame
-            if isinstance(month_df, pd.Series):
-                month_df = pd.DataFrame([month_df])
-
-            month_df = alert_stats_for_month(month_df, business_hours)
-
-            try:
-                value = month_df.at[stat, dispo]
-            except KeyError: # dispo didn't happen during the given month
-                value = None
-            if isinstance(value, datetime.timedelta): # convert to hours
-                value = value.total_seconds() / 60 / 60
-            month_data[month] = value
-            
-        stat_data[dispo] = month_data
+    totals = df.groupby(['month', 'disposition'])[['quantity', 'cycle_time', 'business_cycle_time']].sum()
+    if stat == 'Quantity':
+        values = totals['quantity']
+    else:
+        # converting cycle times to hours for astetic and graphing purposes
+        values = totals['business_cycle_time' if business_hours else 'cycle_time'] / totals['quantity'] / 60 / 60
 
-    stat_data_df = pd.DataFrame(data=stat_data)
+    stat_data_df = values.unstack('disposition').reindex(columns=METRICS_DISPOSITIONS)
+    stat_data_df.fillna(0, inplace=True)
     if stat == 'Quantity':
-        stat_data_df.fillna(0, inplace=True)
         stat_data_df = stat_data_df.astype(int)
         stat_data_df.name = "Alert Quantities" 
     else:
-        stat_data_df.fillna(0, inplace=True)
         if business_hours:
             stat_data_df.name = "Business Hour Alert " + stat
         else:
@@ -2338,175 +2330,82 @@ def statistic_by_dispo(df, stat, business_hours=False):
     return stat_data_df
 
 
-def SliceAlertsByTimeCategory(df):
-    # this function evaluates the alerts in the given dataframe and then 
-    # places those alerts in new dataframes based on when the alert was created
+def hours_of_operation_category(dt):
+    # places an alert in a bucket based on when the alert was created
     # i.e., weekend, business hours, and week nights
-    
-    df.reset_index(0, inplace=True) # unsetting to better intertuple
-    # Cycle-Time Max Min Quantity Stdev Total
-     
-    weekend_indexes = []
-    bday_indexes = []
-    night_indexes = []
-    i=0
-    # month->insert_date    disposition disposition_time    owner_id    owner_time
-    for row in df.itertuples():
-
-        if row.insert_date.weekday() == 5: # Sat
-            # put into weekend bucket
-            weekend_indexes.append(i) 
-            
-        elif row.insert_date.weekday() == 6: # Sunday
-            # put into weekend bucket
-            weekend_indexes.append(i)
-            
-        elif row.insert_date.weekday() == 0: # Monday
-            #either weekend or weeknight bucket
-            if row.insert_date.time() < datetime.time(hour=6, minute=0, second=0):
-                night_indexes.append(i)
-            elif row.insert_date.time() >= datetime.time(hour=18, minute=0, second=0):
-                night_indexes.append(i)
-            else: #put into Buisness hours bucket
-                bday_indexes.append(i)
-                
-        elif row.insert_date.weekday() == 1: #'Tue':
-            if ( row.insert_date.time() < datetime.time(hour=6, minute=0, second=0)
-                 or row.insert_date.time() >= datetime.time(hour=18, minute=0, second=0) ):
-                night_indexes.append(i)
-            else: # put into buisness hour bucket
-                bday_indexes.append(i)
-                
-        elif row.insert_date.weekday() == 2: #'Wed':
-            if ( row.insert_date.time() < datetime.time(hour=6, minute=0, second=0)
-                 or row.insert_date.time() >= datetime.time(hour=18, minute=0, second=0) ):
-                # put into weeknight bucket
-                night_indexes.append(i)
-            else: # put into buisness hour bucket
-                bday_indexes.append(i)
-                
-        elif row.insert_date.weekday() == 3: # Thurs
-            if ( row.insert_date.time() < datetime.time(hour=6, minute=0, second=0)
-                 or row.insert_date.time() >= datetime.time(hour=18, minute=0, second=0) ):
-                # put into weeknight bucket
-                night_indexes.append(i)
-            else: # put into buisness hour bucket
-                bday_indexes.append(i)
-                
-        elif row.insert_date.weekday() == 4: #'Fri':
-            if row.insert_date.time() < datetime.time(hour=6, minute=0, second=0):
-                # put into weeknight bucket
-                night_indexes.append(i)
-            elif row.insert_date.time() >= datetime.time(hour=18, minute=0, second=0):
-                # put into weeknight or weekend bucket?
-                weekend_indexes.append(i)
-            else: # buisness hours - get first day remainder 
-                # buisness hour bucket
-                bday_indexes.append(i)
-        i+=1
-    weekend_df = df[df.index.isin(weekend_indexes)]
-    bday_df = df[df.index.isin(bday_indexes)]
-    nights_df = df[df.index.isin(night_indexes)]
-    if((len(weekend_df) + len(nights_df) + len(bday_df)) != len(df) ):
-        logging.error("Incorrect Alert count/Missing Alerts")
-    return weekend_df, nights_df, bday_df
+    if dt.weekday() in [ 5, 6 ]: # Sat, Sun
+        return 'Weekend'
+
+    if dt.time() >= datetime.time(hour=18, minute=0, second=0):
+        # friday nights count as the weekend
+        return 'Weekend' if dt.weekday() == 4 else 'Nights'
+
+    if dt.time() < datetime.time(hour=6, minute=0, second=0):
+        return 'Nights'
+
+    return 'Bus Hrs'
 
 
 def Hours_of_Operation(df):
-    # df = dataframe of alerts -> SliceAlertsByTimeCategory
+    # df = dataframe of hourly alert rollups (see alert_metrics_to_df)
     # output = df of alert-cycle-time averages and quantities,
     #          for each month (across all dispositions), and respective to the hours
     #          of operation by which alerts where created in
-    
-    months = df.index.get_level_values('month').unique()
-    
-    weekend, nights, bday = SliceAlertsByTimeCategory(df)
-    weekend.set_index('month', inplace=True)
-    nights.set_index('month', inplace=True)
-    bday.set_index('month', inplace=True)
-
-    bday_averages = []
-    weekend_averages = []
-    nights_averages = []
-    bday_quantities = []
-    weekend_quantities = []
-    nights_quantities = []
-    for month in months:
-        try:
-            bday_ct = bday.loc[month, 'disposition_time'] - bday.loc[month, 'insert_date']
-        except KeyError: # month not in index, or only one alert
-            bday_ct = pd.Series(data=pd.Timedelta(0))
-        try:
-            nights_ct = nights.loc[month, 'disposition_time'] - nights.loc[month, 'insert_date']
-        except KeyError: # month not in index 
-            nights_ct = pd.Series(data=pd.Timedelta(0))
-        try: 
-            weekend_ct = weekend.loc[month, 'disposition_time'] - weekend.loc[month, 'insert_date']
-        except KeyError:
-            weekend_ct = pd.Series(data=pd.Timedelta(0))
-
-        # handle case of single alert in a bucket for the month
-        if isinstance(bday_ct, pd.Timedelta):
-            bday_ct = pd.Series(data=bday_ct)
-        if isinstance(nights_ct, pd.Timedelta):
-            nights_ct = pd.Series(data=nights_ct)
-        if isinstance(weekend_ct, pd.Timedelta):
-            weekend_ct = pd.Series(data=weekend_ct)
-
-        bday_averages.append((bday_ct.mean().total_seconds() / 60) / 60)
-        nights_averages.append((nights_ct.mean().total_seconds() / 60) / 60)
-        weekend_averages.append((weekend_ct.mean().total_seconds() / 60) / 60)
-        
-        bday_quantities.append(len(bday_ct))
-        nights_quantities.append(len(nights_ct))
-        weekend_quantities.append(len(weekend_ct))
-        
-    data = {
-             ('Cycle-Time Averages', 'Bus Hrs'): bday_averages,
-             ('Cycle-Time Averages', 'Nights'): nights_averages,
-             ('Cycle-Time Averages', 'Weekend'): weekend_averages,
-             ('Quantities', 'Bus Hrs'): bday_quantities,
-             ('Quantities', 'Nights'): nights_quantities,
-             ('Quantities', 'Weekend'): weekend_quantities
-            }
-        
-    
-    new_df = pd.DataFrame(data, index=months)
+
+    df = df.assign(category=df.bucket_start.map(hours_of_operation_category))
+    totals = df.groupby(['month', 'category'])[['quantity', 'cycle_time']].sum()
+    categories = [ 'Bus Hrs', 'Nights', 'Weekend' ]
+    quantities = totals['quantity'].unstack('category').reindex(columns=categories).fillna(0).astype(int)
+    averages = (totals['cycle_time'] / totals['quantity'] / 60 / 60).unstack('category').reindex(columns=categories).fillna(0)
+
+    data = {}
+    for category in categories:
+        data[('Cycle-Time Averages', category)] = averages[category]
+    for category in categories:
+        data[('Quantities', category)] = quantities[category]
+
+    new_df = pd.DataFrame(data, index=averages.index)
     new_df.name = "Hours of Operation"
     return new_df
 
 
-def monthly_alert_SLAs(alerts):
-    # input - dataframe of alerts
-    
-    months = alerts.index.get_level_values('month').unique()
-    
-    quantities = []
-    bh_cycletime = []
-    total_cycletime = []
-    for month in months:
-        bh_alert_ct = businessHourCycleTimes(alerts.loc[[month],['disposition_time', 'insert_date']]) #alerts_BH.loc[month, 'disposition_time'] - alerts_BH.loc[month, 'insert_date']
-        alert_ct = alerts.loc[month, 'disposition_time'] - alerts.loc[month, 'insert_date'] 
-        quantities.append(len(alerts.loc[month]))
-        
-        if isinstance(bh_alert_ct, pd.Timedelta):
-            bh_alert_ct = pd.Series(data=bh_alert_ct)
-        if isinstance(alert_ct, pd.Timedelta):
-            alert_ct = pd.Series(data=alert_ct)
-        bh_cycletime.append(((bh_alert_ct.mean()).total_seconds() /60 ) /60)
-        total_cycletime.append(((alert_ct.mean()).total_seconds() /60 ) /60)
-    
+def monthly_alert_SLAs(df):
+    # input - dataframe of alert rollups (see alert_metrics_to_df)
+
+    totals = df.groupby('month')[['quantity', 'cycle_time', 'business_cycle_time']].sum()
     data = {
-             'Business Hour cycle time': bh_cycletime,
-             'Total Cycle time': total_cycletime,
-             'Quantity': quantities
+             'Business Hour cycle time': totals['business_cycle_time'] / totals['quantity'] / 60 / 60,
+             'Total Cycle time': totals['cycle_time'] / totals['quantity'] / 60 / 60,
+             'Quantity': totals['quantity']
            }
 
-    result = pd.DataFrame(data, index=months)
+    result = pd.DataFrame(data, index=totals.index)
     result.name = "Average Alert Cycle Times"
     return result
 
 
+def cycle_time_percentiles(alert_metrics, key_index, names=None):
+    # input - dict of AlertMetrics keyed as (bucket_start, alert_type, company_id, disposition, disposition_user_id)
+    #         key_index - the part of the key to group by (1 for alert type, 2 for company, 4 for analyst)
+    #         names - optional dict to translate the grouped values for display
+    # output - df of the estimated 50th, 90th and 95th percentile cycle times (in hours) and quantities
+
+    groups = {}
+    for key, metrics in alert_metrics.items():
+        name = key[key_index] if names is None else names.get(key[key_index], key[key_index])
+        if name not in groups:
+            groups[name] = AlertMetrics()
+        groups[name].merge(metrics)
+
+    group_names = sorted(groups.keys(), key=str)
+    data = [ [ groups[name].dispositioned_count, 
+               groups[name].percentile(50), 
+               groups[name].percentile(90), 
+               groups[name].percentile(95) ] for name in group_names ]
+
+    return pd.DataFrame(data, index=group_names, columns=[ 'Quantity', '50th', '90th', '95th' ])
+
+
 def add_email_alert_counts_per_event(events):
 
     # given event id and company name ~ get alert count per company
@@ -2647,7 +2546,7 @@ def metrics():
             target_companies.append(row)
 
     alert_df = dispo_stats_df = HOP_df = sla_df = incidents = events = pd.DataFrame()
-    months = query = company_name = company_id = daterange = post_bool = download_results = None
+    company_name = company_id = daterange = post_bool = download_results = None
     selected_companies = [] 
     metric_actions = tables = []
     if request.method == "POST" and request.form['daterange']:
@@ -2672,43 +2571,25 @@ def metrics():
             daterange_end = datetime.datetime.now()
             daterange_start = daterange_end - datetime.timedelta(days=7)
             
-        query = """SELECT DATE_FORMAT(insert_date, '%%Y%%m') AS month, insert_date, disposition,
-            disposition_time, owner_id, owner_time FROM alerts
-            WHERE insert_date BETWEEN %s AND %s AND alert_type!='faqueue'
-            AND alert_type!='dlp - internal threat' AND alert_type!='dlp-exit-alert' 
-            AND disposition IS NOT NULL {}{}"""
-
-        query = query.format(' AND ' if company_ids else '', '( ' + ' OR '.join(['company_id=%s' for x in company_ids]) +')' if company_ids else '')
-
-        with get_db_connection() as db:
-            params = [daterange_start.strftime('%Y-%m-%d %H:%M:%S'),
-                      daterange_end.strftime('%Y-%m-%d %H:%M:%S')]
-            params.extend(company_ids)
-            alert_df = pd.read_sql_query(query, db, params=params)
-
-        # go ahead and drop the dispositions we don't care about
-        alert_df = alert_df[alert_df.disposition != 'UNKNOWN']
-        alert_df = alert_df[alert_df.disposition != 'IGNORE']
-        alert_df = alert_df[alert_df.disposition != 'REVIEWED']
+        # the alert metrics come from the rollups maintained by ace update-metrics (see saq.metrics)
+        # hours of operation needs the hourly rollups, everything else can use the daily rollups
+        alert_metrics = get_alert_metrics(daterange_start, daterange_end, company_ids=company_ids,
+                                          excluded_alert_types=[ 'faqueue', 'dlp - internal threat', 'dlp-exit-alert' ],
+                                          excluded_dispositions=[ DISPOSITION_UNKNOWN, DISPOSITION_IGNORE, DISPOSITION_REVIEWED ],
+                                          period=PERIOD_HOUR if 'HoP' in metric_actions else PERIOD_DAY)
 
-        # First, alert quantities by disposition per month
-        alert_df.set_index('month', inplace=True)
-        months = alert_df.index.get_level_values('month').unique()
-        
         # if March 2015 alerts in our results then manually insert alert 
         # for https://wiki.local/display/integral/20150309+ctbCryptoLocker
         # No alert was ever put into ACE for this event
-        if '201503' in months:
+        if any([ key[0].strftime('%Y%m') == '201503' for key in alert_metrics ]):
             insert_date = datetime.datetime(year=2015, month=3, day=9, hour=10, minute=12, second=8)
             #Alert Dwell Time was 4hr, 15mins according to wiki
             disposition_time = insert_date + datetime.timedelta(hours=4, minutes=15)
-            ctbCryptoLocker = pd.DataFrame({ 'insert_date' : insert_date,
-                                             'disposition' : 'DAMAGE',
-                                             'disposition_time' : disposition_time,
-                                             'owner_id' : 4.0,
-                                             'owner_time' : insert_date},
-                                             index=['201503'])
-            alert_df = pd.concat([alert_df, ctbCryptoLocker])
+            ctbCryptoLocker = AlertMetrics()
+            ctbCryptoLocker.add_alert(insert_date, disposition_time)
+            alert_metrics[(insert_date.replace(minute=0, second=0), None, 0, DISPOSITION_DAMAGE, 4)] = ctbCryptoLocker
+
+        alert_df = alert_metrics_to_df(alert_metrics)
 
         # generate and store our tables
         if 'alert_quan' in metric_actions:
@@ -2721,15 +2602,35 @@ def metrics():
                 tables.append(CT_stats_df)
 
         if 'HoP' in metric_actions:
-            HOP_df = Hours_of_Operation(alert_df.copy())
+            HOP_df = Hours_of_Operation(alert_df)
             if not HOP_df.empty:
                 tables.append(HOP_df)
 
         if 'cycle_time' in metric_actions:
-            sla_df = monthly_alert_SLAs(alert_df.copy())
+            sla_df = monthly_alert_SLAs(alert_df)
             if not sla_df.empty:
                 tables.append(sla_df)
 
+        if 'cycle_time_percentiles' in metric_actions:
+            percentiles_df = cycle_time_percentiles(alert_metrics, 1)
+            percentiles_df.name = "Cycle Time Percentiles by Alert Type"
+            if not percentiles_df.empty:
+                tables.append(percentiles_df)
+
+            usernames = { user.id: user.username for user in db.session.query(User) }
+            usernames[0] = 'nobody'
+            percentiles_df = cycle_time_percentiles(alert_metrics, 4, usernames)
+            percentiles_df.name = "Cycle Time Percentiles by Analyst"
+            if not percentiles_df.empty:
+                tables.append(percentiles_df)
+
+            company_names = dict(target_companies)
+            company_names[0] = 'none'
+            percentiles_df = cycle_time_percentiles(alert_metrics, 2, company_names)
+            percentiles_df.name = "Cycle Time Percentiles by Company"
+            if not percentiles_df.empty:
+                tables.append(percentiles_df)
+
         # Make incident and email event tables
         event_query = """SELECT 
                 events.id, 
@@ -2764,11 +2665,11 @@ def metrics():
 
         event_query = event_query.format(' AND ' if company_ids else '', '( ' + ' OR '.join(['company.name=%s' for company in selected_companies]) +') ' if company_ids else '')
 
-        with get_db_connection() as db:
+        with get_db_connection() as dbcon:
             params = [daterange_start.strftime('%Y-%m-%d %H:%M:%S'),
                       daterange_end.strftime('%Y-%m-%d %H:%M:%S')]
             params.extend(selected_companies)
-            events = pd.read_sql_query(event_query, db, params=params)
+            events = pd.read_sql_query(event_query, dbcon, params=params)
 
         events.set_index('Date', inplace=True)
 
@@ -3758,17 +3659,24 @@ def download_archive():
         hostname = row[0]
         logging.info("got hostname {} for md5 {}".format(hostname, md5))
 
-    root_archive_path = saq.CONFIG['analysis_module_email_archiver']['archive_dir']
-    archive_path = os.path.join(root_archive_path, hostname, md5[0:3], '{}.gz.gpg'.format(md5))
-    full_path = os.path.join(SAQ_HOME, archive_path)
+    root_archive_path = os.path.join(saq.DATA_DIR, saq.CONFIG['analysis_module_email_archiver']['archive_dir'])
+    full_path = find_archive_path(root_archive_path, hostname, md5)
 
-    if not os.path.exists(full_path):
-        logging.error("archive path {} does not exist".format(full_path))
+    if full_path is None:
+        logging.error("archive {} does not exist in {}".format(md5, root_archive_path))
         #flash("archive path {} does not exist".format(archive_path))
         return redirect(url_for('analysis.index'))
 
-    logging.info("user {} downloaded email archive {}".format(current_user, archive_path))
-    return send_from_directory(os.path.dirname(full_path), os.path.basename(full_path), as_attachment=True)
+    logging.info("user {} downloaded email archive {}".format(current_user, full_path))
+
+    # without the decryption password all we can do is hand over the encrypted file
+    if not saq.ENCRYPTION_PASSWORD:
+        return send_from_directory(os.path.dirname(full_path), os.path.basename(full_path), as_attachment=True)
+
+    # otherwise the email is decrypted and decompressed as it is sent
+    response = Response(stream_with_context(read_archive(full_path)), mimetype='message/rfc822')
+    response.headers['Content-Disposition'] = 'attachment; filename={}.rfc822'.format(md5.lower())
+    return response
 
 @analysis.route('/image', methods=['GET'])
 @login_required
@@ -3780,7 +3688,7 @@ def image():
     alert.load()
     _file = alert.get_observable(observable_uuid)
 
-    with open(_file.path, 'rb') as fp:
+    with open_storage_file(os.path.join(SAQ_HOME, alert.storage_dir), _file.value, 'rb') as fp:
         result = fp.read()
 
     response = make_response(result)
@@ -3878,25 +3786,14 @@ def remediate_emails():
     for db_name in archive_ids.keys():
         with get_db_connection(db_name) as db:
             c = db.cursor()
-            c.execute("""SELECT archive_id, field, value FROM archive_search 
-                         WHERE ( field = 'message_id' OR field = 'env_to' OR field = 'body_to' ) 
-                         AND archive_id IN ( {} )""".format(','.join(['%s' for _ in archive_ids[db_name]])), 
+            c.execute("""SELECT archive_id, message_id, env_to, body_to FROM archive_message
+                         WHERE archive_id IN ( {} )""".format(','.join(['%s' for _ in archive_ids[db_name]])), 
                          tuple(archive_ids[db_name]))
 
-            for row in c:
-                archive_id, field, value = row
-                if archive_id not in targets:
-                    targets[archive_id] = EmailRemediationTarget(archive_id=archive_id)
-
-                if field == 'message_id':
-                    targets[archive_id].message_id = value.decode(errors='ignore')
-
-                if field == 'env_to':
-                    targets[archive_id].recipient = value.decode(errors='ignore')
-
+            for archive_id, message_id, env_to, body_to in c:
                 # use body_to field as recipient if there is no env_to field
-                if field == 'body_to' and targets[archive_id].recipient is None:
-                    targets[archive_id].recipient = value.decode(errors='ignore')
+                targets[archive_id] = EmailRemediationTarget(archive_id=archive_id, message_id=message_id,
+                                                             recipient=env_to if env_to is not None else body_to)
 
     # targets acquired -- perform the remediation or restoration
     params = [ ] # of tuples of ( message-id, email_address )
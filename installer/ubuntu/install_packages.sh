@@ -28,6 +28,7 @@ apt-get -y install \
     libxml2-dev libxslt1-dev \
     libyaml-dev \
     ssdeep \
+    libfuzzy-dev \
     python-pip \
     python3-pip \
 	poppler-utils \
@@ -0,0 +1,231 @@
+# vim: sw=4:ts=4:et
+#
+# full text search index of alert content
+#
+# the gui search used to run find on the storage directory of every alert in the date range and grep on
+# every file it found, so the time it took grew with the number of alerts in the date range
+#
+# instead the content of the data.json file and the analysis details (.ace/*.json) of each alert is kept in
+# a local sqlite FTS5 index (one row per file) that is updated as alerts are saved
+# - Alert.sync indexes every file of an alert the first time it is synced
+# - RootAnalysis.save updates the rows for the files it wrote if the alert is already in the index
+#
+# searches are substring searches (the trigram tokenizer) and are case insensitive
+# if the sqlite library is too old to have the trigram tokenizer then the default tokenizer is used
+# and searches match whole words instead
+#
+# the uuid and path columns of the FTS table are not indexed so alert_files maps (uuid, path) to the rowid of
+# the content in alert_content, which is what updates and deletes go through
+#
+# existing alerts can be added with ace index-alerts
+#
+
+import logging
+import os
+import os.path
+import sqlite3
+
+import saq
+from saq.error import report_exception
+
+__all__ = [
+    'AlertSearchIndex',
+    'get_alert_search_index',
+    'index_alert',
+    'reindex_alert',
+    'remove_alert',
+    'update_alert',
+]
+
+# the path of the main alert file in the index (the rest are .ace/<details file>)
+DATA_PATH = 'data.json'
+
+class AlertSearchIndex(object):
+    """A local sqlite FTS5 index of the content of alerts."""
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        # connections are not shared across processes
+        self._pid = None
+        self.trigram = True
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._pid = os.getpid()
+            # engine workers and the gui all use the same index
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self.initialize()
+
+        return self._connection
+
+    def initialize(self):
+        try:
+            self._connection.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS alert_content
+                                        USING fts5(uuid UNINDEXED, path UNINDEXED, content, tokenize='trigram')""")
+        except sqlite3.OperationalError as e:
+            logging.warning("trigram tokenizer not available ({}): alert searches match whole words".format(e))
+            self._connection.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS alert_content
+                                        USING fts5(uuid UNINDEXED, path UNINDEXED, content)""")
+
+        # an existing index keeps the tokenizer it was created with
+        sql = self._connection.execute("SELECT sql FROM sqlite_master WHERE name = 'alert_content'").fetchone()[0]
+        self.trigram = 'trigram' in sql
+
+        existing = self._connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'alert_files'").fetchone()
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS alert_files (
+                                        uuid TEXT NOT NULL,
+                                        path TEXT NOT NULL,
+                                        content_id INTEGER NOT NULL,
+                                        PRIMARY KEY ( uuid, path ) ) WITHOUT ROWID""")
+
+        # indexes created before alert_files existed
+        if existing is None:
+            self._connection.execute("""INSERT OR REPLACE INTO alert_files ( uuid, path, content_id )
+                                        SELECT uuid, path, rowid FROM alert_content""")
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def is_indexed(self, uuid):
+        """Returns True if the given alert is in the index."""
+        return self.connection.execute("SELECT 1 FROM alert_files WHERE uuid = ? AND path = ?",
+                                       (uuid, DATA_PATH)).fetchone() is not None
+
+    def update(self, uuid, storage_dir, paths):
+        """Replaces the indexed content of the given files (relative to storage_dir) of the given alert."""
+        documents = []
+        for path in paths:
+            try:
+                with open(os.path.join(storage_dir, path), 'r', errors='ignore') as fp:
+                    documents.append(( uuid, path, fp.read() ))
+            except FileNotFoundError:
+                continue
+
+        connection = self.connection
+        connection.execute('BEGIN')
+        try:
+            for path in paths:
+                row = connection.execute("SELECT content_id FROM alert_files WHERE uuid = ? AND path = ?",
+                                         (uuid, path)).fetchone()
+                if row is not None:
+                    connection.execute("DELETE FROM alert_content WHERE rowid = ?", row)
+                    connection.execute("DELETE FROM alert_files WHERE uuid = ? AND path = ?", (uuid, path))
+
+            for document in documents:
+                content_id = connection.execute("INSERT INTO alert_content ( uuid, path, content ) VALUES ( ?, ?, ? )",
+                                                document).lastrowid
+                connection.execute("INSERT INTO alert_files ( uuid, path, content_id ) VALUES ( ?, ?, ? )",
+                                   (document[0], document[1], content_id))
+
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def index(self, uuid, storage_dir):
+        """Indexes (or re-indexes) every file of the given alert."""
+        self.remove(uuid)
+        paths = [ DATA_PATH ]
+        details_dir = os.path.join(storage_dir, '.ace')
+        if os.path.isdir(details_dir):
+            paths.extend([ os.path.join('.ace', file_name) for file_name in sorted(os.listdir(details_dir))
+                           if file_name.endswith('.json') ])
+
+        self.update(uuid, storage_dir, paths)
+
+    def remove(self, uuid):
+        """Removes the given alert from the index."""
+        connection = self.connection
+        connection.execute('BEGIN')
+        try:
+            connection.execute("""DELETE FROM alert_content WHERE rowid IN (
+                                  SELECT content_id FROM alert_files WHERE uuid = ? )""", (uuid,))
+            connection.execute("DELETE FROM alert_files WHERE uuid = ?", (uuid,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def clear(self):
+        """Removes every alert from the index."""
+        self.connection.execute("DELETE FROM alert_content")
+        self.connection.execute("DELETE FROM alert_files")
+
+    def search(self, query, details=False):
+        """Returns the set of uuids of the alerts that contain the given text.
+           Only the data.json files are searched unless details is True."""
+        sql = "SELECT DISTINCT uuid FROM alert_content WHERE "
+        if self.trigram and len(query) < 3:
+            # trigrams can't match anything shorter than three characters
+            sql += "instr(lower(content), lower(?)) > 0"
+            params = [ query ]
+        else:
+            # a quoted string is a phrase (substring with the trigram tokenizer)
+            sql += "alert_content MATCH ?"
+            params = [ '"{}"'.format(query.replace('"', '""')) ]
+
+        if not details:
+            sql += " AND path = ?"
+            params.append(DATA_PATH)
+
+        return set([ row[0] for row in self.connection.execute(sql, params) ])
+
+_index = None
+
+def get_alert_search_index():
+    """Returns the AlertSearchIndex for this node, or None if [alert_search] is not enabled."""
+    global _index
+    if not saq.CONFIG['alert_search'].getboolean('enabled'):
+        return None
+
+    path = os.path.join(saq.DATA_DIR, saq.CONFIG['alert_search']['index_path'])
+    if _index is None or _index.path != path:
+        _index = AlertSearchIndex(path)
+
+    return _index
+
+def index_alert(alert):
+    """Adds the given alert to the index if it isn't already in it."""
+    try:
+        index = get_alert_search_index()
+        if index is not None and not index.is_indexed(alert.uuid):
+            index.index(alert.uuid, os.path.join(saq.SAQ_RELATIVE_DIR, alert.storage_dir))
+    except Exception as e:
+        logging.error("unable to index {}: {}".format(alert, e))
+        report_exception()
+
+def update_alert(root, paths):
+    """Updates the indexed content of the given files (relative to the storage directory) if the root is an indexed alert."""
+    try:
+        index = get_alert_search_index()
+        if index is not None and index.is_indexed(root.uuid):
+            index.update(root.uuid, os.path.join(saq.SAQ_RELATIVE_DIR, root.storage_dir), paths)
+    except Exception as e:
+        logging.error("unable to update the search index for {}: {}".format(root, e))
+        report_exception()
+
+def reindex_alert(uuid, storage_dir):
+    """Re-indexes every file of the given alert (by uuid) if it is already in the index."""
+    try:
+        index = get_alert_search_index()
+        if index is not None and index.is_indexed(uuid):
+            index.index(uuid, storage_dir)
+    except Exception as e:
+        logging.error("unable to re-index {}: {}".format(uuid, e))
+        report_exception()
+
+def remove_alert(uuid):
+    """Removes the given alert (by uuid) from the index."""
+    try:
+        index = get_alert_search_index()
+        if index is not None:
+            index.remove(uuid)
+    except Exception as e:
+        logging.error("unable to remove {} from the search index: {}".format(uuid, e))
+        report_exception()
@@ -22,6 +22,8 @@ import dateutil.parser
 import requests
 
 import saq
+from saq.alert_search import update_alert
+from saq.cold_storage import is_packed, unpack_storage_dir, open_storage_file, storage_file_exists, storage_file_size
 from saq.constants import *
 from saq.error import report_exception
 from saq.util import *
@@ -506,10 +508,10 @@ class Analysis(TaggableObject, DetectableObject):
         self._is_modified = True # tells ACE to save the details
 
     def save(self):
-        """Saves the current results of the Analysis to disk."""
+        """Saves the current results of the Analysis to disk. Returns True if the details were written, False otherwise."""
 
         if not self._is_modified:
-            return
+            return False
 
         # the only thing we actually save is the self.details object
         # which much be serializable to JSON
@@ -517,7 +519,7 @@ class Analysis(TaggableObject, DetectableObject):
         # do we not have anything to save?
         if not self.external_details_loaded and self._details is None:
             #logging.debug("called save() on analysis {} but nothing to save".format(self))
-            return
+            return False
 
         if self.storage_dir is None:
             raise RuntimeError("storage_dir is None for {} in {}".format(self, self.root))
@@ -561,6 +563,7 @@ class Analysis(TaggableObject, DetectableObject):
 
         # at this point we consider the data "loaded"
         self.external_details_loaded = True
+        return True
 
     def flush(self):
         """Calls save() and then clears the details property.  It must be load()ed again."""
@@ -640,17 +643,21 @@ class Analysis(TaggableObject, DetectableObject):
             return None
 
         self._details = None
-        details_file_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace', self.external_details_path)
+        storage_dir = os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir)
+        details_path = os.path.join('.ace', self.external_details_path)
+        details_file_path = os.path.join(storage_dir, details_path)
 
-        if not os.path.exists(details_file_path):
+        # (the details of alerts in cold storage are read from the container)
+        if not storage_file_exists(storage_dir, details_path):
             logging.warning("missing file {0}".format(details_file_path))
             return None
 
-        if os.path.getsize(details_file_path) > 1024 * 1024:
-            logging.debug("JSON file {0} is very large: {1} bytes".format(details_file_path, os.path.getsize(details_file_path)))
+        if storage_file_size(storage_dir, details_path) > 1024 * 1024:
+            logging.debug("JSON file {0} is very large: {1} bytes".format(details_file_path, 
+                          storage_file_size(storage_dir, details_path)))
 
         try:
-            with open(details_file_path, 'r') as fp:
+            with open_storage_file(storage_dir, details_path) as fp:
                 self._details = json.load(fp)
 
             _track_reads()
@@ -2749,17 +2756,25 @@ class RootAnalysis(Analysis):
         if not os.path.exists(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir)):
             os.makedirs(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir))
 
+        # alerts in cold storage are unpacked when they change
+        if is_packed(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir)):
+            unpack_storage_dir(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir))
+
         # analysis details go into a hidden directory
         if not os.path.exists(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace')):
             os.makedirs(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace'))
 
         # save all analysis
+        # (keeping track of the details files that were written for the alert search index)
+        saved_paths = []
         for analysis in self.all_analysis:
             if analysis is not self:
-                analysis.save()
+                if analysis.save():
+                    saved_paths.append(os.path.join('.ace', analysis.external_details_path))
 
         # save our own details
-        Analysis.save(self)
+        if Analysis.save(self):
+            saved_paths.append(os.path.join('.ace', self.external_details_path))
 
         # now the rest should encode as JSON with the custom JSON encoder
         try:
@@ -2775,6 +2790,8 @@ class RootAnalysis(Analysis):
             report_exception()
             return False
 
+        saved_paths.append(os.path.basename(self.json_path))
+        update_alert(self, saved_paths)
         return True
 
     def load(self):
@@ -2786,7 +2803,8 @@ class RootAnalysis(Analysis):
             logging.warning("alert {} already loaded".format(self))
 
         try:
-            with open(self.json_path, 'r') as fp:
+            # (alerts in cold storage are read from the container)
+            with open_storage_file(os.path.dirname(self.json_path), os.path.basename(self.json_path)) as fp:
                 self.json = json.load(fp)
 
             _track_reads()
@@ -0,0 +1,472 @@
+# vim: sw=4:ts=4:et
+#
+# content-addressed cache of file analysis results
+#
+# analysis modules that opt in (cache_results = yes in the module configuration) store the result of
+# analyzing a file keyed by (module, module configuration version, sha256 of the file) and the next time
+# the same content shows up the result is rehydrated instead of executing the analysis again
+#
+# layout (relative to [analysis_cache] cache_dir)
+# <config_section>/<config_version>/<sha256[0:2]>/<sha256>/result.json
+# <config_section>/<config_version>/<sha256[0:2]>/<sha256>/files/<index>  (copies of extracted files)
+#
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import time
+
+import saq
+from saq.analysis import _JSONEncoder
+from saq.constants import *
+from saq.error import report_exception
+
+__all__ = [
+    'AnalysisResultCache',
+    'get_config_version',
+]
+
+# the file observable values of extracted files are stored relative to the analyzed file when possible
+# so that they can be put in the right place when the result is used for a file with a different name
+PATH_TARGET = '{target}'
+PATH_TARGET_DIR = '{target_dir}'
+
+# references to the target observable in relationships and redirections
+REF_TARGET = 'target'
+
+KEY_DETAILS = 'details'
+KEY_TAGS = 'tags'
+KEY_DIRECTIVES = 'directives'
+KEY_DETECTIONS = 'detections'
+KEY_TARGET = 'target'
+KEY_OBSERVABLES = 'observables'
+KEY_TYPE = 'type'
+KEY_VALUE = 'value'
+KEY_TIME = 'time'
+KEY_FILE = 'file'
+KEY_REDIRECTION = 'redirection'
+KEY_RELATIONSHIPS = 'relationships'
+KEY_LIMITED_ANALYSIS = 'limited_analysis'
+KEY_EXCLUDED_ANALYSIS = 'excluded_analysis'
+
+def get_config_version(analysis_module):
+    """Returns a hash of the configuration of the given analysis module, including its result_cache_version."""
+    h = hashlib.sha256()
+    for key, value in sorted(analysis_module.config.items()):
+        h.update('{}={}\n'.format(key, value).encode('utf8', errors='ignore'))
+
+    version = analysis_module.result_cache_version
+    if version is not None:
+        h.update('version={}\n'.format(version).encode('utf8', errors='ignore'))
+
+    return h.hexdigest()[:16]
+
+class _TargetSnapshot(object):
+    """The state of the target observable before analysis so we can tell what the analysis changed."""
+    def __init__(self, observable):
+        self.tags = set([t.name for t in observable.tags])
+        self.directives = list(observable.directives)
+        self.detection_count = len(observable.detections)
+
+class AnalysisResultCache(object):
+    """Stores and rehydrates the results of an analysis module for F_FILE observables."""
+
+    def __init__(self, analysis_module):
+        self.analysis_module = analysis_module
+        # the configuration version is checked again every check_watched_files_frequency seconds
+        # so that changes to the configuration (or whatever result_cache_version depends on) are picked up
+        self._config_version = None
+        self.next_version_check = None
+
+        config = saq.CONFIG['analysis_cache']
+        self.cache_dir = os.path.join(saq.DATA_DIR, config['cache_dir'])
+        self.ttl = analysis_module.config.getint('cache_ttl', fallback=config.getint('ttl'))
+        self.max_entry_size = config.getint('max_entry_size_mb') * 1024 * 1024
+        self.max_size = config.getint('max_size_mb') * 1024 * 1024
+        self.prune_frequency = config.getint('prune_frequency')
+        self.next_prune = time.time() + self.prune_frequency
+
+        # hit rate counters for this process
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+
+    @property
+    def config_version(self):
+        if self._config_version is None or time.time() >= self.next_version_check:
+            self.refresh_config_version()
+
+        return self._config_version
+
+    def refresh_config_version(self):
+        """Recomputes the configuration version used to key cached results."""
+        config_version = get_config_version(self.analysis_module)
+        if self._config_version is not None and config_version != self._config_version:
+            logging.info("configuration version of {} changed from {} to {}".format(
+                         self.analysis_module.config_section, self._config_version, config_version))
+
+        self._config_version = config_version
+        self.next_version_check = time.time() + saq.CONFIG['global'].getint('check_watched_files_frequency')
+
+    @property
+    def module_dir(self):
+        return os.path.join(self.cache_dir, self.analysis_module.config_section)
+
+    @property
+    def version_dir(self):
+        return os.path.join(self.module_dir, self.config_version)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return (self.hits / total) if total else 0.0
+
+    def entry_dir(self, sha256):
+        return os.path.join(self.version_dir, sha256[0:2], sha256)
+
+    def snapshot(self, observable):
+        """Call before executing analysis. Returns an object to pass to store()."""
+        return _TargetSnapshot(observable)
+
+    def load(self, observable):
+        """Rehydrates the cached analysis for the given F_FILE observable. Returns True if a cached result was used."""
+        sha256 = observable.sha256_hash
+        if sha256 is None:
+            return False
+
+        entry_dir = self.entry_dir(sha256)
+        result_path = os.path.join(entry_dir, 'result.json')
+
+        try:
+            if time.time() - os.path.getmtime(result_path) > self.ttl:
+                logging.debug("cached result {} expired".format(entry_dir))
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                self.misses += 1
+                return False
+
+            with open(result_path, 'r') as fp:
+                entry = json.load(fp)
+
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        except Exception as e:
+            logging.warning("unable to load cached result {}: {}".format(entry_dir, e))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            self.errors += 1
+            self.misses += 1
+            return False
+
+        try:
+            self._rehydrate(observable, entry, entry_dir)
+        except Exception as e:
+            logging.error("unable to rehydrate cached result {} for {}: {}".format(entry_dir, observable, e))
+            report_exception()
+            self.errors += 1
+            self.misses += 1
+            # the analysis is executed normally after this so get rid of anything we partially added
+            analysis = observable.get_analysis(self.analysis_module.generated_analysis_type)
+            if analysis is not None:
+                analysis.clear_observables()
+                observable.analysis.pop(analysis.module_path, None)
+            return False
+
+        logging.debug("used cached result from {} for {} sha256 {}".format(self.analysis_module, observable, sha256))
+        self.hits += 1
+        return True
+
+    def _resolve_path(self, target, value):
+        """Returns the path relative to the storage directory of the root for a cached file observable value."""
+        if value.startswith(PATH_TARGET):
+            return target.value + value[len(PATH_TARGET):]
+        if value.startswith(PATH_TARGET_DIR):
+            return os.path.join(os.path.dirname(target.value), value[len(PATH_TARGET_DIR):].lstrip('/'))
+        return value
+
+    def _encode_path(self, target, value):
+        if value.startswith(target.value + '.') or value.startswith(target.value + '/'):
+            return PATH_TARGET + value[len(target.value):]
+        target_dir = os.path.dirname(target.value)
+        if target_dir and value.startswith(target_dir + '/'):
+            return PATH_TARGET_DIR + value[len(target_dir):]
+        return value
+
+    def _rehydrate(self, target, entry, entry_dir):
+        root = self.analysis_module.root
+        storage_dir = os.path.realpath(root.storage_dir)
+
+        # put the files back first so nothing is added if a file is missing
+        paths = []
+        for o_json in entry[KEY_OBSERVABLES]:
+            if o_json[KEY_FILE] is None:
+                paths.append(None)
+                continue
+
+            path = self._resolve_path(target, o_json[KEY_VALUE])
+            dest_path = os.path.realpath(os.path.join(storage_dir, path))
+            if not dest_path.startswith(storage_dir + os.sep):
+                raise ValueError("cached file path {} is outside of {}".format(path, storage_dir))
+
+            if not os.path.exists(dest_path):
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                shutil.copy(os.path.join(entry_dir, o_json[KEY_FILE]), dest_path)
+
+            paths.append(path)
+
+        analysis = self.analysis_module.create_analysis(target)
+        analysis.details = entry[KEY_DETAILS]
+        for tag in entry[KEY_TAGS]:
+            analysis.add_tag(tag)
+        for dp in entry[KEY_DETECTIONS]:
+            analysis.add_detection_point(dp['description'], dp['details'])
+
+        observables = []
+        for o_json, path in zip(entry[KEY_OBSERVABLES], paths):
+            observable = analysis.add_observable(o_json[KEY_TYPE],
+                                                 path if path is not None else o_json[KEY_VALUE],
+                                                 o_json[KEY_TIME])
+            observables.append(observable)
+            if observable is None:
+                continue
+
+            for tag in o_json[KEY_TAGS]:
+                observable.add_tag(tag)
+            for directive in o_json[KEY_DIRECTIVES]:
+                observable.add_directive(directive)
+            for dp in o_json[KEY_DETECTIONS]:
+                observable.add_detection_point(dp['description'], dp['details'])
+            for module_name in o_json[KEY_LIMITED_ANALYSIS]:
+                if module_name not in observable.limited_analysis:
+                    observable.limit_analysis(module_name)
+            for name in o_json[KEY_EXCLUDED_ANALYSIS]:
+                if name not in observable.excluded_analysis:
+                    observable.excluded_analysis.append(name)
+
+        def _reference(ref):
+            if ref == REF_TARGET:
+                return target
+            return observables[ref]
+
+        # relationships and redirections can point to any of the observables so do them last
+        for o_json, observable in zip(entry[KEY_OBSERVABLES], observables):
+            if observable is None:
+                continue
+
+            for r_type, ref in o_json[KEY_RELATIONSHIPS]:
+                if _reference(ref) is not None:
+                    observable.add_relationship(r_type, _reference(ref))
+            if o_json[KEY_REDIRECTION] is not None and _reference(o_json[KEY_REDIRECTION]) is not None:
+                observable.redirection = _reference(o_json[KEY_REDIRECTION])
+
+        # and then whatever the analysis did to the file itself
+        for tag in entry[KEY_TARGET][KEY_TAGS]:
+            target.add_tag(tag)
+        for directive in entry[KEY_TARGET][KEY_DIRECTIVES]:
+            target.add_directive(directive)
+        for dp in entry[KEY_TARGET][KEY_DETECTIONS]:
+            target.add_detection_point(dp['description'], dp['details'])
+
+    def store(self, target, snapshot):
+        """Stores the analysis the module just generated for the given F_FILE observable."""
+        try:
+            self._store(target, snapshot)
+        except Exception as e:
+            logging.error("unable to store cached result for {} by {}: {}".format(target, self.analysis_module, e))
+            report_exception()
+            self.errors += 1
+
+        if time.time() >= self.next_prune:
+            self.next_prune = time.time() + self.prune_frequency
+            self.prune()
+
+    def _store(self, target, snapshot):
+        sha256 = target.sha256_hash
+        if sha256 is None:
+            return
+
+        analysis = target.get_analysis(self.analysis_module.generated_analysis_type)
+        if not analysis or analysis.delayed:
+            return
+
+        entry_dir = self.entry_dir(sha256)
+        if os.path.exists(entry_dir):
+            return
+
+        observables = analysis.observables
+        def _reference(observable):
+            if observable is target:
+                return REF_TARGET
+            if observable in observables:
+                return observables.index(observable)
+            return None
+
+        files = [] # [(source_path, cache_file_name)]
+        entry_size = 0
+        o_list = []
+        for index, observable in enumerate(observables):
+            o_json = {
+                KEY_TYPE: observable.type,
+                KEY_VALUE: observable.value,
+                KEY_TIME: observable.time,
+                KEY_FILE: None,
+                KEY_TAGS: [t.name for t in observable.tags],
+                KEY_DIRECTIVES: list(observable.directives),
+                KEY_DETECTIONS: [dp.json for dp in observable.detections],
+                KEY_LIMITED_ANALYSIS: list(observable.limited_analysis),
+                KEY_EXCLUDED_ANALYSIS: list(observable.excluded_analysis),
+                KEY_RELATIONSHIPS: [],
+                KEY_REDIRECTION: None,
+            }
+
+            for r in observable.relationships:
+                ref = _reference(r.target)
+                if ref is not None:
+                    o_json[KEY_RELATIONSHIPS].append([r.r_type, ref])
+
+            if observable.redirection is not None:
+                o_json[KEY_REDIRECTION] = _reference(observable.redirection)
+
+            if observable.type == F_FILE:
+                source_path = os.path.join(self.analysis_module.root.storage_dir, observable.value)
+                if not os.path.isfile(source_path):
+                    logging.debug("not caching result for {}: missing file {}".format(target, source_path))
+                    return
+
+                entry_size += os.path.getsize(source_path)
+                o_json[KEY_VALUE] = self._encode_path(target, observable.value)
+                o_json[KEY_FILE] = os.path.join('files', str(index))
+                files.append((source_path, o_json[KEY_FILE]))
+
+            o_list.append(o_json)
+
+        if entry_size > self.max_entry_size:
+            logging.debug("not caching result for {}: size {} exceeds max_entry_size_mb".format(target, entry_size))
+            return
+
+        entry = {
+            KEY_DETAILS: analysis.details,
+            KEY_TAGS: [t.name for t in analysis.tags],
+            KEY_DETECTIONS: [dp.json for dp in analysis.detections],
+            KEY_TARGET: {
+                KEY_TAGS: [t.name for t in target.tags if t.name not in snapshot.tags],
+                KEY_DIRECTIVES: [d for d in target.directives if d not in snapshot.directives],
+                KEY_DETECTIONS: [dp.json for dp in target.detections[snapshot.detection_count:]],
+            },
+            KEY_OBSERVABLES: o_list,
+        }
+
+        # build the entry somewhere else and then move it into place
+        temp_dir = '{}.{}.tmp'.format(entry_dir, os.getpid())
+        try:
+            os.makedirs(os.path.join(temp_dir, 'files'))
+            for source_path, cache_file_name in files:
+                shutil.copy(source_path, os.path.join(temp_dir, cache_file_name))
+
+            with open(os.path.join(temp_dir, 'result.json'), 'w') as fp:
+                json.dump(entry, fp, cls=_JSONEncoder)
+
+            try:
+                os.rename(temp_dir, entry_dir)
+            except OSError:
+                # some other process stored it first
+                pass
+
+        finally:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+        logging.debug("stored cached result for {} sha256 {} by {}".format(target, sha256, self.analysis_module))
+        self.stores += 1
+
+    def prune(self):
+        """Removes expired entries and entries from older configuration versions, then the oldest entries
+           until the cache is under max_size_mb. Only one process prunes at a time."""
+
+        logging.info("analysis cache {} hits {} misses {} stores {} errors {} hit rate {:.2f}%".format(
+                     self.analysis_module.config_section, self.hits, self.misses, self.stores, self.errors,
+                     self.hit_rate * 100.0))
+
+        if not os.path.isdir(self.module_dir):
+            return
+
+        with open(os.path.join(self.module_dir, '.prune.lock'), 'a') as lock_fp:
+            try:
+                fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            try:
+                self._prune()
+            finally:
+                fcntl.flock(lock_fp.fileno(), fcntl.LOCK_UN)
+
+    def _last_modified(self, version_dir):
+        """Returns the last time an entry was added to the given version directory."""
+        result = os.path.getmtime(version_dir)
+        for prefix in os.listdir(version_dir):
+            result = max(result, os.path.getmtime(os.path.join(version_dir, prefix)))
+
+        return result
+
+    def _prune(self):
+        now = time.time()
+        config_version = self.config_version
+        for version in os.listdir(self.module_dir):
+            version_dir = os.path.join(self.module_dir, version)
+            if version == config_version or not os.path.isdir(version_dir):
+                continue
+
+            # other workers may still be using (or already be using) a different version
+            # so only versions nothing has been added to for longer than the ttl are removed
+            try:
+                if now - self._last_modified(version_dir) <= self.ttl:
+                    continue
+            except OSError:
+                continue
+
+            logging.info("removing cached results for old configuration version {} of {}".format(
+                         version, self.analysis_module.config_section))
+            shutil.rmtree(version_dir, ignore_errors=True)
+
+        entries = [] # [(mtime, size, entry_dir)]
+        total_size = 0
+        version_dir = os.path.join(self.module_dir, config_version)
+        if not os.path.isdir(version_dir):
+            return
+
+        for prefix in os.listdir(version_dir):
+            prefix_dir = os.path.join(version_dir, prefix)
+            for sha256 in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, sha256)
+                try:
+                    mtime = os.path.getmtime(os.path.join(entry_dir, 'result.json'))
+                except OSError:
+                    # an entry still being built (or broken)
+                    continue
+
+                if now - mtime > self.ttl:
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    continue
+
+                size = 0
+                for dir_path, dir_names, file_names in os.walk(entry_dir):
+                    for file_name in file_names:
+                        try:
+                            size += os.path.getsize(os.path.join(dir_path, file_name))
+                        except OSError:
+                            pass
+
+                entries.append((mtime, size, entry_dir))
+                total_size += size
+
+        # remove the oldest first
+        entries.sort()
+        while entries and total_size > self.max_size:
+            mtime, size, entry_dir = entries.pop(0)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
@@ -5,7 +5,10 @@
 import csv
 import datetime
 import logging
+import os
 import os.path
+import sqlite3
+import time
 
 import saq
 from saq.database import execute_with_retry, use_db
@@ -55,6 +58,145 @@ def query_brocess_by_source_email(source_email_address, db, c):
 
     raise RuntimeError("failed to return a row for sum() query operation !?")
 
+# the most addresses (or conversations) looked up in a single query
+BATCH_SIZE = 500
+
+def _decode_address(value):
+    # the smtplog columns are varbinary
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', errors='replace')
+
+    return value
+
+@use_db(name='brocess')
+def query_brocess_by_email_conversations(conversations, db, c):
+    """Looks up the counts for a list of (source_email_address, dest_email_address) tuples in as few queries as possible.
+       Returns a tuple of (source_counts, conversation_counts) where source_counts is keyed by source and
+       conversation_counts by (source, dest). Conversations with a source that has never been seen are not looked up.
+       NOTE the smtplog columns are varbinary so addresses are matched as they are (case sensitive.)"""
+    sources = sorted(set([ source for source, dest in conversations ]))
+    source_counts = { source: 0 for source in sources }
+    for index in range(0, len(sources), BATCH_SIZE):
+        batch = sources[index:index + BATCH_SIZE]
+        c.execute('SELECT source, SUM(numconnections) FROM smtplog WHERE source IN ( {} ) GROUP BY source'.format(
+                  ','.join([ '%s' ] * len(batch))), tuple(batch))
+        for source, count in c:
+            source_counts[_decode_address(source)] += int(count) if count is not None else 0
+
+    conversations = sorted(set([ ( source, dest ) for source, dest in conversations if source_counts[source] ]))
+    conversation_counts = { conversation: 0 for conversation in conversations }
+    for index in range(0, len(conversations), BATCH_SIZE):
+        batch = conversations[index:index + BATCH_SIZE]
+        c.execute('SELECT source, destination, SUM(numconnections) FROM smtplog '
+                  'WHERE ( source, destination ) IN ( {} ) GROUP BY source, destination'.format(
+                  ','.join([ '( %s, %s )' ] * len(batch))), tuple([ value for pair in batch for value in pair ]))
+        for source, dest, count in c:
+            conversation_counts[(_decode_address(source), _decode_address(dest))] += int(count) if count is not None else 0
+
+    return source_counts, conversation_counts
+
+class BrocessCountCache(object):
+    """A local sqlite cache of brocess counts shared by every process on the node."""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        # how long (in seconds) a count is used
+        self.ttl = ttl
+        self._connection = None
+        # connections are not shared across processes
+        self._pid = None
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._pid = os.getpid()
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS counts ( 
+                                        key TEXT PRIMARY KEY, count INTEGER NOT NULL, insert_time REAL NOT NULL )""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS idx_insert_time ON counts ( insert_time )")
+
+        return self._connection
+
+    def get(self, keys):
+        """Returns a dict of the counts of the given keys that are in the cache and have not expired."""
+        result = {}
+        keys = list(keys)
+        for index in range(0, len(keys), BATCH_SIZE):
+            batch = keys[index:index + BATCH_SIZE]
+            for key, count in self.connection.execute(
+                    "SELECT key, count FROM counts WHERE insert_time >= ? AND key IN ( {} )".format(
+                    ','.join([ '?' ] * len(batch))), [ time.time() - self.ttl ] + batch):
+                result[key] = count
+
+        return result
+
+    def set(self, counts):
+        """Stores the given dict of counts and removes the ones that have expired."""
+        now = time.time()
+        connection = self.connection
+        connection.execute('BEGIN')
+        try:
+            connection.executemany("INSERT OR REPLACE INTO counts ( key, count, insert_time ) VALUES ( ?, ?, ? )",
+                                   [ ( key, count, now ) for key, count in counts.items() ])
+            connection.execute("DELETE FROM counts WHERE insert_time < ?", ( now - self.ttl, ))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def clear(self):
+        self.connection.execute("DELETE FROM counts")
+
+_count_cache = None
+
+def get_brocess_count_cache():
+    """Returns the BrocessCountCache for this node, or None if [brocess_cache] is not enabled."""
+    global _count_cache
+    config = saq.CONFIG['brocess_cache']
+    if not config.getboolean('enabled'):
+        return None
+
+    path = os.path.join(saq.DATA_DIR, config['cache_path'])
+    if _count_cache is None or _count_cache.path != path:
+        _count_cache = BrocessCountCache(path, config.getint('ttl'))
+
+    return _count_cache
+
+def query_email_conversation_counts(conversations):
+    """Same as query_brocess_by_email_conversations but uses (and updates) the node cache of counts."""
+    cache = get_brocess_count_cache()
+    if cache is None:
+        return query_brocess_by_email_conversations(conversations)
+
+    conversations = set(conversations)
+    source_keys = { source: 'smtp_source:{}'.format(source) for source, dest in conversations }
+    conversation_keys = { conversation: 'smtp_conversation:{}|{}'.format(*conversation) 
+                          for conversation in conversations }
+
+    cached = cache.get(list(source_keys.values()) + list(conversation_keys.values()))
+    source_counts = { source: cached[key] for source, key in source_keys.items() if key in cached }
+    conversation_counts = { conversation: cached[key] for conversation, key in conversation_keys.items() 
+                            if key in cached }
+
+    # the conversations with a source we don't have (or need but don't have the conversation count for)
+    missing = [ ( source, dest ) for source, dest in conversations
+                if source not in source_counts 
+                or ( source_counts[source] and ( source, dest ) not in conversation_counts ) ]
+
+    if missing:
+        logging.debug("looking up {} email conversations in brocess".format(len(missing)))
+        missing_source_counts, missing_conversation_counts = query_brocess_by_email_conversations(missing)
+        source_counts.update(missing_source_counts)
+        conversation_counts.update(missing_conversation_counts)
+        new_counts = { source_keys[source]: count for source, count in missing_source_counts.items() }
+        new_counts.update({ conversation_keys[conversation]: count 
+                            for conversation, count in missing_conversation_counts.items() })
+        cache.set(new_counts)
+
+    return source_counts, conversation_counts
+
 @use_db(name='brocess')
 def add_httplog(fqdn, db, c):
     for fqdn_part in iterate_fqdn_parts(fqdn):
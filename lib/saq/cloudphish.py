@@ -1,12 +1,16 @@
 # vim: sw=4:ts=4:et:cc=120
 # constants used by cloudphish
 
+import atexit
+import collections
 import datetime
 import hashlib
 import json
 import logging
 import os, os.path
 import pickle
+import threading
+import time
 import uuid
 
 from urllib.parse import urlparse
@@ -43,11 +47,15 @@ __all__ = [
     'SCAN_RESULT_CLEAR',
     'SCAN_RESULT_ALERT',
     'SCAN_RESULT_PASS',
+    'CloudphishAnalysisResult',
     'hash_url',
     'get_cached_analysis',
+    'get_cached_analyses',
     'create_analysis',
+    'create_analyses',
     'initialize_url_filter',
     'analyze_url',
+    'analyze_urls',
     'KEY_DETAILS_URL',
     'KEY_DETAILS_SHA256_URL',
     'KEY_DETAILS_ALERTABLE',
@@ -55,6 +63,9 @@ __all__ = [
     'update_cloudphish_result',
     'update_content_metadata',
     'get_content_metadata',
+    'invalidate_cached_result',
+    'clear_result_cache',
+    'flush_url_lookups',
 ]
 
 # json schema
@@ -138,6 +149,9 @@ def update_cloudphish_result(
 
     params.append(sha256_url)
 
+    # whatever we had cached for this url is no longer valid
+    invalidate_cached_result(sha256_url)
+
     sql = "UPDATE cloudphish_analysis_results SET {} WHERE sha256_url = UNHEX(%s)".format(', '.join(sql))
     logging.debug("executing cloudphish update {}".format(sql, params))
     return execute_with_retry(db, c, sql, tuple(params), commit=True)
@@ -214,6 +228,230 @@ class CloudphishAnalysisResult(object):
     def __repr__(self):
         return str(self)
 
+    @staticmethod
+    def from_json(json_data):
+        """Returns a new CloudphishAnalysisResult object from the dict generated by the json() method."""
+        return CloudphishAnalysisResult(json_data[KEY_RESULT],
+                                        json_data[KEY_DETAILS],
+                                        status=json_data[KEY_STATUS],
+                                        analysis_result=json_data[KEY_ANALYSIS_RESULT],
+                                        http_result=json_data[KEY_HTTP_RESULT],
+                                        http_message=json_data[KEY_HTTP_MESSAGE],
+                                        sha256_content=json_data[KEY_SHA256_CONTENT],
+                                        sha256_url=json_data[KEY_SHA256_URL],
+                                        location=json_data[KEY_LOCATION],
+                                        file_name=json_data[KEY_FILE_NAME],
+                                        uuid=json_data[KEY_UUID])
+
+#
+# result cache
+#
+# finalized (STATUS_ANALYZED) results are cached in front of the database so that repeat lookups of popular urls
+# do not need to join the tables, load the RootAnalysis from disk and update the last_lookup time
+#
+# NOTE the local backend is per process so a change made by another process is only seen when the entry expires
+# use the memcached backend if multiple processes answer requests for the same urls
+#
+
+class CloudphishResultCache(object):
+    def __init__(self, enabled=True, backend='local', ttl=300, max_size=10000):
+        self.enabled = enabled
+        self.backend = backend
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # key = sha256_url, value = (expiration_time, json dict)
+        self.local_cache = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+        # lazy loaded memcache.Client object
+        self._memcached_client = None
+
+        # cache statistics
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def memcached_client(self):
+        if self._memcached_client is None:
+            import memcache
+            client_address = saq.CONFIG['memcached']['client_address']
+
+            # see if we are using a unix socket with a relative path
+            if client_address.startswith('unix:'):
+                address = client_address[len('unix:'):]
+                if not os.path.isabs(address):
+                    client_address = 'unix:{}/{}'.format(saq.SAQ_HOME, address)
+
+            self._memcached_client = memcache.Client([client_address], debug=0)
+
+        return self._memcached_client
+
+    def _memcached_key(self, sha256_url):
+        return 'cloudphish:{}'.format(sha256_url.lower())
+
+    def get(self, sha256_url):
+        """Returns the cached CloudphishAnalysisResult for the given url hash, or None if it is not cached."""
+        if not self.enabled:
+            return None
+
+        json_data = None
+
+        if self.backend == 'memcached':
+            try:
+                cached_value = self.memcached_client.get(self._memcached_key(sha256_url))
+                if cached_value:
+                    json_data = json.loads(cached_value)
+            except Exception as e:
+                logging.warning("unable to query memcached for cloudphish result {}: {}".format(sha256_url, e))
+        else:
+            with self.lock:
+                try:
+                    expiration_time, json_data = self.local_cache[sha256_url.lower()]
+                    if time.time() >= expiration_time:
+                        del self.local_cache[sha256_url.lower()]
+                        json_data = None
+                    else:
+                        self.local_cache.move_to_end(sha256_url.lower())
+                except KeyError:
+                    pass
+
+        if json_data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return CloudphishAnalysisResult.from_json(json_data)
+
+    def put(self, result):
+        """Caches the given CloudphishAnalysisResult. Only finalized results are cached."""
+        if not self.enabled:
+            return
+
+        if result.result != RESULT_OK or result.status != STATUS_ANALYZED or not result.sha256_url:
+            return
+
+        # if the analysis could not be loaded then the details are missing (try again next time)
+        if result.details is None:
+            return
+
+        if self.backend == 'memcached':
+            try:
+                self.memcached_client.set(self._memcached_key(result.sha256_url), json.dumps(result.json()), 
+                                          time=self.ttl)
+            except Exception as e:
+                logging.warning("unable to cache cloudphish result {} in memcached: {}".format(result.sha256_url, e))
+
+            return
+
+        with self.lock:
+            self.local_cache[result.sha256_url.lower()] = (time.time() + self.ttl, result.json())
+            self.local_cache.move_to_end(result.sha256_url.lower())
+            while len(self.local_cache) > self.max_size:
+                self.local_cache.popitem(last=False)
+
+    def invalidate(self, sha256_url):
+        """Removes the cached result for the given url hash."""
+        if not self.enabled:
+            return
+
+        if self.backend == 'memcached':
+            try:
+                self.memcached_client.delete(self._memcached_key(sha256_url))
+            except Exception as e:
+                logging.warning("unable to delete cloudphish result {} from memcached: {}".format(sha256_url, e))
+
+            return
+
+        with self.lock:
+            self.local_cache.pop(sha256_url.lower(), None)
+
+    def clear(self):
+        """Clears the local cache and resets the statistics."""
+        with self.lock:
+            self.local_cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+# global result cache (see get_result_cache)
+result_cache = None
+
+def get_result_cache():
+    """Returns the global CloudphishResultCache configured by the [cloudphish] section."""
+    global result_cache
+    if result_cache is None:
+        config = saq.CONFIG['cloudphish']
+        result_cache = CloudphishResultCache(enabled=config.getboolean('result_cache_enabled', fallback=False),
+                                             backend=config.get('result_cache_backend', fallback='local'),
+                                             ttl=config.getint('result_cache_ttl', fallback=300),
+                                             max_size=config.getint('result_cache_size', fallback=10000))
+
+    return result_cache
+
+def invalidate_cached_result(sha256_url):
+    """Removes any cached result for the given url hash. Call this whenever the results for a url change."""
+    get_result_cache().invalidate(sha256_url)
+
+def clear_result_cache():
+    """Clears the cached results and discards any pending last_lookup updates."""
+    global result_cache
+    if result_cache is not None:
+        result_cache.clear()
+
+    # force the configuration to be reloaded the next time the cache is used
+    result_cache = None
+
+    with _pending_lookups_lock:
+        _pending_lookups.clear()
+
+#
+# the last_lookup column of cloudphish_url_lookup is used to clean out urls that are no longer requested
+# it does not need to be exact so the updates are collected and flushed in batches
+#
+
+_pending_lookups = set() # of sha256_url
+_pending_lookups_lock = threading.RLock()
+_last_lookup_flush = time.time()
+
+def _track_url_lookup(sha256_url):
+    """Records a lookup for the given url hash, flushing the pending lookups if needed."""
+    with _pending_lookups_lock:
+        _pending_lookups.add(sha256_url)
+        pending_count = len(_pending_lookups)
+
+    config = saq.CONFIG['cloudphish']
+    if pending_count >= config.getint('lookup_flush_size', fallback=1) \
+    or time.time() - _last_lookup_flush >= config.getint('lookup_flush_interval', fallback=0):
+        flush_url_lookups()
+
+def flush_url_lookups():
+    """Updates the last_lookup time for all of the urls that have been looked up since the last flush."""
+    global _last_lookup_flush
+
+    with _pending_lookups_lock:
+        sha256_urls = list(_pending_lookups)
+        _pending_lookups.clear()
+        _last_lookup_flush = time.time()
+
+    if not sha256_urls:
+        return
+
+    try:
+        _flush_url_lookups(sha256_urls)
+        logging.debug("updated last_lookup for {} urls".format(len(sha256_urls)))
+    except Exception as e:
+        logging.error("unable to update last_lookup for {} urls: {}".format(len(sha256_urls), e))
+        report_exception()
+
+@use_db
+def _flush_url_lookups(sha256_urls, db, c):
+    execute_with_retry(db, c, """UPDATE cloudphish_url_lookup SET last_lookup = NOW() 
+                                 WHERE sha256_url IN ( {} )""".format(','.join(['UNHEX(%s)' for _ in sha256_urls])),
+                       tuple(sha256_urls), commit=True)
+
+# don't lose the updates that are still pending when the process exits
+atexit.register(flush_url_lookups)
+
 def get_cached_analysis(url):
     """Returns the CloudphishAnalysisResult of the cached analysis or None if analysis is not cached."""
     try:
@@ -223,14 +461,39 @@ def get_cached_analysis(url):
         logging.error(message)
         report_exception()
 
-        return CloudphishAnalysisResults(RESULT_ERROR, message)
+        return CloudphishAnalysisResult(RESULT_ERROR, message)
 
-@use_db
-def _get_cached_analysis(url, db, c):
+def _get_cached_analysis(url):
     sha256 = hash_url(url)
 
-    # have we already requested and/or processed this URL before?
+    # finalized results are served from the result cache
+    result = get_result_cache().get(sha256)
+    if result is None:
+        result = _query_cached_analysis(sha256)
+        if result is None:
+            return None
+
+        get_result_cache().put(result)
+
+    # keep track of the most popular URLs
+    # old URLs get cleaned out
+    _track_url_lookup(sha256)
+    return result
+
+def _query_cached_analysis(sha256):
+    return _query_cached_analyses([sha256]).get(sha256)
+
+@use_db
+def _query_cached_analyses(sha256_urls, db, c):
+    """Returns a dict of sha256_url -> CloudphishAnalysisResult for the given url hashes that have been requested 
+       and/or processed before. Url hashes that are unknown are not included."""
+
+    if not sha256_urls:
+        return {}
+
+    # have we already requested and/or processed these URLs before?
     c.execute("""SELECT
+                     LOWER(HEX(ar.sha256_url)),
                      ar.status,
                      ar.result,
                      ar.http_result_code,
@@ -241,11 +504,16 @@ def _get_cached_analysis(url, db, c):
                      ar.uuid
                  FROM cloudphish_analysis_results AS ar
                  LEFT JOIN cloudphish_content_metadata AS cm ON ar.sha256_content = cm.sha256_content
-                 WHERE sha256_url = UNHEX(%s)""", (sha256,))
+                 WHERE sha256_url IN ( {} )""".format(','.join(['UNHEX(%s)' for _ in sha256_urls])), 
+              tuple(sha256_urls))
 
-    row = c.fetchone()
-    if row:
-        status, result, http_result, http_message, sha256_content, node, file_name, uuid = row
+    # the hashes are returned in lower case
+    requested = { _.lower(): _ for _ in sha256_urls }
+
+    results = {}
+    for row in c.fetchall():
+        sha256_url, status, result, http_result, http_message, sha256_content, node, file_name, uuid = row
+        sha256_url = requested.get(sha256_url, sha256_url)
         if file_name:
             file_name = file_name.decode('unicode_internal')
 
@@ -266,27 +534,57 @@ def _get_cached_analysis(url, db, c):
                 logging.debug("unable to load cloudphish analysis {}: {}".format(uuid, e))
                 #report_exception()
 
-        # keep track of the most popular URLs
-        # old URLs get cleaned out
-        c.execute("UPDATE cloudphish_url_lookup SET last_lookup = NOW() WHERE sha256_url = UNHEX(%s)",
-                 (sha256,))
-        db.commit()
-
-        return CloudphishAnalysisResult(RESULT_OK,      # result
-                                        root_details,   # details 
-                                        status=status,
-                                        analysis_result=result,
-                                        http_result=http_result,
-                                        http_message=http_message,
-                                        sha256_content=sha256_content,
-                                        sha256_url=sha256,
-                                        location=node,
-                                        file_name=file_name,
-                                        uuid=uuid)
-
-    # if we have not then we return None
-    return None
-    
+        results[sha256_url] = CloudphishAnalysisResult(RESULT_OK,      # result
+                                                       root_details,   # details 
+                                                       status=status,
+                                                       analysis_result=result,
+                                                       http_result=http_result,
+                                                       http_message=http_message,
+                                                       sha256_content=sha256_content,
+                                                       sha256_url=sha256_url,
+                                                       location=node,
+                                                       file_name=file_name,
+                                                       uuid=uuid)
+
+    return results
+
+def get_cached_analyses(urls):
+    """Returns a dict of url -> CloudphishAnalysisResult for the given list of urls. 
+       Urls that have not been analyzed are mapped to None.
+       The results are looked up with a single query."""
+    try:
+        return _get_cached_analyses(urls)
+    except Exception as e:
+        message = "Unable to get analysis for {} urls: {}".format(len(urls), e)
+        logging.error(message)
+        report_exception()
+
+        return { url: CloudphishAnalysisResult(RESULT_ERROR, message) for url in urls }
+
+def _get_cached_analyses(urls):
+    sha256_urls = { url: hash_url(url) for url in urls }
+    results = {}
+
+    # finalized results are served from the result cache
+    missing = []
+    for url, sha256 in sha256_urls.items():
+        results[url] = get_result_cache().get(sha256)
+        if results[url] is None:
+            missing.append(sha256)
+
+    query_results = _query_cached_analyses(list(set(missing)))
+    for url, sha256 in sha256_urls.items():
+        if results[url] is None and sha256 in query_results:
+            results[url] = query_results[sha256]
+            get_result_cache().put(results[url])
+
+    # keep track of the most popular URLs
+    for url, sha256 in sha256_urls.items():
+        if results[url] is not None:
+            _track_url_lookup(sha256)
+
+    return results
+
 def create_analysis(url, reprocess, details):
     try:
         # url must be parsable
@@ -311,8 +609,9 @@ def _create_analysis(url, reprocess, details, db, c):
         # if we're reprocessing the url then we clear any existing analysis
         # IF the current analysis has completed
         # it's OK if we delete nothing here
-        execute_with_retry("""DELETE FROM cloudphish_analysis_results 
-                              WHERE sha256_url = UNHEX(%s) AND status = 'ANALYZED'""", 
+        invalidate_cached_result(sha256_url)
+        execute_with_retry(db, c, """DELETE FROM cloudphish_analysis_results 
+                                     WHERE sha256_url = UNHEX(%s) AND status = 'ANALYZED'""", 
                           (sha256_url,), commit=True)
 
     # if we're at this point it means that when we asked the database for an entry from cloudphish_analysis_results
@@ -343,7 +642,11 @@ def _create_analysis(url, reprocess, details, db, c):
 
     # at this point we've inserted an entry into cloudphish_analysis_results for this url
     # now at it's processing to the workload
+    _schedule_analysis(url, sha256_url, _uuid, details)
+    return get_cached_analysis(url)
 
+def _schedule_analysis(url, sha256_url, _uuid, details):
+    """Creates and schedules the RootAnalysis that analyzes the given url."""
     root = RootAnalysis()
     root.uuid = _uuid
     root.storage_dir = workload_storage_dir(root.uuid)
@@ -385,8 +688,6 @@ def _create_analysis(url, reprocess, details, db, c):
     root.save()
     root.schedule()
 
-    return get_cached_analysis(url)
-
 def analyze_url(url, reprocess, ignore_filters, details):
     """Analyze the given url with cloudphish. If reprocess is True then the existing (cached) results are deleted 
        and the url is processed again."""
@@ -423,3 +724,127 @@ def analyze_url(url, reprocess, ignore_filters, details):
         result = create_analysis(url, reprocess, details)
 
     return result
+
+def create_analyses(urls, reprocess, details):
+    """Creates analysis requests for the given list of urls in bulk.
+       Returns a dict of url -> CloudphishAnalysisResult."""
+    try:
+        for url in urls:
+            # url must be parsable
+            urlparse(url)
+
+        return _create_analyses(urls, reprocess, details)
+    except Exception as e:
+        message = "unable to create analysis requests for {} urls: {}".format(len(urls), e)
+        logging.error(message)
+        report_exception()
+
+        return { url: CloudphishAnalysisResult(RESULT_ERROR, message) for url in urls }
+
+@use_db
+def _create_analyses(urls, reprocess, details, db, c):
+    assert isinstance(urls, list)
+    assert all([isinstance(_, str) for _ in urls])
+    assert isinstance(reprocess, bool)
+    assert isinstance(details, dict)
+
+    if not urls:
+        return {}
+
+    # url -> sha256_url
+    sha256_urls = { url: hash_url(url) for url in urls }
+    sha256_params = tuple(set(sha256_urls.values()))
+    sha256_placeholders = ','.join(['UNHEX(%s)' for _ in sha256_params])
+
+    if reprocess:
+        # see _create_analysis
+        for sha256_url in sha256_params:
+            invalidate_cached_result(sha256_url)
+
+        execute_with_retry(db, c, """DELETE FROM cloudphish_analysis_results 
+                                     WHERE sha256_url IN ( {} ) AND status = 'ANALYZED'""".format(sha256_placeholders),
+                          sha256_params, commit=True)
+
+    # generate an analysis uuid for every url we have not seen yet
+    new_uuids = {} # key = url, value = uuid
+    for url, sha256_url in sha256_urls.items():
+        new_uuids[url] = str(uuid.uuid4())
+
+    # we could have multiple requests coming in at the same time for the same urls
+    # so we insert everything and ignore the duplicates
+    # whatever uuid ends up in the table for a url is the request that is responsible for analyzing it
+    results_params = []
+    lookup_params = []
+    for url, _uuid in new_uuids.items():
+        results_params.extend([sha256_urls[url], _uuid])
+        lookup_params.extend([sha256_urls[url], url])
+
+    execute_with_retry(db, c, [ """INSERT IGNORE INTO cloudphish_analysis_results ( sha256_url, uuid, insert_date ) 
+                                   VALUES {}""".format(','.join(['( UNHEX(%s), %s, NOW() )' for _ in new_uuids])),
+                                """INSERT IGNORE INTO cloudphish_url_lookup ( sha256_url, url )
+                                   VALUES {}""".format(','.join(['( UNHEX(%s), %s )' for _ in new_uuids])) ],
+                       [ tuple(results_params), tuple(lookup_params) ], commit=True)
+
+    # which of these did we actually insert?
+    c.execute("""SELECT LOWER(HEX(sha256_url)), uuid FROM cloudphish_analysis_results 
+                 WHERE sha256_url IN ( {} )""".format(sha256_placeholders), sha256_params)
+    current_uuids = { sha256_url: _uuid for sha256_url, _uuid in c.fetchall() }
+
+    for url, _uuid in new_uuids.items():
+        if current_uuids.get(sha256_urls[url].lower()) != _uuid:
+            # another request created this one between when we asked and now
+            continue
+
+        try:
+            _schedule_analysis(url, sha256_urls[url], _uuid, details)
+        except Exception as e:
+            logging.error("unable to schedule cloudphish analysis for {}: {}".format(url, e))
+            report_exception()
+
+    return get_cached_analyses(urls)
+
+def analyze_urls(urls, reprocess, ignore_filters, details):
+    """Analyze the given list of urls with cloudphish. This is the batch version of analyze_url.
+       The cached results are looked up with a single query and new analysis requests are created in bulk.
+       Returns a dict of url -> CloudphishAnalysisResult."""
+
+    assert isinstance(urls, list) and all([isinstance(_, str) and _ for _ in urls])
+    assert isinstance(reprocess, bool)
+    assert isinstance(ignore_filters, bool)
+    assert isinstance(details, dict)
+
+    # remove any duplicates while keeping the order
+    urls = list(collections.OrderedDict.fromkeys(urls))
+
+    results = { url: None for url in urls }
+
+    # if we've not requested reprocessing then we get the cached results if they exist
+    if not reprocess:
+        results.update(get_cached_analyses(urls))
+
+    # we do not have analysis for these urls yet
+    # now we check to see if we will even analyze them
+    if not ignore_filters:
+        for url in urls:
+            if results[url] is not None:
+                continue
+
+            filtered_result = url_filter.filter(url)
+            if filtered_result.filtered:
+                results[url] = CloudphishAnalysisResult(RESULT_OK,
+                                                        None,
+                                                        status=STATUS_ANALYZED,
+                                                        analysis_result=SCAN_RESULT_PASS,
+                                                        http_message=filtered_result.reason)
+
+    new_urls = [ url for url in urls if results[url] is None ]
+    if new_urls:
+        logging.debug("creating analysis requests for {} urls reprocess {}".format(len(new_urls), reprocess))
+        results.update(create_analyses(new_urls, reprocess, details))
+
+    # make sure every url has a result
+    for url in urls:
+        if results[url] is None:
+            results[url] = CloudphishAnalysisResult(RESULT_ERROR, "unable to create analysis request for {}".format(url))
+
+    return results
@@ -0,0 +1,181 @@
+# vim: sw=4:ts=4:et
+#
+# cold storage of alert storage directories
+#
+# alert storage directories keep data.json, the analysis details (.ace/*.json) and every extracted file as they are
+# until the alert is deleted, which adds up to a lot of files (inodes) and disk space on a busy node
+#
+# ace pack-alerts packs the storage directories of alerts older than [cold_storage] days_old into a single
+# compressed file in the storage directory (CONTAINER_NAME) and removes the original files
+#
+# zip is used for the container because each file is compressed separately and the central directory at the end
+# of the file is an index of the files, so a single file can be read without unpacking anything else
+#
+# - files are read with open_storage_file, which reads from the container when the file is not on disk
+#   (RootAnalysis.load, the analysis details and the gui downloads use this)
+# - anything that writes to the storage directory unpacks it first (RootAnalysis.save and the engine)
+#
+
+import io
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import zipfile
+
+__all__ = [
+    'CONTAINER_NAME',
+    'get_container_path',
+    'is_packed',
+    'pack_storage_dir',
+    'unpack_storage_dir',
+    'open_storage_file',
+    'storage_file_exists',
+    'storage_file_size',
+    'extract_storage_file',
+]
+
+# the name of the container file in the storage directory
+CONTAINER_NAME = '.cold_storage.zip'
+
+def get_container_path(storage_dir):
+    return os.path.join(storage_dir, CONTAINER_NAME)
+
+def is_packed(storage_dir):
+    """Returns True if the given storage directory is in cold storage."""
+    return os.path.exists(get_container_path(storage_dir))
+
+def pack_storage_dir(storage_dir):
+    """Packs every file in the given storage directory into the container and then removes them.
+       Symbolic links are left as they are. Returns the number of files that were packed."""
+    if is_packed(storage_dir):
+        raise RuntimeError("{} is already packed".format(storage_dir))
+
+    packed_paths = []
+    fd, temp_path = tempfile.mkstemp(dir=storage_dir, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            with zipfile.ZipFile(fp, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+                for dir_path, dir_names, file_names in os.walk(storage_dir):
+                    for file_name in file_names:
+                        file_path = os.path.join(dir_path, file_name)
+                        if file_path == temp_path or os.path.islink(file_path):
+                            continue
+
+                        zf.write(file_path, os.path.relpath(file_path, start=storage_dir))
+                        packed_paths.append(file_path)
+
+        # the container only shows up once it is complete
+        os.rename(temp_path, get_container_path(storage_dir))
+
+    except Exception:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+        raise
+
+    for file_path in packed_paths:
+        os.remove(file_path)
+
+    # remove the directories that are now empty (but not the storage directory itself)
+    for dir_path, dir_names, file_names in os.walk(storage_dir, topdown=False):
+        if dir_path != storage_dir:
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                pass
+
+    logging.debug("packed {} files in {}".format(len(packed_paths), storage_dir))
+    return len(packed_paths)
+
+def unpack_storage_dir(storage_dir):
+    """Extracts every file in the container back into the storage directory and removes the container.
+       Does nothing if the storage directory is not packed (or was unpacked by someone else in the meantime)."""
+    container_path = get_container_path(storage_dir)
+    logging.info("unpacking {} from cold storage".format(storage_dir))
+    try:
+        zf = zipfile.ZipFile(container_path)
+    except FileNotFoundError:
+        # the engine and the gui both unpack alerts without holding the alert lock
+        logging.debug("{} was already unpacked".format(storage_dir))
+        return
+
+    with zf:
+        for info in zf.infolist():
+            # files that were written since the alert was packed are newer than what is in the container
+            if not os.path.exists(os.path.join(storage_dir, info.filename)):
+                zf.extract(info, storage_dir)
+
+    try:
+        os.remove(container_path)
+    except FileNotFoundError:
+        pass
+
+def _get_info(storage_dir, path):
+    """Returns the (ZipFile, ZipInfo) of the given path (relative to the storage directory) or (None, None)."""
+    try:
+        zf = zipfile.ZipFile(get_container_path(storage_dir))
+    except FileNotFoundError:
+        return None, None
+
+    try:
+        return zf, zf.getinfo(os.path.normpath(path))
+    except KeyError:
+        zf.close()
+        return None, None
+
+def open_storage_file(storage_dir, path, mode='r'):
+    """Opens the file at the given path (relative to the storage directory) for reading in text ('r') or binary ('rb')
+       mode. The file is read from the container if it is not on disk."""
+    assert mode in [ 'r', 'rb' ]
+    try:
+        return open(os.path.join(storage_dir, path), mode)
+    except FileNotFoundError:
+        zf, info = _get_info(storage_dir, path)
+        if zf is None:
+            raise
+
+    # the container stays open until the file is closed
+    with zf:
+        fp = zf.open(info)
+
+    if mode == 'r':
+        return io.TextIOWrapper(fp)
+
+    return fp
+
+def storage_file_exists(storage_dir, path):
+    """Returns True if the file at the given path (relative to the storage directory) is on disk or in the container."""
+    if os.path.exists(os.path.join(storage_dir, path)):
+        return True
+
+    zf, info = _get_info(storage_dir, path)
+    if zf is None:
+        return False
+
+    zf.close()
+    return True
+
+def storage_file_size(storage_dir, path):
+    """Returns the size of the file at the given path (relative to the storage directory) on disk or in the container."""
+    try:
+        return os.path.getsize(os.path.join(storage_dir, path))
+    except FileNotFoundError:
+        zf, info = _get_info(storage_dir, path)
+        if zf is None:
+            raise
+
+        zf.close()
+        return info.file_size
+
+def extract_storage_file(storage_dir, path, target_dir):
+    """Copies the file at the given path (relative to the storage directory) into target_dir from the disk or
+       from the container and returns the path to the copy."""
+    target_path = os.path.join(target_dir, os.path.basename(path))
+    with open_storage_file(storage_dir, path, 'rb') as fp_in, open(target_path, 'wb') as fp_out:
+        shutil.copyfileobj(fp_in, fp_out)
+
+    return target_path
@@ -114,6 +114,77 @@ def encrypt(source_path, target_path, password=None):
 
                 fp_out.write(encryptor.encrypt(chunk))
 
+class EncryptedFileWriter(object):
+    """A file-like object that encrypts what is written to it into the same format encrypt() uses.
+       fp must be a seekable binary file object since the size of the data is written at the start when it is closed.
+       If password is None then saq.ENCRYPTION_PASSWORD is used instead."""
+
+    def __init__(self, fp, password=None):
+        if password is None:
+            password = saq.ENCRYPTION_PASSWORD
+
+        assert isinstance(password, bytes)
+        assert len(password) == 32
+
+        self.fp = fp
+        self.size = 0
+        # data waiting for a full AES block
+        self.buffer = b''
+
+        iv = Crypto.Random.OSRNG.posix.new().read(AES.block_size)
+        self.encryptor = AES.new(password, AES.MODE_CBC, iv)
+        self.header_offset = fp.tell()
+        self.fp.write(struct.pack('<Q', 0)) # updated in close()
+        self.fp.write(iv)
+
+    def write(self, data):
+        if not data:
+            return
+
+        self.size += len(data)
+        self.buffer += data
+        length = len(self.buffer) - len(self.buffer) % AES.block_size
+        if length:
+            self.fp.write(self.encryptor.encrypt(self.buffer[:length]))
+            self.buffer = self.buffer[length:]
+
+    def close(self):
+        if self.buffer:
+            self.buffer += b' ' * (AES.block_size - len(self.buffer))
+            self.fp.write(self.encryptor.encrypt(self.buffer))
+            self.buffer = b''
+
+        position = self.fp.tell()
+        self.fp.seek(self.header_offset)
+        self.fp.write(struct.pack('<Q', self.size))
+        self.fp.seek(position)
+
+def decrypt_stream(source_path, password=None):
+    """Yields the decrypted content of the given file at source_path (encrypted with encrypt()) in chunks.
+       If password is None then saq.ENCRYPTION_PASSWORD is used instead.
+       password must be a byte string 32 bytes in length."""
+
+    if password is None:
+        password = saq.ENCRYPTION_PASSWORD
+
+    assert isinstance(password, bytes)
+    assert len(password) == 32
+
+    with open(source_path, 'rb') as fp_in:
+        remaining = struct.unpack('<Q', fp_in.read(struct.calcsize('Q')))[0]
+        iv = fp_in.read(16)
+        decryptor = AES.new(password, AES.MODE_CBC, iv)
+
+        while remaining > 0:
+            chunk = fp_in.read(CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+
+            # the padding at the end is not part of the data
+            chunk = decryptor.decrypt(chunk)[:remaining]
+            remaining -= len(chunk)
+            yield chunk
+
 def encrypt_chunk(chunk, password=None):
     """Encrypts the given chunk of data and returns the encrypted chunk.
        If password is None then saq.ENCRYPTION_PASSWORD is used instead.
@@ -13,6 +13,7 @@ import saq
 import saq.analysis
 import saq.constants
 
+from saq.alert_search import index_alert
 from saq.analysis import RootAnalysis
 from saq.error import report_exception
 from saq.performance import track_execution_time
@@ -798,6 +799,26 @@ class Alert(RootAnalysis, Base):
         # make replace keep the hour set to the business time zone hour UGH
         return dt.replace(hour=dt.hour, tzinfo=None)
 
+    def _datetime_from_sla_time_zone(self, dt):
+        """The inverse of _datetime_to_sla_time_zone: converts a naive datetime in the SLA time zone back to local time."""
+        return self._bh_tz.localize(dt).astimezone().replace(tzinfo=None)
+
+    def _add_business_time(self, dt, seconds):
+        """Returns the (naive, SLA time zone) datetime that is the given number of business hour seconds after dt."""
+        start_hour, end_hour = self._bt.business_hours
+        remaining = datetime.timedelta(seconds=max(0, seconds))
+        while True:
+            day_start = datetime.datetime.combine(dt.date(), start_hour)
+            day_end = datetime.datetime.combine(dt.date(), end_hour)
+            if self._bt.isbusinessday(dt) and dt < day_end:
+                dt = max(dt, day_start)
+                if dt + remaining <= day_end:
+                    return dt + remaining
+
+                remaining -= day_end - dt
+
+            dt = datetime.datetime.combine(dt.date() + datetime.timedelta(days=1), start_hour)
+
     @property
     def sla(self):
         """Returns the correct SLA for this alert, or None if SLA is disabled for this alert."""
@@ -862,45 +883,51 @@ class Alert(RootAnalysis, Base):
         return ((self.business_time.days * hours_per_day * 60 * 60) + 
                 (self.business_time.seconds))
 
-    @property
-    def is_approaching_sla(self):
-        """Returns True if this Alert is approaching SLA and has not been dispositioned yet."""
-        if hasattr(self, '_is_approaching_sla'):
-            return getattr(self, '_is_approaching_sla')
+    # the SLA times are computed when the alert is inserted and again when the owner or disposition changes
+    # so that the gui can filter and sort on SLA in the database (see update_sla)
 
-        if self.insert_date is None:
-            return None
+    sla_warning_time = Column(
+        TIMESTAMP,
+        nullable=True)
 
-        if self.sla is None:
-            logging.warning("cannot get SLA for {}".format(self))
-            return None
+    sla_deadline = Column(
+        TIMESTAMP,
+        nullable=True)
 
-        result = False
-        if self.disposition is None and self.sla.enabled and self.alert_type not in saq.EXCLUDED_SLA_ALERT_TYPES:
-            result = self.business_time_seconds >= (self.sla.timeout - self.sla.warning) * 60 * 60
+    def update_sla(self):
+        """Sets sla_warning_time and sla_deadline from the insert_date and the SLA settings of this alert.
+           Both are set to None if no SLA applies (disabled, excluded alert type or already dispositioned.)"""
+        # the SLA that matches may depend on properties that have changed
+        if hasattr(self, '_sla_settings'):
+            delattr(self, '_sla_settings')
 
-        setattr(self, '_is_approaching_sla', result)
-        return result
+        sla_warning_time = sla_deadline = None
+        if self.insert_date is not None and self.disposition is None and self.sla is not None \
+        and self.sla.enabled and self.alert_type not in saq.EXCLUDED_SLA_ALERT_TYPES:
+            start = self._datetime_to_sla_time_zone(dt=self.insert_date)
+            sla_warning_time = self._datetime_from_sla_time_zone(
+                self._add_business_time(start, (self.sla.timeout - self.sla.warning) * 60 * 60))
+            sla_deadline = self._datetime_from_sla_time_zone(
+                self._add_business_time(start, self.sla.timeout * 60 * 60))
 
-    @property
-    def is_over_sla(self):
-        """Returns True if this Alert is over SLA and has not been dispositioned yet."""
-        if hasattr(self, '_is_over_sla'):
-            return getattr(self, '_is_over_sla')
+        self.sla_warning_time = sla_warning_time
+        self.sla_deadline = sla_deadline
 
-        if self.insert_date is None:
-            return None
+    @property
+    def is_approaching_sla(self):
+        """Returns True if this Alert is approaching SLA and has not been dispositioned yet."""
+        if self.disposition is not None or self.sla_warning_time is None:
+            return False
 
-        if self.sla is None:
-            logging.warning("cannot get SLA for {}".format(self))
-            return None
+        return datetime.datetime.now() >= self.sla_warning_time
 
-        result = False
-        if self.disposition is None and self.sla.enabled and self.alert_type not in saq.EXCLUDED_SLA_ALERT_TYPES:
-            result = self.business_time_seconds >= self.sla.timeout * 60 * 60
+    @property
+    def is_over_sla(self):
+        """Returns True if this Alert is over SLA and has not been dispositioned yet."""
+        if self.disposition is not None or self.sla_deadline is None:
+            return False
 
-        setattr(self, '_is_over_sla', result)
-        return result
+        return datetime.datetime.now() >= self.sla_deadline
 
     tool = Column(
         String(256),
@@ -1226,10 +1253,18 @@ class Alert(RootAnalysis, Base):
         
         session.add(self)
         session.commit()
+
+        # the SLA is computed from the insert_date assigned by the database
+        self.update_sla()
+        session.commit()
+
         self.build_index()
 
         self.save() # save this alert now that it has the id
 
+        # alerts are searchable from the gui from here on (after this, save() keeps the index up to date)
+        index_alert(self)
+
         # we want to unlock it here since the corelation is going to want to pick it up as soon as it gets added
         #if self.is_locked():
             #self.unlock()
@@ -1402,6 +1437,17 @@ def sync_observable(observable):
 
     return existing_observable
 
+def update_sla(alert_uuids, session=None):
+    """Recomputes the SLA times (see :meth:`Alert.update_sla`) of the alerts with the given uuids.
+       :param session: The session to use (defaults to saq.db.)"""
+    if session is None:
+        session = saq.db
+
+    for alert in session.query(Alert).filter(Alert.uuid.in_(alert_uuids)):
+        alert.update_sla()
+
+    session.commit()
+
 def set_dispositions(alert_uuids, disposition, user_id, user_comment=None):
     """Utility function to the set disposition of many Alerts at once.
        :param alert_uuids: A list of UUIDs of Alert objects to set.
@@ -1415,7 +1461,7 @@ def set_dispositions(alert_uuids, disposition, user_id, user_comment=None):
         uuid_placeholders = ','.join(['%s' for _ in alert_uuids])
         sql = f"""UPDATE alerts SET 
                       disposition = %s, disposition_user_id = %s, disposition_time = NOW(),
-                      owner_id = %s, owner_time = NOW()
+                      owner_id = %s, owner_time = NOW(), sla_warning_time = NULL, sla_deadline = NULL
                   WHERE 
                       (disposition IS NULL OR disposition != %s) AND uuid IN ( {uuid_placeholders} )"""
         parameters = [disposition, user_id, user_id, disposition]
@@ -1,14 +1,22 @@
 # vim: sw=4:ts=4:et:cc=120
 
+import binascii
+import email.message
+import email.parser
+import hashlib
 import logging
 import os
 import os.path
+import re
 import socket
+import tempfile
+import zlib
 
 import saq
 from email.utils import parseaddr
 from email.header import decode_header
-from saq.database import get_db_connection
+from saq.crypto import EncryptedFileWriter, decrypt_stream
+from saq.database import get_db_connection, execute_with_retry
 
 def normalize_email_address(email_address):
     """Returns a normalized version of email address.  Returns None if the address cannot be parsed."""
@@ -105,6 +113,217 @@ def get_email_archive_sections():
 
     return result
 
+#
+# email archive search index
+#
+# archive_message has one row per archived email with the message properties
+# the properties that are looked up by exact value (message_id, env_to, body_from, body_to) are also stored
+# as MD5 hashes with an index on each one, and the subject (and decoded subject) has an ngram full text index
+# archive_url has one row per url found in the email with a hash and an ngram full text index on the url
+# archive_content has the MD5 of each file found in the email
+#
+# (these replace the field/value rows in archive_index and archive_search, see migrate_archive_search)
+#
+
+# the properties stored in archive_message
+ARCHIVE_MESSAGE_FIELDS = [ 'message_id', 'env_to', 'body_from', 'body_to', 'subject', 'decoded_subject' ]
+# the properties of archive_message that are looked up by hash
+ARCHIVE_HASHED_FIELDS = [ 'message_id', 'env_to', 'body_from', 'body_to' ]
+# the properties that are stored as normalized (lowercase) email addresses
+ARCHIVE_ADDRESS_FIELDS = [ 'env_to', 'body_from', 'body_to' ]
+# every property that can be searched for
+ARCHIVE_SEARCH_FIELDS = ARCHIVE_MESSAGE_FIELDS + [ 'url', 'content' ]
+
+# the size of the column that stores the hashed properties
+ARCHIVE_VALUE_SIZE = 512
+# full text searches for anything shorter than this (ngram_token_size) do not use the index
+NGRAM_TOKEN_SIZE = 2
+# the maximum number of rows in a single INSERT statement
+ARCHIVE_INSERT_BATCH_SIZE = 500
+
+def archive_hash(value):
+    """Returns the hex MD5 of the given email archive property value."""
+    return hashlib.md5(value.encode('utf8', errors='ignore')).hexdigest()
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _full_text_clause(columns, value, exact):
+    """Returns the (where clause, params) that match the given value against the given full text indexed columns."""
+    if exact:
+        confirm = ' OR '.join([ '{} = %s'.format(column) for column in columns ])
+        confirm_params = [ value for _ in columns ]
+    else:
+        confirm = ' OR '.join([ '{} LIKE %s'.format(column) for column in columns ])
+        confirm_params = [ '%{}%'.format(_escape_like(value)) for _ in columns ]
+
+    # the full text index narrows down the rows and then the comparison confirms them
+    if len(value) < NGRAM_TOKEN_SIZE:
+        return '( {} )'.format(confirm), confirm_params
+
+    return ( 'MATCH ( {} ) AGAINST ( %s IN BOOLEAN MODE ) AND ( {} )'.format(', '.join(columns), confirm),
+             [ '"{}"'.format(value.replace('"', ' ')) ] + confirm_params )
+
+def get_archive_search_query(field, value, exact=True):
+    """Returns the (sql, params) that select the archive_id of every archived email with the given property value.
+       If exact is False then the value can appear anywhere in the property."""
+    if field not in ARCHIVE_SEARCH_FIELDS:
+        raise ValueError("invalid email archive search field {}".format(field))
+
+    if field in ARCHIVE_ADDRESS_FIELDS:
+        value = value.lower()
+
+    if field == 'content':
+        # only exact matches make sense for hashes
+        return "SELECT archive_id FROM archive_content WHERE md5 = UNHEX(%s)", ( value.lower(), )
+
+    if field == 'url':
+        if exact:
+            return "SELECT archive_id FROM archive_url WHERE url_hash = UNHEX(%s)", ( archive_hash(value), )
+
+        clause, params = _full_text_clause([ 'url' ], value, exact)
+        return "SELECT DISTINCT archive_id FROM archive_url WHERE {}".format(clause), tuple(params)
+
+    if field in ARCHIVE_HASHED_FIELDS:
+        if exact:
+            return ( "SELECT archive_id FROM archive_message WHERE {}_hash = UNHEX(%s)".format(field), 
+                     ( archive_hash(value), ) )
+
+        return ( "SELECT archive_id FROM archive_message WHERE {} LIKE %s".format(field),
+                 ( '%{}%'.format(_escape_like(value)), ) )
+
+    # subject and decoded_subject share the same full text index
+    clause, params = _full_text_clause([ 'subject', 'decoded_subject' ], value, exact)
+    return "SELECT archive_id FROM archive_message WHERE {}".format(clause), tuple(params)
+
+def search_archive_ids(c, field, value, exact=True):
+    """Returns the set of archive_ids of the archived emails with the given property value."""
+    sql, params = get_archive_search_query(field, value, exact=exact)
+    c.execute(sql, params)
+    return set([ row[0] for row in c ])
+
+def index_archived_email(db, c, archive_id, properties):
+    """Records the given list of (field, value) properties of the given archived email in the search index.
+       Rows are inserted with a few multi-row statements. Does not commit."""
+    message = {}
+    urls = []
+    content = []
+    for field, value in properties:
+        if field in ARCHIVE_MESSAGE_FIELDS:
+            if field not in message:
+                message[field] = value
+        elif field == 'url':
+            if value not in urls:
+                urls.append(value)
+        elif field == 'content':
+            if value not in content:
+                content.append(value)
+
+    if message:
+        columns = [ 'archive_id' ]
+        values = [ '%s' ]
+        params = [ archive_id ]
+        for field, value in message.items():
+            if field in ARCHIVE_HASHED_FIELDS:
+                columns.extend([ field, '{}_hash'.format(field) ])
+                values.extend([ '%s', 'UNHEX(%s)' ])
+                params.extend([ value[:ARCHIVE_VALUE_SIZE], archive_hash(value) ])
+            else:
+                columns.append(field)
+                values.append('%s')
+                params.append(value)
+
+        c.execute("INSERT IGNORE INTO archive_message ( {} ) VALUES ( {} )".format(
+                  ', '.join(columns), ', '.join(values)), tuple(params))
+
+    for index in range(0, len(urls), ARCHIVE_INSERT_BATCH_SIZE):
+        batch = urls[index:index + ARCHIVE_INSERT_BATCH_SIZE]
+        params = []
+        for url in batch:
+            params.extend([ archive_id, archive_hash(url), url ])
+
+        c.execute("INSERT IGNORE INTO archive_url ( archive_id, url_hash, url ) VALUES {}".format(
+                  ','.join([ '( %s, UNHEX(%s), %s )' for _ in batch ])), tuple(params))
+
+    for index in range(0, len(content), ARCHIVE_INSERT_BATCH_SIZE):
+        batch = content[index:index + ARCHIVE_INSERT_BATCH_SIZE]
+        params = []
+        for md5 in batch:
+            params.extend([ archive_id, md5 ])
+
+        c.execute("INSERT IGNORE INTO archive_content ( archive_id, md5 ) VALUES {}".format(
+                  ','.join([ '( %s, UNHEX(%s) )' for _ in batch ])), tuple(params))
+
+def archive_email(db, c, server_id, email_md5, properties):
+    """Records the email with the given MD5 as archived on the given server along with its properties.
+       Returns the archive_id. Does not commit. Meant to be called through execute_with_retry."""
+    # LAST_INSERT_ID(archive_id) makes lastrowid the existing archive_id when the email is already there
+    c.execute("""INSERT INTO archive ( server_id, md5 ) VALUES ( %s, UNHEX(%s) )
+                 ON DUPLICATE KEY UPDATE archive_id = LAST_INSERT_ID(archive_id)""", (server_id, email_md5))
+    archive_id = c.lastrowid
+    index_archived_email(db, c, archive_id, properties)
+    return archive_id
+
+# key = hostname, value = server_id
+_archive_server_ids = {}
+
+def get_archive_server_id(db, c, hostname):
+    """Returns the server_id of the given hostname in the email archive, creating it if it does not exist yet.
+       The result is cached for the lifetime of the process."""
+    if hostname not in _archive_server_ids:
+        execute_with_retry(db, c, """INSERT INTO archive_server ( hostname ) VALUES ( %s )
+                                     ON DUPLICATE KEY UPDATE server_id = LAST_INSERT_ID(server_id)""", 
+                           (hostname,), commit=True)
+        _archive_server_ids[hostname] = c.lastrowid
+        logging.debug("got server_id {} for {}".format(_archive_server_ids[hostname], hostname))
+
+    return _archive_server_ids[hostname]
+
+def migrate_archive_search(source, batch_size=1000, start_id=0):
+    """Copies the properties of the archived emails in the archive_index and archive_search tables of the given
+       email archive (specified by configuration section) into the email archive search index.
+       Emails are migrated in batches of batch_size starting after archive_id start_id.
+       Returns the number of emails migrated."""
+    count = 0
+    skipped = 0
+    with get_db_connection(source) as db:
+        c = db.cursor()
+        while True:
+            c.execute("SELECT archive_id FROM archive WHERE archive_id > %s ORDER BY archive_id LIMIT %s", 
+                     (start_id, batch_size))
+            archive_ids = [ row[0] for row in c ]
+            if not archive_ids:
+                break
+
+            first_id = archive_ids[0]
+            last_id = archive_ids[-1]
+
+            properties = {} # key = archive_id, value = [ (field, value) ]
+            c.execute("""SELECT archive_id, field, value FROM archive_search 
+                         WHERE archive_id BETWEEN %s AND %s""", (first_id, last_id))
+            for archive_id, field, value in c:
+                # values were cut off at the size of the column (and archive_index only has hashes)
+                # so truncated values of the properties that are looked up by their hash are lost
+                if len(value) >= ARCHIVE_VALUE_SIZE and ( field in ARCHIVE_HASHED_FIELDS or field == 'url' ):
+                    logging.warning("skipping truncated {} of archive_id {} in {}".format(field, archive_id, source))
+                    skipped += 1
+                    continue
+
+                # the content values are the hex md5 hashes of the files
+                properties.setdefault(archive_id, []).append(( field, value.decode(errors='ignore') ))
+
+            def _index(db, c, properties):
+                for archive_id, _properties in properties.items():
+                    index_archived_email(db, c, archive_id, _properties)
+
+            execute_with_retry(db, c, _index, (properties,), commit=True)
+            count += len(archive_ids)
+            start_id = last_id
+            logging.info("migrated {} emails in {} (last archive_id {} skipped {} truncated values)".format(
+                         count, source, last_id, skipped))
+
+    return count
+
 def search_archive(source, message_ids, excluded_emails=[]):
     """Searches the given email archive (specified by configuration section) for the given message_ids, 
        returns a dictionary[archive_id] = EmailArchiveEntry
@@ -121,33 +340,18 @@ def search_archive(source, message_ids, excluded_emails=[]):
     _buffer = { }
     with get_db_connection(source) as db:
         c = db.cursor()
-        fmt_str = ','.join(['%s' for _ in message_ids])
-        c.execute("""SELECT as1.field, as1.value, as1.archive_id FROM archive_search as1 
-                     JOIN archive_search as2 ON as1.archive_id = as2.archive_id
-                     WHERE as2.field = 'message_id' AND as2.value IN ( {} )""".format(fmt_str), tuple(message_ids))
-
-        for row in c:
-            field, value, archive_id = row
-            if archive_id not in _buffer:
-                _buffer[archive_id] = EmailArchiveEntry(archive_id)
-
-            value = value.decode(errors='ignore')
-
-            if field == 'message_id':
-                _buffer[archive_id].message_id = value
-
-            if field == 'env_to':
-                _buffer[archive_id].recipient = value
-
+        fmt_str = ','.join(['UNHEX(%s)' for _ in message_ids])
+        c.execute("""SELECT archive_id, message_id, env_to, body_to, subject, body_from FROM archive_message
+                     WHERE message_id_hash IN ( {} )""".format(fmt_str), 
+                  tuple([ archive_hash(message_id) for message_id in message_ids ]))
+
+        for archive_id, message_id, env_to, body_to, subject, body_from in c:
+            entry = _buffer[archive_id] = EmailArchiveEntry(archive_id)
+            entry.message_id = message_id
             # use body_to field as recipient if there is no env_to field
-            if field == 'body_to' and _buffer[archive_id].recipient is None:
-                _buffer[archive_id].recipient = value
-
-            if field == 'subject':
-                _buffer[archive_id].subject = value
-
-            if field == 'body_from':
-                _buffer[archive_id].sender = value
+            entry.recipient = env_to if env_to is not None else body_to
+            entry.subject = subject
+            entry.sender = body_from
 
     # remove excluded entries
     excluded_archive_ids = []
@@ -198,6 +402,117 @@ def search_archive(source, message_ids, excluded_emails=[]):
 
     return _buffer
 
+#
+# archived email files
+#
+# emails are compressed and encrypted in a single pass (nothing unencrypted is written to disk)
+# and stored as <archive_dir>/<hostname>/<md5[0:3]>/<md5><extension>.e (see saq.crypto for the encrypted format)
+# the extension is the compression codec
+#
+
+# key = codec, value = file extension
+ARCHIVE_CODECS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# the amount of data read from the email at a time
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+def _get_compressor(codec):
+    if codec == 'gzip':
+        # wbits 31 writes the gzip container
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    elif codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+
+    raise ValueError("unknown email archive codec {}".format(codec))
+
+def _get_decompressor(codec):
+    if codec == 'gzip':
+        return zlib.decompressobj(31)
+    elif codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    raise ValueError("unknown email archive codec {}".format(codec))
+
+def get_archive_codec(archive_path):
+    """Returns the compression codec used by the given archive file, or None if it is not an archive file."""
+    for codec, extension in ARCHIVE_CODECS.items():
+        if archive_path.endswith('{}.e'.format(extension)):
+            return codec
+
+    return None
+
+def get_archive_path(archive_dir, hostname, md5, codec='gzip'):
+    """Returns the path to the archive file for the given email md5 (it may not exist.)"""
+    return os.path.join(archive_dir, hostname.lower(), md5.lower()[0:3], 
+                        '{}{}.e'.format(md5.lower(), ARCHIVE_CODECS[codec]))
+
+def find_archive_path(archive_dir, hostname, md5):
+    """Returns the path to the existing archive file for the given email md5, or None if it does not exist."""
+    for codec in ARCHIVE_CODECS.keys():
+        archive_path = get_archive_path(archive_dir, hostname, md5, codec)
+        if os.path.exists(archive_path):
+            return archive_path
+
+    return None
+
+def write_archive(source_path, archive_path, codec='gzip', password=None):
+    """Compresses and encrypts the file at source_path into archive_path in a single pass.
+       If password is None then saq.ENCRYPTION_PASSWORD is used instead."""
+    compressor = _get_compressor(codec)
+    # the archive only shows up once it is complete
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(archive_path), suffix='.tmp')
+    try:
+        with open(source_path, 'rb') as fp_in, os.fdopen(fd, 'wb') as fp_out:
+            writer = EncryptedFileWriter(fp_out, password=password)
+            while True:
+                chunk = fp_in.read(ARCHIVE_CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                writer.write(compressor.compress(chunk))
+
+            writer.write(compressor.flush())
+            writer.close()
+
+        os.rename(temp_path, archive_path)
+
+    except Exception:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+        raise
+
+def read_archive(archive_path, password=None):
+    """Yields the decrypted and decompressed content of the given archive file in chunks.
+       If password is None then saq.ENCRYPTION_PASSWORD is used instead."""
+    codec = get_archive_codec(archive_path)
+    if codec is None:
+        raise ValueError("{} is not an email archive file".format(archive_path))
+
+    decompressor = _get_decompressor(codec)
+    for chunk in decrypt_stream(archive_path, password=password):
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+
+    if codec == 'gzip':
+        data = decompressor.flush()
+        if data:
+            yield data
+
+def extract_archive(archive_path, target_path, password=None):
+    """Decrypts and decompresses the given archive file into target_path."""
+    with open(target_path, 'wb') as fp:
+        for chunk in read_archive(archive_path, password=password):
+            fp.write(chunk)
+
 def maintain_archive(verbose=False):
     """Deletes archived emails older than what is configured as [analysis_module_email_archiver] expiration_days."""
 
@@ -243,10 +558,10 @@ def maintain_archive(verbose=False):
 
             for archive_id, md5 in results:
                 # delete the file if it exists on disk
-                target_path = os.path.join(archive_dir, hostname, md5[0:3], '{}.gz.e'.format(md5))
+                target_path = find_archive_path(archive_dir, hostname, md5)
 
-                if not os.path.exists(target_path):
-                    logging.warning("expired archive path {} no longer exists".format(target_path))
+                if target_path is None:
+                    logging.warning("expired archive {} no longer exists".format(md5))
                 else:
                     try:
                         os.remove(target_path)
@@ -257,3 +572,256 @@ def maintain_archive(verbose=False):
             sql = "DELETE FROM archive WHERE archive_id IN ( {} )".format(','.join([str(r[0]) for r in results]))
             c.execute(sql)
             db.commit()
+
+#
+# streaming email parsing
+#
+# parsing an email with the email package keeps the entire email in memory (several times over with the parsed
+# tree and the decoded payloads) which is a problem for journaled emails with large attachments
+#
+# StreamingEmailParser reads the email a line at a time and only keeps the headers of each MIME part in memory
+# the body of each part is decoded (base64 and quoted-printable) into a file in the spool directory as it is read
+# message/rfc822 parts are spooled as they are and then parsed from the spool file
+#
+
+# a line in the header block of a MIME part (see email.feedparser)
+_PATTERN_MIME_HEADER = re.compile(rb'^(From |[\041-\071\073-\176]*:|[\t ])')
+# what can follow a MIME boundary on the boundary line
+_PATTERN_MIME_BOUNDARY_END = re.compile(rb'(--)?[ \t]*(\r\n|\r|\n)?')
+# characters that are not part of base64 encoded data
+_PATTERN_NOT_BASE64 = re.compile(rb'[^A-Za-z0-9+/=]')
+
+class SpooledMessage(email.message.Message):
+    """A MIME part parsed by StreamingEmailParser. The body of the part is in the file at spool_path."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the decoded body (None for multipart parts)
+        self.spool_path = None
+        self.payload_size = 0
+        self.payload_sha256 = None
+
+class StreamingEmailParser(object):
+    """Parses an email file into a tree of SpooledMessage objects without reading the email into memory.
+       Parts past max_parts are skipped and parts nested deeper than max_depth are not parsed 
+       (they are spooled as they are). truncated is set to True when either limit is reached."""
+
+    def __init__(self, spool_dir, max_parts=None, max_depth=None):
+        self.spool_dir = spool_dir
+        self.max_parts = max_parts
+        self.max_depth = max_depth
+        self.part_count = 0
+        self.truncated = False
+
+        self._fp = None
+        self._pending_line = None
+        # the boundary lines of the multipart parts we are in
+        self._boundaries = []
+
+    def parse(self, path):
+        """Parses the given email file and returns the root SpooledMessage."""
+        with open(path, 'rb') as fp:
+            self._fp = fp
+            self._pending_line = None
+            self._boundaries = []
+
+            # we ignore any leading whitespace
+            # this isn't technically "correct" but some systems make mistakes
+            while True:
+                line = self._readline()
+                if not line or line.strip():
+                    break
+
+            if line:
+                self._unreadline(line.lstrip())
+
+            return self._parse_part(0)
+
+    def _readline(self):
+        if self._pending_line is not None:
+            line = self._pending_line
+            self._pending_line = None
+            return line
+
+        # lines are read in bounded chunks so a file without line breaks is not read into memory
+        return self._fp.readline(ARCHIVE_CHUNK_SIZE)
+
+    def _unreadline(self, line):
+        self._pending_line = line
+
+    def _match_boundary(self, line):
+        """Returns (boundary, is_closing_boundary) if the line is the boundary of any multipart we are in."""
+        if not self._boundaries or not line.startswith(b'--'):
+            return None
+
+        for boundary in reversed(self._boundaries):
+            if line.startswith(boundary):
+                m = _PATTERN_MIME_BOUNDARY_END.fullmatch(line, len(boundary))
+                if m:
+                    return boundary, m.group(1) is not None
+
+        return None
+
+    def _parse_part(self, depth):
+        header_lines = []
+        while True:
+            line = self._readline()
+            if not line or not line.rstrip(b'\r\n'):
+                break
+
+            if not _PATTERN_MIME_HEADER.match(line) or self._match_boundary(line):
+                # this part has no blank line between the headers and the body
+                self._unreadline(line)
+                break
+
+            header_lines.append(line)
+
+        part = email.parser.Parser(_class=SpooledMessage).parsestr(
+               b''.join(header_lines).decode('utf-8', errors='ignore'), headersonly=True)
+        self.part_count += 1
+
+        too_deep = self.max_depth and depth >= self.max_depth
+        if part.get_content_maintype() == 'multipart' and part.get_boundary() and not too_deep:
+            self._parse_multipart(part, depth)
+        elif part.get_content_type() == 'message/rfc822' and not too_deep:
+            self._parse_message(part, depth)
+        else:
+            if too_deep and (part.get_content_maintype() == 'multipart' or part.get_content_type() == 'message/rfc822'):
+                logging.warning("email part {} is nested more than {} parts deep".format(
+                                part.get_content_type(), self.max_depth))
+                self.truncated = True
+
+            part.set_payload(None)
+            self._spool_body(part)
+
+        return part
+
+    def _parse_multipart(self, part, depth):
+        boundary = '--{}'.format(part.get_boundary()).encode('utf-8', errors='ignore')
+        children = []
+        self._boundaries.append(boundary)
+        try:
+            # the preamble
+            self._skip_body()
+            while True:
+                line = self._readline()
+                match = self._match_boundary(line)
+                if match is None or match[0] != boundary:
+                    # the end of the file or the end of a multipart we are in (the closing boundary is missing)
+                    if line:
+                        self._unreadline(line)
+
+                    break
+
+                if match[1]:
+                    break
+
+                if self.max_parts and self.part_count >= self.max_parts:
+                    if not self.truncated:
+                        logging.warning("email has more than {} parts".format(self.max_parts))
+
+                    self.truncated = True
+                    self._skip_body()
+                    continue
+
+                children.append(self._parse_part(depth + 1))
+        finally:
+            self._boundaries.pop()
+
+        # the epilogue
+        if match is not None and match[0] == boundary:
+            self._skip_body()
+
+        part.set_payload(children)
+
+    def _parse_message(self, part, depth):
+        # the attached email is spooled as it is so that it can be extracted as a file
+        self._spool_body(part)
+
+        saved_state = self._fp, self._pending_line, self._boundaries
+        try:
+            with open(part.spool_path, 'rb') as fp:
+                self._fp = fp
+                self._pending_line = None
+                self._boundaries = []
+                part.set_payload([ self._parse_part(depth + 1) ])
+        finally:
+            self._fp, self._pending_line, self._boundaries = saved_state
+
+    def _skip_body(self):
+        while True:
+            line = self._readline()
+            if not line:
+                break
+
+            if self._match_boundary(line):
+                self._unreadline(line)
+                break
+
+    def _spool_body(self, part):
+        encoding = str(part.get('content-transfer-encoding', '')).strip().lower()
+        fd, part.spool_path = tempfile.mkstemp(dir=self.spool_dir)
+        sha256 = hashlib.sha256()
+
+        # the line break before a boundary is part of the boundary
+        line_break = b''
+        base64_data = []
+        base64_size = 0
+
+        with os.fdopen(fd, 'wb') as fp:
+            def _write(data):
+                fp.write(data)
+                sha256.update(data)
+                part.payload_size += len(data)
+
+            def _write_base64(final=False):
+                data = b''.join(base64_data)
+                del base64_data[:]
+                remainder = len(data) % 4
+                if remainder and not final:
+                    base64_data.append(data[-remainder:])
+                    data = data[:-remainder]
+                elif remainder:
+                    data += b'=' * (4 - remainder)
+
+                try:
+                    _write(binascii.a2b_base64(data))
+                except binascii.Error as e:
+                    logging.debug("invalid base64 data in email part: {}".format(e))
+
+                return len(base64_data[0]) if base64_data else 0
+
+            while True:
+                line = self._readline()
+                if not line:
+                    # without a boundary the last line break is part of the body
+                    _write(line_break)
+                    break
+
+                if self._match_boundary(line):
+                    self._unreadline(line)
+                    break
+
+                content = line.rstrip(b'\r\n')
+                if encoding == 'base64':
+                    content = _PATTERN_NOT_BASE64.sub(b'', content)
+                    base64_data.append(content)
+                    base64_size += len(content)
+                    if base64_size >= ARCHIVE_CHUNK_SIZE:
+                        base64_size = _write_base64()
+
+                    continue
+
+                if encoding == 'quoted-printable':
+                    _write(line_break + binascii.a2b_qp(content))
+                    # a line that ends with = is continued on the next line
+                    line_break = b'' if content.endswith(b'=') else line[len(content):]
+                    continue
+
+                _write(line_break + content)
+                line_break = line[len(content):]
+
+            if base64_data:
+                _write_base64(final=True)
+
+        part.payload_sha256 = sha256.hexdigest()
@@ -31,6 +31,7 @@ import saq.analysis
 import saq.database
 
 from saq.analysis import Observable, Analysis, RootAnalysis
+from saq.cold_storage import is_packed, unpack_storage_dir
 from saq.constants import *
 from saq.database import Alert, use_db, release_cached_db_connection, enable_cached_db_connections, \
                          get_db_connection, add_workload, acquire_lock, release_lock, execute_with_retry, \
@@ -1857,6 +1858,10 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
             logging.warning("storage directory {} missing - already processed?".format(work_item.storage_dir))
             return
 
+        # alerts in cold storage are unpacked before they are analyzed again
+        if is_packed(work_item.storage_dir):
+            unpack_storage_dir(work_item.storage_dir)
+
         if isinstance(work_item, DelayedAnalysisRequest):
             self.delayed_analysis_request = work_item
             self.delayed_analysis_request.load()
@@ -2553,6 +2553,49 @@ class TestCase(ACEEngineTestCase):
         self.assertIsNone(saq.db.query(Alert).filter(Alert.uuid == ignore_root.uuid).first())
         self.assertFalse(os.path.exists(ignore_root.storage_dir))
 
+    def test_cleanup_resume(self):
+
+        from saq.database import Alert
+        from saq.util.maintenance import cleanup_alerts, CleanupCheckpoint
+
+        root = create_root_analysis(analysis_mode='test_single', uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        root.add_observable(F_TEST, 'test_detection')
+        root.save()
+        root.schedule()
+
+        engine = TestEngine()
+        engine.enable_alerting()
+        engine.enable_module('analysis_module_basic_test', 'test_single')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        alert = saq.db.query(Alert).filter(Alert.uuid==root.uuid).one()
+        alert.load()
+        alert.disposition = DISPOSITION_IGNORE
+        alert.disposition_time = datetime.datetime.now() - datetime.timedelta(days=saq.CONFIG['global'].getint('ignore_days') + 1)
+        alert.sync()
+        alert_id = alert.id
+        saq.db.remove()
+
+        # pretend an earlier cleanup was interrupted after it got past this alert
+        checkpoint = CleanupCheckpoint(os.path.join(saq.DATA_DIR, saq.CONFIG['cleanup']['checkpoint_path']))
+        checkpoint.set('ignore', alert_id)
+
+        # the cleanup picks up after the checkpoint so the alert is still there
+        cleanup_alerts()
+        saq.db.remove()
+        self.assertIsNotNone(saq.db.query(Alert).filter(Alert.uuid == root.uuid).first())
+        self.assertTrue(os.path.exists(root.storage_dir))
+
+        # and the cleanup after that starts from the beginning
+        self.assertEquals(CleanupCheckpoint(checkpoint.path).get('ignore'), 0)
+        cleanup_alerts()
+        saq.db.remove()
+        self.assertIsNone(saq.db.query(Alert).filter(Alert.uuid == root.uuid).first())
+        self.assertFalse(os.path.exists(root.storage_dir))
+
     def test_analysis_mode_dispositioned(self):
 
         from saq.database import Alert, User, Workload, add_workload, set_dispositions
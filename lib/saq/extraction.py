@@ -0,0 +1,253 @@
+# vim: sw=4:ts=4:et
+#
+# bounded archive extraction
+#
+# archives are listed before anything is extracted so that archives that would expand into too many bytes
+# (or that expand too much for their size) are rejected before any work is done
+#
+# zip and tar archives are listed and extracted in process with zipfile and tarfile
+# counting the bytes actually written (the sizes in the listing can lie)
+#
+# everything else is extracted by an external program (7z, unrar, etc...) that runs under
+# cpu time, file size and wall time limits so that a bomb cannot pin the worker that runs it
+#
+# the number of extractions running at the same time on a node is bounded by a set of slot lock files
+# shared by every worker process
+#
+
+import fcntl
+import fnmatch
+import logging
+import os
+import os.path
+import shutil
+import tarfile
+import time
+import zipfile
+
+from collections import namedtuple
+
+__all__ = [
+    'ArchiveEntry',
+    'ArchiveRejected',
+    'ExtractionLimits',
+    'ExtractionSlot',
+    'check_expansion',
+    'extract_tar',
+    'extract_zip',
+    'limited_command',
+    'list_tar',
+    'list_zip',
+    'safe_member_path',
+]
+
+# archives that expand to less than this are never rejected for their compression ratio
+RATIO_MIN_SIZE = 1024 * 1024
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# name is the path inside the archive, size is the uncompressed size
+ArchiveEntry = namedtuple('ArchiveEntry', [ 'name', 'size', 'is_dir' ])
+
+class ArchiveRejected(Exception):
+    """Raised when an archive would exceed the extraction limits."""
+    pass
+
+class ExtractionLimits(object):
+    """The limits applied to a single extraction. A value of 0 means no limit."""
+
+    def __init__(self, max_output_bytes=0, max_files=0, max_compression_ratio=0, cpu_seconds=0,
+                 memory_mb=0, timeout=0):
+        # the total number of bytes that can be extracted
+        self.max_output_bytes = max_output_bytes
+        # the number of files that can be extracted
+        self.max_files = max_files
+        # the maximum ratio of the extracted size to the archive size
+        self.max_compression_ratio = max_compression_ratio
+        # the cpu time (in seconds) an external program can use
+        self.cpu_seconds = cpu_seconds
+        # the virtual memory (in megabytes) an external program can use
+        self.memory_mb = memory_mb
+        # the wall time (in seconds) an external program can run for
+        self.timeout = timeout
+
+def check_expansion(total_size, archive_size, limits):
+    """Raises ArchiveRejected if an archive of archive_size bytes that lists total_size bytes of content
+       would exceed the given limits."""
+    if limits.max_output_bytes and total_size > limits.max_output_bytes:
+        raise ArchiveRejected("archive expands to {} bytes (limit is {})".format(total_size, limits.max_output_bytes))
+
+    if limits.max_compression_ratio and total_size > RATIO_MIN_SIZE:
+        ratio = total_size / max(archive_size, 1)
+        if ratio > limits.max_compression_ratio:
+            raise ArchiveRejected("archive has a compression ratio of {:.0f} (limit is {})".format(
+                                  ratio, limits.max_compression_ratio))
+
+def safe_member_path(target_dir, name):
+    """Returns the path the archive member name should be extracted to inside of target_dir,
+       or None if the name would land outside of it."""
+    name = name.replace('\\', '/')
+    parts = [ p for p in name.split('/') if p not in ( '', '.' ) ]
+    # drive letters (C:) are dropped along with leading slashes
+    if parts and parts[0].endswith(':'):
+        parts = parts[1:]
+
+    if not parts or '..' in parts:
+        return None
+
+    return os.path.join(target_dir, *parts)
+
+def list_zip(path):
+    """Returns the list of ArchiveEntry in the given zip file."""
+    with zipfile.ZipFile(path) as zfile:
+        return [ ArchiveEntry(info.filename, info.file_size, info.is_dir()) for info in zfile.infolist() ]
+
+def list_tar(path):
+    """Returns the list of ArchiveEntry for the regular files and directories in the given tar file."""
+    with tarfile.open(path) as tfile:
+        return [ ArchiveEntry(info.name, info.size, info.isdir()) for info in tfile.getmembers()
+                 if info.isreg() or info.isdir() ]
+
+class _OutputBudget(object):
+    def __init__(self, limits):
+        self.limits = limits
+        self.bytes_written = 0
+        self.files_written = 0
+
+    def add_file(self):
+        if self.limits.max_files and self.files_written >= self.limits.max_files:
+            raise ArchiveRejected("archive contains more than {} files".format(self.limits.max_files))
+
+        self.files_written += 1
+
+    def copy(self, source_fp, target_path):
+        with open(target_path, 'wb') as fp:
+            while True:
+                data = source_fp.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+
+                self.bytes_written += len(data)
+                if self.limits.max_output_bytes and self.bytes_written > self.limits.max_output_bytes:
+                    raise ArchiveRejected("extracted more than {} bytes".format(self.limits.max_output_bytes))
+
+                fp.write(data)
+
+def _is_excluded(name, excluded):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in excluded)
+
+def extract_zip(path, target_dir, limits, password=None, excluded=[]):
+    """Extracts the files in the given zip file into target_dir and returns the list of paths extracted.
+       Members that match any of the fnmatch patterns in excluded are skipped.
+       Raises ArchiveRejected if the limits are exceeded. Anything zipfile cannot handle
+       (unsupported compression or encryption, bad passwords) raises what zipfile raises."""
+    budget = _OutputBudget(limits)
+    result = []
+    with zipfile.ZipFile(path) as zfile:
+        for info in zfile.infolist():
+            if info.is_dir() or _is_excluded(info.filename, excluded):
+                continue
+
+            target_path = safe_member_path(target_dir, info.filename)
+            if target_path is None:
+                logging.warning("skipping zip member {} in {} (invalid path)".format(info.filename, path))
+                continue
+
+            budget.add_file()
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            # bit 0 of the flags is set for encrypted members
+            with zfile.open(info, pwd=password if info.flag_bits & 0x1 else None) as fp:
+                budget.copy(fp, target_path)
+
+            result.append(target_path)
+
+    return result
+
+def extract_tar(path, target_dir, limits):
+    """Extracts the regular files in the given tar file into target_dir and returns the list of paths extracted.
+       Links and device files are skipped. Raises ArchiveRejected if the limits are exceeded."""
+    budget = _OutputBudget(limits)
+    result = []
+    with tarfile.open(path) as tfile:
+        for info in tfile:
+            if not info.isreg():
+                continue
+
+            target_path = safe_member_path(target_dir, info.name)
+            if target_path is None:
+                logging.warning("skipping tar member {} in {} (invalid path)".format(info.name, path))
+                continue
+
+            budget.add_file()
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            budget.copy(tfile.extractfile(info), target_path)
+            result.append(target_path)
+
+    return result
+
+def limited_command(params, limits):
+    """Returns the command line that runs params under the cpu, file size, memory and wall time limits.
+       The limits are applied by the shell so this works with saq.process_server.Popen."""
+    if not shutil.which('timeout') or not limits.timeout:
+        wrapper = 'exec "$@"'
+    else:
+        # the process is killed (not asked) when it runs out of time
+        wrapper = 'exec timeout -s KILL {} "$@"'.format(int(limits.timeout))
+
+    ulimits = []
+    if limits.cpu_seconds:
+        ulimits.append('ulimit -t {}'.format(int(limits.cpu_seconds)))
+    if limits.max_output_bytes:
+        # no single file can be larger than everything we're allowed to extract (in 512 byte blocks)
+        ulimits.append('ulimit -f {}'.format(int(limits.max_output_bytes // 512) + 1))
+    if limits.memory_mb:
+        ulimits.append('ulimit -v {}'.format(int(limits.memory_mb * 1024)))
+
+    return [ '/bin/sh', '-c', '; '.join(ulimits + [ wrapper ]), 'extract' ] + list(params)
+
+class ExtractionSlot(object):
+    """Context manager that holds one of count slots shared by every process on the node.
+       Raises TimeoutError if no slot becomes available in time. A count of 0 means no limit."""
+
+    def __init__(self, slot_dir, count, timeout):
+        self.slot_dir = slot_dir
+        self.count = count
+        self.timeout = timeout
+        self.lock_fp = None
+
+    def acquire(self):
+        if not self.count:
+            return True
+
+        os.makedirs(self.slot_dir, exist_ok=True)
+        start = time.time()
+        while True:
+            for index in range(self.count):
+                lock_fp = open(os.path.join(self.slot_dir, 'slot_{}.lock'.format(index)), 'a')
+                try:
+                    fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock_fp.close()
+                    continue
+
+                self.lock_fp = lock_fp
+                return True
+
+            if time.time() - start >= self.timeout:
+                raise TimeoutError("no extraction slot available in {} after {} seconds".format(
+                                   self.slot_dir, self.timeout))
+
+            time.sleep(0.1)
+
+    def release(self):
+        if self.lock_fp is not None:
+            fcntl.flock(self.lock_fp.fileno(), fcntl.LOCK_UN)
+            self.lock_fp.close()
+            self.lock_fp = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
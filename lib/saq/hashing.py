@@ -0,0 +1,200 @@
+# vim: sw=4:ts=4:et
+#
+# single pass file hashing
+#
+# the md5, sha1, sha256 and ssdeep (when the ssdeep python bindings are installed) digests of a file
+# are all computed from the same read of the data, using large buffers
+#
+# once more than [hashing] thread_threshold bytes have been fed in each digest continues in its own thread
+# hashlib releases the GIL while it hashes large buffers so the digests are computed in parallel
+# with each other and with the I/O that reads (or writes) the data
+#
+
+import hashlib
+import logging
+import queue
+import threading
+
+import saq
+
+__all__ = [
+    'DIGEST_MD5',
+    'DIGEST_SHA1',
+    'DIGEST_SHA256',
+    'DIGEST_SSDEEP',
+    'MultiDigest',
+    'compute_file_digests',
+    'copy_with_digests',
+]
+
+DIGEST_MD5 = 'md5'
+DIGEST_SHA1 = 'sha1'
+DIGEST_SHA256 = 'sha256'
+DIGEST_SSDEEP = 'ssdeep'
+
+# the number of buffers each digest thread can fall behind the reader
+THREAD_QUEUE_SIZE = 4
+
+# the ssdeep module if it is available, False if it is not, None if we have not checked yet
+_ssdeep = None
+
+def _get_ssdeep():
+    global _ssdeep
+    if _ssdeep is None:
+        try:
+            import ssdeep
+            _ssdeep = ssdeep
+        except ImportError as e:
+            logging.debug("ssdeep python bindings not available: {}".format(e))
+            _ssdeep = False
+
+    return _ssdeep
+
+def _config_int(name, default):
+    if saq.CONFIG is None or not saq.CONFIG.has_section('hashing'):
+        return default
+
+    return saq.CONFIG['hashing'].getint(name, fallback=default)
+
+def _config_bool(name, default):
+    if saq.CONFIG is None or not saq.CONFIG.has_section('hashing'):
+        return default
+
+    return saq.CONFIG['hashing'].getboolean(name, fallback=default)
+
+def _update_loop(hasher, data_queue, errors):
+    while True:
+        data = data_queue.get()
+        if data is None:
+            break
+
+        # keep draining the queue after an error so the reader never blocks
+        if not errors:
+            try:
+                hasher.update(data)
+            except Exception as e:
+                errors.append(e)
+
+class MultiDigest(object):
+    """Feeds the same data to every digest. Use update() and then digests(), or close() if you give up early."""
+
+    def __init__(self, thread_threshold=None, ssdeep=None):
+        if thread_threshold is None:
+            thread_threshold = _config_int('thread_threshold', 16 * 1024 * 1024)
+        if ssdeep is None:
+            ssdeep = _config_bool('ssdeep', True)
+
+        # threads are started once this many bytes have been fed in (0 means never)
+        self.thread_threshold = thread_threshold
+        self.size = 0
+
+        self.hashers = {
+            DIGEST_MD5: hashlib.md5(),
+            DIGEST_SHA1: hashlib.sha1(),
+            DIGEST_SHA256: hashlib.sha256(),
+        }
+
+        if ssdeep and _get_ssdeep():
+            self.hashers[DIGEST_SSDEEP] = _get_ssdeep().Hash()
+
+        self.threads = []
+        self.queues = []
+        self.errors = []
+
+    @property
+    def threaded(self):
+        return bool(self.threads)
+
+    def _start_threads(self):
+        for name, hasher in self.hashers.items():
+            data_queue = queue.Queue(maxsize=THREAD_QUEUE_SIZE)
+            thread = threading.Thread(target=_update_loop, args=(hasher, data_queue, self.errors),
+                                      name='Digest {}'.format(name), daemon=True)
+            thread.start()
+            self.queues.append(data_queue)
+            self.threads.append(thread)
+
+    def update(self, data):
+        if not data:
+            return
+
+        self.size += len(data)
+        if not self.threads and self.thread_threshold and self.size > self.thread_threshold:
+            self._start_threads()
+
+        if self.threads:
+            # the same (immutable) bytes object is shared by every thread
+            data = bytes(data)
+            for data_queue in self.queues:
+                data_queue.put(data)
+        else:
+            for hasher in self.hashers.values():
+                hasher.update(data)
+
+    def close(self):
+        """Stops the digest threads (if any were started.)"""
+        for data_queue in self.queues:
+            data_queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.queues = []
+        self.threads = []
+
+    def digests(self):
+        """Returns a dict of the hex digest of each digest name (ssdeep only if it is available.)"""
+        self.close()
+        if self.errors:
+            raise self.errors[0]
+
+        result = {}
+        for name, hasher in self.hashers.items():
+            if name == DIGEST_SSDEEP:
+                result[name] = hasher.digest()
+            else:
+                result[name] = hasher.hexdigest()
+
+        return result
+
+def _buffer_size(buffer_size):
+    if buffer_size is None:
+        buffer_size = _config_int('buffer_size', 1024 * 1024)
+
+    return buffer_size
+
+def compute_file_digests(path, buffer_size=None, thread_threshold=None, ssdeep=None):
+    """Returns the digests of the given file as a dict (see MultiDigest.digests.)"""
+    buffer_size = _buffer_size(buffer_size)
+    digest = MultiDigest(thread_threshold=thread_threshold, ssdeep=ssdeep)
+    try:
+        with open(path, 'rb') as fp:
+            while True:
+                data = fp.read(buffer_size)
+                if not data:
+                    break
+
+                digest.update(data)
+
+        return digest.digests()
+    finally:
+        digest.close()
+
+def copy_with_digests(source_fp, target_path, buffer_size=None, thread_threshold=None, ssdeep=None):
+    """Copies the data of the given file object to target_path and returns the digests of the data.
+       The digests are computed from the data as it is written so the file is never read again."""
+    buffer_size = _buffer_size(buffer_size)
+    digest = MultiDigest(thread_threshold=thread_threshold, ssdeep=ssdeep)
+    try:
+        with open(target_path, 'wb') as fp:
+            while True:
+                data = source_fp.read(buffer_size)
+                if not data:
+                    break
+
+                digest.update(data)
+                fp.write(data)
+
+        return digest.digests()
+    finally:
+        digest.close()
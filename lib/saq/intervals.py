@@ -0,0 +1,84 @@
+# vim: sw=4:ts=4:et
+#
+# integer interval index
+#
+# intervals are sorted by (start asc, end desc) and stored as flat arrays
+# starts    the start of each interval
+# ends      the (inclusive) end of each interval
+# max_ends  the largest end of any interval up to and including this one
+# links     the index of the closest earlier interval that ends at or after this one (-1 if none)
+#
+# to find the intervals that contain a value we bisect to the last interval that starts at or before it
+# and walk backwards from there, following links past intervals that end before the value
+# (everything between an interval and its link ends even earlier) and stopping once max_ends
+# says nothing earlier can reach the value
+#
+# for nested data such as CIDR blocks a link always points at the enclosing block, so after
+# the bisect the walk only climbs nesting levels and a lookup is O(log n + matches * depth)
+# instead of a scan of every interval
+#
+
+from array import array
+from bisect import bisect_right
+
+__all__ = [
+    'IntervalIndex',
+]
+
+class IntervalIndex(object):
+    """Finds every interval that contains a given integer."""
+
+    def __init__(self, starts, ends, max_ends, links):
+        # these can be anything that supports len() and indexing (lists, arrays, memoryviews)
+        self.starts = starts
+        self.ends = ends
+        self.max_ends = max_ends
+        self.links = links
+
+    def __len__(self):
+        return len(self.starts)
+
+    @staticmethod
+    def build(intervals):
+        """Builds an index from an iterable of (start, end) tuples.
+           Returns a tuple of (index, order) where order[i] is the position in the input of the interval at index i.
+           Intervals that are equal keep their input order."""
+        intervals = list(intervals)
+        order = sorted(range(len(intervals)), key=lambda i: (intervals[i][0], -intervals[i][1], i))
+
+        starts = array('I')
+        ends = array('I')
+        max_ends = array('I')
+        links = array('i')
+
+        max_end = 0
+        stack = [] # indexes of the intervals whose end has not been passed yet
+        for i, position in enumerate(order):
+            start, end = intervals[position]
+            if start > end:
+                raise ValueError("invalid interval {} - {}".format(start, end))
+
+            max_end = max(max_end, end)
+            while stack and ends[stack[-1]] < end:
+                stack.pop()
+
+            starts.append(start)
+            ends.append(end)
+            max_ends.append(max_end)
+            links.append(stack[-1] if stack else -1)
+            stack.append(i)
+
+        return IntervalIndex(starts, ends, max_ends, links), order
+
+    def find(self, value):
+        """Returns the indexes of every interval that contains value, the most specific (latest starting) first."""
+        result = []
+        index = bisect_right(self.starts, value) - 1
+        while index >= 0 and self.max_ends[index] >= value:
+            if self.ends[index] >= value:
+                result.append(index)
+                index -= 1
+            else:
+                index = self.links[index]
+
+        return result
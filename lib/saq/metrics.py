@@ -0,0 +1,307 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# rollups of the alert metrics displayed by the gui
+#
+# the metrics page reports alert counts and cycle times (the time between when an alert was inserted and when it
+# was dispositioned) by month, disposition, alert type and analyst over date ranges that can span years
+#
+# metrics_alert_rollup holds these already added up for every hour (PERIOD_HOUR) and every day (PERIOD_DAY) the alerts
+# were inserted in, one row per alert type, company, disposition and analyst (the user that dispositioned the alerts)
+# each row carries a histogram of the cycle times so that percentiles can be estimated without the individual alerts
+#
+# ace update-metrics (meant to run from cron) recomputes the days that have alerts that were inserted or
+# dispositioned since it last ran and then moves metrics_rollup_status.last_update up to the start of the current hour
+# get_alert_metrics reads the rollups up to last_update and the alerts table after that
+#
+
+import bisect
+import datetime
+import logging
+
+import businesstime
+
+from saq.database import execute_with_retry, use_db
+
+__all__ = [
+    'PERIOD_HOUR',
+    'PERIOD_DAY',
+    'CYCLE_TIME_BINS',
+    'business_cycle_time',
+    'AlertMetrics',
+    'aggregate_alerts',
+    'rollup_metrics',
+    'get_last_update',
+    'update_metrics_rollup',
+    'get_alert_metrics',
+]
+
+PERIOD_HOUR = 'HOUR'
+PERIOD_DAY = 'DAY'
+
+# the upper edges (in hours) of the bins of the cycle time histograms (the last bin holds everything longer)
+CYCLE_TIME_BINS = [ 0.25, 0.5, 1, 2, 4, 8, 12, 24, 48, 72, 120, 168, 336, 720 ]
+
+# the business hours used to compute business hour cycle times
+_business_time = businesstime.BusinessTime(business_hours=(datetime.time(6), datetime.time(18)))
+
+def business_cycle_time(insert_date, disposition_time):
+    """Returns the time between insert_date and disposition_time in business hours as a datetime.timedelta."""
+    btd = _business_time.businesstimedelta(insert_date, disposition_time)
+    open_hours = _business_time.open_hours.seconds / 3600
+    return datetime.timedelta(hours=(btd.days * open_hours + btd.seconds / 3600))
+
+class AlertMetrics(object):
+    """The number of alerts and the totals and histogram of their cycle times for a single rollup row."""
+
+    def __init__(self, alert_count=0, cycle_time=0, business_cycle_time=0, histogram=None):
+        self.alert_count = alert_count
+        # the sums of the cycle times of the dispositioned alerts (in seconds)
+        self.cycle_time = cycle_time
+        self.business_cycle_time = business_cycle_time
+        # the number of dispositioned alerts in each of the CYCLE_TIME_BINS
+        self.histogram = histogram if histogram is not None else [ 0 for _ in range(len(CYCLE_TIME_BINS) + 1) ]
+
+    def __repr__(self):
+        return "AlertMetrics(alert_count={},cycle_time={},business_cycle_time={})".format(
+                self.alert_count, self.cycle_time, self.business_cycle_time)
+
+    @property
+    def dispositioned_count(self):
+        return sum(self.histogram)
+
+    def add_alert(self, insert_date, disposition_time):
+        self.alert_count += 1
+        if disposition_time is None:
+            return
+
+        cycle_time = (disposition_time - insert_date).total_seconds()
+        self.cycle_time += cycle_time
+        self.business_cycle_time += business_cycle_time(insert_date, disposition_time).total_seconds()
+        self.histogram[bisect.bisect_left(CYCLE_TIME_BINS, max(0, cycle_time) / 3600)] += 1
+
+    def merge(self, other):
+        self.alert_count += other.alert_count
+        self.cycle_time += other.cycle_time
+        self.business_cycle_time += other.business_cycle_time
+        self.histogram = [ a + b for a, b in zip(self.histogram, other.histogram) ]
+
+    def percentile(self, percent):
+        """Returns an estimate (in hours) of the given percentile (0-100) of the cycle times, or None if no alerts
+           were dispositioned. The estimate is interpolated within the bin of the histogram the percentile falls in."""
+        target = self.dispositioned_count * percent / 100
+        cumulative = 0
+        for index, count in enumerate(self.histogram):
+            if count and cumulative + count >= target:
+                lower = CYCLE_TIME_BINS[index - 1] if index else 0
+                if index == len(CYCLE_TIME_BINS):
+                    return lower
+
+                return lower + (CYCLE_TIME_BINS[index] - lower) * (target - cumulative) / count
+
+            cumulative += count
+
+        return None
+
+def _bucket_start(dt, period):
+    if period == PERIOD_HOUR:
+        return dt.replace(minute=0, second=0, microsecond=0)
+
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _bucket_end(dt, period):
+    """Returns the start of the bucket after dt unless dt is already the start of a bucket."""
+    start = _bucket_start(dt, period)
+    if start == dt:
+        return start
+
+    return start + (datetime.timedelta(hours=1) if period == PERIOD_HOUR else datetime.timedelta(days=1))
+
+def aggregate_alerts(rows, period=PERIOD_HOUR):
+    """Adds up the given rows of (insert_date, alert_type, company_id, disposition, disposition_user_id,
+       disposition_time) into a dict of AlertMetrics keyed by (bucket_start, alert_type, company_id, disposition,
+       disposition_user_id). Missing companies and users are keyed as 0 and open alerts as disposition ''."""
+    result = {}
+    for insert_date, alert_type, company_id, disposition, disposition_user_id, disposition_time in rows:
+        key = (_bucket_start(insert_date, period), alert_type, company_id or 0, disposition or '',
+               disposition_user_id or 0)
+        if key not in result:
+            result[key] = AlertMetrics()
+
+        result[key].add_alert(insert_date, disposition_time if disposition else None)
+
+    return result
+
+def _merge(metrics, key, alert_metrics):
+    if key not in metrics:
+        metrics[key] = AlertMetrics()
+
+    metrics[key].merge(alert_metrics)
+
+def rollup_metrics(metrics, period):
+    """Merges the given AlertMetrics (see aggregate_alerts) into the buckets of the given (larger) period."""
+    result = {}
+    for (bucket_start, *key), alert_metrics in metrics.items():
+        _merge(result, (_bucket_start(bucket_start, period), *key), alert_metrics)
+
+    return result
+
+@use_db
+def get_last_update(db, c):
+    """Returns the time up to which the rollups are complete, or None if they have not been computed yet."""
+    c.execute("SELECT last_update FROM metrics_rollup_status WHERE id = 1")
+    row = c.fetchone()
+    return row[0] if row else None
+
+@use_db
+def update_metrics_rollup(rebuild=False, db=None, c=None):
+    """Recomputes the rollups of every day with alerts that were inserted or dispositioned since the last update, or
+       of every day if rebuild is True (or the rollups have never been computed.) Returns the number of days updated."""
+
+    c.execute("SELECT NOW()")
+    watermark = _bucket_start(c.fetchone()[0], PERIOD_HOUR)
+
+    last_update = None if rebuild else get_last_update()
+    if last_update is None:
+        # the status goes with the rollups so the metrics are read from the alerts table until the rebuild finishes
+        # (and the next update starts over if this one does not)
+        def _clear_rollups(db, c):
+            c.execute("DELETE FROM metrics_rollup_status")
+            c.execute("DELETE FROM metrics_alert_rollup")
+
+        execute_with_retry(db, c, _clear_rollups, (), commit=True)
+        c.execute("SELECT DISTINCT DATE(insert_date) FROM alerts WHERE insert_date < %s", (watermark,))
+    else:
+        c.execute("""
+SELECT DATE(insert_date) FROM alerts WHERE insert_date >= %s AND insert_date < %s
+UNION
+SELECT DATE(insert_date) FROM alerts WHERE disposition_time >= %s AND insert_date < %s""",
+        (last_update, watermark, last_update, watermark))
+
+    days = sorted([ row[0] for row in c ])
+    logging.info("updating the metrics rollups of {} days up to {}".format(len(days), watermark))
+
+    for day in days:
+        day_start = datetime.datetime.combine(day, datetime.time())
+        c.execute("""
+SELECT insert_date, alert_type, company_id, disposition, disposition_user_id, disposition_time
+FROM alerts WHERE insert_date >= %s AND insert_date < %s""",
+        (day_start, min(day_start + datetime.timedelta(days=1), watermark)))
+
+        hour_metrics = aggregate_alerts(c.fetchall(), PERIOD_HOUR)
+        rows = []
+        for period, metrics in [ (PERIOD_HOUR, hour_metrics), (PERIOD_DAY, rollup_metrics(hour_metrics, PERIOD_DAY)) ]:
+            for (bucket_start, alert_type, company_id, disposition, disposition_user_id), alert_metrics \
+            in metrics.items():
+                rows.append((period, bucket_start, alert_type, company_id, disposition, disposition_user_id,
+                             alert_metrics.alert_count, int(alert_metrics.cycle_time),
+                             int(alert_metrics.business_cycle_time),
+                             ','.join(map(str, alert_metrics.histogram))))
+
+        def _replace_day(db, c, day_start, rows):
+            c.execute("""DELETE FROM metrics_alert_rollup WHERE bucket_start >= %s AND bucket_start < %s""",
+                     (day_start, day_start + datetime.timedelta(days=1)))
+            c.executemany("""
+INSERT INTO metrics_alert_rollup ( period, bucket_start, alert_type, company_id, disposition, disposition_user_id,
+                                   alert_count, cycle_time, business_cycle_time, cycle_time_histogram )
+VALUES ( %s, %s, %s, %s, %s, %s, %s, %s, %s, %s )""", rows)
+
+        execute_with_retry(db, c, _replace_day, (day_start, rows), commit=True)
+
+    execute_with_retry(db, c, """
+INSERT INTO metrics_rollup_status ( id, last_update ) VALUES ( 1, %s )
+ON DUPLICATE KEY UPDATE last_update = %s""", (watermark, watermark), commit=True)
+
+    return len(days)
+
+def _split_range(start, end, last_update, period):
+    """Splits the insert date range from start to end (inclusive) into the (period, start, end) ranges read from the
+       rollups and the (start, end, inclusive) ranges read from the alerts table. Ranges end before their end time
+       unless inclusive is True."""
+    rollup_ranges = []
+    raw_ranges = []
+
+    hour_start = _bucket_end(start, PERIOD_HOUR)
+    hour_end = _bucket_start(end, PERIOD_HOUR)
+    if last_update is not None:
+        hour_end = min(hour_end, last_update)
+
+    if last_update is None or hour_start >= hour_end:
+        return rollup_ranges, [ (start, end, True) ]
+
+    raw_ranges = [ (start, hour_start, False), (hour_end, end, True) ]
+
+    day_start = _bucket_end(hour_start, PERIOD_DAY)
+    day_end = _bucket_start(hour_end, PERIOD_DAY)
+    if period == PERIOD_DAY and day_start < day_end:
+        rollup_ranges = [ (PERIOD_HOUR, hour_start, day_start),
+                          (PERIOD_DAY, day_start, day_end),
+                          (PERIOD_HOUR, day_end, hour_end) ]
+    else:
+        rollup_ranges = [ (PERIOD_HOUR, hour_start, hour_end) ]
+
+    return [ _ for _ in rollup_ranges if _[1] < _[2] ], [ _ for _ in raw_ranges if _[0] < _[1] or _[2] ]
+
+def _in_clause(column, values, negate=False):
+    return "{} {}IN ( {} )".format(column, 'NOT ' if negate else '', ','.join([ '%s' for _ in values ]))
+
+@use_db
+def get_alert_metrics(start, end, company_ids=None, excluded_alert_types=None, excluded_dispositions=None,
+                      dispositioned_only=True, period=PERIOD_DAY, db=None, c=None):
+    """Returns the AlertMetrics (see aggregate_alerts) of the alerts inserted from start to end (inclusive.)
+       The rollups of the given period (PERIOD_DAY or PERIOD_HOUR) are used where the range covers entire buckets,
+       hourly rollups or the alerts themselves are used for the rest."""
+
+    where = []
+    params = []
+    if company_ids:
+        where.append(_in_clause('company_id', company_ids))
+        params.extend(company_ids)
+
+    if excluded_alert_types:
+        where.append(_in_clause('alert_type', excluded_alert_types, negate=True))
+        params.extend(excluded_alert_types)
+
+    # open alerts are stored with a disposition of '' in the rollups
+    rollup_where = where[:]
+    rollup_params = params[:]
+    raw_where = where[:]
+    raw_params = params[:]
+
+    if excluded_dispositions:
+        rollup_where.append(_in_clause('disposition', excluded_dispositions, negate=True))
+        rollup_params.extend(excluded_dispositions)
+        raw_where.append('( disposition IS NULL OR {} )'.format(
+                         _in_clause('disposition', excluded_dispositions, negate=True)))
+        raw_params.extend(excluded_dispositions)
+
+    if dispositioned_only:
+        rollup_where.append("disposition != ''")
+        raw_where.append("disposition IS NOT NULL")
+
+    rollup_ranges, raw_ranges = _split_range(start, end, get_last_update(), period)
+    result = {}
+
+    for range_period, range_start, range_end in rollup_ranges:
+        c.execute("""
+SELECT bucket_start, alert_type, company_id, disposition, disposition_user_id,
+       alert_count, cycle_time, business_cycle_time, cycle_time_histogram
+FROM metrics_alert_rollup
+WHERE period = %s AND bucket_start >= %s AND bucket_start < %s {}""".format(
+        ''.join([ ' AND {}'.format(_) for _ in rollup_where ])),
+        tuple([ range_period, range_start, range_end ] + rollup_params))
+
+        for row in c:
+            _merge(result, tuple(row[:5]), AlertMetrics(row[5], row[6], row[7], [ int(_) for _ in row[8].split(',') ]))
+
+    for range_start, range_end, inclusive in raw_ranges:
+        c.execute("""
+SELECT insert_date, alert_type, company_id, disposition, disposition_user_id, disposition_time
+FROM alerts
+WHERE insert_date >= %s AND insert_date {} %s {}""".format(
+        '<=' if inclusive else '<', ''.join([ ' AND {}'.format(_) for _ in raw_where ])),
+        tuple([ range_start, range_end ] + raw_params))
+
+        for key, alert_metrics in aggregate_alerts(c.fetchall(), PERIOD_HOUR).items():
+            _merge(result, key, alert_metrics)
+
+    return result
@@ -16,6 +16,7 @@ import xml.etree.ElementTree as ET
 import saq
 
 from saq.analysis import Analysis, Observable
+from saq.constants import F_FILE
 from saq.error import report_exception
 from saq.network_semaphore import NetworkSemaphoreClient
 from saq.util import create_timedelta, parse_event_time
@@ -111,6 +112,10 @@ class AnalysisModule(object):
         if 'observation_grouping_time_range' in self.config:
             self.observation_grouping_time_range = create_timedelta(self.config['observation_grouping_time_range'])
 
+        # the results of analyzing F_FILE observables can be cached by the sha256 of the file (see saq.analysis_cache)
+        self.cache_results = self.config.getboolean('cache_results', fallback=False)
+        self._result_cache = None
+
     @property
     def is_grouped_by_time(self):
         """Returns True if the observation_grouping_time_range configuration option is being used."""
@@ -222,6 +227,10 @@ class AnalysisModule(object):
                         logging.error("callback failed for {} file {}: {}".format(self, watched_file.path, e))
                         report_exception()
 
+                    # cached results keyed by the old version of the file are no longer used
+                    if self._result_cache is not None:
+                        self._result_cache.refresh_config_version()
+
             except Exception as e:
                 logging.error("unable to check file {}: {}".format(watched_file.path, e))
                 report_exception()
@@ -606,6 +615,8 @@ class AnalysisModule(object):
         # if we are executing in "final analysis mode" then we call this function instead
         if final_analysis:
             analysis_result = self.execute_final_analysis(obj)
+        elif self.cache_results and isinstance(obj, Observable) and obj.type == F_FILE:
+            analysis_result = self.execute_cached_analysis(obj)
         else:
             analysis_result = self.execute_analysis(obj)
 
@@ -616,6 +627,33 @@ class AnalysisModule(object):
 
         return analysis_result
 
+    @property
+    def result_cache(self):
+        """Returns the AnalysisResultCache used by this module when cache_results is enabled."""
+        if self._result_cache is None:
+            from saq.analysis_cache import AnalysisResultCache
+            self._result_cache = AnalysisResultCache(self)
+
+        return self._result_cache
+
+    @property
+    def result_cache_version(self):
+        """Returns a value that changes when cached results of this module are no longer valid.
+           Override this if the results depend on something other than the file and the module configuration."""
+        return None
+
+    def execute_cached_analysis(self, _file):
+        """Uses the cached result for this file if one exists, otherwise executes the analysis and caches the result."""
+        if self.result_cache.load(_file):
+            return True
+
+        snapshot = self.result_cache.snapshot(_file)
+        analysis_result = self.execute_analysis(_file)
+        if analysis_result is True:
+            self.result_cache.store(_file, snapshot)
+
+        return analysis_result
+
     def cleanup(self):
         """Called after all analysis has completed. Override this if you need to clean up something after analysis."""
         pass
@@ -971,6 +1009,36 @@ class SplunkAnalysisModule(AnalysisModule, SplunkQueryObject):
 
         return self.query_relative(query, event_time)
 
+    def splunk_search(self, search, value, event_time=None):
+        """Runs the given saq.splunk.SplunkSearch for the given value around the event_time (defaults to the alert time.)
+           The search is merged with the searches for other values made at the same time and the results are cached.
+           Returns the list of events for the value, or None if the search failed."""
+        from saq.splunk import SplunkSearchCoalescer, execute_splunk_search
+        assert event_time is None or isinstance(event_time, datetime.datetime)
+        if not self.enabled:
+            return None
+
+        if event_time is None:
+            event_time = self.root.event_time_datetime
+
+        earliest = event_time - create_timedelta(self.relative_duration_before)
+        latest = event_time + create_timedelta(self.relative_duration_after)
+
+        def _execute(query, earliest, latest, value_count):
+            try:
+                # the search still runs when semaphores are disabled (or unavailable)
+                self.acquire_semaphore()
+                if self.cancel_analysis_flag:
+                    raise RuntimeError("analysis was cancelled")
+
+                return execute_splunk_search(query, earliest, latest,
+                                             max_result_count=int(self.max_result_count) * value_count,
+                                             timeout=saq.CONFIG['splunk'].getint('query_timeout'))
+            finally:
+                self.release_semaphore()
+
+        return SplunkSearchCoalescer().search(search, value, earliest, latest, _execute)
+
     def handle_cancel_event(self):
         # try to stop any existing splunk query
         self.cancel()
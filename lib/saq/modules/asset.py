@@ -14,8 +14,7 @@ import saq
 from saq.analysis import Analysis, Observable
 from saq.modules import AnalysisModule, LDAPAnalysisModule, CarbonBlackAnalysisModule
 from saq.constants import *
-
-import iptools
+from saq.refdata import get_reference_data, ipv4_range
 
 ANALYSIS_DNS_RESOLVED = 'resolved'
 ANALYSIS_DNS_FQDN = 'fqdn'
@@ -49,11 +48,6 @@ def is_fqdn(value):
 
     return False
 
-class _NetworkDefinition(object):
-    def __init__(self, cidr, name):
-        self.cidr = cidr
-        self.name = name
-
 class NetworkIdentifierAnalysis(Analysis):
     """Is this a managed IP address?  What is the general network location?"""
 
@@ -95,33 +89,47 @@ class NetworkIdentifier(AnalysisModule):
     
     def __init__(self, *args, **kwargs):
         super(NetworkIdentifier, self).__init__(*args, **kwargs)
-        self._networks = [] # list of _NetworkDefinition
-        
-        # load the network definitions from the CSV file
-        with open(os.path.join(saq.SAQ_HOME, saq.CONFIG.get(self.config_section, 'csv_file')), 'r') as fp:
+
+        # the network definitions are compiled into shared reference data that all workers map
+        self._networks = get_reference_data('network_identifier', [ self.csv_file ], self.compile_networks)
+        self.watch_file(self.csv_file, self.load_networks)
+
+    @property
+    def csv_file(self):
+        return os.path.join(saq.SAQ_HOME, self.config['csv_file'])
+
+    def load_networks(self):
+        if self._networks.load():
+            logging.debug("loaded {0} network definitions".format(len(self._networks)))
+
+    def compile_networks(self):
+        """Parses the network definitions CSV file into (start, end, [ row_number, name ]) records."""
+        with open(self.csv_file, 'r') as fp:
             reader = csv.reader(fp)
             # these are pulled from splunk and these are the header names
             header = next(reader)
             assert header[0] == 'Indicator'
             assert header[1] == 'Indicator_Type'
-            for row in reader:
-                #logging.debug("loading {0} = {1}".format(row[0], row[1]))
-                self._networks.append(_NetworkDefinition(iptools.IpRange(row[0]), row[1]))
+            for row_number, row in enumerate(reader):
+                try:
+                    start, end = ipv4_range(row[0])
+                except ValueError as e:
+                    logging.error("invalid network definition {}: {}".format(row[0], e))
+                    continue
 
-        logging.debug("loaded {0} network definitions".format(len(self._networks)))
+                yield start, end, [ row_number, row[1] ]
 
     def execute_analysis(self, observable):
 
         # results contain a list of the names of the networks this IP address is in
         analysis = self.create_analysis(observable)
 
-        for network in self._networks:
-            try:
-                if observable.value in network.cidr:
-                    analysis.details.append(network.name)
-            except Exception as e:
-                logging.error("invalid ipv4 {}: {}".format(observable.value, str(e)))
-                continue
+        try:
+            # keep the names in the order they are defined in the CSV file
+            for row_number, name in sorted(self._networks.lookup(observable.value)):
+                analysis.details.append(name)
+        except Exception as e:
+            logging.error("invalid ipv4 {}: {}".format(observable.value, str(e)))
 
         #analysis.details = [x.name for x in self._networks if observable.value in x.cidr]
         observable.add_analysis(analysis)
@@ -218,6 +218,11 @@ class CloudphishAnalyzer(AnalysisModule):
         super().__init__(*args, **kwargs)
         self.next_pool_index = 0
 
+        # results of the last batch submission
+        self.prefetched_results = {} # key = url, value = cloudphish result
+        self.prefetched_root_uuid = None
+        self.prefetched_time = None
+
     @property
     def generated_analysis_type(self):
         return CloudphishAnalysis
@@ -246,6 +251,10 @@ class CloudphishAnalyzer(AnalysisModule):
     def cloudphish_request_limit(self):
         return self.config.getint('cloudphish_request_limit')
 
+    @property
+    def batch_submit(self):
+        return self.config.getboolean('batch_submit', fallback=False)
+
     def verify_environment(self):
         self.verify_config_exists('timeout')
         self.verify_config_exists('use_proxy')
@@ -280,6 +289,83 @@ class CloudphishAnalyzer(AnalysisModule):
         self.next_pool_index += 1
         return result
 
+    def get_context(self):
+        """Returns the context sent to cloudphish with each request."""
+        context = {
+            'c': self.root.uuid, # context
+            't': None, # tracking (see below)
+        }
+
+        tracking = []
+        for o in self.root.all_observables:
+            if o.has_directive(DIRECTIVE_TRACKED):
+                tracking.append({'type': o.type, 
+                                 'value': o.value, 
+                                 'time': None if o.time is None 
+                                         else o.time.strftime(event_time_format_json_tz)})
+
+        context['t'] = json.dumps(tracking, cls=_JSONEncoder)
+        return context
+
+    def get_prefetched_result(self, url, cloudphish_server, context):
+        """Returns the cloudphish result for the given url from a batch submission of all the urls in the current
+           analysis that still need results, or None if the result is not available."""
+
+        # prefetched results are only good for the analysis they were made for
+        # and only until we would check on the status again
+        if self.prefetched_root_uuid != self.root.uuid \
+        or self.prefetched_time is None \
+        or time.time() - self.prefetched_time >= self.frequency:
+            self.prefetched_results = {}
+
+        if url not in self.prefetched_results:
+            self.prefetched_results = {}
+            self.prefetched_root_uuid = self.root.uuid
+            self.prefetched_time = time.time()
+
+            # urls that are already generating work for ACE do not count against the request limit
+            available_requests = self.cloudphish_request_limit - len(self.state['requests'])
+            urls = [ url ]
+            for o in self.root.get_observables_by_type(F_URL):
+                if o.value in urls:
+                    continue
+
+                if o.value not in self.state['requests']:
+                    if available_requests <= len([_ for _ in urls if _ not in self.state['requests']]):
+                        continue
+
+                if urlparse(o.value).scheme not in [ 'http', 'https', 'ftp' ]:
+                    continue
+
+                if not self.accepts(o):
+                    continue
+
+                urls.append(o.value)
+
+            # not worth a batch request for a single url
+            if len(urls) < 2:
+                return None
+
+            try:
+                response = ace_api.cloudphish_submit_batch(urls,
+                                                           context=context, 
+                                                           remote_host=cloudphish_server,
+                                                           ssl_verification=saq.CA_CHAIN_PATH,
+                                                           proxies=saq.PROXIES if self.use_proxy else None,
+                                                           timeout=self.timeout)
+
+                self.prefetched_results = response['results']
+                logging.debug("got {} results for cloudphish batch query @ {} for {}".format(
+                              len(self.prefetched_results), cloudphish_server, self.root))
+
+            except Exception as e:
+                # we fall back to submitting urls one at a time
+                logging.warning("cloudphish batch request failed: {}".format(e))
+                return None
+
+        # each result is only used once
+        return self.prefetched_results.pop(url, None)
+
     def execute_analysis(self, url):
         # don't run cloudphish on cloudphish alerts
         if self.root.alert_type == ANALYSIS_TYPE_CLOUDPHISH:
@@ -342,26 +428,20 @@ class CloudphishAnalyzer(AnalysisModule):
         logging.debug("making cloudphish query against {} for {}".format(cloudphish_server, url.value))
 
         try:
-            context = {
-                'c': self.root.uuid, # context
-                't': None, # tracking (see below)
-            }
-
-            tracking = []
-            for o in self.root.all_observables:
-                if o.has_directive(DIRECTIVE_TRACKED):
-                    tracking.append({'type': o.type, 
-                                     'value': o.value, 
-                                     'time': None if o.time is None 
-                                             else o.time.strftime(event_time_format_json_tz)})
-
-            context['t'] = json.dumps(tracking, cls=_JSONEncoder)
-            response = ace_api.cloudphish_submit(url.value, 
-                                                 context=context, 
-                                                 remote_host=cloudphish_server,
-                                                 ssl_verification=saq.CA_CHAIN_PATH,
-                                                 proxies=saq.PROXIES if self.use_proxy else None,
-                                                 timeout=self.timeout)
+            context = self.get_context()
+
+            # submit all the urls for this analysis at once if we can
+            response = None
+            if self.batch_submit:
+                response = self.get_prefetched_result(url.value, cloudphish_server, context)
+
+            if response is None:
+                response = ace_api.cloudphish_submit(url.value, 
+                                                     context=context, 
+                                                     remote_host=cloudphish_server,
+                                                     ssl_verification=saq.CA_CHAIN_PATH,
+                                                     proxies=saq.PROXIES if self.use_proxy else None,
+                                                     timeout=self.timeout)
 
             logging.debug("got result {} for cloudphish query @ {} for {}".format(response, cloudphish_server, url.value))
 
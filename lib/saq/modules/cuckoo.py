@@ -90,6 +90,13 @@ class CuckooAnalysis(Analysis):
     def generate_summary(self):
         return "Cuckoo Analysis ({}/10.0)".format(self.malscore)
 
+# cuckoo is done with tasks that are reported or failed at any stage (failed_analysis, failed_processing, etc...)
+def is_failed_task_status(status):
+    return status.startswith('failed_')
+
+def is_finished_task_status(status):
+    return status == 'reported' or is_failed_task_status(status)
+
 class CuckooAnalyzer(SandboxAnalysisModule):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -112,6 +119,11 @@ class CuckooAnalyzer(SandboxAnalysisModule):
     def threat_score_threshold(self):
         return self.config.getfloat('threat_score_threshold')
 
+    @property
+    def task_list_limit(self):
+        """Returns the number of recent tasks the sandbox poller lists at once."""
+        return self.config.getint('task_list_limit', fallback=500)
+
     @property
     def protocol(self):
         if 'protocol' in self.config:
@@ -204,7 +216,7 @@ class CuckooAnalyzer(SandboxAnalysisModule):
             if task['id'] in analysis.tasks:
                 continue
 
-            if task['status'] == "failed_analysis":
+            if is_failed_task_status(task['status']):
                 analysis.tasks[task['id']] = True
                 continue
 
@@ -226,12 +238,46 @@ class CuckooAnalyzer(SandboxAnalysisModule):
 
         # if we have not received a report for every task then check back later
         if not analysis.complete:
-            self.delay_analysis(sample, analysis, seconds=self.frequency)
+            job_ids = [ '{}/{}'.format(analysis.server, task['id']) for task in tasks if task['id'] not in analysis.tasks ]
+            self.delay_sandbox_analysis(sample, analysis, job_ids, seconds=self.frequency)
 
         # mark samples as malicious that exceed the threshold defined in the configuration file
         if analysis.malscore >= self.threat_score_threshold:
             sample.add_tag('malicious')
 
+    def get_finished_jobs(self, job_ids):
+        # job ids are server/task_id
+        task_ids = {}
+        for job_id in job_ids:
+            server, task_id = job_id.rsplit('/', 1)
+            task_ids.setdefault(server, []).append(int(task_id))
+
+        result = []
+        for server, server_task_ids in task_ids.items():
+            # the most recent tasks are listed first
+            statuses = {}
+            for task in self.get_api_data(server, 'tasks/list/{}'.format(self.task_list_limit)):
+                statuses[task['id']] = task['status']
+
+            for task_id in server_task_ids:
+                if task_id not in statuses:
+                    # older than anything in the list
+                    statuses[task_id] = self.get_api_data(server, 'tasks/view/{}'.format(task_id))['status']
+
+                if is_finished_task_status(statuses[task_id]):
+                    result.append('{}/{}'.format(server, task_id))
+
+        return result
+
+    def get_api_data(self, server, path):
+        r = requests.get("{}://{}/api/{}/".format(self.protocol, server, path), proxies=self.proxies, verify=False) # XXX
+        if r.status_code != 200:
+            raise Exception("failed to get {}: status code {}".format(path, r.status_code))
+        response = json.loads(r.text)
+        if response['error'] == True:
+            raise Exception("failed to get {}: {}".format(path, response['error_value']))
+        return response['data']
+
     # gets list of tasks linked to this sample
     def get_tasks(self, server, analysis):
         logging.debug("looking for existing tasks")
@@ -11,6 +11,7 @@ import saq
 from saq.analysis import Analysis, Observable
 from saq.constants import *
 from saq.modules import SplunkAnalysisModule, splunktime_to_saqtime
+from saq.splunk import SplunkSearch
 
 KEY_SOURCE_COUNT = 'src_count'
 KEY_REQUEST_BREAKDOWN = 'request_breakdown'
@@ -106,37 +107,36 @@ class DNSRequestAnalyzer_v1(SplunkAnalysisModule):
 
         logging.debug("performing DNS analysis on {}".format(observable.value))
 
-        # first we look at our Windows DNS systems
-        query_broad_filter = observable.value
-        query_fine_filter = 'domain = {} AND snd_rcv = Snd'.format(observable.value)
+        event_time = self.root.event_time_datetime if observable.time_datetime is None else observable.time_datetime
 
         # who made these requests?
+        # (these searches are merged with the searches for other domains made at the same time)
         self.relative_duration_before = self.config['relative_duration_before']
         self.relative_duration_after = self.config['relative_duration_after']
 
-        self.splunk_query("""index=dns_logs {} | search {} | stats dc(src_ip) as source_count""".format(
-            query_broad_filter, query_fine_filter),
-            self.root.event_time_datetime if observable.time_datetime is None else observable.time_datetime)
-        
-        source_count_results = self.json()
+        source_count_results = self.splunk_search(SplunkSearch(
+            'index=dns_logs {terms} | search {conditions} AND snd_rcv = Snd '
+            '| stats dc(src_ip) as source_count by domain', 'domain'), observable.value, event_time)
 
-        if source_count_results is None or len(source_count_results) == 0:
-            logging.error("got 0 results from a stats command (should not happen)")
+        if source_count_results is None:
+            logging.debug("missing search results after splunk query")
             return False
 
         analysis = self.create_analysis(observable)
-        analysis.source_count = source_count_results[0]['source_count']
+        # domains nobody requested do not show up in the stats
+        analysis.source_count = int(source_count_results[0]['source_count']) if source_count_results else 0
 
         # now perform a detailed query for the individual dns requests
-        self.splunk_query("""index=dns_logs {} | search {} | head limit={} | fields *""".format(
-            query_broad_filter, query_fine_filter, self.config['max_request_count']),
-            self.root.event_time_datetime if observable.time_datetime is None else observable.time_datetime)
+        dns_requests = self.splunk_search(SplunkSearch(
+            'index=dns_logs {{terms}} | search {{conditions}} AND snd_rcv = Snd '
+            '| dedup {} domain | fields *'.format(self.config.getint('max_request_count')), 'domain'),
+            observable.value, event_time)
 
-        if self.search_results is None:
+        if dns_requests is None:
             logging.debug("missing search results after splunk query")
             return True
 
-        analysis.dns_requests = self.json()
+        analysis.dns_requests = dns_requests
 
         if analysis.source_count > self.config.getint('max_source_count'):
             return True
@@ -1,10 +1,9 @@
 # vim: sw=4:ts=4:et:cc=120
+import concurrent.futures
 import datetime
 import email.header
 import email.parser
 import email.utils
-import gzip
-import hashlib
 import json
 import logging
 import os, os.path
@@ -13,6 +12,7 @@ import re
 import shutil
 import socket
 import subprocess
+import tempfile
 import uuid
 
 #from subprocess import Popen, PIPE
@@ -20,15 +20,18 @@ import uuid
 import saq
 
 from saq.analysis import Analysis, Observable, recurse_tree, search_down
-from saq.brocess import query_brocess_by_email_conversation, query_brocess_by_source_email
+from saq.brocess import query_email_conversation_counts
 from saq.constants import *
-from saq.crypto import encrypt, decrypt
 from saq.database import get_db_connection, execute_with_retry, Alert, use_db
-from saq.email import normalize_email_address, search_archive, get_email_archive_sections, decode_rfc2822
+from saq.email import normalize_email_address, search_archive, get_email_archive_sections, decode_rfc2822, \
+                      archive_email, archive_hash, get_archive_server_id, \
+                      find_archive_path, get_archive_path, get_archive_codec, write_archive, extract_archive, \
+                      ARCHIVE_CODECS, StreamingEmailParser
 from saq.error import report_exception
 from saq.modules import AnalysisModule, SplunkAnalysisModule, AnalysisModule
 from saq.modules.util import get_email
 from saq.process_server import Popen, PIPE
+from saq.splunk import SplunkSearch
 from saq.whitelist import BrotexWhitelist, WHITELIST_TYPE_SMTP_FROM, WHITELIST_TYPE_SMTP_TO
 
 from msoffice_decrypt import MSOfficeDecryptor, UnsupportedAlgorithm
@@ -366,9 +369,6 @@ class EncryptedArchiveAnalysis(Analysis):
         return "Encrypted Archive Analysis - {}".format(self.details)
 
 class EncryptedArchiveAnalyzer(AnalysisModule):
-    def verify_environment(self):
-        self.verify_program_exists('zcat')
-
     @property
     def generated_analysis_type(self):
         return EncryptedArchiveAnalysis
@@ -382,21 +382,17 @@ class EncryptedArchiveAnalyzer(AnalysisModule):
         if not saq.ENCRYPTION_PASSWORD:
             return False
 
-        # encrypted archives end with .gz.e
-        if not _file.value.endswith('.gz.e'):
+        # encrypted archives end with .gz.e (or .zst.e)
+        codec = get_archive_codec(_file.value)
+        if codec is None:
             return False
 
         file_path = os.path.join(self.root.storage_dir, _file.value)
-        gzip_path = '{}.rfc822.gz'.format(file_path[:-len('.gz.e')])
-        dest_path = '{}.rfc822'.format(file_path[:-len('.gz.e')])
+        dest_path = '{}.rfc822'.format(file_path[:-len('{}.e'.format(ARCHIVE_CODECS[codec]))])
 
         # decrypt and decompress the archive file
         try:
-            decrypt(file_path, gzip_path)
-            with gzip.open(gzip_path, 'rb') as fp_in:
-                with open(dest_path, 'wb') as fp_out:
-                    shutil.copyfileobj(fp_in, fp_out)
-
+            extract_archive(file_path, dest_path)
         except Exception as e:
             logging.error("unable to decrypt {}: {}".format(file_path, e))
             report_exception()
@@ -477,41 +473,15 @@ class BrotexSMTPStreamArchiveAction(AnalysisModule):
             logging.warning("archive path {} already exists".format('{}.gz.e'.format(archive_path)))
             analysis.details = archive_path
             return True
-        else:
-            shutil.copy2(source_path, archive_path)
 
         archive_path += '.gz'
 
-        # compress the data
-        logging.debug("compressing {}".format(archive_path))
-        try:
-            with open(source_path, 'rb') as fp_in:
-                with gzip.open(archive_path, 'wb') as fp_out:
-                    shutil.copyfileobj(fp_in, fp_out)
-
-        except Exception as e:
-            logging.error("compression failed for {}: {}".format(archive_path, e))
-
-        if not os.path.exists(archive_path):
-            raise Exception("compression failed for {}".format(archive_path))
-
-        # encrypt the archive file
+        # compress and encrypt the data in a single pass
         encrypted_file = '{}.e'.format(archive_path)
-
         try:
-            encrypt(archive_path, encrypted_file)
+            write_archive(source_path, encrypted_file, 'gzip')
         except Exception as e:
-            logging.error("unable to encrypt archived stream {}: {}".format(archive_path, e))
-
-        if os.path.exists(encrypted_file):
-            logging.debug("encrypted {}".format(archive_path))
-            try:
-                os.remove(archive_path)
-            except Exception as e:
-                logging.error("unable to delete unencrypted archive file {}: {}".format(archive_path, e))
-                raise e
-        else:
-            raise Exception("expected encrypted output file {} does not exist".format(encrypted_file))
+            raise Exception("unable to archive stream {} to {}: {}".format(source_path, encrypted_file, e))
 
         logging.debug("archived stream {} to {}".format(source_path, encrypted_file))
 
@@ -1160,6 +1130,8 @@ class EmailAnalyzer(AnalysisModule):
         self.verify_config_exists('whitelist_path')
         self.verify_path_exists(self.config['whitelist_path'])
         self.verify_config_exists('scan_inbound_only')
+        self.verify_config_exists('max_parts')
+        self.verify_config_exists('max_depth')
 
     def load_config(self):
         self.whitelist = BrotexWhitelist(os.path.join(saq.SAQ_HOME, self.config['whitelist_path']))
@@ -1185,8 +1157,16 @@ class EmailAnalyzer(AnalysisModule):
         if _file.value.endswith('.headers'):
             return False
 
+        # the parts of the email are decoded into here as the email is parsed
+        spool_dir = tempfile.mkdtemp(prefix='.email_parts_', dir=self.root.storage_dir)
+        try:
+            return self._analyze_rfc822(_file, spool_dir)
+        finally:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+    def _analyze_rfc822(self, _file, spool_dir):
+
         # parse the email
-        unparsed_email = None
         parsed_email = None
 
         # sometimes the actual email we want will be an attachment
@@ -1195,13 +1175,13 @@ class EmailAnalyzer(AnalysisModule):
 
         try:
             logging.debug("parsing email file {}".format(_file))
-            with open(os.path.join(self.root.storage_dir, _file.value), 'r', errors='ignore') as fp:
-                # we ignore any leading and/or trailing whitespace
-                # this isn't technically "correct" but some systems make mistakes
-                unparsed_email = fp.read().strip()
-            
+            parser = StreamingEmailParser(spool_dir, max_parts=self.config.getint('max_parts'),
+                                          max_depth=self.config.getint('max_depth'))
+
             # by default we target the parsed email (see NOTE A)
-            target_email = parsed_email = email.parser.Parser().parsestr(unparsed_email)
+            target_email = parsed_email = parser.parse(os.path.join(self.root.storage_dir, _file.value))
+            if parser.truncated:
+                logging.warning("email {} exceeded the part limits and was only partially parsed".format(_file))
 
         except Exception as e:
             logging.error("unable to parse email {}: {}".format(_file, e))
@@ -1213,9 +1193,6 @@ class EmailAnalyzer(AnalysisModule):
                 dst_path = os.path.join(saq.DATA_DIR, 'review', 'rfc822', str(uuid.uuid4()))
                 shutil.copy(src_path, dst_path)
 
-                with open('{}.unparsed'.format(dst_path), 'w') as fp:
-                    fp.write(unparsed_email)
-
             except Exception as e:
                 logging.error("unable to save file for review: {}".format(e))
 
@@ -1452,7 +1429,8 @@ class EmailAnalyzer(AnalysisModule):
                 # do not extract the target email
                 if target.get_content_type() == 'message/rfc822':
                     # the actual message-id will be in one of the payloads of the email
-                    for payload in target.get_payload():
+                    # (there are none if the email was nested too deep to be parsed)
+                    for payload in target.get_payload() or []:
                         if 'message-id' in payload and payload['message-id'].strip() == target_message_id:
                             return
 
@@ -1516,20 +1494,9 @@ class EmailAnalyzer(AnalysisModule):
                     file_path = '{}{}'.format(_file_name, _file_ext)
                     file_path = os.path.join(self.root.storage_dir, file_path)
 
-                # figure out what the payload should be
-                if target.get_content_type() == 'message/rfc822':
-                    part = target.get_payload()
-                    part = part[0]
-                    payload = part.as_bytes()
-                elif target.is_multipart():
-                    # in the case of email attachments we need the whole things (including headers)
-                    payload = target.as_bytes()
-                else:
-                    # otherwise we just need the decoded contents as bytes
-                    payload = target.get_payload(decode=True)
-
-                with open(file_path, 'wb') as fp:
-                    fp.write(payload)
+                # the payload was already decoded into the spool directory by the parser
+                # (for attached emails this is the entire email including the headers)
+                shutil.move(target.spool_path, file_path)
 
                 logging.debug("extracted {} from {}".format(file_path, _file.value))
 
@@ -1540,8 +1507,8 @@ class EmailAnalyzer(AnalysisModule):
                     extracted_file.add_directive(DIRECTIVE_EXTRACT_URLS)
 
                 # XXX I can't remember why we are still doing the attachment thing
-                attachments.append((len(payload), target.get_content_type(), 
-                                    file_name, hashlib.sha256(payload).hexdigest()))
+                attachments.append((target.payload_size, target.get_content_type(), 
+                                    file_name, target.payload_sha256))
                  
             # otherwise, if it's a multi-part then we want to recurse into it
             elif target.is_multipart():
@@ -1835,10 +1802,13 @@ class EmailArchiveAction(AnalysisModule):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
     
-        # the server_id value of the archive_server table
-        # this will get set once
+        # the hostname recorded in the archive_server table
         self.hostname = socket.gethostname().lower()
-        self.server_id = None
+
+        # the thread pool the archive files are written in when archive_threads is set
+        self.archive_executor = None
+        # the (future, source_path, archive_path) of each archive file still being written for the current analysis
+        self.pending_archives = []
 
     @property
     def valid_observable_types(self):
@@ -1888,61 +1858,68 @@ class EmailArchiveAction(AnalysisModule):
 
         # if we have the encryption password set then we use it to store an encrypted copy of the email
         if saq.ENCRYPTION_PASSWORD:
-            archive_dir = os.path.join(saq.DATA_DIR, self.config['archive_dir'], self.hostname, email_md5[0:3])
+            archive_base_dir = os.path.join(saq.DATA_DIR, self.config['archive_dir'])
+            existing_path = find_archive_path(archive_base_dir, self.hostname, email_md5)
+            if existing_path:
+                logging.info(f"archive path {existing_path} already exists")
+                analysis.details = existing_path[:-len('.e')]
+                return True
+
+            archive_path = get_archive_path(archive_base_dir, self.hostname, email_md5, self.config['compression'])
+            archive_dir = os.path.dirname(archive_path)
             if not os.path.isdir(archive_dir):
                 logging.debug(f"creating archive directory {archive_dir}")
 
                 try:
                     os.makedirs(archive_dir)
-                except:
+                except Exception as e:
                     # it might have already been created by another process
                     # mkdir is an atomic operation (FYI)
                     if not os.path.isdir(archive_dir):
                         raise Exception(f"unable to create archive directory {archive_dir}: {e}")
 
             source_path = os.path.join(self.root.storage_dir, _file.value)
-            archive_path = '{}.gz'.format(os.path.join(archive_dir, email_md5))
-            if os.path.exists('{}.e'.format(archive_path)):
-                logging.info(f"archive path {archive_path}.e already exists")
-                analysis.details = archive_path
-                return True
-                
-            # compress the data
-            logging.debug(f"compressing {archive_path}")
-            try:
-                with open(source_path, 'rb') as fp_in:
-                    with gzip.open(archive_path, 'wb') as fp_out:
-                        shutil.copyfileobj(fp_in, fp_out)
 
-            except Exception as e:
-                logging.error(f"compression failed for {archive_path}: {e}".format(archive_path, e))
-                return False
+            # compress and encrypt the email in a single pass
+            if self.config.getint('archive_threads'):
+                # in the background while the rest of the analysis continues (see cleanup)
+                if self.archive_executor is None:
+                    self.archive_executor = concurrent.futures.ThreadPoolExecutor(
+                                            max_workers=self.config.getint('archive_threads'),
+                                            thread_name_prefix='Email Archiver')
 
-            # encrypt the archive file
-            encrypted_file = f'{archive_path}.e'
+                future = self.archive_executor.submit(write_archive, source_path, archive_path, 
+                                                      self.config['compression'])
+                self.pending_archives.append((future, source_path, archive_path))
+
+                # the archive path is recorded and the email is indexed once the archive file has been written
+                # (see execute_post_analysis)
+                return True
 
             try:
-                encrypt(archive_path, encrypted_file)
+                write_archive(source_path, archive_path, self.config['compression'])
+                logging.info(f"archived email {source_path} to {archive_path}")
             except Exception as e:
-                logging.error(f"unable to encrypt archived email {archive_path}: {e}")
-
-            logging.info(f"archived email {archive_path} to {encrypted_file}")
-
-            # delete the unencrypted copy
-            if os.path.exists(encrypted_file):
-                try:
-                    os.remove(archive_path)
-                except Exception as e:
-                    logging.error(f"unable to delete unencrypted archive file {archive_path}: {e}")
-            else:
-                logging.error(f"expected encrypted output file {encrypted_file} does not exist")
+                logging.error(f"unable to archive email {source_path} to {archive_path}: {e}")
                 return False
 
-            analysis.details = archive_path
+            analysis.details = archive_path[:-len('.e')]
 
         self.index_email(_file, email_analysis)
         return True
 
+    def wait_for_archives(self):
+        """Waits for the archive files still being written in the background."""
+        for future, source_path, archive_path in self.pending_archives:
+            try:
+                future.result()
+                logging.info(f"archived email {source_path} to {archive_path}")
+            except Exception as e:
+                logging.error(f"unable to archive email {source_path} to {archive_path}: {e}")
+                report_exception()
+
+        self.pending_archives = []
+
     def index_email(self, _file, email_analysis):
 
         #
@@ -1953,104 +1930,82 @@ class EmailArchiveAction(AnalysisModule):
         if not email_md5:
             return
 
-        with get_db_connection('email_archive') as db:
-            c = db.cursor()
+        transactions = []
 
-            # do we have our server_id yet?
-            if not self.server_id:
-                c.execute("SELECT server_id FROM archive_server WHERE hostname = %s", (self.hostname,))
-                try:
-                    row = c.fetchone() 
-                    self.server_id = row[0]
-                    logging.debug(f"got server_id {self.server_id} for {self.hostname}")
-                except:
-                    # create the server_id if it does not exist yet
-                    execute_with_retry(db, c, "INSERT IGNORE INTO archive_server ( hostname ) VALUES ( %s )", 
-                                      (self.hostname,))
-                    db.commit()
+        #env_from = normalize_email_address(email_analysis.env_mail_from)
+        #if env_from:
+            #transactions.append(('env_from', env_from))
 
-                    c.execute("SELECT server_id FROM archive_server WHERE hostname = %s", (self.hostname,))
-                    row = c.fetchone() 
-                    self.server_id = row[0]
-                    logging.debug(f"created server_id {self.server_id} for {self.hostname}")
-
-            # have we already started archiving this email?
-            c.execute("SELECT archive_id FROM archive WHERE md5 = UNHEX(%s)", (email_md5,))
-            row = c.fetchone()
-            if row is None:
-                execute_with_retry(db, c, "INSERT IGNORE INTO archive ( server_id, md5 ) VALUES ( %s, UNHEX(%s) )", 
-                                  (self.server_id, email_md5))
-                archive_id = c.lastrowid
-            else:
-                archive_id = row[0]
-
-            logging.debug(f"got archive_id {archive_id} for email {_file.value}")
+        if email_analysis.env_rcpt_to:
+            env_to = normalize_email_address(email_analysis.env_rcpt_to[0])
+            if env_to:
+                transactions.append(('env_to', env_to))
 
-            transactions = []
+        body_from = normalize_email_address(email_analysis.mail_from)
+        if body_from:
+            transactions.append(('body_from', body_from))
 
-            #env_from = normalize_email_address(email_analysis.env_mail_from)
-            #if env_from:
-                #transactions.append(('env_from', env_from))
+        body_to = normalize_email_address(email_analysis.mail_to)
+        if body_to:
+            transactions.append(('body_to', body_to))
 
-            if email_analysis.env_rcpt_to:
-                env_to = normalize_email_address(email_analysis.env_rcpt_to[0])
-                if env_to:
-                    transactions.append(('env_to', env_to))
+        if email_analysis.subject:
+            transactions.append(('subject', email_analysis.subject))
 
-            body_from = normalize_email_address(email_analysis.mail_from)
-            if body_from:
-                transactions.append(('body_from', body_from))
+        if email_analysis.decoded_subject:
+            transactions.append(('decoded_subject', email_analysis.decoded_subject))
 
-            body_to = normalize_email_address(email_analysis.mail_to)
-            if body_to:
-                transactions.append(('body_to', body_to))
+        if email_analysis.message_id:
+            transactions.append(('message_id', email_analysis.message_id))
 
-            if email_analysis.subject:
-                transactions.append(('subject', email_analysis.subject))
-
-            if email_analysis.decoded_subject:
-                transactions.append(('decoded_subject', email_analysis.decoded_subject))
+        from saq.modules.file_analysis import FileHashAnalysis
 
-            if email_analysis.message_id:
-                transactions.append(('message_id', email_analysis.message_id))
-
-            from saq.modules.file_analysis import FileHashAnalysis
-
-            def _callback(target):
-                if isinstance(target, Observable) and target.type == F_URL:
-                    transactions.append(('url', target.value))
+        def _callback(target):
+            if isinstance(target, Observable) and target.type == F_URL:
+                transactions.append(('url', target.value))
 
-                if isinstance(target, FileHashAnalysis):
-                    if target.md5:
-                        transactions.append(('content', target.md5))
-                    
-            recurse_tree(_file, _callback)
+            if isinstance(target, FileHashAnalysis):
+                if target.md5:
+                    transactions.append(('content', target.md5))
+                
+        recurse_tree(_file, _callback)
 
-            # update the fast search indexes
-            for field, email_property in transactions:
-                hasher = hashlib.md5()
-                # not the greatest idea to use the ascii encoding for this...
-                hasher.update(email_property.encode('ascii', errors='ignore'))
-                property_md5 = hasher.hexdigest()
+        with get_db_connection('email_archive') as db:
+            c = db.cursor()
+            server_id = get_archive_server_id(db, c, self.hostname)
 
-                execute_with_retry(db, c, 
-                    "INSERT IGNORE INTO archive_index ( field, hash, archive_id ) VALUES ( %s, UNHEX(%s), %s )",
-                    (field, property_md5, archive_id))
-                execute_with_retry(db, c, 
-                    "INSERT IGNORE INTO archive_search ( field, value, archive_id ) VALUES ( %s, %s, %s )", 
-                    (field, email_property[:2083], archive_id))
+            # the archive entry and all of the search index rows go in as a single transaction
+            archive_id = execute_with_retry(db, c, archive_email, (server_id, email_md5, transactions), commit=True)
+            logging.debug(f"got archive_id {archive_id} for email {_file.value}")
 
-            db.commit()
+    def cleanup(self):
+        # the emails are deleted along with the storage directory so wait for the archive files to be written
+        # (post analysis does not execute when the analysis is delayed)
+        self.wait_for_archives()
 
     #
     # url and content data found in attachments can (will) be added after we initially record the archive analysis
 
     def execute_post_analysis(self):
+        self.wait_for_archives()
+
         for _file in self.root.find_observables(F_FILE):
             email_analysis = _file.get_analysis(EmailAnalysis)
             if not email_analysis:
                 continue
 
+            # emails archived in the background are only recorded once the archive file exists
+            archive_analysis = _file.get_analysis(EmailArchiveResults)
+            if saq.ENCRYPTION_PASSWORD and archive_analysis and not archive_analysis.details:
+                email_md5 = self._get_email_md5(_file)
+                archive_path = find_archive_path(os.path.join(saq.DATA_DIR, self.config['archive_dir']),
+                                                 self.hostname, email_md5) if email_md5 else None
+                if not archive_path:
+                    logging.warning(f"not indexing email {_file.value}: archive file was not written")
+                    continue
+
+                archive_analysis.details = archive_path[:-len('.e')]
+
             self.index_email(_file, email_analysis)
 
     # this was broken when we moved to analysis modes
@@ -2085,6 +2040,14 @@ class EmailConversationFrequencyAnalysis(Analysis):
             self.details['dest_count'])
 
 class EmailConversationFrequencyAnalyzer(AnalysisModule):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # the brocess counts of the email conversations of the root we last looked up (see get_conversation_counts)
+        self.batch_uuid = None
+        self.batch_conversations = set()
+        self.batch_counts = None
+
     def verify_environment(self):
         self.verify_config_exists('cooldown_period')
         self.verify_config_exists('conversation_count_threshold')
@@ -2104,6 +2067,19 @@ class EmailConversationFrequencyAnalyzer(AnalysisModule):
     def valid_observable_types(self):
         return F_EMAIL_CONVERSATION
 
+    def get_conversation_counts(self, email_conversation):
+        """Returns the (source_counts, conversation_counts) of every email conversation in the current root.
+           (see saq.brocess.query_email_conversation_counts)"""
+        # all of the conversations in the root are looked up together the first time one of them is analyzed
+        if self.batch_uuid != self.root.uuid or email_conversation.value not in self.batch_conversations:
+            self.batch_conversations = set([ o.value for o in self.root.get_observables_by_type(F_EMAIL_CONVERSATION) ])
+            self.batch_conversations.add(email_conversation.value)
+            self.batch_counts = query_email_conversation_counts(
+                                [ parse_email_conversation(value) for value in self.batch_conversations ])
+            self.batch_uuid = self.root.uuid
+
+        return self.batch_counts
+
     def execute_analysis(self, email_conversation):
         # are we on cooldown?
         # XXX this should be done from the engine!
@@ -2113,16 +2089,16 @@ class EmailConversationFrequencyAnalyzer(AnalysisModule):
 
         mail_from, rcpt_to = parse_email_conversation(email_conversation.value)
 
-        # how often do we see this email address sending us emails?
-        source_count = 0
         try:
-            source_count = query_brocess_by_source_email(mail_from)
+            source_counts, conversation_counts = self.get_conversation_counts(email_conversation)
         except Exception as e:
             logging.error("unable to query brocess: {}".format(e))
             report_exception()
             self.enter_cooldown()
             return False
 
+        # how often do we see this email address sending us emails?
+        source_count = source_counts[mail_from]
         if not source_count:
             email_conversation.add_tag('new_sender')
 
@@ -2133,22 +2109,13 @@ class EmailConversationFrequencyAnalyzer(AnalysisModule):
         # more frequency analysis
         if source_count:
             # how often do these guys talk?
-            conversation_count = 0
-            try:
-                conversation_count = query_brocess_by_email_conversation(mail_from, rcpt_to)
-
-                # do these guys talk a lot?
-                if conversation_count >= self.conversation_count_threshold:
-                    email_conversation.add_tag('frequent_conversation')
+            conversation_count = conversation_counts[(mail_from, rcpt_to)]
 
-                analysis.details['dest_count'] = conversation_count
-                return True
+            # do these guys talk a lot?
+            if conversation_count >= self.conversation_count_threshold:
+                email_conversation.add_tag('frequent_conversation')
 
-            except Exception as e:
-                logging.error("unable to query brocess: {}".format(e))
-                report_exception()
-                self.enter_cooldown()
-                return False
+            analysis.details['dest_count'] = conversation_count
 
         return True
 
@@ -2315,15 +2282,20 @@ class EmailHistoryAnalyzer_v1(SplunkAnalysisModule):
 
     def execute_analysis(self, email_address):
 
-        self.splunk_query('index=bro sourcetype=bro_smtp {0} | search rcptto = "*{0}*" | sort _time | fields *'.format(email_address.value), 
+        # this search is merged with the searches for other email addresses made at the same time
+        # the number of results is limited per address so that one busy address does not use up the others
+        emails = self.splunk_search(SplunkSearch('index=bro sourcetype=bro_smtp {terms} | search {conditions} '
+                                                 '{limit} | sort _time | fields *', 'rcptto', wildcard=True,
+                                                 limit=int(self.max_result_count)),
+            email_address.value,
             self.root.event_time_datetime if email_address.time_datetime is None else email_address.time_datetime)
 
-        if self.search_results is None:
+        if emails is None:
             logging.debug("missing search results after splunk query")
             return False
 
         analysis = self.create_analysis(email_address)
-        analysis.emails = self.json()
+        analysis.emails = emails
 
 class EmailHistoryRecord(object):
     """Utility class to add extra fields not present in the splunk logs."""
@@ -2882,12 +2854,12 @@ SELECT
     archive_server.hostname, HEX(archive.md5)
 FROM
     archive JOIN archive_server ON archive.server_id = archive_server.server_id
-    JOIN archive_index ON archive.archive_id = archive_index.archive_id
+    JOIN archive_message ON archive.archive_id = archive_message.archive_id
 WHERE 
-    archive_index.field = 'message_id' AND archive_index.hash = UNHEX(MD5(%s))
+    archive_message.message_id_hash = UNHEX(%s)
 """
 
-            c.execute(query, (message_id.value,))
+            c.execute(query, (archive_hash(message_id.value),))
 
             for server, md5 in c:
                 result.append((server, md5))
@@ -2903,15 +2875,14 @@ WHERE
                 logging.warning("archive directory {} does not exist".format(archive_base_dir))
                 continue
 
-            archive_path = os.path.join(archive_base_dir, server.lower(), md5.lower()[0:3], 
-                                        '{}.gz.e'.format(md5.lower()))
-
-            if not os.path.exists(archive_path):
-                logging.warning("archive email {} does not exist at {}".format(md5, archive_path))
+            archive_path = find_archive_path(archive_base_dir, server, md5)
+            if archive_path is None:
+                logging.warning("archive email {} does not exist in {}".format(md5, archive_base_dir))
                 continue
 
             # just add the encrypted file as-is
-            target_path = os.path.join(self.root.storage_dir, '{}.gz.e'.format(message_id.value))
+            target_path = os.path.join(self.root.storage_dir, '{}{}.e'.format(
+                                       message_id.value, ARCHIVE_CODECS[get_archive_codec(archive_path)]))
             if os.path.exists(target_path):
                 logging.warning("target file {} already exists".format(target_path))
 
@@ -2990,7 +2961,7 @@ class URLEmailPivotAnalyzer(AnalysisModule):
     def execute_analysis(self, url):
 
         # at the minimum we look up all the emails that have this url in them
-        url_md5 = hashlib.md5(url.value.encode()).hexdigest()
+        url_md5 = archive_hash(url.value)
         db_sections = get_email_archive_sections()
         emails = {}
         count = 0
@@ -3002,9 +2973,9 @@ class URLEmailPivotAnalyzer(AnalysisModule):
 SELECT 
     COUNT(DISTINCT(archive_id))
 FROM 
-    archive_index 
+    archive_url 
 WHERE 
-    field = 'url' AND hash = UNHEX(%s)""", ( url_md5, ))
+    url_hash = UNHEX(%s)""", ( url_md5, ))
 
                 # first we check to see how many of these we've got
                 row = c.fetchone()
@@ -3028,12 +2999,11 @@ WHERE
                 c = db.cursor()
                 c.execute("""
 SELECT 
-    DISTINCT(asrch.value)
+    DISTINCT(am.message_id)
 FROM 
-    archive_search asrch JOIN archive a ON asrch.archive_id = a.archive_id
-    JOIN archive_index ai ON a.archive_id = ai.archive_id
+    archive_message am JOIN archive_url au ON am.archive_id = au.archive_id
 WHERE 
-    asrch.field = 'message_id' AND ai.field = 'url' AND ai.hash = UNHEX(%s)""", ( url_md5, ))
+    am.message_id IS NOT NULL AND au.url_hash = UNHEX(%s)""", ( url_md5, ))
 
                 message_ids = []
                 for row in c:
@@ -3465,7 +3435,8 @@ SET
     disposition = %s, 
     disposition_user_id = %s, 
     disposition_time = NOW(),
-    owner_id = %s, owner_time = NOW()
+    owner_id = %s, owner_time = NOW(),
+    sla_warning_time = NULL, sla_deadline = NULL
 WHERE 
     uuid = %s AND (disposition IS NULL OR disposition != %s)""", (
                     DISPOSITION_WEAPONIZATION,
@@ -17,7 +17,9 @@ import shutil
 import socket
 import stat
 import sys
+import tarfile
 import tempfile
+import threading
 import time
 import zipfile
 
@@ -35,8 +37,12 @@ import yara_scanner
 from saq.analysis import Analysis, Observable, RootAnalysis
 from saq.constants import *
 from saq.error import report_exception
+from saq.extraction import ArchiveRejected, ExtractionLimits, ExtractionSlot, check_expansion, \
+                           extract_tar, extract_zip, limited_command, list_tar, list_zip
 from saq.modules import AnalysisModule
 from saq.process_server import Popen, PIPE, DEVNULL, TimeoutExpired
+from saq.ssdeep_index import SsdeepHashFile, parse_line
+from saq.yara_server import YaraScannerClient, create_yara_scanner, get_signature_sources
 from saq.util import is_url, URL_REGEX_B, URL_REGEX_STR
 
 from bs4 import BeautifulSoup
@@ -183,6 +189,61 @@ def is_empty_macro(path):
 
     return True
 
+# find_urls is expensive so parts of files that cannot contain a url are skipped
+# (this also matches the utf-16 versions and urls written with backslashes)
+URL_PREFILTER_REGEX = re.compile(rb'://|:\\\\|www\.|:\x00/\x00/|w\x00w\x00w\x00\.', re.I)
+# bytes that end a url, used to pick where to split a file
+# NUL is not one of them because every other byte of utf-16 text is NUL, but the NUL that follows a delimiter
+# in utf-16 is included so that the next chunk starts on a character boundary
+URL_DELIMITER_REGEX = re.compile(rb'[\s"\'<>]\x00?')
+
+def find_urls_in_file(path, base_url=None, chunk_size=4 * 1024 * 1024, overlap=4096, max_urls=None, prefilter=True):
+    """Returns the list of unique urls find_urls extracts from the given file.
+       The file is mapped and passed to find_urls in chunks of chunk_size bytes so that large files are never read into memory.
+       Chunks end at a byte that cannot be part of a url found within overlap bytes of the end of the chunk,
+       or if there is no such byte the chunk is extended by overlap bytes which the next chunk also covers.
+       If prefilter is True then chunks without anything that looks like the start of a url are skipped.
+       Extraction stops once max_urls urls have been found."""
+    result = {} # key = url, value = None (used as an ordered set)
+    if os.path.getsize(path) == 0:
+        return []
+
+    with open(path, 'rb') as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            file_size = len(mm)
+            start = 0
+            while start < file_size:
+                end = min(start + chunk_size, file_size)
+                next_start = end
+                if end < file_size:
+                    # split after the last byte in the last overlap bytes of the chunk that cannot be part of a url
+                    split = None
+                    for m in URL_DELIMITER_REGEX.finditer(mm, max(start, end - overlap), end):
+                        split = m.end()
+
+                    # or extend the chunk to the first one in the next overlap bytes
+                    if split is None:
+                        m = URL_DELIMITER_REGEX.search(mm, end, min(end + overlap, file_size))
+                        if m:
+                            split = m.end()
+
+                    if split is not None:
+                        end = next_start = split
+                    else:
+                        # nowhere to split so the next chunk overlaps this one
+                        end = min(end + overlap, file_size)
+
+                if not prefilter or URL_PREFILTER_REGEX.search(mm, start, end):
+                    for url in find_urls(mm[start:end], base_url=base_url):
+                        result[url] = None
+                        if max_urls is not None and len(result) >= max_urls:
+                            logging.info("reached the limit of {} urls extracted from {}".format(max_urls, path))
+                            return list(result.keys())
+
+                start = next_start
+
+    return list(result.keys())
+
 def _safe_filename(s):
 
     def _safe_char(c):
@@ -352,6 +413,18 @@ class SsdeepAnalysis(Analysis):
 
 class SsdeepAnalyzer(AnalysisModule):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # the hashes we match against are kept in memory and reloaded when the file changes
+        self.ssdeep_hash_file = SsdeepHashFile(self.ssdeep_hashes_path)
+        self.watch_file(self.ssdeep_hashes_path, self.load_ssdeep_hashes)
+
+        # the python bindings for libfuzzy are used to hash files if they are available
+        # otherwise the ssdeep command is used
+        self.fuzzy = None
+        self.fuzzy_failed = False
+
     def verify_environment(self):
         self.verify_config_exists('ssdeep_hashes')
         self.verify_path_exists(self.config['ssdeep_hashes'])
@@ -363,6 +436,10 @@ class SsdeepAnalyzer(AnalysisModule):
     def ssdeep_hashes(self):
         return self.config['ssdeep_hashes']
 
+    @property
+    def ssdeep_hashes_path(self):
+        return os.path.join(saq.SAQ_HOME, self.ssdeep_hashes)
+
     @property
     def maximum_size(self):
         return self.config.getint('maximum_size')
@@ -371,6 +448,14 @@ class SsdeepAnalyzer(AnalysisModule):
     def ssdeep_match_threshold(self):
         return self.config.getint('ssdeep_match_threshold')
 
+    @property
+    def result_cache_version(self):
+        """Cached results are invalidated when the ssdeep hashes file changes."""
+        try:
+            return os.path.getmtime(self.ssdeep_hashes_path)
+        except OSError:
+            return None
+
     @property
     def generated_analysis_type(self):
         return SsdeepAnalysis
@@ -379,6 +464,42 @@ class SsdeepAnalyzer(AnalysisModule):
     def valid_observable_types(self):
         return F_FILE
 
+    def load_ssdeep_hashes(self):
+        count = self.ssdeep_hash_file.load()
+        logging.debug("loaded {} ssdeep hashes from {} ({} total)".format(
+                      count, self.ssdeep_hashes_path, len(self.ssdeep_hash_file.index)))
+
+    def get_ssdeep_hash(self, local_file_path):
+        """Returns the ssdeep hash of the given file, or None if it could not be computed."""
+        if self.fuzzy is None and not self.fuzzy_failed:
+            try:
+                import ssdeep
+                self.fuzzy = ssdeep
+            except ImportError as e:
+                logging.debug("ssdeep python bindings not available (using the ssdeep command instead): {}".format(e))
+                self.fuzzy_failed = True
+
+        if self.fuzzy is not None:
+            return self.fuzzy.hash_from_file(local_file_path)
+
+        p = Popen(['ssdeep', '-s', '-b', local_file_path], stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        (stdout, stderr) = p.communicate()
+
+        if len(stderr) > 0:
+            logging.debug("ssdeep returned errors for {}".format(local_file_path))
+            return None
+
+        # example output:
+        # ssdeep,1.1--blocksize:hash:hash,filename
+        # 96:s4Ud1Lj96tHHlZDrwciQmA+4uy1I0G4HYuL8N3TzS8QsO/wqWXLcMSx:sF1LjEtHHlZDrJzrhuyZvHYm8tKp/RWO,"a5dc57aea5f397c2313e127a6e01aa00"
+        for line in stdout.split('\n'):
+            entry = parse_line(line)
+            if entry is not None:
+                return entry[0]
+
+        logging.error("unexpected ssdeep output for {}: {}".format(local_file_path, stdout))
+        return None
+
     def execute_analysis(self, _file):
 
         # does this file exist as an attachment?
@@ -398,43 +519,28 @@ class SsdeepAnalyzer(AnalysisModule):
             logging.debug("{} too large ({}) for ssdeep analysis".format(local_file_path, file_size))
             return False
 
+        if self.ssdeep_hash_file.index is None:
+            logging.warning("ssdeep hashes not loaded from {}".format(self.ssdeep_hashes_path))
+            return False
+
         logging.debug("analyzing file {}".format(local_file_path))
-        p = Popen(['ssdeep', '-m', self.ssdeep_hashes, local_file_path], 
-            stdout=PIPE, stderr=PIPE, universal_newlines=True)
-        (stdout, stderr) = p.communicate()
+        # use the ssdeep hash computed with the other digests if we have it
+        ssdeep_hash = _file.ssdeep_hash
+        if ssdeep_hash is None:
+            ssdeep_hash = self.get_ssdeep_hash(local_file_path)
 
-        if len(stderr) > 0:
-            logging.debug("ssdeep returned errors for {}".format(local_file_path))
+        if ssdeep_hash is None:
             return False
 
         analysis = None
 
-        for line in stdout.split('\n'):
-            # example output:
-            # /opt/mwzoo/data/pos/frameworkpos/1/a5dc57aea5f397c2313e127a6e01aa00 matches all_the_hashes.ssdeep:/opt/mwzoo/data/pos/frameworkpos/1/a5dc57aea5f397c2313e127a6e01aa00.sample (100)
-            if line == '':
-                continue
-
-            m = re.match(r'^.+? matches [^:]+:(.+) \(([0-9]{1,3})\)$', line)
-            if not m:
-                logging.error("unexpected ssdeep output: {}".format(line))
-                continue
-
-            matched_file = m.group(1)
-            ssdeep_score = 0
-
-            try:
-                ssdeep_score = int(m.group(2))
-            except Exception as e:
-                logging.error("unable to parse {} as integer".format(ssdeep_score))
-
-            if ssdeep_score >= self.ssdeep_match_threshold:
-                _file.add_tag('ssdeep')
-                _file.add_directive(DIRECTIVE_SANDBOX)
-                if not analysis:
-                    analysis = self.create_analysis(_file)
+        for matched_file, ssdeep_score in self.ssdeep_hash_file.index.search(ssdeep_hash, self.ssdeep_match_threshold):
+            _file.add_tag('ssdeep')
+            _file.add_directive(DIRECTIVE_SANDBOX)
+            if not analysis:
+                analysis = self.create_analysis(_file)
 
-                analysis.details['matches'].append({'file': matched_file, 'score': int(ssdeep_score)})
+            analysis.details['matches'].append({'file': matched_file, 'score': ssdeep_score})
 
         return analysis is not None
 
@@ -444,6 +550,8 @@ class ArchiveAnalysis(Analysis):
     def initialize_details(self):
         self.details = {
             'file_count': None,
+            'depth': 0,
+            'limit_exceeded': None,
         }
 
     @property
@@ -454,12 +562,39 @@ class ArchiveAnalysis(Analysis):
     def file_count(self, value):
         self.details['file_count'] = value
 
+    @property
+    def depth(self):
+        """How many archives deep the archive this analysis is for was extracted from."""
+        if not self.details:
+            return 0
+
+        return self.details.get('depth', 0)
+
+    @depth.setter
+    def depth(self, value):
+        self.details['depth'] = value
+
+    @property
+    def limit_exceeded(self):
+        """The reason the extracted files were discarded, or None if they were not."""
+        if not self.details:
+            return None
+
+        return self.details.get('limit_exceeded')
+
+    @limit_exceeded.setter
+    def limit_exceeded(self, value):
+        self.details['limit_exceeded'] = value
+
     def upgrade(self):
         if 'file_count' not in self.details:
             logging.debug("upgrading {0}".format(self))
             self.details['file_count'] = len([x for x in self.observables if x.type == F_FILE])
 
     def generate_summary(self):
+        if self.limit_exceeded:
+            return "Archive Analysis (extracted files discarded: {})".format(self.limit_exceeded)
+
         if self.details['file_count'] is not None and self.details['file_count'] > 0:
             files_available = self.details['file_count']
             files_extracted = len([x for x in self.observables if x.type == F_FILE])
@@ -469,16 +604,33 @@ class ArchiveAnalysis(Analysis):
         return None
 
 # 2018-02-19 12:15:48          319534300    299585795  155 files, 47 folders
-Z7_SUMMARY_REGEX = re.compile(rb'^\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2}\s+\d+\s+\d+\s+(\d+)\s+files.*?')
+Z7_SUMMARY_REGEX = re.compile(rb'^\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2}\s+(\d+)\s+\d+\s+(\d+)\s+files.*?')
 
 # listed: 1 files, totaling 711.168 bytes (compressed 326.520)
 UNACE_SUMMARY_REGEX = re.compile(rb'^listed: (\d+) files,.*')
 
+# avoid the numerious XML documents in excel files
+XLSX_EXCLUDED_MEMBERS = [ 'xl/activeX/*', 'xl/activeX/_rels/*', 'xl/ctrlProps/*.xml' ]
+
+# archive members that indicate the archive is really an office document
+OFFICE_MEMBER_REGEX = re.compile(r'ppt/slides/_rels|word/document\.xml|xl/embeddings/oleObject|xl/worksheets/sheet|'
+                                 r'word.embeddings.oleObject1\.bin')
+
+def get_archive_depth(_file):
+    """Returns how many archives deep the given file was extracted from (0 if it was not extracted from an archive.)"""
+    depth = 0
+    for analysis in _file.parents:
+        if isinstance(analysis, ArchiveAnalysis):
+            depth = max(depth, analysis.depth + 1)
+
+    return depth
+
 class ArchiveAnalyzer(AnalysisModule):
     def verify_environment(self):
         self.verify_config_exists('max_file_count')
         self.verify_config_exists('max_jar_file_count')
         self.verify_config_exists('timeout')
+        self.verify_program_exists('timeout')
         self.verify_program_exists('7z')
         self.verify_program_exists('unrar')
         self.verify_program_exists('unace')
@@ -497,6 +649,58 @@ class ArchiveAnalyzer(AnalysisModule):
     def timeout(self):
         return self.config.getint('timeout')
 
+    @property
+    def kill_timeout(self):
+        return self.config.getint('kill_timeout', fallback=60)
+
+    @property
+    def cpu_limit(self):
+        return self.config.getint('cpu_limit', fallback=0)
+
+    @property
+    def memory_limit_mb(self):
+        return self.config.getint('memory_limit_mb', fallback=0)
+
+    @property
+    def max_extracted_size(self):
+        return self.config.getint('max_extracted_size_mb', fallback=0) * 1024 * 1024
+
+    @property
+    def max_extracted_files(self):
+        return self.config.getint('max_extracted_files', fallback=0)
+
+    @property
+    def max_compression_ratio(self):
+        return self.config.getint('max_compression_ratio', fallback=0)
+
+    @property
+    def max_depth(self):
+        return self.config.getint('max_depth', fallback=0)
+
+    @property
+    def in_process(self):
+        return self.config.getboolean('in_process', fallback=True)
+
+    @property
+    def max_concurrent_extractions(self):
+        return self.config.getint('max_concurrent_extractions', fallback=0)
+
+    @property
+    def slot_timeout(self):
+        return self.config.getint('slot_timeout', fallback=60)
+
+    @property
+    def slot_dir(self):
+        return os.path.join(saq.DATA_DIR, self.config.get('slot_dir', fallback='var/archive_extraction'))
+
+    def get_limits(self):
+        return ExtractionLimits(max_output_bytes=self.max_extracted_size,
+                                max_files=self.max_extracted_files,
+                                max_compression_ratio=self.max_compression_ratio,
+                                cpu_seconds=self.cpu_limit,
+                                memory_mb=self.memory_limit_mb,
+                                timeout=self.kill_timeout)
+
     @property
     def excluded_mime_types(self):
         if 'excluded_mime_types' in self.config:
@@ -511,6 +715,62 @@ class ArchiveAnalyzer(AnalysisModule):
     def valid_observable_types(self):
         return F_FILE
 
+    def extract_with_program(self, local_file_path, extracted_path, limits,
+                             is_rar_file, is_jar_file, is_zip_file, is_ace_file):
+        """Extracts the archive with the external program for the type of archive it is.
+           Returns the exit code of the program."""
+        kwargs = { 'stdout': PIPE, 'stderr': PIPE }
+
+        if is_rar_file:
+            params = ['unrar', 'e', '-y', '-o+', local_file_path, extracted_path]
+        elif is_jar_file:
+            decompiler_path = os.path.join(saq.SAQ_HOME, "bin", "procyon_decompiler.jar")
+            params = ['java', '-jar', decompiler_path, '-jar', local_file_path, '-o', extracted_path]
+        elif is_zip_file:
+            params = ['unzip', local_file_path]
+            for pattern in XLSX_EXCLUDED_MEMBERS:
+                params.extend(['-x', pattern])
+            params.extend(['-d', extracted_path])
+        elif is_ace_file:
+            # for some reason, unace doesn't let you use a full path
+            params = ['unace', 'x', '-y', '-o', os.path.relpath(local_file_path, start=extracted_path)]
+            kwargs['cwd'] = extracted_path
+        else:
+            params = ['7z', '-y', '-pinfected', '-o{}'.format(extracted_path), 'x', local_file_path]
+
+        # the program is killed if it goes past the limits so waiting for it after the timeout is bounded
+        p = Popen(limited_command(params, limits), **kwargs)
+
+        try:
+            (stdout, stderr) = p.communicate(timeout=self.timeout)
+        except TimeoutExpired as e:
+            (stdout, stderr) = p.communicate()
+
+        if p.returncode != 0:
+            logging.warning("{} exited with {} extracting {}: {}".format(
+                            params[0], p.returncode, local_file_path, stderr.decode(errors='ignore').strip()[:1024]))
+
+        return p.returncode
+
+    def check_extracted(self, extracted_path, limits):
+        """Raises ArchiveRejected if the files in extracted_path exceed the number of files or bytes
+           allowed by the given limits. The external programs only have the size of each file limited."""
+        file_count = 0
+        total_size = 0
+        for root, dirs, files in os.walk(extracted_path):
+            for file_name in files:
+                file_count += 1
+                if limits.max_files and file_count > limits.max_files:
+                    raise ArchiveRejected("archive extracted more than {} files".format(limits.max_files))
+
+                try:
+                    total_size += os.lstat(os.path.join(root, file_name)).st_size
+                except OSError:
+                    continue
+
+                if limits.max_output_bytes and total_size > limits.max_output_bytes:
+                    raise ArchiveRejected("archive extracted more than {} bytes".format(limits.max_output_bytes))
+
     def execute_analysis(self, _file):
 
         # does this file exist as an attachment?
@@ -562,9 +822,41 @@ class ArchiveAnalyzer(AnalysisModule):
         is_ace_file = 'ACE archive data' in file_type_analysis.file_type
         is_ace_file |= _file.value.lower().endswith('.ace')
 
+        # avoid extracting archives nested inside of archives inside of archives...
+        depth = get_archive_depth(_file)
+        if self.max_depth and depth >= self.max_depth:
+            logging.info("skipping archive analysis of {}: extracted from {} nested archives (max_depth is {})".format(
+                         local_file_path, depth, self.max_depth))
+            return False
+
+        # zip and tar files are listed and extracted in process when we can
+        in_process_format = None
+        if self.in_process and not is_rar_file and not is_jar_file and not is_ace_file:
+            if zipfile.is_zipfile(local_file_path):
+                in_process_format = 'zip'
+            elif file_type_analysis.mime_type == 'application/x-tar' and tarfile.is_tarfile(local_file_path):
+                in_process_format = 'tar'
+
+        entries = None
+        if in_process_format:
+            try:
+                entries = list_zip(local_file_path) if in_process_format == 'zip' else list_tar(local_file_path)
+            except Exception as e:
+                logging.info("unable to list {} in process: {}".format(local_file_path, e))
+                in_process_format = None
+
         count = 0
+        # the total size of the files in the archive (if we know it)
+        total_size = None
+
+        if entries is not None:
+            count = len([entry for entry in entries if not entry.is_dir])
+            total_size = sum([entry.size for entry in entries])
+            for entry in entries:
+                if OFFICE_MEMBER_REGEX.search(entry.name):
+                    is_office_document = True
 
-        if is_rar_file:
+        elif is_rar_file:
             logging.debug("using unrar to extract files from {}".format(local_file_path))
             p = Popen(['unrar', 'la', local_file_path], stdout=PIPE, stderr=PIPE)
             try:
@@ -671,7 +963,8 @@ class ArchiveAnalyzer(AnalysisModule):
             for line in stdout.split(b'\n'):
                 m = Z7_SUMMARY_REGEX.match(line)
                 if m:
-                    count = int(m.group(1))
+                    total_size = int(m.group(1))
+                    count = int(m.group(2))
 
                 #if line.startswith(b'Testing'):
                     #count += 1
@@ -709,6 +1002,15 @@ class ArchiveAnalyzer(AnalysisModule):
         if count == 0:
             return False
 
+        # reject archive bombs before we extract anything
+        limits = self.get_limits()
+        if total_size is not None:
+            try:
+                check_expansion(total_size, os.path.getsize(local_file_path), limits)
+            except ArchiveRejected as e:
+                logging.warning("skipping archive analysis of {}: {}".format(local_file_path, e))
+                return False
+
         # we need a place to store these things
         extracted_path = '{}.extracted'.format(local_file_path).replace('*', '_') # XXX need a normalize function
         if not os.path.isdir(extracted_path):
@@ -720,37 +1022,47 @@ class ArchiveAnalyzer(AnalysisModule):
 
         logging.debug("extracting {} files from archive {} into {}".format(count, local_file_path, extracted_path))
 
-        analysis = self.create_analysis(_file)
-        analysis.file_count = count
+        try:
+            with ExtractionSlot(self.slot_dir, self.max_concurrent_extractions, self.slot_timeout):
+                if in_process_format:
+                    try:
+                        if in_process_format == 'zip':
+                            extract_zip(local_file_path, extracted_path, limits, password=b'infected',
+                                        excluded=XLSX_EXCLUDED_MEMBERS if is_zip_file else [])
+                        else:
+                            extract_tar(local_file_path, extracted_path, limits)
 
-        params = []
-        kwargs = { 'stdout': PIPE, 'stderr': PIPE }
+                    except ArchiveRejected as e:
+                        logging.warning("stopped extracting {}: {}".format(local_file_path, e))
+                        shutil.rmtree(extracted_path, ignore_errors=True)
+                        return False
 
-        if is_rar_file:
-            params = ['unrar', 'e', '-y', '-o+', local_file_path, extracted_path]
-        elif is_jar_file:
-            decompiler_path = os.path.join(saq.SAQ_HOME, "bin", "procyon_decompiler.jar")
-            params = ['java', '-jar', decompiler_path, '-jar', local_file_path, '-o', extracted_path]
-        elif is_zip_file:
-            # avoid the numerious XML documents in excel files
-            params = ['unzip', local_file_path, '-x', 'xl/activeX/*', 
-                                                '-x', 'xl/activeX/_rels/*', 
-                                                '-x', 'xl/ctrlProps/*.xml',
-                      '-d', extracted_path]
-        elif is_ace_file:
-            # for some reason, unace doesn't let you use a full path
-            params = ['unace', 'x', '-y', '-o', os.path.relpath(local_file_path, start=extracted_path)]
-            kwargs['cwd'] = extracted_path
-        else:
-            params = ['7z', '-y', '-pinfected', '-o{}'.format(extracted_path), 'x', local_file_path]
+                    except Exception as e:
+                        # unsupported compression or encryption methods
+                        logging.info("unable to extract {} in process (trying external program): {}".format(
+                                     local_file_path, e))
+                        in_process_format = None
 
-        if params:
-            p = Popen(params, **kwargs)
+                if not in_process_format:
+                    self.extract_with_program(local_file_path, extracted_path, limits,
+                                              is_rar_file, is_jar_file, is_zip_file, is_ace_file)
 
-            try:
-                (stdout, stderr) = p.communicate(timeout=self.timeout)
-            except TimeoutExpired as e:
-                (stdout, stderr) = p.communicate()
+        except TimeoutError as e:
+            logging.warning("unable to extract {}: {}".format(local_file_path, e))
+            return False
+
+        analysis = self.create_analysis(_file)
+        analysis.file_count = count
+        analysis.depth = depth
+
+        # the listings can be wrong (or missing) so what was actually extracted is checked too
+        try:
+            self.check_extracted(extracted_path, limits)
+        except ArchiveRejected as e:
+            logging.warning("discarding files extracted from {}: {}".format(local_file_path, e))
+            shutil.rmtree(extracted_path, ignore_errors=True)
+            analysis.limit_exceeded = str(e)
+            return True
 
         #logging.debug("extracted into {}".format(extracted_path))
 
@@ -1944,7 +2256,46 @@ class FileTypeAnalysis(Analysis):
                 self.details['mime'] if self.details['mime'] else '')
         return None
 
+class _FileTypeClassifier(object):
+    """Returns the same description and mime type as file -b -L and file -b --mime-type -L using libmagic in process."""
+
+    def __init__(self, buffer_size):
+        import magic
+
+        # the magic database is loaded once for each of these
+        self.description_magic = magic.Magic()
+        self.mime_magic = magic.Magic(mime=True)
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+
+    def classify(self, path):
+        """Returns a tuple of (description, mime_type) for the given file."""
+        # a single read of the header is used for both (open follows symlinks like file -L)
+        with open(path, 'rb') as fp:
+            data = fp.read(self.buffer_size)
+
+        with self.lock:
+            return (self.description_magic.from_buffer(data).strip(),
+                    self.mime_magic.from_buffer(data).strip())
+
 class FileTypeAnalyzer(AnalysisModule):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # the libmagic classifier is created the first time it is needed in each worker process
+        # if it cannot be created then the file command is used
+        self.classifier = None
+        self.classifier_failed = False
+
+    @property
+    def use_libmagic(self):
+        return self.config.getboolean('use_libmagic', fallback=True)
+
+    @property
+    def magic_buffer_size(self):
+        return self.config.getint('magic_buffer_size', fallback=1024 * 1024)
+
     @property
     def generated_analysis_type(self):
         return FileTypeAnalysis
@@ -1952,17 +2303,30 @@ class FileTypeAnalyzer(AnalysisModule):
     @property
     def valid_observable_types(self):
         return F_FILE
-    
-    def execute_analysis(self, _file):
 
-        # does this file exist as an attachment?
-        local_file_path = get_local_file_path(self.root, _file)
-        if not os.path.exists(local_file_path):
-            logging.error("cannot find local file path for {}".format(_file.value))
-            return False
+    def get_classifier(self):
+        """Returns the _FileTypeClassifier to use, or None if the file command should be used instead."""
+        if not self.use_libmagic or self.classifier_failed:
+            return None
 
-        logging.debug("analyzing file {}".format(local_file_path))
-        analysis = self.create_analysis(_file)
+        if self.classifier is None:
+            try:
+                self.classifier = _FileTypeClassifier(self.magic_buffer_size)
+            except Exception as e:
+                logging.warning("unable to load libmagic (using the file command instead): {}".format(e))
+                self.classifier_failed = True
+                return None
+
+        return self.classifier
+
+    def get_file_type(self, local_file_path):
+        """Returns a tuple of (description, mime_type) for the given file."""
+        classifier = self.get_classifier()
+        if classifier is not None:
+            try:
+                return classifier.classify(local_file_path)
+            except Exception as e:
+                logging.warning("libmagic failed for {} (using the file command instead): {}".format(local_file_path, e))
 
         # get the human readable
         p = Popen(['file', '-b', '-L', local_file_path], stdout=PIPE, stderr=PIPE)
@@ -1971,7 +2335,7 @@ class FileTypeAnalyzer(AnalysisModule):
         if len(stderr) > 0:
             logging.warning("file command returned error output for {0}".format(local_file_path))
 
-        analysis.details['type'] = stdout.decode().strip()
+        file_type = stdout.decode().strip()
 
         # get the mime type
         p = Popen(['file', '-b', '--mime-type', '-L', local_file_path], stdout=PIPE, stderr=PIPE)
@@ -1980,7 +2344,20 @@ class FileTypeAnalyzer(AnalysisModule):
         if len(stderr) > 0:
             logging.warning("file command returned error output for {0}".format(local_file_path))
 
-        analysis.details['mime'] = stdout.decode().strip()
+        return file_type, stdout.decode().strip()
+    
+    def execute_analysis(self, _file):
+
+        # does this file exist as an attachment?
+        local_file_path = get_local_file_path(self.root, _file)
+        if not os.path.exists(local_file_path):
+            logging.error("cannot find local file path for {}".format(_file.value))
+            return False
+
+        logging.debug("analyzing file {}".format(local_file_path))
+        analysis = self.create_analysis(_file)
+
+        analysis.details['type'], analysis.details['mime'] = self.get_file_type(local_file_path)
 
         analysis.details['is_office_ext'] = is_office_ext(local_file_path)
         analysis.details['is_ole_file'] = is_ole_file(local_file_path)
@@ -2235,6 +2612,7 @@ class YaraScanResults_v3_4(Analysis):
 #
 # this module has two modes of operation
 # the default mode is to use the Yara Scanner Server (see /opt/yara_scanner)
+# or the yara scanner server built into ACE if [yara_server] is enabled (see saq.yara_server)
 # if this is unavailable then local yara scanning will be used until the server is available again
 #
 
@@ -2263,6 +2641,40 @@ class YaraScanner_v3_4(AnalysisModule):
         """Relative directory of the socket directory of the yara scanner server."""
         return saq.YSS_SOCKET_DIR
 
+    @property
+    def use_yara_server(self):
+        """Returns True if the yara scanner server built into ACE is used instead of yss."""
+        return saq.CONFIG['yara_server'].getboolean('enabled')
+
+    @property
+    def max_batch_size(self):
+        """The maximum number of files sent to the yara scanner server in a single request."""
+        return saq.CONFIG['yara_server'].getint('max_batch_size')
+
+    @property
+    def result_cache_version(self):
+        """Cached results are invalidated when the signature configuration or any of the yara rules change."""
+        result = []
+        for option in sorted(saq.CONFIG['yara'].keys()):
+            if not option.startswith('signature_'):
+                continue
+
+            path = os.path.join(saq.SAQ_HOME, saq.CONFIG['yara'][option])
+            last_mtime = 0
+            for dir_path, dir_names, file_names in os.walk(path):
+                for file_name in file_names:
+                    try:
+                        last_mtime = max(last_mtime, os.path.getmtime(os.path.join(dir_path, file_name)))
+                    except OSError:
+                        pass
+
+            if os.path.isfile(path):
+                last_mtime = os.path.getmtime(path)
+
+            result.append('{}:{}:{}'.format(option, path, last_mtime))
+
+        return ','.join(result)
+
     @property
     def generated_analysis_type(self):
         return YaraScanResults_v3_4
@@ -2293,23 +2705,87 @@ class YaraScanner_v3_4(AnalysisModule):
         # we use it for N minutes defined in the configuration
         self.scanner_start_time = None
 
+        # the pool of connections to the yara scanner server built into ACE
+        self.yara_client = None
+
+        # when using the yara scanner server all the files extracted together are scanned in a single request
+        # key = (root uuid, observable id), value = yara results (or { 'error': message })
+        self.batch_results = {}
+        self.batch_root_uuid = None
+
     def initialize_local_scanner(self):
         logging.info("initializing local yara scanner")
         # initialize the scanner and compile the rules
-        self.scanner = yara_scanner.YaraScanner()
-
-        # load yara dirs and repos
-        for option in saq.CONFIG['yara'].keys():
-            if option.startswith('signature_dir'):
-                self.scanner.track_yara_dir(os.path.join(saq.SAQ_HOME, saq.CONFIG['yara'][option]))
-            elif option.startswith('signature_repo'):
-                self.scanner.track_yara_repository(os.path.join(saq.SAQ_HOME, saq.CONFIG['yara'][option]))
-            elif option.startswith('signature_file'):
-                self.scanner.track_yara_file(os.path.join(saq.SAQ_HOME, saq.CONFIG['yara'][option]))
-
-        self.scanner.load_rules()
+        self.scanner = create_yara_scanner(get_signature_sources())
         self.scanner_start_time = datetime.datetime.now()
-        #self.load_blacklist()
+
+    def get_yara_client(self):
+        if self.yara_client is None:
+            config = saq.CONFIG['yara_server']
+            self.yara_client = YaraScannerClient(os.path.join(saq.DATA_DIR, config['socket_path']),
+                                                 pool_size=config.getint('client_pool_size'),
+                                                 timeout=config.getint('client_timeout'))
+
+        return self.yara_client
+
+    def get_full_path(self, _file):
+        # this path needs to be absolute for the yara scanner server to know where to find it
+        local_file_path = get_local_file_path(self.root, _file)
+        if not os.path.isabs(local_file_path):
+            return os.path.join(os.getcwd(), local_file_path)
+
+        return local_file_path
+
+    def get_batch(self, _file):
+        """Returns the list of (file observable, full path) to scan in a single request: the given file followed by
+           the other files extracted along with it (from the same archive, email, etc.) that have not been scanned yet."""
+        result = [ (_file, self.get_full_path(_file)) ]
+        for parent in _file.parents:
+            for observable in parent.get_observables_by_type(F_FILE):
+                if len(result) >= self.max_batch_size:
+                    return result
+
+                if observable.id in [o.id for o, _ in result]:
+                    continue
+
+                if observable.get_analysis(self.generated_analysis_type) is not None:
+                    continue
+
+                if (self.root.uuid, observable.id) in self.batch_results:
+                    continue
+
+                if observable.has_directive(DIRECTIVE_NO_SCAN):
+                    continue
+
+                full_path = self.get_full_path(observable)
+                if not os.path.exists(full_path) or os.path.getsize(full_path) == 0:
+                    continue
+
+                result.append((observable, full_path))
+
+        return result
+
+    def scan_with_server(self, _file):
+        """Scans the given file (and the files extracted along with it) with the yara scanner server built into ACE.
+           Returns the yara results for the given file."""
+        if self.batch_root_uuid != self.root.uuid:
+            self.batch_results = {}
+            self.batch_root_uuid = self.root.uuid
+
+        result = self.batch_results.pop((self.root.uuid, _file.id), None)
+        if result is None:
+            batch = self.get_batch(_file)
+            results = self.get_yara_client().scan_files([full_path for _, full_path in batch])
+            logging.debug("scanned {} files with yara server for {}".format(len(batch), _file))
+            for (observable, _), observable_result in zip(batch[1:], results[1:]):
+                self.batch_results[(self.root.uuid, observable.id)] = observable_result
+
+            result = results[0]
+
+        if isinstance(result, dict):
+            raise RuntimeError(result['error'])
+
+        return result
 
     #def load_blacklist(self):
         #if self.scanner is None:
@@ -2373,14 +2849,17 @@ class YaraScanner_v3_4(AnalysisModule):
             matches_found = False # set to True if at least one rule matched
 
             try:
-                # this path needs to be absolute for the yara scanner server to know where to find it
-                _full_path = local_file_path
-                if not os.path.isabs(local_file_path):
-                    _full_path = os.path.join(os.getcwd(), local_file_path)
-                result = yara_scanner.scan_file(_full_path, base_dir=self.base_dir, socket_dir=self.socket_dir)
-                matches_found = bool(result)
+                if self.use_yara_server:
+                    result = self.scan_with_server(_file)
+                    matches_found = bool(result)
+                    logging.debug("scanned file {} with yara server (matches found: {})".format(local_file_path, matches_found))
+                else:
+                    # this path needs to be absolute for the yara scanner server to know where to find it
+                    _full_path = self.get_full_path(_file)
+                    result = yara_scanner.scan_file(_full_path, base_dir=self.base_dir, socket_dir=self.socket_dir)
+                    matches_found = bool(result)
 
-                logging.debug("scanned file {} with yss (matches found: {})".format(_full_path, matches_found))
+                    logging.debug("scanned file {} with yss (matches found: {})".format(_full_path, matches_found))
 
                 # if that worked and we have a local scanner see if we still need it
                 # we keep it around for some length of time
@@ -3285,9 +3764,29 @@ class URLExtractionAnalyzer(AnalysisModule):
 
     @property
     def max_file_size(self):
-        """The max file size to extract URLs from (in bytes.)"""
+        """The max file size to extract URLs from (in bytes, 0 for no limit.)"""
         return self.config.getint("max_file_size") * 1024 * 1024
 
+    @property
+    def chunk_size(self):
+        """The number of bytes passed to find_urls at a time."""
+        return self.config.getint("chunk_size", fallback=4096) * 1024
+
+    @property
+    def chunk_overlap(self):
+        """The number of bytes chunks overlap by when they cannot be split between urls."""
+        return self.config.getint("chunk_overlap", fallback=4096)
+
+    @property
+    def max_urls(self):
+        """The maximum number of urls extracted from a single file (0 for no limit.)"""
+        return self.config.getint("max_urls", fallback=0) or None
+
+    @property
+    def use_prefilter(self):
+        """Skip the parts of files that do not contain anything that looks like the start of a url."""
+        return self.config.getboolean("prefilter", fallback=True)
+
     def order_urls_by_interest(self, extracted_urls):
         """Sort the extracted urls into a list by their domain+TLD frequency and path extension.
         Baically, we want the urls that are more likely to be malicious to come first.
@@ -3352,7 +3851,7 @@ class URLExtractionAnalyzer(AnalysisModule):
             return False
 
         # skip files that are too large
-        if file_size > self.max_file_size:
+        if self.max_file_size and file_size > self.max_file_size:
             logging.debug("file {} is too large to extract URLs from".format(_file.value))
             return False
 
@@ -3367,9 +3866,13 @@ class URLExtractionAnalyzer(AnalysisModule):
                 base_url = downloaded_from.target.value
 
         # extract all the URLs out of this file
-        with open(local_file_path, 'rb') as fp:
-            extracted_urls = find_urls(fp.read(), base_url=base_url)
-            logging.debug("extracted {} urls from {}".format(len(extracted_urls), local_file_path))
+        # relative urls do not look like urls so everything is passed to find_urls when we have a base url
+        extracted_urls = find_urls_in_file(local_file_path, base_url=base_url,
+                                           chunk_size=self.chunk_size,
+                                           overlap=self.chunk_overlap,
+                                           max_urls=self.max_urls,
+                                           prefilter=self.use_prefilter and base_url is None)
+        logging.debug("extracted {} urls from {}".format(len(extracted_urls), local_file_path))
 
             # use the strings command to extract any urls that parse out that way
             #try:
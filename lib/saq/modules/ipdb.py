@@ -9,8 +9,7 @@ import saq
 from saq.analysis import Analysis, Observable
 from saq.constants import *
 from saq.modules import AnalysisModule
-
-from iptools import IpRange
+from saq.refdata import get_reference_data, ipv4_range
 
 NETWORK_NETWORK = 'network'
 NETWORK_NAME = 'network_name'
@@ -170,10 +169,8 @@ class IPDBAnalyzer(AnalysisModule):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.networks = [] # list of IPDBNetwork objects
-        self.assignments = {} # key = ipv4, value = IPDBAssignment
-
-        # load the ipdb csv
+        # the ipdb csv is compiled into shared reference data that all workers map
+        self.ipdb = get_reference_data('ipdb', [ self.csv_file ], self.compile_csv_file)
         self.watch_file(self.csv_file, self.load_csv_file)
 
     @property
@@ -185,6 +182,13 @@ class IPDBAnalyzer(AnalysisModule):
         return self.config['csv_file_encoding']
 
     def load_csv_file(self):
+        if self.ipdb.load():
+            logging.debug("loaded {0} ipdb networks and assignments".format(len(self.ipdb)))
+
+    def compile_csv_file(self):
+        """Parses the ipdb csv into /24 network records and single address assignment records."""
+        network_count = 0
+        assignment_count = 0
         line_number = 0
         with open(self.csv_file, 'r', encoding=self.csv_file_encoding) as fp:
             reader = csv.reader(fp)
@@ -229,9 +233,10 @@ class IPDBAnalyzer(AnalysisModule):
                             m = re.match(r'([0-9]{3})\.([0-9]{3})\.([0-9]{3})\.([0-9]{3})$', network)
                             (a,b,c,d) = m.groups()
                             network = '{0}.{1}.{2}'.format(str(int(a)), str(int(b)), str(int(c)))
-                            cidr = IpRange('{0}.0/24'.format(network)) # assuming they are all /24 specs
+                            cidr = '{0}.0/24'.format(network) # assuming they are all /24 specs
                             current_network = IPDBNetwork(network, name, cidr)
-                            self.networks.append(current_network)
+                            network_count += 1
+                            yield ipv4_range(cidr) + (current_network.json,)
                             skip_mode = False
                             #logging.debug("loaded {0}".format(current_network))
 
@@ -265,14 +270,15 @@ class IPDBAnalyzer(AnalysisModule):
                     #if ipv4 in self.assignments:
                         #logging.warning("duplicate ipv4 assignment for {0}".format(ipv4))
 
-                    self.assignments[ipv4] = assignment
+                    assignment_count += 1
+                    yield ipv4_range(ipv4) + (assignment.json,)
                     #logging.debug("loaded {0}".format(assignment))
 
                 except Exception as e:
                     logging.debug("trouble reading ipbd file: {0}".format(str(e)))
                     continue
         
-        logging.debug("loaded {0} ipdb networks and {1} ipdb assignments".format(len(self.networks), len(self.assignments)))
+        logging.debug("parsed {0} ipdb networks and {1} ipdb assignments".format(network_count, assignment_count))
 
     def execute_analysis(self, ipv4):
 
@@ -280,19 +286,15 @@ class IPDBAnalyzer(AnalysisModule):
         analysis = IPDBAnalysis()
         analysis.details = None
 
-        # first check for the ipv4 direct mapping
+        # an assignment for the ipv4 is more specific than the /24 network it is in
+        # and the last entry in the file wins if there are duplicates
         try:
-            analysis.details = self.assignments[ipv4.value].json
-            logging.debug("got ipdb match for {0}: {1}".format(ipv4.value, self.assignments[ipv4.value]))
-        except KeyError:
-            # try to look for the network assignment instead
-            for network in self.networks:
-                try:
-                    if ipv4.value in network.cidr:
-                        analysis.details = network.json
-                        logging.debug("got ipdb network match for {0}: {1}".format(ipv4.value, network))
-                except TypeError:
-                    pass
+            matches = self.ipdb.lookup(ipv4.value)
+            if matches:
+                analysis.details = matches[0]
+                logging.debug("got ipdb match for {0}: {1}".format(ipv4.value, analysis.details))
+        except ValueError:
+            logging.debug("invalid ipv4 {0}".format(ipv4.value))
 
         ipv4.add_analysis(analysis)
 
@@ -83,3 +83,19 @@ class SandboxAnalysisModule(AnalysisModule):
 
         logging.debug("{} is not a supported file type for vx analysis".format(file_path))
         return False
+
+    def get_finished_jobs(self, job_ids):
+        """Returns the list of the given job ids the sandbox has finished (or failed) analyzing.
+           Override this to ask the sandbox about all of the jobs at once (see saq.sandbox_poller.)"""
+        raise NotImplementedError()
+
+    def delay_sandbox_analysis(self, observable, analysis, job_ids, seconds, timeout_minutes=None):
+        """Delays analysis until the sandbox finishes the given jobs.
+           When the sandbox poller is enabled the jobs are registered with it and analysis is delayed
+           for [sandbox_poller] fallback_frequency seconds instead (the poller wakes it up sooner.)"""
+        if saq.CONFIG['sandbox_poller'].getboolean('enabled') and job_ids:
+            from saq.sandbox_poller import register_sandbox_jobs
+            if register_sandbox_jobs(self.root, observable, self, job_ids):
+                seconds = saq.CONFIG['sandbox_poller'].getint('fallback_frequency')
+
+        return self.delay_analysis(observable, analysis, seconds=seconds, timeout_minutes=timeout_minutes)
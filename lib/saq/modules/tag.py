@@ -59,6 +59,10 @@ class _tag_mapping(object):
         if self.match_type == _tag_mapping.MATCH_TYPE_REGEX:
             self.compiled_regex = re.compile(self.value, flags=re.I if ignore_case else 0)
 
+        # globs are compiled the same way (fnmatch.fnmatch only ignores case on some platforms)
+        if self.match_type == _tag_mapping.MATCH_TYPE_GLOB:
+            self.compiled_glob = re.compile(fnmatch.translate(self.value), flags=re.I if ignore_case else 0)
+
         # if we have a cidr go ahead and create the object used to match it
         if self.match_type == _tag_mapping.MATCH_TYPE_CIDR:
             self.compiled_cidr = ipaddress.ip_network(value)
@@ -87,10 +91,7 @@ class _tag_mapping(object):
         return self.value == value
 
     def _matches_glob(self, value):
-        if self.ignore_case:
-            return fnmatch.fnmatch(value, self.value)
-
-        return fnmatch.fnmatchcase(value, self.value)
+        return self.compiled_glob.match(value) is not None
 
     def _matches_regex(self, value):
         return self.compiled_regex.search(value) is not None
@@ -106,6 +107,117 @@ class _tag_mapping(object):
         # is value equal to or a subdomain of self.value?
         return is_subdomain(value, self.value)
 
+# regular expressions that use backreferences cannot be combined with other expressions
+RE_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+class _tag_matcher(object):
+    """All of the tag mappings for a single observable type compiled into indexed lookups."""
+
+    def __init__(self):
+        # each index maps to a list of (position, _tag_mapping) where position is the load order
+        self.exact = {} # key = value
+        self.exact_ignore_case = {} # key = value.lower()
+        self.subdomains = {} # key = domain.lower()
+        self.networks = {} # key = (version, prefixlen), value = { network address >> host bits : [] }
+
+        # glob and regex mappings are tested one at a time but only if the combined filter matches
+        self.patterns = [] # [(position, _tag_mapping)]
+        self.pattern_filter = None
+        # patterns that could not be combined into the filter are always tested
+        self.unfiltered_patterns = [] # [(position, _tag_mapping)]
+
+        self.count = 0
+
+    def add(self, mapper):
+        entry = (self.count, mapper)
+        self.count += 1
+
+        if mapper.match_type == _tag_mapping.MATCH_TYPE_DEFAULT:
+            if mapper.ignore_case:
+                self.exact_ignore_case.setdefault(mapper.value.lower(), []).append(entry)
+            else:
+                self.exact.setdefault(mapper.value, []).append(entry)
+        elif mapper.match_type == _tag_mapping.MATCH_TYPE_SUBDOMAIN:
+            self.subdomains.setdefault(mapper.value.lower(), []).append(entry)
+        elif mapper.match_type == _tag_mapping.MATCH_TYPE_CIDR:
+            network = mapper.compiled_cidr
+            host_bits = network.max_prefixlen - network.prefixlen
+            self.networks.setdefault((network.version, network.prefixlen), {}) \
+                         .setdefault(int(network.network_address) >> host_bits, []).append(entry)
+        elif mapper.match_type == _tag_mapping.MATCH_TYPE_REGEX and RE_BACKREFERENCE.search(mapper.value):
+            self.unfiltered_patterns.append(entry)
+        else:
+            self.patterns.append(entry)
+
+    def compile(self):
+        """Combines the glob and regex mappings into a single expression used to skip values none of them match."""
+        self.pattern_filter = None
+        if not self.patterns:
+            return
+
+        expressions = []
+        patterns = []
+        for entry in self.patterns:
+            position, mapper = entry
+            if mapper.match_type == _tag_mapping.MATCH_TYPE_GLOB:
+                expression = '\\A(?{}:{})'.format('i' if mapper.ignore_case else '', fnmatch.translate(mapper.value))
+            else:
+                expression = '(?{}:{})'.format('i' if mapper.ignore_case else '', mapper.value)
+
+            # things like global inline flags are only valid at the start of an expression
+            try:
+                re.compile(expression)
+            except re.error as e:
+                logging.debug("tag mapping {} cannot be combined: {}".format(mapper, e))
+                self.unfiltered_patterns.append(entry)
+                continue
+
+            expressions.append(expression)
+            patterns.append(entry)
+
+        self.patterns = patterns
+        self.unfiltered_patterns.sort(key=lambda entry: entry[0])
+
+        try:
+            if expressions:
+                self.pattern_filter = re.compile('|'.join(expressions))
+        except re.error as e:
+            logging.warning("unable to combine tag patterns (testing them individually): {}".format(e))
+            self.unfiltered_patterns.extend(self.patterns)
+            self.unfiltered_patterns.sort(key=lambda entry: entry[0])
+            self.patterns = []
+
+    def match(self, value):
+        """Returns the list of _tag_mapping objects that match the given value in the order they were loaded."""
+        result = []
+        result.extend(self.exact.get(value, []))
+        if self.exact_ignore_case:
+            result.extend(self.exact_ignore_case.get(value.lower(), []))
+
+        if self.subdomains:
+            labels = value.lower().split('.')
+            for index in range(len(labels)):
+                result.extend(self.subdomains.get('.'.join(labels[index:]), []))
+
+        if self.networks:
+            try:
+                address = ipaddress.ip_address(value)
+            except ValueError:
+                address = None
+
+            if address is not None:
+                for (version, prefixlen), networks in self.networks.items():
+                    if version == address.version:
+                        result.extend(networks.get(int(address) >> (address.max_prefixlen - prefixlen), []))
+
+        if self.pattern_filter is not None and self.pattern_filter.search(value):
+            result.extend([entry for entry in self.patterns if entry[1].matches(value)])
+
+        result.extend([entry for entry in self.unfiltered_patterns if entry[1].matches(value)])
+
+        result.sort(key=lambda entry: entry[0])
+        return [mapper for position, mapper in result]
+
 class SiteTagAnalyzer(TagAnalysisModule):
     def verify_environment(self):
         self.verify_config_exists('csv_file')
@@ -129,11 +241,12 @@ class SiteTagAnalyzer(TagAnalysisModule):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.tag_mapping = {} # key = type, value = [_tag_mapping]
+        self.tag_mapping = {} # key = type, value = _tag_matcher
         self.watch_file(self.csv_file, self.load_csv_file)
 
     def load_csv_file(self):
         # load the configuration
+        tag_mapping = {} # key = type, value = _tag_matcher
         with open(self.csv_file, 'r') as fp:
             for row in csv.reader(fp):
                 try:
@@ -146,14 +259,26 @@ class SiteTagAnalyzer(TagAnalysisModule):
                 ignore_case = bool(ignore_case)
                 tags = tags.split('|')
 
-                mapper = _tag_mapping(match_type, ignore_case, value, tags)
+                try:
+                    mapper = _tag_mapping(match_type, ignore_case, value, tags)
+                except Exception as e:
+                    logging.error("invalid tag specification: {}: {}".format(','.join(row), e))
+                    continue
+
                 #logging.debug("created mapping {}".format(mapper))
 
                 for o_type in o_types:
-                    if o_type not in self.tag_mapping:
-                        self.tag_mapping[o_type] = []
+                    if o_type not in tag_mapping:
+                        tag_mapping[o_type] = _tag_matcher()
+
+                    tag_mapping[o_type].add(mapper)
+
+        for matcher in tag_mapping.values():
+            matcher.compile()
 
-                    self.tag_mapping[o_type].append(mapper)
+        # replace the old mappings all at once when the file is reloaded
+        self.tag_mapping = tag_mapping
+        logging.debug("loaded {} tag mappings".format(sum([m.count for m in tag_mapping.values()])))
 
     def execute_analysis(self, observable):
 
@@ -162,11 +287,10 @@ class SiteTagAnalyzer(TagAnalysisModule):
 
         analysis = self.create_analysis(observable)
 
-        for mapper in self.tag_mapping[observable.type]:
-            if mapper.matches(observable.value):
-                logging.debug("{} matches {}".format(observable, mapper))
-                for tag in mapper.tags:
-                    observable.add_tag(tag)
+        for mapper in self.tag_mapping[observable.type].match(observable.value):
+            logging.debug("{} matches {}".format(observable, mapper))
+            for tag in mapper.tags:
+                observable.add_tag(tag)
 
         return True
 
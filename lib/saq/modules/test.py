@@ -14,6 +14,7 @@ import saq.test
 from saq.constants import *
 from saq.analysis import Analysis
 from saq.modules import AnalysisModule
+from saq.modules.sandbox import SandboxAnalysisModule
 from saq.test import *
 from saq.util import *
 
@@ -351,6 +352,63 @@ class DelayedAnalysisTestModule(AnalysisModule):
         analysis.details[KEY_COMPLETE_TIME] = datetime.datetime.now()
         return True
 
+class SandboxTestAnalysis(TestAnalysis):
+    def initialize_details(self):
+        self.details = {
+            KEY_REQUEST_COUNT: 0,
+            KEY_COMPLETE_TIME: None,
+        }
+
+    @property
+    def complete_time(self):
+        return self.details_property(KEY_COMPLETE_TIME)
+
+    @property
+    def request_count(self):
+        return self.details_property(KEY_REQUEST_COUNT)
+
+class SandboxTestModule(SandboxAnalysisModule):
+    """Waits on the fake sandbox jobs listed in the observable value (job ids separated by commas.)
+       A job is finished once a file named after it exists in the job_dir."""
+
+    @property
+    def generated_analysis_type(self):
+        return SandboxTestAnalysis
+
+    @property
+    def valid_observable_types(self):
+        return F_TEST
+
+    @property
+    def required_directives(self):
+        return []
+
+    @property
+    def frequency(self):
+        return self.config.getint('frequency')
+
+    @property
+    def job_dir(self):
+        return os.path.join(saq.DATA_DIR, self.config['job_dir'])
+
+    def get_finished_jobs(self, job_ids):
+        return [ job_id for job_id in job_ids if os.path.exists(os.path.join(self.job_dir, job_id)) ]
+
+    def execute_analysis(self, test):
+        analysis = test.get_analysis(SandboxTestAnalysis)
+        if not analysis:
+            analysis = self.create_analysis(test)
+
+        analysis.details[KEY_REQUEST_COUNT] += 1
+        job_ids = test.value.split(',')
+        finished = self.get_finished_jobs(job_ids)
+        if len(finished) < len(job_ids):
+            return self.delay_sandbox_analysis(test, analysis, [ j for j in job_ids if j not in finished ],
+                                               seconds=self.frequency)
+
+        analysis.details[KEY_COMPLETE_TIME] = datetime.datetime.now()
+        return True
+
 class EngineLockingTestAnalysis(Analysis):
     def initialize_details(self):
         pass
@@ -3,6 +3,7 @@
 import datetime
 import filecmp
 import gzip
+import importlib.util
 import json
 import logging
 import os, os.path
@@ -17,7 +18,8 @@ import saq, saq.test
 from saq.analysis import RootAnalysis
 from saq.crypto import decrypt
 from saq.constants import *
-from saq.database import get_db_connection
+from saq.database import get_db_connection, execute_with_retry
+from saq.email import search_archive_ids, archive_email, get_archive_server_id
 from saq.test import *
 from saq.util import storage_dir_from_uuid, workload_storage_dir
 
@@ -550,24 +552,24 @@ class TestCase(ACEModuleTestCase):
             archive_id = row[0]
 
             # check the index and make sure all the expected values are there
-            expected_values = [ ('body_from', b'unixfreak0037@gmail.com'),
-            ('body_to', b'jwdavison@company.com'),
-            ('decoded_subject', b'canary #3'),
-            ('env_to', b'jwdavison@company.com'),
-            ('message_id', b'<CANTOGZsMiMb+7aB868zXSen_fO=NS-qFTUMo9h2eHtOexY8Qhw@mail.gmail.com>'),
-            ('subject', b'canary #3'),
-            ('url', b'http://tldp.org/LDP/abs/html'),
-            ('url', b'https://www.alienvault.com'),
-            ('url', b'http://197.210.28.107')]
+            expected_values = [ ('body_from', 'unixfreak0037@gmail.com'),
+            ('body_to', 'jwdavison@company.com'),
+            ('decoded_subject', 'canary #3'),
+            ('env_to', 'jwdavison@company.com'),
+            ('message_id', '<CANTOGZsMiMb+7aB868zXSen_fO=NS-qFTUMo9h2eHtOexY8Qhw@mail.gmail.com>'),
+            ('subject', 'canary #3'),
+            ('url', 'http://tldp.org/LDP/abs/html'),
+            ('url', 'https://www.alienvault.com'),
+            ('url', 'http://197.210.28.107')]
 
             for field_name, field_value in expected_values:
                 with self.subTest(field_name=field_name, field_value=field_value):
-                    c.execute("SELECT value FROM archive_search WHERE field = %s AND archive_id = %s AND value = %s", 
-                             (field_name, archive_id, field_value))
-                    row = c.fetchone()
-                    self.assertIsNotNone(row)
-                    value = row[0]
-                    self.assertEquals(value, field_value)
+                    self.assertIn(archive_id, search_archive_ids(c, field_name, field_value))
+
+            # the subject and urls can be searched for partial values
+            self.assertIn(archive_id, search_archive_ids(c, 'subject', 'CANARY', exact=False))
+            self.assertIn(archive_id, search_archive_ids(c, 'url', 'alienvault', exact=False))
+            self.assertNotIn(archive_id, search_archive_ids(c, 'url', 'alienvault', exact=True))
 
     def test_archive_2(self):
 
@@ -626,23 +628,18 @@ class TestCase(ACEModuleTestCase):
             archive_id = row[0]
 
             # check the index and make sure all the expected values are there
-            expected_values = [ ('env_to', b'jwdavison@company.com'),
-            ('body_from', b'unixfreak0037@gmail.com'),
-            ('body_to', b'jwdavison@company.com'),
-            ('subject', b'canary #1'),
-            ('decoded_subject', b'canary #1'),
-            ('message_id', b'<CANTOGZuWahvYOEr0NwPELF5ASriGNWjfVsWhMSE_ekiSVw1RbA@mail.gmail.com>'),
-            #('url', b'mailto:unixfreak0037@gmail.com'),
-            ('content', b'6967810094670a0978da20db86fbfadc'),
-            ('url', b'http://www.ams.org') ]
+            expected_values = [ ('env_to', 'jwdavison@company.com'),
+            ('body_from', 'unixfreak0037@gmail.com'),
+            ('body_to', 'jwdavison@company.com'),
+            ('subject', 'canary #1'),
+            ('decoded_subject', 'canary #1'),
+            ('message_id', '<CANTOGZuWahvYOEr0NwPELF5ASriGNWjfVsWhMSE_ekiSVw1RbA@mail.gmail.com>'),
+            #('url', 'mailto:unixfreak0037@gmail.com'),
+            ('content', '6967810094670a0978da20db86fbfadc'),
+            ('url', 'http://www.ams.org') ]
 
             for field_name, field_value in expected_values:
-                c.execute("SELECT value FROM archive_search WHERE field = %s AND archive_id = %s AND value = %s", 
-                         (field_name, archive_id, field_value))
-                row = c.fetchone()
-                self.assertIsNotNone(row)
-                value = row[0]
-                self.assertEquals(value, field_value)
+                self.assertIn(archive_id, search_archive_ids(c, field_name, field_value))
 
     def test_archive_no_local_archive(self):
 
@@ -690,24 +687,130 @@ class TestCase(ACEModuleTestCase):
             archive_id = row[0]
 
             # check the index and make sure all the expected values are there
-            expected_values = [ ('body_from', b'unixfreak0037@gmail.com'),
-            ('body_to', b'jwdavison@company.com'),
-            ('decoded_subject', b'canary #3'),
-            ('env_to', b'jwdavison@company.com'),
-            ('message_id', b'<CANTOGZsMiMb+7aB868zXSen_fO=NS-qFTUMo9h2eHtOexY8Qhw@mail.gmail.com>'),
-            ('subject', b'canary #3'),
-            ('url', b'http://tldp.org/LDP/abs/html'),
-            ('url', b'https://www.alienvault.com'),
-            ('url', b'http://197.210.28.107')]
+            expected_values = [ ('body_from', 'unixfreak0037@gmail.com'),
+            ('body_to', 'jwdavison@company.com'),
+            ('decoded_subject', 'canary #3'),
+            ('env_to', 'jwdavison@company.com'),
+            ('message_id', '<CANTOGZsMiMb+7aB868zXSen_fO=NS-qFTUMo9h2eHtOexY8Qhw@mail.gmail.com>'),
+            ('subject', 'canary #3'),
+            ('url', 'http://tldp.org/LDP/abs/html'),
+            ('url', 'https://www.alienvault.com'),
+            ('url', 'http://197.210.28.107')]
 
             for field_name, field_value in expected_values:
                 with self.subTest(field_name=field_name, field_value=field_value):
-                    c.execute("SELECT value FROM archive_search WHERE field = %s AND archive_id = %s AND value = %s", 
-                             (field_name, archive_id, field_value))
-                    row = c.fetchone()
-                    self.assertIsNotNone(row)
-                    value = row[0]
-                    self.assertEquals(value, field_value)
+                    self.assertIn(archive_id, search_archive_ids(c, field_name, field_value))
+
+    def test_archive_codecs(self):
+        from saq.email import write_archive, read_archive, get_archive_path, find_archive_path
+
+        source_path = os.path.join('test_data', 'emails', 'splunk_logging.email.rfc822')
+        with open(source_path, 'rb') as fp:
+            data = fp.read()
+
+        # zstandard is optional (zstd archives cannot be written or read without it)
+        codecs = [ 'gzip' ]
+        if importlib.util.find_spec('zstandard') is not None:
+            codecs.append('zstd')
+
+        archive_dir = os.path.join(saq.TEMP_DIR, 'archive_unittest')
+        for codec in codecs:
+            with self.subTest(codec=codec):
+                archive_path = get_archive_path(archive_dir, 'unittest', '0123456789abcdef0123456789abcdef', codec)
+                os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+                write_archive(source_path, archive_path, codec)
+                self.assertEquals(find_archive_path(archive_dir, 'unittest', '0123456789ABCDEF0123456789ABCDEF'), 
+                                  archive_path)
+                self.assertEquals(b''.join(read_archive(archive_path)), data)
+                # nothing else (like an unencrypted copy) is left behind
+                self.assertEquals(os.listdir(os.path.dirname(archive_path)), [ os.path.basename(archive_path) ])
+                os.remove(archive_path)
+
+    def test_archive_email(self):
+
+        self.reset_email_archive()
+
+        email_md5 = '0123456789abcdef0123456789abcdef'
+        properties = [ ('message_id', '<unittest@local>'), ('subject', 'hello world') ]
+        properties.extend([ ('url', 'http://unittest.local/{}'.format(i)) for i in range(1200) ])
+
+        with get_db_connection('email_archive') as db:
+            c = db.cursor()
+            server_id = get_archive_server_id(db, c, 'unittest.local')
+            self.assertEquals(get_archive_server_id(db, c, 'unittest.local'), server_id)
+
+            archive_id = execute_with_retry(db, c, archive_email, (server_id, email_md5, properties), commit=True)
+            self.assertEquals(search_archive_ids(c, 'message_id', '<unittest@local>'), set([ archive_id ]))
+            c.execute("SELECT COUNT(*) FROM archive_url WHERE archive_id = %s", (archive_id,))
+            self.assertEquals(c.fetchone()[0], 1200)
+
+            # archiving the same email again adds to the same entry
+            properties.append(('url', 'http://unittest.local/extra'))
+            self.assertEquals(execute_with_retry(db, c, archive_email, (server_id, email_md5, properties), commit=True),
+                              archive_id)
+            c.execute("SELECT COUNT(*) FROM archive")
+            self.assertEquals(c.fetchone()[0], 1)
+            c.execute("SELECT COUNT(*) FROM archive_url WHERE archive_id = %s", (archive_id,))
+            self.assertEquals(c.fetchone()[0], 1201)
+
+    def test_migrate_archive_search(self):
+        from saq.email import migrate_archive_search
+
+        self.reset_email_archive()
+
+        long_url = 'http://unittest.local/{}'.format('a' * 600)
+        properties = [ ('message_id', '<migrate@local>'),
+                       ('env_to', 'john@local'),
+                       ('subject', 'migrated email'),
+                       ('url', 'http://unittest.local/migrated'),
+                       ('url', long_url),
+                       ('content', '0123456789abcdef0123456789abcdef') ]
+
+        with get_db_connection('email_archive') as db:
+            c = db.cursor()
+            # the tables the properties used to be stored in
+            c.execute("""CREATE TABLE IF NOT EXISTS archive_index (
+                         field enum('env_from','env_to','body_from','body_to','subject','decoded_subject','message_id',
+                                    'content','url') NOT NULL,
+                         hash binary(16) NOT NULL,
+                         archive_id int(11) NOT NULL,
+                         PRIMARY KEY (hash, archive_id, field) )""")
+            c.execute("""CREATE TABLE IF NOT EXISTS archive_search (
+                         field enum('env_from','env_to','body_from','body_to','subject','decoded_subject','message_id',
+                                    'content','url') NOT NULL,
+                         value varbinary(512) NOT NULL,
+                         archive_id int(11) NOT NULL,
+                         PRIMARY KEY (field, value, archive_id) )""")
+
+            try:
+                server_id = get_archive_server_id(db, c, 'unittest.local')
+                c.execute("INSERT INTO archive ( server_id, md5 ) VALUES ( %s, UNHEX(%s) )",
+                          (server_id, 'fedcba9876543210fedcba9876543210'))
+                archive_id = c.lastrowid
+
+                # the way the properties used to be recorded (the hash of the value and the value cut to the column)
+                for field, value in properties:
+                    c.execute("INSERT INTO archive_index ( field, hash, archive_id ) VALUES ( %s, UNHEX(MD5(%s)), %s )",
+                              (field, value, archive_id))
+                    c.execute("INSERT INTO archive_search ( field, value, archive_id ) VALUES ( %s, %s, %s )",
+                              (field, value[:512], archive_id))
+
+                db.commit()
+
+                self.assertEquals(migrate_archive_search('email_archive'), 1)
+
+                self.assertEquals(search_archive_ids(c, 'message_id', '<migrate@local>'), set([ archive_id ]))
+                self.assertEquals(search_archive_ids(c, 'env_to', 'john@local'), set([ archive_id ]))
+                self.assertEquals(search_archive_ids(c, 'subject', 'migrated', exact=False), set([ archive_id ]))
+                self.assertEquals(search_archive_ids(c, 'url', 'http://unittest.local/migrated'), set([ archive_id ]))
+                self.assertEquals(search_archive_ids(c, 'content', '0123456789abcdef0123456789abcdef'),
+                                  set([ archive_id ]))
+                # the truncated url could not be migrated
+                self.assertEquals(search_archive_ids(c, 'url', long_url), set())
+
+            finally:
+                c.execute("DROP TABLE IF EXISTS archive_index")
+                c.execute("DROP TABLE IF EXISTS archive_search")
 
     def test_email_pivot(self):
 
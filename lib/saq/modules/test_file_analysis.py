@@ -1,6 +1,8 @@
 # vim: sw=4:ts=4:et
 
 import datetime
+import importlib.util
+import json
 import logging
 import os, os.path
 import shutil
@@ -199,6 +201,72 @@ class TestCase(ACEModuleTestCase):
         bad_url = 'http://www.williamtoms.com/wp-includes/354387473a/autodomain/autodomain/autodomain/autofil'
         self.assertTrue(bad_url in [url.value for url in url_analysis.get_observables_by_type(F_URL)])
 
+    def test_file_analysis_000_url_extraction_002_chunked(self):
+        from urlfinderlib import find_urls
+        from saq.modules.file_analysis import find_urls_in_file
+
+        # urls mixed with text, long runs of bytes that cannot be split on and utf-16
+        target_path = os.path.join(saq.TEMP_DIR, 'url_extraction_chunked')
+        self.tracked_test_files.append(target_path)
+        with open(target_path, 'wb') as fp:
+            for i in range(500):
+                if i % 3 == 0:
+                    fp.write('visit http://host{}.example.com/path/{}/index.html today\n'.format(i, i).encode())
+                elif i % 7 == 0:
+                    fp.write(b'A' * 3000)
+                elif i % 11 == 0:
+                    fp.write(' https://utf16-{}.example.com/ '.format(i).encode('utf-16le'))
+                elif i % 13 == 0:
+                    # utf-16 text longer than the overlap so that chunks have to be split inside of it
+                    fp.write((' '.join(['word{}'.format(j) for j in range(200)]) +
+                              ' https://utf16-long-{}.example.com/path '.format(i)).encode('utf-16le'))
+                else:
+                    fp.write('nothing to see here {}\n'.format(i).encode())
+
+        with open(target_path, 'rb') as fp:
+            expected = set(find_urls(fp.read()))
+
+        self.assertTrue(len(expected) > 0)
+        for chunk_size, overlap in [ (1024, 256), (4096, 4096), (1024 * 1024, 4096) ]:
+            with self.subTest(chunk_size=chunk_size, overlap=overlap):
+                self.assertEquals(set(find_urls_in_file(target_path, chunk_size=chunk_size, overlap=overlap)), expected)
+
+        # the number of urls can be limited
+        self.assertEquals(len(find_urls_in_file(target_path, chunk_size=1024, overlap=256, max_urls=10)), 10)
+
+    def test_file_analysis_000_url_extraction_003_large_file(self):
+        from saq.modules.file_analysis import URLExtractionAnalysis
+
+        root = create_root_analysis(event_time=datetime.datetime.now())
+        root.initialize_storage()
+
+        # larger than the 10MB files used to be limited to with urls at the start, middle and end
+        target_file = 'url_extraction_large'
+        with open(os.path.join(root.storage_dir, target_file), 'wb') as fp:
+            for index in range(3):
+                fp.write(' http://large-{}.example.com/path '.format(index).encode())
+                if index < 2:
+                    fp.write(b'A' * (8 * 1024 * 1024))
+
+        file_observable = root.add_observable(F_FILE, target_file)
+        file_observable.add_directive(DIRECTIVE_EXTRACT_URLS)
+        root.save()
+        root.schedule()
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_url_extraction', 'test_groups')
+        engine.enable_module('analysis_module_file_type', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        root.load()
+        file_observable = root.get_observable(file_observable.id)
+        analysis = file_observable.get_analysis(URLExtractionAnalysis)
+        self.assertTrue(analysis)
+        self.assertEquals(set([ url.value for url in analysis.get_observables_by_type(F_URL) ]),
+                          set([ 'http://large-{}.example.com/path'.format(index) for index in range(3) ]))
+
     def test_file_analysis_001_oletools_000(self):
 
         #from saq.modules.file_analysis import OLEVBA_Analysis_v1_2
@@ -282,6 +350,28 @@ class TestCase(ACEModuleTestCase):
                 macro_count = len([f for f in root.all_observables if f.type == F_FILE and f.has_tag('macro')])
                 self.assertEquals(macro_count, results[file_name][KEY_MACRO_COUNT])
 
+    def test_file_analysis_ssdeep_hash_fallback(self):
+        from saq.modules.file_analysis import SsdeepAnalyzer
+
+        target_path = os.path.join(saq.TEMP_DIR, 'ssdeep_unittest')
+        self.tracked_test_files.append(target_path)
+        with open(target_path, 'w') as fp:
+            for i in range(1000):
+                fp.write('line {} of the file to hash\n'.format(i))
+
+        # without the python bindings the file is hashed with the ssdeep command
+        analyzer = SsdeepAnalyzer('analysis_module_ssdeep')
+        analyzer.fuzzy_failed = True
+        command_hash = analyzer.get_ssdeep_hash(target_path)
+        self.assertIsNotNone(command_hash)
+        self.assertTrue(command_hash.count(':') == 2)
+
+        # and the bindings (when they are installed) compute the same hash
+        if importlib.util.find_spec('ssdeep') is not None:
+            analyzer = SsdeepAnalyzer('analysis_module_ssdeep')
+            self.assertEquals(analyzer.get_ssdeep_hash(target_path), command_hash)
+            self.assertIsNotNone(analyzer.fuzzy)
+
     def test_file_analysis_002_archive_000_zip(self):
 
         root = create_root_analysis(uuid=str(uuid.uuid4()))
@@ -384,6 +474,130 @@ class TestCase(ACEModuleTestCase):
         self.assertIsNotNone(analysis)
         self.assertFalse(analysis)
 
+    def test_file_analysis_archive_bomb(self):
+
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        import zipfile
+        with zipfile.ZipFile(os.path.join(root.storage_dir, 'bomb.zip'), 'w', compression=zipfile.ZIP_DEFLATED) as zfile:
+            zfile.writestr('zeros.bin', bytes(10 * 1024 * 1024))
+
+        _file = root.add_observable(F_FILE, 'bomb.zip')
+        root.save()
+        root.schedule()
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_archive', 'test_groups')
+        engine.enable_module('analysis_module_file_type', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        # the listing is enough to reject it
+        self.assertEquals(log_count('has a compression ratio of'), 1)
+        self.assertFalse(os.path.exists(os.path.join(root.storage_dir, 'bomb.zip.extracted')))
+
+        root.load()
+        _file = root.get_observable(_file.id)
+        
+        from saq.modules.file_analysis import ArchiveAnalysis
+        analysis = _file.get_analysis(ArchiveAnalysis)
+        self.assertFalse(analysis)
+
+    def test_file_analysis_archive_program_limits(self):
+
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        import tarfile
+        with tarfile.open(os.path.join(root.storage_dir, 'many.tar'), 'w') as tfile:
+            for index in range(3):
+                target_path = os.path.join(saq.TEMP_DIR, 'archive_unittest_{}.txt'.format(index))
+                self.tracked_test_files.append(target_path)
+                with open(target_path, 'w') as fp:
+                    fp.write('test')
+
+                tfile.add(target_path, arcname=os.path.basename(target_path))
+
+        _file = root.add_observable(F_FILE, 'many.tar')
+        root.save()
+        root.schedule()
+
+        # 7z extracts it and only the extracted files show it goes past the limit
+        saq.CONFIG['analysis_module_archive']['in_process'] = 'no'
+        saq.CONFIG['analysis_module_archive']['max_extracted_files'] = '2'
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_archive', 'test_groups')
+        engine.enable_module('analysis_module_file_type', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        self.assertEquals(log_count('archive extracted more than 2 files'), 1)
+        self.assertFalse(os.path.exists(os.path.join(root.storage_dir, 'many.tar.extracted')))
+
+        root.load()
+        _file = root.get_observable(_file.id)
+        
+        from saq.modules.file_analysis import ArchiveAnalysis
+        analysis = _file.get_analysis(ArchiveAnalysis)
+        self.assertTrue(analysis)
+        self.assertIsNotNone(analysis.limit_exceeded)
+        self.assertEquals(len(analysis.get_observables_by_type(F_FILE)), 0)
+
+    def test_file_analysis_archive_tar_nested(self):
+
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+
+        # a tar file inside of a tar file inside of a tar file
+        import tarfile
+        target_path = os.path.join(saq.TEMP_DIR, 'archive_unittest.txt')
+        self.tracked_test_files.append(target_path)
+        with open(target_path, 'w') as fp:
+            fp.write('test')
+
+        for index in range(3):
+            tar_path = os.path.join(saq.TEMP_DIR, 'archive_unittest_{}.tar'.format(index))
+            self.tracked_test_files.append(tar_path)
+            with tarfile.open(tar_path, 'w') as tfile:
+                tfile.add(target_path, arcname=os.path.basename(target_path))
+
+            target_path = tar_path
+
+        shutil.copy(target_path, os.path.join(root.storage_dir, 'nested.tar'))
+        _file = root.add_observable(F_FILE, 'nested.tar')
+        root.save()
+        root.schedule()
+
+        saq.CONFIG['analysis_module_archive']['max_depth'] = '2'
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_archive', 'test_groups')
+        engine.enable_module('analysis_module_file_type', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        root.load()
+        _file = root.get_observable(_file.id)
+        
+        from saq.modules.file_analysis import ArchiveAnalysis
+        analysis = _file.get_analysis(ArchiveAnalysis)
+        self.assertTrue(analysis)
+        self.assertEquals(analysis.file_count, 1)
+        self.assertEquals(analysis.depth, 0)
+
+        # the second tar file is extracted but not the third
+        _file = analysis.get_observables_by_type(F_FILE)[0]
+        analysis = _file.get_analysis(ArchiveAnalysis)
+        self.assertTrue(analysis)
+        self.assertEquals(analysis.depth, 1)
+
+        _file = analysis.get_observables_by_type(F_FILE)[0]
+        self.assertFalse(_file.get_analysis(ArchiveAnalysis))
+        self.assertEquals(log_count('extracted from 2 nested archives'), 1)
+
     def test_file_analysis_002_archive_002_ace(self):
 
         root = create_root_analysis(uuid=str(uuid.uuid4()))
@@ -689,6 +903,59 @@ class TestCase(ACEModuleTestCase):
         crits_id = analysis.get_observables_by_type(F_INDICATOR)
         self.assertEquals(len(crits_id), 1)
 
+    def test_file_analysis_004_yara_005_server(self):
+
+        from saq.yara_server import YaraScannerServer
+
+        saq.CONFIG['yara_server']['enabled'] = 'yes'
+        saq.CONFIG['yara_server']['scanner_count'] = '2'
+        server = YaraScannerServer()
+        server.start()
+
+        try:
+            self.assertTrue(wait_for(lambda: os.path.exists(server.socket_path), interval=0.1))
+
+            root = create_root_analysis(uuid=str(uuid.uuid4()))
+            root.initialize_storage()
+            file_names = [ 'match', 'no_alert', 'add_directive' ]
+            for file_name in file_names:
+                shutil.copy(os.path.join('test_data/scan_targets', file_name), root.storage_dir)
+                root.add_observable(F_FILE, file_name)
+
+            root.save()
+            root.schedule()
+
+            engine = TestEngine()
+            engine.enable_module('analysis_module_yara_scanner_v3_4', 'test_groups')
+            engine.controlled_stop()
+            engine.start()
+            engine.wait()
+
+            stats = server.get_stats()
+        finally:
+            server.stop()
+
+        # all three files were scanned with a single request
+        self.assertEquals(log_count('scanned 3 files with yara server'), 1)
+        self.assertEquals(log_count('with yara server (matches found: True)'), 3)
+        self.assertEquals(log_count('with yss (matches found'), 0)
+
+        self.assertEquals(stats['scans'], 3)
+        self.assertEquals(stats['rules']['test_rule'], 1)
+        self.assertEquals(stats['rules']['no_alert_rule'], 1)
+        self.assertEquals(stats['rules']['add_directive'], 1)
+
+        root.load()
+        from saq.modules.file_analysis import YaraScanResults_v3_4
+        for _file in root.get_observables_by_type(F_FILE):
+            with self.subTest(file_name=_file.value):
+                analysis = _file.get_analysis(YaraScanResults_v3_4)
+                self.assertTrue(analysis)
+                self.assertEquals(len(analysis.get_observables_by_type(F_YARA_RULE)), 1)
+
+        _file = root.find_observable(lambda o: o.type == F_FILE and o.value == 'add_directive')
+        self.assertTrue(_file.has_directive(DIRECTIVE_EXTRACT_URLS))
+
     def test_file_analysis_005_pcode_000_extract_pcode(self):
 
         root = create_root_analysis(uuid=str(uuid.uuid4()))
@@ -891,3 +1158,118 @@ class TestCase(ACEModuleTestCase):
         # should have extracted a single file
         self.assertEquals(len(analysis.details), 1)
         self.assertEquals(len(analysis.get_observables_by_type(F_FILE)), 1)
+
+    def test_file_analysis_cached_results(self):
+
+        cache_dir = os.path.join(saq.DATA_DIR, saq.CONFIG['analysis_cache']['cache_dir'])
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+
+        saq.CONFIG['analysis_module_archive']['cache_results'] = 'yes'
+
+        def _analyze(file_name):
+            root = create_root_analysis(uuid=str(uuid.uuid4()))
+            root.initialize_storage()
+            os.makedirs(os.path.dirname(os.path.join(root.storage_dir, file_name)), exist_ok=True)
+            shutil.copy('test_data/zip/test.zip', os.path.join(root.storage_dir, file_name))
+            _file = root.add_observable(F_FILE, file_name)
+            root.save()
+            root.schedule()
+
+            engine = TestEngine()
+            engine.enable_module('analysis_module_archive', 'test_groups')
+            engine.enable_module('analysis_module_file_type', 'test_groups')
+            engine.controlled_stop()
+            engine.start()
+            engine.wait()
+
+            root.load()
+            return root, root.get_observable(_file.id)
+
+        from saq.modules.file_analysis import ArchiveAnalysis
+        root, _file = _analyze('test.zip')
+        analysis = _file.get_analysis(ArchiveAnalysis)
+        self.assertIsNotNone(analysis)
+        self.assertEquals(analysis.file_count, 1)
+
+        # the result is stored under the sha256 of the file
+        entry_dirs = []
+        for dir_path, dir_names, file_names in os.walk(cache_dir):
+            if 'result.json' in file_names:
+                entry_dirs.append(dir_path)
+
+        self.assertEquals(len(entry_dirs), 1)
+        self.assertEquals(os.path.basename(entry_dirs[0]), _file.sha256_hash)
+
+        # modify the cached result so we can tell it was used
+        result_path = os.path.join(entry_dirs[0], 'result.json')
+        with open(result_path, 'r') as fp:
+            entry = json.load(fp)
+
+        entry['details']['file_count'] = 99
+        with open(result_path, 'w') as fp:
+            json.dump(entry, fp)
+
+        # the same content with a different name in a different directory
+        root, _file = _analyze('subdir/other.zip')
+        analysis = _file.get_analysis(ArchiveAnalysis)
+        self.assertIsNotNone(analysis)
+        self.assertEquals(analysis.file_count, 99)
+
+        # and the extracted file was put back relative to the new file
+        extracted = analysis.get_observables_by_type(F_FILE)
+        self.assertEquals(len(extracted), 1)
+        self.assertTrue(extracted[0].value.startswith('subdir/other.zip.extracted/'))
+        self.assertTrue(os.path.exists(os.path.join(root.storage_dir, extracted[0].value)))
+        self.assertTrue(extracted[0].has_relationship(R_EXTRACTED_FROM))
+
+    def test_file_analysis_cache_versions(self):
+
+        import time
+        from saq.analysis_cache import AnalysisResultCache
+        from saq.modules.file_analysis import ArchiveAnalyzer
+
+        cache_dir = os.path.join(saq.DATA_DIR, saq.CONFIG['analysis_cache']['cache_dir'])
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+
+        cache = AnalysisResultCache(ArchiveAnalyzer('analysis_module_archive'))
+        version = cache.config_version
+
+        # configuration changes are picked up without restarting
+        saq.CONFIG['analysis_module_archive']['max_file_count'] = '12345'
+        cache.next_version_check = 0
+        self.assertNotEquals(cache.config_version, version)
+
+        # other versions are only removed once nothing has been added to them for longer than the ttl
+        os.makedirs(os.path.join(cache.module_dir, 'recent', '00'))
+        os.makedirs(os.path.join(cache.module_dir, 'old', '00'))
+        old_time = time.time() - cache.ttl - 60
+        for path in [ os.path.join(cache.module_dir, 'old', '00'), os.path.join(cache.module_dir, 'old') ]:
+            os.utime(path, (old_time, old_time))
+
+        cache.prune()
+        self.assertTrue(os.path.isdir(os.path.join(cache.module_dir, 'recent')))
+        self.assertFalse(os.path.exists(os.path.join(cache.module_dir, 'old')))
+
+    def test_file_analysis_file_type_libmagic(self):
+
+        from saq.modules.file_analysis import FileTypeAnalyzer
+
+        saq.CONFIG['analysis_module_file_type']['use_libmagic'] = 'yes'
+        libmagic_analyzer = FileTypeAnalyzer('analysis_module_file_type')
+        self.assertIsNotNone(libmagic_analyzer.get_classifier())
+
+        saq.CONFIG['analysis_module_file_type']['use_libmagic'] = 'no'
+        command_analyzer = FileTypeAnalyzer('analysis_module_file_type')
+        self.assertIsNone(command_analyzer.get_classifier())
+
+        # libmagic should give the same answer as the file command
+        for path in [ 'test_data/zip/test.zip',
+                      'test_data/pdf/Payment_Advice.pdf',
+                      'test_data/docx/xml_rel.docx',
+                      'test_data/sample.jar',
+                      'test_data/invalid.exe',
+                      'test_data/live_browser.000.html' ]:
+            with self.subTest(path=path):
+                self.assertEquals(libmagic_analyzer.get_file_type(path), command_analyzer.get_file_type(path))
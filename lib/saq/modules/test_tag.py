@@ -0,0 +1,52 @@
+# vim: sw=4:ts=4:et
+
+from saq.modules.tag import _tag_mapping, _tag_matcher
+from saq.test import *
+
+class SiteTagTestCase(ACEModuleTestCase):
+
+    def create_matcher(self, mappings):
+        matcher = _tag_matcher()
+        for mapping in mappings:
+            matcher.add(mapping)
+
+        matcher.compile()
+        return matcher
+
+    def test_matcher(self):
+        mappings = [
+            _tag_mapping('default', False, 'Evil.com', [ 'exact' ]),
+            _tag_mapping('default', True, 'Evil.com', [ 'exact_ignore_case' ]),
+            _tag_mapping('subdomain', False, 'evil.com', [ 'subdomain' ]),
+            _tag_mapping('cidr', False, '10.0.0.0/8', [ 'cidr_8' ]),
+            _tag_mapping('cidr', False, '10.1.0.0/16', [ 'cidr_16' ]),
+            _tag_mapping('cidr', False, '2001:db8::/32', [ 'cidr_v6' ]),
+            _tag_mapping('glob', True, '*.BAD.org', [ 'glob_ignore_case' ]),
+            _tag_mapping('glob', False, 'x?z', [ 'glob' ]),
+            _tag_mapping('regex', False, r'(a)\1', [ 'backreference' ]),
+            _tag_mapping('regex', True, r'^mal', [ 'regex' ]), ]
+
+        matcher = self.create_matcher(mappings)
+        # the expression with the backreference is tested on its own
+        self.assertEquals(len(matcher.unfiltered_patterns), 1)
+        self.assertIsNotNone(matcher.pattern_filter)
+
+        for value in [ 'Evil.com', 'evil.com', 'x.EVIL.com', 'evil.comx', '10.1.2.3', '10.2.2.2', '2001:db8::1',
+                       'a.bad.org', 'A.BAD.ORG', 'xyz', 'XyZ', 'aa', 'MALware', 'nothing', '' ]:
+            # results must be the same as testing each mapping in order
+            self.assertEquals(matcher.match(value), [ m for m in mappings if m.matches(value) ])
+
+        self.assertEquals([ m.tags[0] for m in matcher.match('Evil.com') ], [ 'exact', 'exact_ignore_case', 'subdomain' ])
+        self.assertEquals([ m.tags[0] for m in matcher.match('10.1.2.3') ], [ 'cidr_8', 'cidr_16' ])
+        self.assertEquals([ m.tags[0] for m in matcher.match('A.BAD.ORG') ], [ 'glob_ignore_case' ])
+        self.assertEquals(matcher.match('XyZ'), [])
+
+    def test_matcher_uncombinable_pattern(self):
+        # global inline flags are only valid at the start of the expression
+        mappings = [
+            _tag_mapping('regex', False, r'(?i)weird', [ 'inline_flags' ]),
+            _tag_mapping('regex', False, r'normal', [ 'normal' ]), ]
+
+        matcher = self.create_matcher(mappings)
+        self.assertEquals([ m.tags[0] for m in matcher.match('WEIRD and normal') ], [ 'inline_flags', 'normal' ])
+        self.assertEquals(matcher.match('nothing'), [])
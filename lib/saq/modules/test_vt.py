@@ -0,0 +1,187 @@
+# vim: sw=4:ts=4:et
+
+import http.server
+import json
+import socketserver
+import threading
+import urllib.parse
+import uuid
+
+import saq, saq.test
+from saq.constants import *
+from saq.database import get_db_connection
+from saq.test import *
+from saq.vt_cache import store_reports
+
+LOCAL_PORT = 43125
+
+MALICIOUS_MD5 = '0123456789abcdef0123456789abcdef'
+CLEAN_SHA256 = '0123456789abcdef0123456789abcdef0123456789abcdef0123456789abcdef'
+UNKNOWN_MD5 = 'fedcba9876543210fedcba9876543210'
+# the stub does not send anything back for this one
+MISSING_MD5 = 'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'
+
+def create_report(_hash):
+    if _hash == MALICIOUS_MD5:
+        return { 'response_code': 1, 'resource': _hash, 'md5': _hash, 'sha1': '1' * 40, 'sha256': '1' * 64,
+                 'positives': 1, 'total': 2, 'permalink': 'http://localhost/',
+                 'scans': { 'Vendor A': { 'detected': True, 'result': 'Evil' },
+                            'Vendor B': { 'detected': False, 'result': None } } }
+
+    if _hash == CLEAN_SHA256:
+        return { 'response_code': 1, 'resource': _hash, 'md5': '2' * 32, 'sha1': '2' * 40, 'sha256': _hash,
+                 'positives': 0, 'total': 2, 'permalink': 'http://localhost/',
+                 'scans': { 'Vendor A': { 'detected': False, 'result': None } } }
+
+    return { 'response_code': 0, 'resource': _hash, 'verbose_msg': 'The requested resource is not among the finished, '
+                                                                   'queued or pending scans' }
+
+# the list of hashes asked for in each request the stub received
+vt_requests = []
+web_server = None
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    """Answers like the vt_hash_cache (h=) and virus total (resource=) do
+       (a list of reports when asked for more than one hash.)"""
+    def do_GET(self):
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        hashes = params['h' if 'h' in params else 'resource'][0].split(',')
+        vt_requests.append(hashes)
+
+        reports = [ create_report(_hash) for _hash in hashes if _hash != MISSING_MD5 ]
+        content = json.dumps(reports[0] if len(reports) == 1 else reports).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args, **kwargs):
+        pass
+
+class TestCase(ACEModuleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        global web_server
+
+        class _customTCPServer(socketserver.TCPServer):
+            allow_reuse_address = True
+
+        web_server = _customTCPServer(('127.0.0.1', LOCAL_PORT), _StubHandler)
+        web_server_thread = threading.Thread(target=web_server.serve_forever)
+        web_server_thread.daemon = True
+        web_server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        web_server.shutdown()
+        web_server.server_close()
+
+    def setUp(self):
+        ACEModuleTestCase.setUp(self)
+        del vt_requests[:]
+        saq.CONFIG['analysis_module_vt_hash_analyzer']['query_url'] = 'http://127.0.0.1:{}/vthc/query'.format(LOCAL_PORT)
+        saq.CONFIG['analysis_module_vt_hash_analyzer']['use_proxy'] = 'no'
+
+        with get_db_connection('vt_hash_cache') as db:
+            c = db.cursor()
+            c.execute("DELETE FROM result_cache")
+            db.commit()
+
+    def analyze(self, hashes):
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        observables = [ root.add_observable(o_type, o_value) for o_type, o_value in hashes ]
+        root.save()
+        root.schedule()
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_vt_hash_analyzer', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        root.load()
+        return [ root.get_observable(o.id) for o in observables ]
+
+    def test_vt_hash_batch(self):
+        from saq.modules.vt import VTHashAnalysis
+
+        saq.CONFIG['analysis_module_vt_hash_analyzer']['use_cache'] = 'no'
+        malicious, clean, unknown = self.analyze([ (F_MD5, MALICIOUS_MD5), (F_SHA256, CLEAN_SHA256), (F_MD5, UNKNOWN_MD5) ])
+
+        # all three were looked up with a single request
+        self.assertEquals(len(vt_requests), 1)
+        self.assertEquals(sorted(vt_requests[0]), sorted([ MALICIOUS_MD5, CLEAN_SHA256, UNKNOWN_MD5 ]))
+
+        analysis = malicious.get_analysis(VTHashAnalysis)
+        self.assertTrue(analysis)
+        self.assertEquals(analysis.positives, 1)
+        self.assertTrue(malicious.has_tag('malicious'))
+
+        analysis = clean.get_analysis(VTHashAnalysis)
+        self.assertTrue(analysis)
+        self.assertEquals(analysis.positives, 0)
+        self.assertFalse(clean.has_tag('malicious'))
+
+        analysis = unknown.get_analysis(VTHashAnalysis)
+        self.assertTrue(analysis)
+        self.assertFalse(analysis.is_known())
+
+    def test_vt_hash_cache(self):
+        from saq.modules.vt import VTHashAnalysis
+
+        saq.CONFIG['analysis_module_vt_hash_analyzer']['use_cache'] = 'yes'
+        self.assertEquals(store_reports([ create_report(MALICIOUS_MD5), create_report(UNKNOWN_MD5) ]), 2)
+
+        # both reports come from the cache
+        malicious, unknown = self.analyze([ (F_MD5, MALICIOUS_MD5), (F_MD5, UNKNOWN_MD5) ])
+        self.assertEquals(len(vt_requests), 0)
+        self.assertTrue(malicious.has_tag('malicious'))
+        self.assertFalse(unknown.get_analysis(VTHashAnalysis).is_known())
+
+        # reports for unknown files expire sooner than reports for known files
+        with get_db_connection('vt_hash_cache') as db:
+            c = db.cursor()
+            c.execute("UPDATE result_cache SET insert_date = NOW() - INTERVAL 2 HOUR")
+            db.commit()
+
+        saq.CONFIG['vt_hash_cache']['positive_ttl'] = '86400'
+        saq.CONFIG['vt_hash_cache']['negative_ttl'] = '3600'
+
+        malicious, unknown = self.analyze([ (F_MD5, MALICIOUS_MD5), (F_MD5, UNKNOWN_MD5) ])
+        self.assertEquals(vt_requests, [ [ UNKNOWN_MD5 ] ])
+        self.assertTrue(malicious.has_tag('malicious'))
+        self.assertTrue(unknown.get_analysis(VTHashAnalysis))
+
+    def test_vt_hash_cache_query(self):
+        from flask import Flask
+        from app.vt_hash_cache import vt_hash_cache_bp
+        from saq.vt_cache import lookup_reports
+
+        app = Flask(__name__)
+        app.register_blueprint(vt_hash_cache_bp)
+        client = app.test_client()
+
+        # the gui asks the stub as if it was virus total
+        saq.CONFIG['virus_total']['query_url'] = 'http://127.0.0.1:{}/vtapi/v2/file/report'.format(LOCAL_PORT)
+        proxies = saq.PROXIES
+        saq.PROXIES = {}
+        try:
+            result = client.get('/vthc/query', query_string={
+                                'resource': ','.join([ MALICIOUS_MD5, MISSING_MD5, UNKNOWN_MD5 ]) })
+        finally:
+            saq.PROXIES = proxies
+
+        # the hash virus total sent nothing back for does not fail the rest of the batch
+        self.assertEquals(result.status_code, 200)
+        self.assertEquals(len(vt_requests), 1)
+        reports = json.loads(result.data.decode())
+        self.assertEquals([ report['resource'] for report in reports ], [ MALICIOUS_MD5, MISSING_MD5, UNKNOWN_MD5 ])
+        self.assertEquals([ report['response_code'] for report in reports ], [ 1, 0, 0 ])
+
+        # and only what virus total sent back is cached
+        self.assertEquals(set(lookup_reports([ MALICIOUS_MD5, MISSING_MD5, UNKNOWN_MD5 ]).keys()),
+                          set([ MALICIOUS_MD5, UNKNOWN_MD5 ]))
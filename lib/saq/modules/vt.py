@@ -1,6 +1,5 @@
 # vim: sw=4:ts=4:et
 
-import json
 import logging
 import os
 import shutil
@@ -11,8 +10,7 @@ from saq.modules.file_analysis import FileHashAnalysis
 from saq.error import report_exception
 from saq.modules import AnalysisModule
 from saq.constants import *
-
-import requests
+from saq.vt_cache import lookup_reports, match_reports, parse_reports
 
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
@@ -289,6 +287,89 @@ class VTHashAnalyzer(AnalysisModule):
         else:
             self.ignored_vendors = set()
 
+        # the reports looked up with the last batch of hashes
+        # key = lower case hash, value = report
+        self.batch_results = {}
+        # the uuid of the root the batch was for
+        self.batch_root_uuid = None
+
+    @property
+    def use_cache(self):
+        return self.config.getboolean('use_cache', fallback=False)
+
+    @property
+    def max_batch_size(self):
+        return self.config.getint('max_batch_size', fallback=1)
+
+    def get_batch(self, _hash):
+        """Returns the list of hash observables to look up with the given one."""
+        result = [ _hash ]
+        # one hash from each file is enough
+        file_hash_analysis = set([id(a) for a in self.root.iterate_all_references(_hash) if isinstance(a, FileHashAnalysis)])
+        for observable in self.root.all_observables:
+            if len(result) >= self.max_batch_size:
+                break
+
+            if observable is _hash or observable.type not in self.valid_observable_types:
+                continue
+
+            if observable.get_analysis(VTHashAnalysis) is not None:
+                continue
+
+            if observable.value.lower() in self.batch_results:
+                continue
+
+            references = [a for a in self.root.iterate_all_references(observable) if isinstance(a, FileHashAnalysis)]
+            if any([id(a) in file_hash_analysis for a in references]):
+                continue
+
+            file_hash_analysis.update([id(a) for a in references])
+            result.append(observable)
+
+        return result
+
+    def lookup_reports(self, hashes):
+        """Returns a dict of the given (lower case) hashes matched to their reports.
+           Hashes that could not be looked up are not included."""
+        result = {}
+        if self.use_cache:
+            try:
+                result.update(lookup_reports(hashes))
+            except Exception as e:
+                logging.warning("unable to query vt hash cache: {}".format(e))
+
+        missing = [_hash for _hash in hashes if _hash not in result]
+        if not missing:
+            logging.debug("found cached vt reports for {}".format(','.join(hashes)))
+            return result
+
+        logging.debug("looking up VT reports for {}".format(','.join(missing)))
+
+        try:
+            # the vt_hash_cache stores what it looks up
+            r = requests.get(self.query_url, params={ 'h': ','.join(missing) }, proxies=self.proxies, timeout=5, verify=False)
+
+        except Exception as e:
+            logging.error("unable to query VT: {}".format(e))
+            return result
+
+        if r.status_code == 403:
+            logging.error("invalid virus total api key!")
+            return result
+
+        if r.status_code != 200:
+            logging.debug("got invalid HTTP result {}: {}".format(r.status_code, r.reason))
+            return result
+
+        # note that here were just using whatever virus total sends
+        # if they change their JSON structure we'll probably break
+        try:
+            result.update(match_reports(missing, parse_reports(r.content.decode())))
+        except Exception as e:
+            logging.error("unable to parse vt result for {}: {}".format(','.join(missing), e))
+
+        return result
+
     def execute_analysis(self, _hash):
 
         # it is possible that you are looking at an MD5 but you already have the analysis of the SHA1
@@ -315,42 +396,22 @@ class VTHashAnalyzer(AnalysisModule):
                             return False
 
 
-        logging.debug("looking up VT report for {}".format(_hash))
-
-        try:
-            #r = requests.get(self.query_url, params={
-                #'resource': _hash.value,
-                #'apikey': self.api_key}, proxies=saq.PROXIES, timeout=5)
-
-            r = requests.get(self.query_url, params={ 'h': _hash.value }, proxies=self.proxies, timeout=5, verify=False)
-
-        except Exception as e:
-            logging.error("unable to query VT: {}".format(e))
-            return False
+        # the other hashes in this analysis that still need to be looked up are looked up at the same time
+        if self.batch_root_uuid != self.root.uuid:
+            self.batch_results = {}
+            self.batch_root_uuid = self.root.uuid
 
-        if r.status_code == 403:
-            logging.error("invalid virus total api key!")
-            return False
+        if _hash.value.lower() not in self.batch_results:
+            batch = [observable.value.lower() for observable in self.get_batch(_hash)]
+            self.batch_results.update(self.lookup_reports(batch))
 
-        if r.status_code != 200:
-            logging.debug("got invalid HTTP result {}: {}".format(r.status_code, r.reason))
+        report = self.batch_results.pop(_hash.value.lower(), None)
+        if report is None:
             return False
 
         analysis = self.create_analysis(_hash)
-
-        # note that here were just using whatever virus total sends
-        # if they change their JSON structure we'll probably break
-
         logging.debug("got valid vt result for {}".format(_hash))
-        analysis.details = json.loads(r.content.decode())
-        
-        # 4/28/2016 - looks like they now return an array of results
-        if isinstance(analysis.details, list):
-            analysis.details = analysis.details[0]
-
-        if not isinstance(analysis.details, dict):
-            logging.error("expecting dict but got {} for analysis.details of vt".format(type(analysis.details)))
-            return False
+        analysis.details = report
 
         # do any vendors outside of our excluded list of vendors think this is "bad"
         if 'scans' in analysis.details:
@@ -372,6 +372,18 @@ class VxStreamAnalyzer(SandboxAnalysisModule):
 
         return True
 
+    def get_finished_jobs(self, job_ids):
+        # job ids are sha256:environment_id
+        # the v1 api has no way to ask about more than one job at a time
+        result = []
+        for job_id in job_ids:
+            sha256_hash, environment_id = job_id.rsplit(':', 1)
+            if self.vx.get_status(sha256_hash, environment_id) not in [ VXSTREAM_STATUS_IN_PROGRESS,
+                                                                        VXSTREAM_STATUS_IN_QUEUE ]:
+                result.append(job_id)
+
+        return result
+
     def execute_vxstream_analysis(self, target, analysis):
 
         # at this point we should definitely have a sha256 value
@@ -386,7 +398,9 @@ class VxStreamAnalyzer(SandboxAnalysisModule):
 
         if analysis.status == VXSTREAM_STATUS_IN_PROGRESS or analysis.status == VXSTREAM_STATUS_IN_QUEUE:
             logging.debug("waiting for completion of {}".format(target))
-            return self.delay_analysis(target, analysis, seconds=self.frequency, timeout_minutes=self.timeout)
+            job_id = '{}:{}'.format(analysis.sha256, analysis.environment_id)
+            return self.delay_sandbox_analysis(target, analysis, [ job_id ], seconds=self.frequency,
+                                               timeout_minutes=self.timeout)
 
         # something go wrong?
         if analysis.status == VXSTREAM_STATUS_ERROR or analysis.status == VXSTREAM_STATUS_UNKNOWN:
@@ -1063,6 +1077,25 @@ class FalconAnalyzer(SandboxAnalysisModule):
             return result
         return False
 
+    def get_finished_jobs(self, job_ids):
+        # the summaries of all of the jobs are requested at once
+        summaries = self.vx._request("/report/summary", method='POST', params={ 'hashes[]': job_ids }).json()
+        states = {}
+        if isinstance(summaries, list):
+            for summary in summaries:
+                if isinstance(summary, dict) and 'job_id' in summary:
+                    states[str(summary['job_id'])] = summary.get('state')
+
+        result = []
+        for job_id in job_ids:
+            if job_id not in states:
+                states[job_id] = self.vx._request("/report/{}/state".format(job_id)).json().get('state')
+
+            if states[job_id] not in [ VXSTREAM_STATUS_IN_PROGRESS, VXSTREAM_STATUS_IN_QUEUE ]:
+                result.append(job_id)
+
+        return result
+
     def execute_vxstream_analysis(self, target, analysis):
 
         if target.type == F_SHA1 or target.type == F_MD5:
@@ -1115,7 +1148,8 @@ class FalconAnalyzer(SandboxAnalysisModule):
 
         if analysis.status == VXSTREAM_STATUS_IN_PROGRESS or analysis.status == VXSTREAM_STATUS_IN_QUEUE:
             logging.debug("waiting for completion of {}".format(target))
-            return self.delay_analysis(target, analysis, seconds=self.frequency, timeout_minutes=self.timeout)
+            return self.delay_sandbox_analysis(target, analysis, [ analysis.job_id ], seconds=self.frequency,
+                                               timeout_minutes=self.timeout)
 
         # something go wrong?
         if analysis.status == VXSTREAM_STATUS_ERROR or analysis.status == VXSTREAM_STATUS_UNKNOWN:
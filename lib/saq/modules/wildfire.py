@@ -125,6 +125,24 @@ class WildfireAnalyzer(SandboxAnalysisModule):
         self.verify_config_exists('timeout')
         self.verify_config_exists('supported_extensions')
     
+    def get_finished_jobs(self, job_ids):
+        # job ids are sha256 hashes which can be asked about (one per line) all at once
+        job = { "apikey": self.api_key }
+        file = { "file": ( "hashes.txt", '\n'.join(job_ids) ) }
+        url = "https://wildfire.paloaltonetworks.com/publicapi/get/verdicts"
+        r = requests.post(url, data=job, files=file, verify=False, proxies=self.proxies)
+        if r.status_code != 200:
+            raise Exception("failed to get verdicts {}: {}".format(r.status_code, r.text))
+
+        result = []
+        for info in xml.fromstring(r.text).iter('get-verdict-info'):
+            sha256_hash = info.findtext('sha256', '').strip().lower()
+            # -100 means wildfire is still analyzing the file and -102 means it has not seen it yet
+            if info.findtext('verdict', '').strip() not in [ '-100', '-102' ]:
+                result.extend([ job_id for job_id in job_ids if job_id.lower() == sha256_hash ])
+
+        return result
+
     def execute_analysis(self, _file):
         # we want to sandbox the root file which this file originated from
         while _file.redirection:
@@ -183,7 +201,7 @@ class WildfireAnalyzer(SandboxAnalysisModule):
                 analysis.fail("failed to submit file {}".format(r.status_code), r.text)
                 return
 
-            self.delay_analysis(_file, analysis, seconds=self.frequency)
+            self.delay_sandbox_analysis(_file, analysis, [ analysis.sha256 ], seconds=self.frequency)
             analysis.submit_date = datetime.datetime.now()
             return
 
@@ -206,7 +224,7 @@ class WildfireAnalyzer(SandboxAnalysisModule):
                     return
 
             logging.debug("waiting on wildfire analysis...")
-            self.delay_analysis(_file, analysis, seconds=self.frequency)
+            self.delay_sandbox_analysis(_file, analysis, [ analysis.sha256 ], seconds=self.frequency)
             return
 
         # tag appropriately if verdict is malware or grayware
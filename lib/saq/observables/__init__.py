@@ -2,7 +2,6 @@
 
 import base64
 import hashlib
-import io
 import ipaddress
 import logging
 import os.path
@@ -14,10 +13,12 @@ from subprocess import Popen, PIPE
 
 import saq
 from saq.analysis import Observable, DetectionPoint
+from saq.cold_storage import storage_file_exists, storage_file_size
 from saq.constants import *
 from saq.email import normalize_email_address
 from saq.error import report_exception
 from saq.gui import *
+from saq.hashing import DIGEST_MD5, DIGEST_SHA1, DIGEST_SHA256, DIGEST_SSDEEP, compute_file_digests
 from saq.util import is_subdomain
 
 import iptools
@@ -219,6 +220,7 @@ class FileObservable(Observable):
     KEY_MD5_HASH = 'md5_hash'
     KEY_SHA1_HASH = 'sha1_hash'
     KEY_SHA256_HASH = 'sha256_hash'
+    KEY_SSDEEP_HASH = 'ssdeep_hash'
     KEY_MIME_TYPE = 'mime_type'
 
     def __init__(self, *args, **kwargs):
@@ -227,6 +229,7 @@ class FileObservable(Observable):
         self._md5_hash = None
         self._sha1_hash = None
         self._sha256_hash = None
+        self._ssdeep_hash = None
 
         self._mime_type = None
 
@@ -265,6 +268,7 @@ class FileObservable(Observable):
             FileObservable.KEY_MD5_HASH: self.md5_hash,
             FileObservable.KEY_SHA1_HASH: self.sha1_hash,
             FileObservable.KEY_SHA256_HASH: self.sha256_hash,
+            FileObservable.KEY_SSDEEP_HASH: self._ssdeep_hash,
             FileObservable.KEY_MIME_TYPE: self._mime_type,
         })
         return result
@@ -280,6 +284,8 @@ class FileObservable(Observable):
             self._sha1_hash = value[FileObservable.KEY_SHA1_HASH]
         if FileObservable.KEY_SHA256_HASH in value:
             self._sha256_hash = value[FileObservable.KEY_SHA256_HASH]
+        if FileObservable.KEY_SSDEEP_HASH in value:
+            self._ssdeep_hash = value[FileObservable.KEY_SSDEEP_HASH]
         if FileObservable.KEY_MIME_TYPE in value:
             self._mime_type = value[FileObservable.KEY_MIME_TYPE]
 
@@ -298,8 +304,22 @@ class FileObservable(Observable):
         self.compute_hashes()
         return self._sha256_hash
 
+    @property
+    def ssdeep_hash(self):
+        """Returns the ssdeep hash of the file, or None if the ssdeep python bindings are not available."""
+        self.compute_hashes()
+        return self._ssdeep_hash
+
+    def set_digests(self, digests):
+        """Records the digests (see saq.hashing) that were computed when the file was staged
+           so the file does not need to be read again to hash it."""
+        self._md5_hash = digests[DIGEST_MD5]
+        self._sha1_hash = digests[DIGEST_SHA1]
+        self._sha256_hash = digests[DIGEST_SHA256]
+        self._ssdeep_hash = digests.get(DIGEST_SSDEEP)
+
     def compute_hashes(self):
-        """Computes the md5, sha1 and sha256 hashes of the file and stores them as properties."""
+        """Computes the md5, sha1, sha256 and ssdeep hashes of the file and stores them as properties."""
 
         if self._md5_hash is not None and self._sha1_hash is not None and self._sha256_hash is not None:
             return True
@@ -314,34 +334,16 @@ class FileObservable(Observable):
             logging.error("compute_hashes was called before root.storage_dir was set for {}".format(self))
             return False
         
-        md5_hasher = hashlib.md5()
-        sha1_hasher = hashlib.sha1()
-        sha256_hasher = hashlib.sha256()
-    
         try:
-            with open(self.path, 'rb') as fp:
-                while True:
-                    data = fp.read(io.DEFAULT_BUFFER_SIZE)
-                    if data == b'':
-                        break
-
-                    md5_hasher.update(data)
-                    sha1_hasher.update(data)
-                    sha256_hasher.update(data)
-
+            digests = compute_file_digests(self.path)
         except Exception as e:
             # this will happen if a F_FILE observable refers to a file that no longer (or never did) exists
             logging.debug(f"unable to compute hashes of {self.value}: {e}")
             return False
         
-        md5_hash = md5_hasher.hexdigest()
-        sha1_hash = sha1_hasher.hexdigest()
-        sha256_hash = sha256_hasher.hexdigest()
-        logging.debug("file {} has md5 {} sha1 {} sha256 {}".format(self.path, md5_hash, sha1_hash, sha256_hash))
-
-        self._md5_hash = md5_hash
-        self._sha1_hash = sha1_hash
-        self._sha256_hash = sha256_hash
+        self.set_digests(digests)
+        logging.debug("file {} has md5 {} sha1 {} sha256 {} ssdeep {}".format(
+                      self.path, self._md5_hash, self._sha1_hash, self._sha256_hash, self._ssdeep_hash))
 
         return True
 
@@ -384,7 +386,8 @@ class FileObservable(Observable):
     def exists(self):
         try:
             #logging.info("checking stat of {}".format(self.path))
-            return os.path.exists(self.path)
+            # (the file may be in the cold storage container of the alert)
+            return storage_file_exists(os.path.join(saq.SAQ_RELATIVE_DIR, self.root.storage_dir), self.value)
         except Exception as e:
             logging.warning("unable to stat path: {}".format(e))
             #report_exception()
@@ -393,7 +396,7 @@ class FileObservable(Observable):
     @property
     def size(self):
         try:
-            return os.path.getsize(self.path)
+            return storage_file_size(os.path.join(saq.SAQ_RELATIVE_DIR, self.root.storage_dir), self.value)
         except Exception as e:
             logging.warning("unable to get size: {}".format(e))
             return 0
@@ -0,0 +1,200 @@
+# vim: sw=4:ts=4:et
+#
+# shared reference data
+#
+# large ip lookup tables (BGP routing tables, local network definitions, the IPDB export)
+# are compiled once into a sorted interval file under DATA_DIR which every worker process
+# maps read-only, so the data lives once in the page cache instead of once per process
+#
+# file layout (native byte order)
+# header: magic, record count, blob size, source signature
+# uint32 starts[count]     sorted by (start asc, end desc, source order)
+# uint32 ends[count]
+# uint32 max_ends[count]
+# int32 links[count]       see saq.intervals
+# uint32 offsets[count+1]  offsets into the value blob
+# value blob               utf-8 json value of each record
+#
+
+import fcntl
+import hashlib
+import ipaddress
+import json
+import logging
+import mmap
+import os
+import os.path
+import struct
+
+from array import array
+
+import saq
+from saq.intervals import IntervalIndex
+
+__all__ = [
+    'ReferenceData',
+    'get_reference_data',
+    'ipv4_range',
+    'ipv4_to_int',
+]
+
+MAGIC = b'ACEREF02'
+HEADER = struct.Struct('=8sII32s')
+ITEM_SIZE = array('I').itemsize
+
+# key = name, value = ReferenceData
+_reference_data = {}
+
+def ipv4_to_int(value):
+    """Returns the given ipv4 address as an integer. Raises ValueError if the value is not a valid ipv4."""
+    if isinstance(value, int):
+        return value
+
+    return int(ipaddress.IPv4Address(value))
+
+def ipv4_range(value):
+    """Returns the (start, end) integer ipv4 addresses of the given address or cidr."""
+    network = ipaddress.IPv4Network(value.strip(), strict=False)
+    return int(network.network_address), int(network.broadcast_address)
+
+def get_reference_data(name, source_paths, compiler):
+    """Returns the ReferenceData for the given name, shared by everything in this process that asks for it."""
+    if name not in _reference_data:
+        _reference_data[name] = ReferenceData(name, source_paths, compiler)
+
+    return _reference_data[name]
+
+class ReferenceData(object):
+    """Read-only ipv4 interval data compiled from one or more source files and mapped into memory.
+
+    The compiler is a callable that returns an iterable of (start, end, value) tuples
+    where start and end are inclusive integer ipv4 addresses and value is anything json can store."""
+
+    def __init__(self, name, source_paths, compiler):
+        self.name = name
+        self.source_paths = source_paths
+        self.compiler = compiler
+
+        # the signature of the data currently mapped
+        self.signature = None
+        self.count = 0
+
+        self._mm = None
+        self._index = None
+        self._offsets = None
+        self._blob_offset = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def data_dir(self):
+        return os.path.join(saq.DATA_DIR, saq.CONFIG['reference_data']['data_dir'])
+
+    @property
+    def compiled_path(self):
+        return os.path.join(self.data_dir, '{}.dat'.format(self.name))
+
+    @property
+    def lock_path(self):
+        return os.path.join(self.data_dir, '{}.lock'.format(self.name))
+
+    def source_signature(self):
+        """Returns the signature of the current source files (path, size and mtime of each one.)"""
+        h = hashlib.sha256()
+        for path in self.source_paths:
+            s = os.stat(path)
+            h.update('{}:{}:{}\n'.format(path, s.st_size, s.st_mtime_ns).encode())
+
+        return h.digest()
+
+    def load(self):
+        """Maps the compiled data, compiling it first if it is missing or out of date. Returns True if new data was mapped."""
+        signature = self.source_signature()
+        if self._mm is not None and self.signature == signature:
+            return False
+
+        os.makedirs(self.data_dir, exist_ok=True)
+        if self._read_signature() != signature:
+            # only one process compiles, the rest wait and then use what it wrote
+            with open(self.lock_path, 'a') as lock_fp:
+                fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+                try:
+                    if self._read_signature() != signature:
+                        self._compile(signature)
+                finally:
+                    fcntl.flock(lock_fp.fileno(), fcntl.LOCK_UN)
+
+        self._map()
+        return True
+
+    def _read_signature(self):
+        try:
+            with open(self.compiled_path, 'rb') as fp:
+                magic, count, blob_size, signature = HEADER.unpack(fp.read(HEADER.size))
+        except (OSError, struct.error):
+            return None
+
+        if magic != MAGIC:
+            return None
+
+        return signature
+
+    def _compile(self, signature):
+        logging.info("compiling reference data {} from {}".format(self.name, ','.join(self.source_paths)))
+
+        records = list(self.compiler())
+        index, order = IntervalIndex.build([(start, end) for start, end, value in records])
+
+        offsets = array('I', [0])
+        blob = bytearray()
+        for position in order:
+            blob.extend(json.dumps(records[position][2]).encode('utf8'))
+            offsets.append(len(blob))
+
+        temp_path = '{}.{}.tmp'.format(self.compiled_path, os.getpid())
+        with open(temp_path, 'wb') as fp:
+            fp.write(HEADER.pack(MAGIC, len(records), len(blob), signature))
+            for a in (index.starts, index.ends, index.max_ends, index.links, offsets):
+                a.tofile(fp)
+            fp.write(blob)
+
+        # readers that still have the old file mapped keep using it until they reload
+        os.rename(temp_path, self.compiled_path)
+        logging.info("compiled {} records into {}".format(len(records), self.compiled_path))
+
+    def _map(self):
+        with open(self.compiled_path, 'rb') as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, blob_size, signature = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError("invalid reference data file {}".format(self.compiled_path))
+
+        view = memoryview(mm)
+        offset = HEADER.size
+        arrays = []
+        for typecode, size in (('I', count), ('I', count), ('I', count), ('i', count), ('I', count + 1)):
+            arrays.append(view[offset:offset + (size * ITEM_SIZE)].cast(typecode))
+            offset += size * ITEM_SIZE
+
+        # the previous mapping is released once nothing references it anymore
+        self._mm = mm
+        self._index = IntervalIndex(*arrays[:4])
+        self._offsets = arrays[4]
+        self._blob_offset = offset
+        self.signature = signature
+        self.count = count
+        logging.debug("mapped {} records of reference data {}".format(count, self.name))
+
+    def _value(self, index):
+        start = self._blob_offset + self._offsets[index]
+        end = self._blob_offset + self._offsets[index + 1]
+        return json.loads(self._mm[start:end].decode('utf8'))
+
+    def lookup(self, ipv4):
+        """Returns the values of every interval that contains the given ipv4, most specific first."""
+        if self._mm is None:
+            self.load()
+
+        return [ self._value(index) for index in self._index.find(ipv4_to_int(ipv4)) ]
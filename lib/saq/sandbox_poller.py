@@ -0,0 +1,205 @@
+# vim: sw=4:ts=4:et
+#
+# node-wide sandbox job poller
+#
+# sandbox analysis modules used to delay analysis for a few seconds at a time and then ask the sandbox
+# about the one job they were waiting on, so every outstanding job cost an engine wake-up (a lock, a load of
+# the RootAnalysis and a request to the sandbox) every [frequency] seconds
+#
+# instead the modules register the jobs they are waiting on in the sandbox_jobs table and delay analysis
+# for [sandbox_poller] fallback_frequency seconds (in case the poller is not running)
+# the poller asks each sandbox about all of the outstanding jobs on this node at once and moves
+# delayed_until up to NOW() for the delayed analysis once every job it is waiting on has finished
+#
+# each sandbox analysis module knows how to ask its own sandbox (see SandboxAnalysisModule.get_finished_jobs)
+#
+
+import logging
+import threading
+
+import saq
+from saq.database import use_db, execute_with_retry, initialize_node
+from saq.error import report_exception
+
+__all__ = [
+    'SandboxPoller',
+    'register_sandbox_jobs',
+]
+
+@use_db
+def register_sandbox_jobs(root, observable, analysis_module, job_ids, db, c):
+    """Records that the given analysis module is waiting on the given sandbox jobs for the given observable.
+       Returns True if the jobs were registered, False otherwise."""
+    if saq.SAQ_NODE_ID is None:
+        initialize_node()
+
+    try:
+        sql = """INSERT IGNORE INTO sandbox_jobs ( uuid, observable_uuid, analysis_module, job_id, node_id, insert_date )
+                 VALUES {}""".format(','.join(['( %s, %s, %s, %s, %s, NOW() )' for _ in job_ids]))
+        params = []
+        for job_id in job_ids:
+            params.extend([ root.uuid, observable.id, analysis_module.config_section, str(job_id), saq.SAQ_NODE_ID ])
+
+        execute_with_retry(db, c, sql, tuple(params), commit=True)
+        logging.debug("registered sandbox jobs {} for {} by {} in {}".format(
+                      ','.join(map(str, job_ids)), observable, analysis_module.config_section, root))
+        return True
+
+    except Exception as e:
+        logging.error("unable to register sandbox jobs for {} by {} in {}: {}".format(
+                      observable, analysis_module.config_section, root, e))
+        report_exception()
+        return False
+
+class SandboxPoller(object):
+    """Polls the sandboxes for the jobs the analysis modules on this node are waiting on."""
+
+    def __init__(self):
+        # how often (in seconds) the sandboxes are polled
+        self.frequency = saq.CONFIG['sandbox_poller'].getint('frequency')
+        # the maximum number of jobs to ask a sandbox about in a single request
+        self.max_batch_size = saq.CONFIG['sandbox_poller'].getint('max_batch_size')
+        # how long (in seconds) finished jobs with no delayed analysis waiting on them are kept
+        self.orphan_timeout = saq.CONFIG['sandbox_poller'].getint('orphan_timeout')
+
+        # key = analysis module config section, value = the loaded AnalysisModule
+        self.analysis_modules = {}
+
+        self.shutdown_event = threading.Event()
+        self.poller_thread = None
+
+    def start(self):
+        self.poller_thread = threading.Thread(target=self.loop, name="Sandbox Poller")
+        self.poller_thread.start()
+
+    def stop(self):
+        logging.info("shutting down")
+        self.shutdown_event.set()
+
+    def wait(self):
+        self.poller_thread.join()
+
+    def loop(self):
+        while not self.shutdown_event.is_set():
+            try:
+                self.execute()
+            except Exception as e:
+                logging.error("uncaught exception in sandbox poller: {}".format(e))
+                report_exception()
+
+            self.shutdown_event.wait(self.frequency)
+
+    def get_analysis_module(self, config_section):
+        """Returns the (cached) AnalysisModule for the given config section, or None if it cannot be loaded."""
+        if config_section not in self.analysis_modules:
+            from saq.engine import load_module
+            self.analysis_modules[config_section] = load_module(config_section)
+
+        return self.analysis_modules[config_section]
+
+    def execute(self):
+        """Polls the sandboxes once and wakes up the delayed analysis that is no longer waiting on anything.
+           Returns the number of delayed analysis requests that were woken up."""
+        if saq.SAQ_NODE_ID is None:
+            initialize_node()
+
+        for config_section, job_ids in self.get_outstanding_jobs().items():
+            self.check_jobs(config_section, job_ids)
+
+        result = self.wake_delayed_analysis()
+        self.delete_orphaned_jobs()
+        return result
+
+    @use_db
+    def get_outstanding_jobs(self, db, c):
+        """Returns a dict of analysis module config section to the list of unfinished job ids."""
+        c.execute("""SELECT DISTINCT analysis_module, job_id FROM sandbox_jobs
+                     WHERE node_id = %s AND finished = 0""", (saq.SAQ_NODE_ID,))
+
+        result = {}
+        for config_section, job_id in c:
+            result.setdefault(config_section, []).append(job_id)
+
+        db.commit()
+        return result
+
+    def check_jobs(self, config_section, job_ids):
+        """Asks the sandbox used by the given analysis module about the given jobs in batches."""
+        analysis_module = self.get_analysis_module(config_section)
+        if analysis_module is None:
+            logging.warning("unable to load {} to check sandbox jobs".format(config_section))
+            return
+
+        for index in range(0, len(job_ids), self.max_batch_size):
+            batch = job_ids[index:index + self.max_batch_size]
+            try:
+                finished = analysis_module.get_finished_jobs(batch)
+            except Exception as e:
+                logging.error("unable to check sandbox jobs for {}: {}".format(config_section, e))
+                report_exception()
+                continue
+
+            logging.debug("{} of {} jobs finished for {}".format(len(finished), len(batch), config_section))
+            self.update_jobs(config_section, batch, finished)
+
+    @use_db
+    def update_jobs(self, config_section, job_ids, finished, db, c):
+        """Records that the given jobs were checked and which ones are finished."""
+        job_ids = list(job_ids)
+        execute_with_retry(db, c, """UPDATE sandbox_jobs SET last_checked = NOW()
+                                     WHERE node_id = %s AND analysis_module = %s AND job_id IN ( {} )""".format(
+                                     ','.join(['%s' for _ in job_ids])),
+                          tuple([ saq.SAQ_NODE_ID, config_section ] + job_ids))
+
+        finished = [ str(job_id) for job_id in finished ]
+        if finished:
+            execute_with_retry(db, c, """UPDATE sandbox_jobs SET finished = 1
+                                         WHERE node_id = %s AND analysis_module = %s AND job_id IN ( {} )""".format(
+                                         ','.join(['%s' for _ in finished])),
+                              tuple([ saq.SAQ_NODE_ID, config_section ] + finished))
+
+        db.commit()
+
+    @use_db
+    def wake_delayed_analysis(self, db, c):
+        """Moves delayed_until up to NOW() for delayed analysis that is only waiting on finished jobs.
+           Returns the number of delayed analysis requests woken up."""
+        c.execute("""SELECT uuid, observable_uuid, analysis_module FROM sandbox_jobs WHERE node_id = %s
+                     GROUP BY uuid, observable_uuid, analysis_module HAVING MIN(finished) = 1""", (saq.SAQ_NODE_ID,))
+        targets = c.fetchall()
+        db.commit()
+
+        result = 0
+        for uuid, observable_uuid, config_section in targets:
+            woken = execute_with_retry(db, c, """UPDATE delayed_analysis SET delayed_until = NOW()
+                                         WHERE uuid = %s AND observable_uuid = %s AND analysis_module = %s
+                                         AND delayed_until > NOW()""", (uuid, observable_uuid, config_section))
+            c.execute("""SELECT COUNT(*) FROM delayed_analysis
+                         WHERE uuid = %s AND observable_uuid = %s AND analysis_module = %s""",
+                      (uuid, observable_uuid, config_section))
+            waiting = c.fetchone()[0]
+
+            # the jobs are kept until the delayed analysis they belong to shows up
+            # (the module registers the jobs before it delays the analysis)
+            if waiting:
+                execute_with_retry(db, c, """DELETE FROM sandbox_jobs
+                                             WHERE uuid = %s AND observable_uuid = %s AND analysis_module = %s""",
+                                  (uuid, observable_uuid, config_section))
+
+            db.commit()
+
+            if woken:
+                logging.info("sandbox jobs finished for uuid {} observable_uuid {} analysis_module {}".format(
+                             uuid, observable_uuid, config_section))
+                result += woken
+
+        return result
+
+    @use_db
+    def delete_orphaned_jobs(self, db, c):
+        """Deletes finished jobs that no delayed analysis has shown up for."""
+        count = execute_with_retry(db, c, """DELETE FROM sandbox_jobs WHERE node_id = %s AND finished = 1
+                                             AND insert_date < NOW() - INTERVAL %s SECOND""",
+                                   (saq.SAQ_NODE_ID, self.orphan_timeout), commit=True)
+        if count:
+            logging.info("deleted {} orphaned sandbox jobs".format(count))
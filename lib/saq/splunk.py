@@ -0,0 +1,305 @@
+# vim: sw=4:ts=4:et
+#
+# coalesced and cached splunk searches
+#
+# analysis modules used to run one splunk search per observable per alert, even when every alert that came in
+# during the same minute asked about the same domain or email address
+#
+# a coalesced search is a template with two placeholders, {terms} and {conditions}, and a field to match on
+# the searches for different values of the same template and time window that are requested within
+# [splunk] coalesce_window seconds of each other (by any process on the node) are run as a single search
+# with the values OR-ed together and the results are split back out by the value of the field
+#
+#   index=dns_logs {terms} | search {conditions} AND snd_rcv = Snd | fields *
+#
+# becomes (for the values a.com and b.com and the field domain)
+#
+#   index=dns_logs ("a.com" OR "b.com") | search (domain="a.com" OR domain="b.com") AND snd_rcv = Snd | fields *
+#
+# NOTE that anything in the template that limits the number of results has to do so per value
+# (stats ... by field instead of stats ..., and the {limit} placeholder instead of head N)
+#
+# the {limit} placeholder tags each event with the values it was found for (SEARCHED_VALUE_FIELD) and keeps the
+# first limit events of each value, so one busy value does not use up the results of the others
+#
+# the time window is widened to [splunk] time_bucket boundaries so that alerts that happened close to each other
+# search the same window, and the results for each value are kept for [splunk] cache_ttl seconds
+#
+# layout (relative to [splunk] cache_dir)
+# <search key>/lock
+# <search key>/pending            (the values waiting to be searched for, one per line)
+# <search key>/<value key>.json   (the results for a value)
+#
+
+import datetime
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import os.path
+import re
+import shutil
+import tempfile
+import time
+
+import requests
+
+import saq
+
+__all__ = [
+    'SEARCHED_VALUE_FIELD',
+    'SplunkSearch',
+    'SplunkSearchCoalescer',
+    'execute_splunk_search',
+]
+
+# the field the {limit} placeholder records the searched value an event was found for in
+SEARCHED_VALUE_FIELD = 'ace_searched_value'
+
+class SplunkSearch(object):
+    """A search template that can be run for several values at once."""
+
+    def __init__(self, template, field, wildcard=False, limit=0):
+        # the search with the {terms}, {conditions} and (optional) {limit} placeholders
+        self.template = template
+        # the field the values are matched against
+        self.field = field
+        # set to True to match the field anywhere in its value (field="*value*")
+        self.wildcard = wildcard
+        # the most events returned for each value (0 = no limit)
+        self.limit = limit
+
+    @staticmethod
+    def quote(value):
+        return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+    def format(self, values):
+        """Returns the search for the given values."""
+        values = sorted(values)
+        terms = [ self.quote(value) for value in values ]
+        conditions = [ '{}={}'.format(self.field, self.quote('*{}*'.format(value) if self.wildcard else value))
+                       for value in values ]
+
+        if len(values) > 1:
+            terms = '({})'.format(' OR '.join(terms))
+            conditions = '({})'.format(' OR '.join(conditions))
+        else:
+            terms = terms[0]
+            conditions = conditions[0]
+
+        limit = ''
+        if self.limit:
+            # the same match as the conditions (case insensitive) for each value
+            pattern = '(?i){}' if self.wildcard else '(?i)^{}$'
+            matched = [ 'if(isnotnull(mvfind({}, {})), {}, null())'.format(
+                        self.field, self.quote(pattern.format(re.escape(value))), self.quote(value))
+                        for value in values ]
+            limit = '| eval {field}=mvappend({matched}) | mvexpand {field} | dedup {limit} {field}'.format(
+                    field=SEARCHED_VALUE_FIELD, matched=', '.join(matched), limit=int(self.limit))
+
+        return self.template.format(terms=terms, conditions=conditions, limit=limit)
+
+    def matches(self, event, value):
+        """Returns True if the given result event is for the given value."""
+        field_values = event.get(self.field)
+        if field_values is None:
+            return False
+
+        # multi-value fields come back as lists
+        if not isinstance(field_values, list):
+            field_values = [ field_values ]
+
+        value = value.lower()
+        for field_value in field_values:
+            field_value = str(field_value).lower()
+            if (value in field_value) if self.wildcard else (value == field_value):
+                return True
+
+        return False
+
+    def split(self, events, values):
+        """Returns a dict of each of the given values matched to the list of events for it."""
+        if self.limit:
+            # events found for several values were copied once for each of them
+            return { value: [ event for event in events if event.get(SEARCHED_VALUE_FIELD) == value ]
+                     for value in values }
+
+        return { value: [ event for event in events if self.matches(event, value) ] for value in values }
+
+    def key(self, earliest, latest):
+        """Returns the key that identifies searches that can be merged together."""
+        normalized = ' '.join(self.template.split())
+        return hashlib.sha256('{}|{}|{}|{}|{}|{}'.format(normalized, self.field, self.wildcard, self.limit,
+                              int(earliest.timestamp()), int(latest.timestamp())).encode()).hexdigest()
+
+def execute_splunk_search(query, earliest, latest, max_result_count=0, timeout=None):
+    """Runs the given search over the REST api of the configured splunk server and returns the list of result events."""
+    if not query.lstrip().startswith('|') and not query.lstrip().startswith('search '):
+        query = 'search {}'.format(query)
+
+    logging.debug("executing splunk search {} earliest {} latest {}".format(query, earliest, latest))
+    r = requests.post('{}/services/search/jobs'.format(saq.CONFIG['splunk']['uri'].rstrip('/')),
+                      auth=(saq.CONFIG['splunk']['username'], saq.CONFIG['splunk']['password']),
+                      data={ 'search': query,
+                             'exec_mode': 'oneshot',
+                             'output_mode': 'json',
+                             'earliest_time': str(int(earliest.timestamp())),
+                             'latest_time': str(int(latest.timestamp())),
+                             'count': str(max_result_count) },
+                      verify=False, # XXX
+                      timeout=timeout)
+
+    if r.status_code != 200:
+        raise RuntimeError("splunk search failed ({}): {}".format(r.status_code, r.text))
+
+    return r.json().get('results', [])
+
+class SplunkSearchCoalescer(object):
+    """Merges the searches made by every process on the node for the same template and time window."""
+
+    def __init__(self, cache_dir=None, coalesce_window=None, cache_ttl=None, time_bucket=None, timeout=None):
+        config = saq.CONFIG['splunk']
+        if cache_dir is None:
+            cache_dir = os.path.join(saq.DATA_DIR, config['cache_dir'])
+        # the directory the pending values and the results are kept in
+        self.cache_dir = cache_dir
+        # how long (in seconds) to wait for other values to search for
+        self.coalesce_window = config.getfloat('coalesce_window') if coalesce_window is None else coalesce_window
+        # how long (in seconds) results are kept
+        self.cache_ttl = config.getint('cache_ttl') if cache_ttl is None else cache_ttl
+        # the time window of a search is widened to these boundaries (in seconds)
+        self.time_bucket = config.getint('time_bucket') if time_bucket is None else time_bucket
+        # how long (in seconds) a search can take
+        self.timeout = config.getint('query_timeout') if timeout is None else timeout
+
+    def get_time_window(self, earliest, latest):
+        """Returns the (earliest, latest) time window widened to the time bucket boundaries."""
+        if not self.time_bucket:
+            return earliest, latest
+
+        earliest_ts = earliest.timestamp()
+        latest_ts = latest.timestamp()
+        earliest_ts -= earliest_ts % self.time_bucket
+        if latest_ts % self.time_bucket:
+            latest_ts += self.time_bucket - latest_ts % self.time_bucket
+
+        return ( datetime.datetime.fromtimestamp(earliest_ts, tz=earliest.tzinfo),
+                 datetime.datetime.fromtimestamp(latest_ts, tz=latest.tzinfo) )
+
+    def _result_path(self, key_dir, value):
+        return os.path.join(key_dir, '{}.json'.format(hashlib.sha256(value.lower().encode()).hexdigest()))
+
+    def _load_result(self, key_dir, value):
+        """Returns the cached result for the value, or None if there isn't one (or it has expired.)"""
+        result_path = self._result_path(key_dir, value)
+        try:
+            if time.time() - os.path.getmtime(result_path) >= self.cache_ttl:
+                return None
+
+            with open(result_path, 'r') as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+
+    def _store_result(self, key_dir, value, result):
+        fd, temp_path = tempfile.mkstemp(dir=key_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(result, fp)
+
+        os.rename(temp_path, self._result_path(key_dir, value))
+
+    def search(self, search, value, earliest, latest, execute):
+        """Returns the list of events for the given value, or None if the search failed.
+           execute(query, earliest, latest, value_count) runs the search and returns the list of events."""
+        earliest, latest = self.get_time_window(earliest, latest)
+        key_dir = os.path.join(self.cache_dir, search.key(earliest, latest))
+        os.makedirs(key_dir, exist_ok=True)
+        pending_path = os.path.join(key_dir, 'pending')
+
+        with open(os.path.join(key_dir, 'lock'), 'a') as lock_fp:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+            try:
+                # failed searches are not used by searches that come later
+                result = self._load_result(key_dir, value)
+                if result is not None and 'error' not in result:
+                    logging.debug("using cached splunk results for {}".format(value))
+                    return result.get('results')
+
+                pending = []
+                if os.path.exists(pending_path):
+                    # a batch that has been pending for too long was abandoned
+                    if time.time() - os.path.getmtime(pending_path) < self.coalesce_window + self.timeout:
+                        with open(pending_path, 'r') as fp:
+                            pending = fp.read().splitlines()
+
+                # the first one to ask runs the search for everyone that asks during the window
+                leader = not pending
+                joined = time.time()
+                if value not in pending:
+                    pending.append(value)
+                    with open(pending_path, 'w' if leader else 'a') as fp:
+                        fp.write('{}\n'.format(value))
+            finally:
+                fcntl.flock(lock_fp.fileno(), fcntl.LOCK_UN)
+
+            if not leader:
+                return self._wait_for_result(key_dir, value, joined)
+
+            time.sleep(self.coalesce_window)
+
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+            try:
+                with open(pending_path, 'r') as fp:
+                    values = [ v for v in fp.read().splitlines() if v ]
+                os.remove(pending_path)
+            finally:
+                fcntl.flock(lock_fp.fileno(), fcntl.LOCK_UN)
+
+        if value not in values:
+            values.append(value)
+
+        logging.info("searching splunk for {} values of {}".format(len(values), search.field))
+        try:
+            events = execute(search.format(values), earliest, latest, len(values))
+            results = { v: { 'results': r } for v, r in search.split(events, values).items() }
+        except Exception as e:
+            logging.error("splunk search failed for {}: {}".format(','.join(values), e))
+            results = { v: { 'results': None, 'error': str(e) } for v in values }
+
+        for v, result in results.items():
+            self._store_result(key_dir, v, result)
+
+        self.expire()
+        return results[value]['results']
+
+    def _wait_for_result(self, key_dir, value, joined):
+        """Waits for the leader of the batch joined at the given time to store the result for the value."""
+        time_limit = time.time() + self.coalesce_window + self.timeout
+        while time.time() < time_limit:
+            result = self._load_result(key_dir, value)
+            # failures stored before we joined the batch are from an earlier batch
+            if result is not None and 'error' in result:
+                try:
+                    if os.path.getmtime(self._result_path(key_dir, value)) < joined:
+                        result = None
+                except FileNotFoundError:
+                    result = None
+
+            if result is not None:
+                return result.get('results')
+
+            time.sleep(0.1)
+
+        logging.warning("timed out waiting for splunk results for {}".format(value))
+        return None
+
+    def expire(self):
+        """Deletes the searches that only have expired results."""
+        try:
+            for key in os.listdir(self.cache_dir):
+                key_dir = os.path.join(self.cache_dir, key)
+                if time.time() - os.path.getmtime(key_dir) > self.cache_ttl + self.coalesce_window + self.timeout:
+                    shutil.rmtree(key_dir, ignore_errors=True)
+        except Exception as e:
+            logging.warning("unable to expire splunk search results in {}: {}".format(self.cache_dir, e))
@@ -0,0 +1,260 @@
+# vim: sw=4:ts=4:et
+#
+# in-memory ssdeep similarity index
+#
+# an ssdeep hash looks like block_size:signature:double_signature where the double signature
+# was generated with twice the block size, so two hashes can only be compared when their block
+# sizes are equal or differ by a factor of two, and two signatures only score above zero when
+# they share a substring of 7 characters (the size of the rolling window)
+#
+# the index keeps each signature in a bucket for the block size it was generated with,
+# keyed by each 7-gram it contains, so a search only scores the hashes that share a 7-gram
+# with the target instead of comparing against every hash like ssdeep -m does
+#
+# scores are computed the same way libfuzzy's fuzzy_compare computes them
+#
+# hashes can be added to an index at any time, and when a file of hashes is only appended to
+# just the new lines are added to the index loaded from it
+#
+
+import csv
+import logging
+import os
+import re
+
+__all__ = [
+    'SsdeepHashFile',
+    'SsdeepIndex',
+    'compare',
+    'parse_hash',
+    'parse_line',
+]
+
+ROLLING_WINDOW = 7
+MIN_BLOCKSIZE = 3
+SPAMSUM_LENGTH = 64
+
+# the first line of the output of the ssdeep command
+HEADER_PREFIX = 'ssdeep,'
+
+RE_HASH = re.compile(r'^([0-9]+):([^:]*):([^:,]*)$')
+# sequences of more than 3 identical characters carry little information and are reduced to 3
+RE_SEQUENCE = re.compile(r'(.)\1{3,}')
+
+def _eliminate_sequences(signature):
+    return RE_SEQUENCE.sub(r'\1\1\1', signature)
+
+def parse_hash(ssdeep_hash):
+    """Returns a tuple of (block_size, signature, double_signature) for the given ssdeep hash.
+       Repeated character sequences are already reduced. Raises ValueError if the hash is invalid."""
+    m = RE_HASH.match(ssdeep_hash.strip())
+    if not m:
+        raise ValueError("invalid ssdeep hash {}".format(ssdeep_hash))
+
+    block_size = int(m.group(1))
+    if block_size < MIN_BLOCKSIZE:
+        raise ValueError("invalid ssdeep block size in {}".format(ssdeep_hash))
+
+    return block_size, _eliminate_sequences(m.group(2)), _eliminate_sequences(m.group(3))
+
+def parse_line(line):
+    """Parses a line of ssdeep output (hash,"file name") into a tuple of (hash, name).
+       Returns None for the header and blank lines. Raises ValueError if the line is invalid."""
+    line = line.strip()
+    if not line or line.startswith(HEADER_PREFIX):
+        return None
+
+    fields = next(csv.reader([line]))
+    ssdeep_hash = fields[0]
+    name = ','.join(fields[1:]) if len(fields) > 1 else ssdeep_hash
+    parse_hash(ssdeep_hash)
+    return ssdeep_hash, name
+
+def _grams(signature):
+    return { signature[i:i + ROLLING_WINDOW] for i in range(len(signature) - ROLLING_WINDOW + 1) }
+
+def _edit_distance(s1, s2):
+    # insert and delete cost 1, change costs 2 (the same as a delete plus an insert)
+    previous = list(range(len(s2) + 1))
+    for i, c1 in enumerate(s1, 1):
+        current = [i]
+        for j, c2 in enumerate(s2, 1):
+            if c1 == c2:
+                current.append(previous[j - 1])
+            else:
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + 2))
+        previous = current
+
+    return previous[-1]
+
+def _score_signatures(s1, s2, block_size):
+    if len(s1) > SPAMSUM_LENGTH or len(s2) > SPAMSUM_LENGTH:
+        return 0
+
+    if not (_grams(s1) & _grams(s2)):
+        return 0
+
+    score = _edit_distance(s1, s2)
+    score = (score * SPAMSUM_LENGTH) // (len(s1) + len(s2))
+    score = (100 * score) // SPAMSUM_LENGTH
+    if score >= 100:
+        return 0
+
+    score = 100 - score
+    # small block sizes are not allowed to exaggerate their matches
+    if block_size < (99 + ROLLING_WINDOW) // ROLLING_WINDOW * MIN_BLOCKSIZE:
+        score = min(score, block_size // MIN_BLOCKSIZE * min(len(s1), len(s2)))
+
+    return score
+
+def _compare(h1, h2):
+    block_size1, s1, d1 = h1
+    block_size2, s2, d2 = h2
+
+    if block_size1 == block_size2:
+        if s1 == s2 and d1 == d2:
+            return 100
+
+        return max(_score_signatures(s1, s2, block_size1), _score_signatures(d1, d2, block_size1 * 2))
+    elif block_size1 * 2 == block_size2:
+        return _score_signatures(s2, d1, block_size2)
+    elif block_size2 * 2 == block_size1:
+        return _score_signatures(s1, d2, block_size1)
+
+    return 0
+
+def compare(hash1, hash2):
+    """Returns the similarity score (0 - 100) of the two given ssdeep hashes."""
+    return _compare(parse_hash(hash1), parse_hash(hash2))
+
+class SsdeepIndex(object):
+    """Finds the ssdeep hashes that are similar to a given hash."""
+
+    def __init__(self):
+        # list of (name, ssdeep_hash, parsed_hash)
+        self.entries = []
+        # key = (ssdeep_hash, name) of every entry
+        self.keys = set()
+        # key = block size, value = { key = 7-gram, value = set(entry index) }
+        self.buckets = {}
+        # key = parsed_hash, value = [entry index]
+        # identical hashes always match even when the signatures are too short to share a 7-gram
+        self.exact = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, ssdeep_hash, name):
+        """Adds the given hash to the index. Returns False if it was already there.
+           Raises ValueError if the hash is invalid."""
+        ssdeep_hash = ssdeep_hash.strip()
+        if (ssdeep_hash, name) in self.keys:
+            return False
+
+        parsed_hash = parse_hash(ssdeep_hash)
+        block_size, signature, double_signature = parsed_hash
+
+        index = len(self.entries)
+        self.entries.append((name, ssdeep_hash, parsed_hash))
+        self.keys.add((ssdeep_hash, name))
+        self.exact.setdefault(parsed_hash, []).append(index)
+
+        for bucket_size, s in ((block_size, signature), (block_size * 2, double_signature)):
+            bucket = self.buckets.setdefault(bucket_size, {})
+            for gram in _grams(s):
+                bucket.setdefault(gram, set()).add(index)
+
+        return True
+
+    def candidates(self, ssdeep_hash):
+        """Returns the indexes of the entries that can score above zero against the given hash."""
+        block_size, signature, double_signature = parse_hash(ssdeep_hash)
+        result = set(self.exact.get((block_size, signature, double_signature), []))
+        for bucket_size, s in ((block_size, signature), (block_size * 2, double_signature)):
+            bucket = self.buckets.get(bucket_size)
+            if not bucket:
+                continue
+
+            for gram in _grams(s):
+                result.update(bucket.get(gram, ()))
+
+        return result
+
+    def search(self, ssdeep_hash, threshold=1):
+        """Returns a list of (name, score) for each indexed hash that scores at least threshold against the given hash,
+           highest score first (ties in the order they were added.)"""
+        parsed_hash = parse_hash(ssdeep_hash)
+        result = []
+        for index in sorted(self.candidates(ssdeep_hash)):
+            name, _, entry_hash = self.entries[index]
+            score = _compare(parsed_hash, entry_hash)
+            if score >= threshold:
+                result.append((name, score))
+
+        result.sort(key=lambda r: -r[1])
+        return result
+
+class SsdeepHashFile(object):
+    """An SsdeepIndex loaded from a file of ssdeep output (ssdeep files_to_hash > path.)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = None
+
+        # what has been loaded so far
+        self.file_id = None
+        self.offset = 0
+        self.last_line = None
+
+    def _is_appended(self, file_id, file_size):
+        """Returns True if the file is the one that was loaded with more lines added to the end."""
+        if self.index is None or self.file_id != file_id or file_size < self.offset:
+            return False
+
+        if self.last_line is None:
+            return True
+
+        # make sure the file was not rewritten in place
+        with open(self.path, 'rb') as fp:
+            fp.seek(self.offset - len(self.last_line))
+            return fp.read(len(self.last_line)) == self.last_line
+
+    def load(self):
+        """Loads the file, adding just the new lines if the file was only appended to. Returns the number of hashes added."""
+        s = os.stat(self.path)
+        file_id = (s.st_dev, s.st_ino)
+
+        if self._is_appended(file_id, s.st_size):
+            index = self.index
+            offset = self.offset
+            last_line = self.last_line
+        else:
+            index = SsdeepIndex()
+            offset = 0
+            last_line = None
+
+        count = 0
+        with open(self.path, 'rb') as fp:
+            fp.seek(offset)
+            for line in fp:
+                # a line that is still being written is picked up the next time
+                if not line.endswith(b'\n'):
+                    break
+
+                offset += len(line)
+                last_line = line
+
+                try:
+                    entry = parse_line(line.decode('utf8', errors='replace'))
+                except ValueError as e:
+                    logging.warning("skipping invalid line in {}: {}".format(self.path, e))
+                    continue
+
+                if entry is not None and index.add(*entry):
+                    count += 1
+
+        self.index = index
+        self.file_id = file_id
+        self.offset = offset
+        self.last_line = last_line
+        return count
@@ -629,6 +629,13 @@ class ACEBasicTestCase(TestCase):
         c.execute("""DELETE FROM httplog""")
         c.execute("""DELETE FROM smtplog""")
         db.commit()
+
+        # and the cached counts
+        from saq.brocess import get_brocess_count_cache
+        cache = get_brocess_count_cache()
+        if cache is not None:
+            cache.clear()
+
         # TODO instead of using harded values pull the limits from the config
         c.execute("""INSERT INTO httplog ( host, numconnections, firstconnectdate ) 
                      VALUES ( 'local', 1000, UNIX_TIMESTAMP(NOW()) ),
@@ -644,6 +651,10 @@ class ACEBasicTestCase(TestCase):
         c.execute("""DELETE FROM cloudphish_content_metadata""")
         db.commit()
 
+        # clear the cloudphish result cache
+        from saq.cloudphish import clear_result_cache
+        clear_result_cache()
+
         # clear cloudphish engine and module cache
         for cache_dir in [ saq.CONFIG['cloudphish']['cache_dir'] ]:
             if os.path.isdir(cache_dir):
@@ -669,6 +680,11 @@ class ACEBasicTestCase(TestCase):
                 except Exception as e:
                     logging.error(f"unable to clear {subdir}: {e}")
 
+        from saq.alert_search import get_alert_search_index
+        alert_search_index = get_alert_search_index()
+        if alert_search_index is not None:
+            alert_search_index.clear()
+
         c.execute("DELETE FROM alerts")
         c.execute("DELETE FROM workload")
         c.execute("DELETE FROM observables")
@@ -681,8 +697,11 @@ class ACEBasicTestCase(TestCase):
         c.execute("UPDATE nodes SET is_primary = 0")
         c.execute("DELETE FROM locks")
         c.execute("DELETE FROM delayed_analysis")
+        c.execute("DELETE FROM sandbox_jobs")
         c.execute("DELETE FROM users")
         c.execute("DELETE FROM malware")
+        c.execute("DELETE FROM metrics_alert_rollup")
+        c.execute("DELETE FROM metrics_rollup_status")
 
         from app.models import User
         u = User()
@@ -0,0 +1,95 @@
+# vim: sw=4:ts=4:et
+
+import os
+import os.path
+import sqlite3
+import uuid
+
+import saq
+from saq.alert_search import AlertSearchIndex, get_alert_search_index
+from saq.constants import *
+from saq.database import Alert
+from saq.test import *
+
+class AlertSearchTestCase(ACEBasicTestCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.index_path = os.path.join(saq.TEMP_DIR, 'alert_search_unittest.db')
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
+    def create_files(self, storage_dir, data, details=None):
+        os.makedirs(os.path.join(storage_dir, '.ace'), exist_ok=True)
+        with open(os.path.join(storage_dir, 'data.json'), 'w') as fp:
+            fp.write(data)
+        if details is not None:
+            with open(os.path.join(storage_dir, '.ace', 'details.json'), 'w') as fp:
+                fp.write(details)
+
+    def test_search(self):
+        index = AlertSearchIndex(self.index_path)
+        storage_dir = os.path.join(saq.TEMP_DIR, 'alert_search_unittest')
+        self.create_files(storage_dir, '{"desc": "Suspicious Email From evil.com"}', '{"headers": "X-Mailer: phishkit"}')
+        index.index('uuid_a', storage_dir)
+        self.assertTrue(index.is_indexed('uuid_a'))
+        self.assertFalse(index.is_indexed('uuid_b'))
+
+        # substrings, case insensitive
+        self.assertEquals(index.search('evil.co'), set([ 'uuid_a' ]))
+        self.assertEquals(index.search('suspicious email'), set([ 'uuid_a' ]))
+        self.assertEquals(index.search('"desc"'), set([ 'uuid_a' ]))
+        self.assertEquals(index.search('l.'), set([ 'uuid_a' ]))
+        self.assertEquals(index.search('good.com'), set())
+
+        # the details are only searched when asked for
+        self.assertEquals(index.search('phishkit'), set())
+        self.assertEquals(index.search('phishkit', details=True), set([ 'uuid_a' ]))
+
+        # updates replace the content of the files that changed
+        self.create_files(storage_dir, '{"desc": "Suspicious Email From bad.com"}')
+        index.update('uuid_a', storage_dir, [ 'data.json' ])
+        self.assertEquals(index.search('evil.com'), set())
+        self.assertEquals(index.search('bad.com'), set([ 'uuid_a' ]))
+        self.assertEquals(index.search('phishkit', details=True), set([ 'uuid_a' ]))
+
+        index.remove('uuid_a')
+        self.assertFalse(index.is_indexed('uuid_a'))
+        self.assertEquals(index.search('bad.com'), set())
+
+    def test_existing_index(self):
+        # indexes created before alert_files existed only have the FTS table
+        connection = sqlite3.connect(self.index_path)
+        connection.execute("CREATE VIRTUAL TABLE alert_content USING fts5(uuid UNINDEXED, path UNINDEXED, content)")
+        connection.execute("INSERT INTO alert_content ( uuid, path, content ) VALUES ( 'uuid_a', 'data.json', 'evil' )")
+        connection.commit()
+        connection.close()
+
+        index = AlertSearchIndex(self.index_path)
+        self.assertTrue(index.is_indexed('uuid_a'))
+        self.assertEquals(index.search('evil'), set([ 'uuid_a' ]))
+
+        index.remove('uuid_a')
+        self.assertFalse(index.is_indexed('uuid_a'))
+        self.assertEquals(index.connection.execute("SELECT COUNT(*) FROM alert_content").fetchone()[0], 0)
+
+    def test_alert(self):
+        root = create_root_analysis(uuid=str(uuid.uuid4()), details={ 'indicator': 'detail_marker_value' })
+        root.initialize_storage()
+        root.add_observable(F_TEST, 'observable_marker_value')
+        root.save()
+
+        # analysis is not in the index until it becomes an alert
+        index = get_alert_search_index()
+        self.assertEquals(index.search('observable_marker_value'), set())
+
+        alert = Alert(storage_dir=root.storage_dir)
+        alert.load()
+        alert.sync()
+        self.assertEquals(index.search('observable_marker_value'), set([ root.uuid ]))
+        self.assertEquals(index.search('detail_marker_value', details=True), set([ root.uuid ]))
+
+        # and saves keep the index up to date
+        alert.add_observable(F_TEST, 'another_marker_value')
+        alert.save()
+        self.assertEquals(index.search('another_marker_value'), set([ root.uuid ]))
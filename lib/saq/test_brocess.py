@@ -0,0 +1,102 @@
+# vim: sw=4:ts=4:et
+
+import os.path
+import uuid
+
+import saq
+from saq.brocess import query_email_conversation_counts, query_brocess_by_email_conversations, \
+                        get_brocess_count_cache, BrocessCountCache
+from saq.constants import *
+from saq.database import use_db
+from saq.test import *
+
+class BrocessTestCase(ACEModuleTestCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.reset_brocess()
+        self.add_smtplog([ ( 'sender@local', 'alice@local', 3 ),
+                           ( 'sender@local', 'bob@local', 7 ),
+                           ( 'other@local', 'alice@local', 1 ),
+                           ( 'Mixed@Local', 'Alice@local', 2 ) ])
+
+    @use_db(name='brocess')
+    def add_smtplog(self, rows, db, c):
+        c.executemany("""INSERT INTO smtplog ( source, destination, numconnections, firstconnectdate )
+                         VALUES ( %s, %s, %s, UNIX_TIMESTAMP(NOW()) )""", rows)
+        db.commit()
+
+    def test_query_email_conversations(self):
+        source_counts, conversation_counts = query_brocess_by_email_conversations([ 
+            ( 'sender@local', 'alice@local' ), 
+            ( 'sender@local', 'carol@local' ), 
+            ( 'new@local', 'alice@local' ),
+            ( 'Mixed@Local', 'Alice@local' ) ])
+
+        self.assertEquals(source_counts, { 'sender@local': 10, 'new@local': 0, 'Mixed@Local': 2 })
+        # new senders have no conversations to look up
+        # and addresses are matched as they were recorded
+        self.assertEquals(conversation_counts, { ( 'sender@local', 'alice@local' ): 3,
+                                                 ( 'sender@local', 'carol@local' ): 0,
+                                                 ( 'Mixed@Local', 'Alice@local' ): 2 })
+
+    def test_count_cache(self):
+        conversations = [ ( 'sender@local', 'alice@local' ), ( 'other@local', 'alice@local' ) ]
+        source_counts, conversation_counts = query_email_conversation_counts(conversations)
+        self.assertEquals(source_counts['sender@local'], 10)
+        self.assertEquals(conversation_counts[('other@local', 'alice@local')], 1)
+
+        # the counts are used from the cache
+        self.add_smtplog([ ( 'sender@local', 'carol@local', 5 ) ])
+        source_counts, conversation_counts = query_email_conversation_counts(conversations)
+        self.assertEquals(source_counts['sender@local'], 10)
+
+        # but new conversations are still looked up
+        source_counts, conversation_counts = query_email_conversation_counts([ ( 'sender@local', 'carol@local' ) ])
+        self.assertEquals(conversation_counts[('sender@local', 'carol@local')], 5)
+
+        get_brocess_count_cache().clear()
+        source_counts, conversation_counts = query_email_conversation_counts(conversations)
+        self.assertEquals(source_counts['sender@local'], 15)
+
+    def test_count_cache_expiration(self):
+        cache = BrocessCountCache(os.path.join(saq.TEMP_DIR, 'brocess_cache_unittest.db'), 60)
+        cache.clear()
+        cache.set({ 'a': 1, 'b': 0 })
+        self.assertEquals(cache.get([ 'a', 'b', 'c' ]), { 'a': 1, 'b': 0 })
+        cache.ttl = 0
+        self.assertEquals(cache.get([ 'a', 'b', 'c' ]), {})
+
+    def test_email_conversation_frequency_analyzer(self):
+        from saq.modules.email import EmailConversationFrequencyAnalysis
+
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        observables = [ root.add_observable(F_EMAIL_CONVERSATION, create_email_conversation('sender@local', dest))
+                        for dest in [ 'alice@local', 'bob@local', 'carol@local' ] ]
+        new_sender = root.add_observable(F_EMAIL_CONVERSATION, create_email_conversation('new@local', 'alice@local'))
+        root.save()
+        root.schedule()
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_email_conversation_frequency_analyzer', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        root.load()
+        counts = {}
+        for observable in observables:
+            analysis = root.get_observable(observable.id).get_analysis(EmailConversationFrequencyAnalysis)
+            self.assertIsNotNone(analysis)
+            self.assertEquals(analysis.details['source_count'], 10)
+            counts[observable.value] = analysis.details['dest_count']
+
+        self.assertEquals(counts, { 'sender@local|alice@local': 3, 
+                                    'sender@local|bob@local': 7, 
+                                    'sender@local|carol@local': 0 })
+        self.assertTrue(root.get_observable(observables[1].id).has_tag('frequent_conversation'))
+
+        new_sender = root.get_observable(new_sender.id)
+        self.assertTrue(new_sender.has_tag('new_sender'))
+        self.assertEquals(new_sender.get_analysis(EmailConversationFrequencyAnalysis).details, { 'source_count': 0 })
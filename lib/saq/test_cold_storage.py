@@ -0,0 +1,93 @@
+# vim: sw=4:ts=4:et
+
+import os
+import os.path
+import tempfile
+
+import saq
+from saq.analysis import RootAnalysis
+from saq.cold_storage import *
+from saq.constants import *
+from saq.test import *
+
+class ColdStorageTestCase(ACEBasicTestCase):
+
+    def create_packed_root(self):
+        root = create_root_analysis()
+        root.initialize_storage()
+        root.details = { 'hello': 'world' }
+        os.makedirs(os.path.join(root.storage_dir, 'sub'))
+        with open(os.path.join(root.storage_dir, 'sub', 'sample.txt'), 'w') as fp:
+            fp.write('test')
+
+        _file = root.add_observable(F_FILE, 'sub/sample.txt')
+        root.save()
+
+        self.assertTrue(pack_storage_dir(root.storage_dir) > 0)
+        return root, _file
+
+    def test_pack_unpack(self):
+        root, _file = self.create_packed_root()
+        self.assertTrue(is_packed(root.storage_dir))
+        self.assertEquals(os.listdir(root.storage_dir), [ CONTAINER_NAME ])
+        with self.assertRaises(RuntimeError):
+            pack_storage_dir(root.storage_dir)
+
+        # files are read from the container
+        self.assertTrue(storage_file_exists(root.storage_dir, 'sub/sample.txt'))
+        self.assertFalse(storage_file_exists(root.storage_dir, 'sub/missing.txt'))
+        self.assertEquals(storage_file_size(root.storage_dir, 'sub/sample.txt'), 4)
+        with open_storage_file(root.storage_dir, 'sub/sample.txt') as fp:
+            self.assertEquals(fp.read(), 'test')
+
+        with open_storage_file(root.storage_dir, 'sub/sample.txt', 'rb') as fp:
+            self.assertEquals(fp.read(), b'test')
+
+        with self.assertRaises(FileNotFoundError):
+            open_storage_file(root.storage_dir, 'sub/missing.txt')
+
+        temp_dir = tempfile.mkdtemp(dir=saq.TEMP_DIR)
+        target_path = extract_storage_file(root.storage_dir, 'sub/sample.txt', temp_dir)
+        with open(target_path, 'r') as fp:
+            self.assertEquals(fp.read(), 'test')
+
+        # files on disk are newer than the files in the container
+        os.makedirs(os.path.join(root.storage_dir, 'sub'))
+        with open(os.path.join(root.storage_dir, 'sub', 'sample.txt'), 'w') as fp:
+            fp.write('new')
+
+        with open_storage_file(root.storage_dir, 'sub/sample.txt') as fp:
+            self.assertEquals(fp.read(), 'new')
+
+        unpack_storage_dir(root.storage_dir)
+        self.assertFalse(is_packed(root.storage_dir))
+        with open(os.path.join(root.storage_dir, 'sub', 'sample.txt'), 'r') as fp:
+            self.assertEquals(fp.read(), 'new')
+
+        self.assertTrue(os.path.exists(os.path.join(root.storage_dir, 'data.json')))
+
+        # unpacking something that was already unpacked (by another process) does nothing
+        unpack_storage_dir(root.storage_dir)
+        self.assertFalse(is_packed(root.storage_dir))
+
+    def test_load_packed_root(self):
+        root, _file = self.create_packed_root()
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertTrue(is_packed(root.storage_dir))
+        self.assertEquals(root.details, { 'hello': 'world' })
+        _file = root.get_observable(_file.id)
+        self.assertTrue(_file.exists)
+        self.assertEquals(_file.size, 4)
+
+        # saving the alert unpacks it
+        root.add_observable(F_TEST, 'test')
+        root.save()
+        self.assertFalse(is_packed(root.storage_dir))
+        self.assertTrue(os.path.exists(os.path.join(root.storage_dir, 'sub', 'sample.txt')))
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertEquals(root.details, { 'hello': 'world' })
+        self.assertIsNotNone(root.find_observable(F_TEST))
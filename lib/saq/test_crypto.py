@@ -1,10 +1,12 @@
 # vim: sw=4:ts=4:et
 
 import logging
+import os
+import os.path
 
 import saq
 
-from saq.crypto import encrypt_chunk, decrypt_chunk, get_aes_key
+from saq.crypto import encrypt_chunk, decrypt_chunk, get_aes_key, decrypt, decrypt_stream, EncryptedFileWriter
 from saq.test import *
 
 class ACECryptoTestCase(ACEBasicTestCase):
@@ -31,3 +33,22 @@ class ACECryptoTestCase(ACEBasicTestCase):
         self.assertNotEquals(chunk, encrypted_chunk)
         decrypted_chunk = decrypt_chunk(encrypted_chunk)
         self.assertEquals(chunk, decrypted_chunk)
+
+    def test_anp_002_encrypted_file_writer(self):
+        target_path = os.path.join(saq.TEMP_DIR, 'unittest.e')
+        for size in [ 0, 1, 16, 17, 64 * 1024 + 1, 200000 ]:
+            with self.subTest(size=size):
+                data = os.urandom(size)
+                with open(target_path, 'wb') as fp:
+                    writer = EncryptedFileWriter(fp)
+                    # written in pieces that do not line up with the AES blocks
+                    for index in range(0, size, 1000):
+                        writer.write(data[index:index + 1000])
+                    writer.close()
+
+                self.assertEquals(b''.join(decrypt_stream(target_path)), data)
+
+                # same format as encrypt()
+                decrypt(target_path, '{}.decrypted'.format(target_path))
+                with open('{}.decrypted'.format(target_path), 'rb') as fp:
+                    self.assertEquals(fp.read(), data)
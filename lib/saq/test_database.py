@@ -406,6 +406,55 @@ class TestCase(ACEBasicTestCase):
 
         self.assertEquals(len(alert.description), 1024)
 
+    def test_alert_sla(self):
+        from saq.database import set_dispositions, update_sla
+
+        enabled = saq.GLOBAL_SLA_SETTINGS.enabled
+        saq.GLOBAL_SLA_SETTINGS.enabled = True
+        try:
+            root_analysis = create_root_analysis()
+            root_analysis.save()
+            alert = Alert(storage_dir=root_analysis.storage_dir)
+            alert.load()
+            alert.sync()
+
+            # the SLA times are set when the alert is inserted
+            alert = saq.db.query(Alert).filter(Alert.uuid == root_analysis.uuid).one()
+            self.assertIsNotNone(alert.sla_warning_time)
+            self.assertIsNotNone(alert.sla_deadline)
+            self.assertTrue(alert.insert_date < alert.sla_warning_time < alert.sla_deadline)
+            self.assertFalse(alert.is_over_sla)
+
+            # and are kept in business hours
+            start_hour, end_hour = alert._bt.business_hours
+            for value in [ alert.sla_warning_time, alert.sla_deadline ]:
+                value = alert._datetime_to_sla_time_zone(dt=value)
+                self.assertTrue(alert._bt.isbusinessday(value))
+                self.assertTrue(start_hour <= value.time() <= end_hour)
+
+            # alerts that are excluded from SLA have no SLA times
+            saq.EXCLUDED_SLA_ALERT_TYPES.append(alert.alert_type)
+            try:
+                update_sla([alert.uuid])
+                saq.db.refresh(alert)
+                self.assertIsNone(alert.sla_deadline)
+            finally:
+                saq.EXCLUDED_SLA_ALERT_TYPES.remove(alert.alert_type)
+
+            update_sla([alert.uuid])
+            saq.db.refresh(alert)
+            self.assertIsNotNone(alert.sla_deadline)
+
+            # and dispositioned alerts are out of SLA
+            set_dispositions([alert.uuid], DISPOSITION_FALSE_POSITIVE, UNITTEST_USER_ID)
+            saq.db.refresh(alert)
+            self.assertIsNone(alert.sla_warning_time)
+            self.assertIsNone(alert.sla_deadline)
+            self.assertFalse(alert.is_approaching_sla)
+
+        finally:
+            saq.GLOBAL_SLA_SETTINGS.enabled = enabled
+
     def test_sync_observable_mapping(self):
         root_analysis = create_root_analysis()
         root_analysis.save()
@@ -1,6 +1,13 @@
 # vim: sw=4:ts=4:et
 
-from saq.email import normalize_email_address, decode_rfc2822
+import email
+import hashlib
+import os
+import os.path
+import shutil
+
+import saq
+from saq.email import normalize_email_address, decode_rfc2822, StreamingEmailParser
 from saq.test import *
 
 class TestCase(ACEBasicTestCase):
@@ -23,3 +30,54 @@ class TestCase(ACEBasicTestCase):
                           'Puede que algunos contribuyentes tengan que enmendar su declaración de impuestos')
         self.assertEquals(decode_rfc2822('=?GBK?B?UmU6gYbKssC8tcTNxo9Wst/C1A==?='), 
                           'Re:亞什兰的推廣策略')
+
+    def test_streaming_email_parser(self):
+        spool_dir = os.path.join(saq.TEMP_DIR, 'email_parts_unittest')
+        os.makedirs(spool_dir, exist_ok=True)
+
+        for file_name in os.listdir(os.path.join('test_data', 'emails')):
+            path = os.path.join('test_data', 'emails', file_name)
+            with self.subTest(file_name=file_name):
+                with open(path, 'r', errors='ignore') as fp:
+                    expected_parts = list(email.message_from_string(fp.read().strip()).walk())
+
+                parts = list(StreamingEmailParser(spool_dir).parse(path).walk())
+                self.assertEquals(len(parts), len(expected_parts))
+
+                # same parts with the same headers and the same decoded payloads
+                for part, expected_part in zip(parts, expected_parts):
+                    self.assertEquals(part.items(), expected_part.items())
+                    self.assertEquals(part.is_multipart(), expected_part.is_multipart())
+                    if not part.is_multipart():
+                        with open(part.spool_path, 'rb') as fp:
+                            payload = fp.read()
+
+                        self.assertEquals(payload, expected_part.get_payload(decode=True))
+                        self.assertEquals(part.payload_size, len(payload))
+                        self.assertEquals(part.payload_sha256, hashlib.sha256(payload).hexdigest())
+
+        shutil.rmtree(spool_dir)
+
+    def test_streaming_email_parser_limits(self):
+        spool_dir = os.path.join(saq.TEMP_DIR, 'email_parts_unittest')
+        os.makedirs(spool_dir, exist_ok=True)
+        path = os.path.join('test_data', 'emails', 'extra_message_id.email.rfc822')
+
+        parser = StreamingEmailParser(spool_dir)
+        self.assertEquals(len(list(parser.parse(path).walk())), 14)
+        self.assertFalse(parser.truncated)
+
+        parser = StreamingEmailParser(spool_dir, max_parts=4)
+        self.assertEquals(len(list(parser.parse(path).walk())), 4)
+        self.assertTrue(parser.truncated)
+
+        # the attached email is not parsed but is still there to be extracted
+        parser = StreamingEmailParser(spool_dir, max_depth=1)
+        parts = list(parser.parse(path).walk())
+        self.assertEquals([ part.get_content_type() for part in parts ], 
+                          [ 'multipart/mixed', 'text/plain', 'message/rfc822' ])
+        self.assertFalse(parts[2].is_multipart())
+        self.assertTrue(parts[2].payload_size > 0)
+        self.assertTrue(parser.truncated)
+
+        shutil.rmtree(spool_dir)
@@ -0,0 +1,122 @@
+# vim: sw=4:ts=4:et
+
+import io
+import os
+import os.path
+import shutil
+import tarfile
+import zipfile
+
+from subprocess import Popen, PIPE
+
+import saq
+from saq.extraction import *
+from saq.test import *
+
+class ExtractionTestCase(ACEBasicTestCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.archive_path = os.path.join(saq.TEMP_DIR, 'extraction_unittest.archive')
+        self.target_dir = os.path.join(saq.TEMP_DIR, 'extraction_unittest.extracted')
+        self.slot_dir = os.path.join(saq.TEMP_DIR, 'extraction_unittest.slots')
+        self.tracked_test_files.append(self.archive_path)
+
+    def tearDown(self, *args, **kwargs):
+        super().tearDown(*args, **kwargs)
+        for path in [ self.target_dir, self.slot_dir ]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def create_zip(self, members):
+        with zipfile.ZipFile(self.archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as zfile:
+            for name, data in members:
+                zfile.writestr(name, data)
+
+    def test_safe_member_path(self):
+        self.assertEquals(safe_member_path('/tmp/x', 'a/b.txt'), '/tmp/x/a/b.txt')
+        self.assertEquals(safe_member_path('/tmp/x', '/etc/passwd'), '/tmp/x/etc/passwd')
+        self.assertEquals(safe_member_path('/tmp/x', r'C:\windows\evil.exe'), '/tmp/x/windows/evil.exe')
+        self.assertIsNone(safe_member_path('/tmp/x', '../../etc/passwd'))
+        self.assertIsNone(safe_member_path('/tmp/x', 'a/../../b'))
+        self.assertIsNone(safe_member_path('/tmp/x', '/'))
+
+    def test_check_expansion(self):
+        limits = ExtractionLimits(max_output_bytes=10 * 1024 * 1024, max_compression_ratio=100)
+        check_expansion(1024, 1, limits) # small archives are never rejected for their ratio
+        check_expansion(5 * 1024 * 1024, 1024 * 1024, limits)
+        with self.assertRaises(ArchiveRejected):
+            check_expansion(5 * 1024 * 1024, 1024, limits)
+        with self.assertRaises(ArchiveRejected):
+            check_expansion(11 * 1024 * 1024, 11 * 1024 * 1024, limits)
+
+        # no limits
+        check_expansion(11 * 1024 * 1024, 1, ExtractionLimits())
+
+    def test_extract_zip(self):
+        self.create_zip([ ('a.txt', 'a'), ('dir/b.txt', 'b'), ('../evil.txt', 'evil'), ('xl/activeX/x.bin', 'x') ])
+        self.assertEquals(len(list_zip(self.archive_path)), 4)
+
+        paths = extract_zip(self.archive_path, self.target_dir, ExtractionLimits(), excluded=[ 'xl/activeX/*' ])
+        self.assertEquals(sorted(paths), [ os.path.join(self.target_dir, 'a.txt'),
+                                           os.path.join(self.target_dir, 'dir', 'b.txt') ])
+        self.assertFalse(os.path.exists(os.path.join(saq.TEMP_DIR, 'evil.txt')))
+
+        with open(os.path.join(self.target_dir, 'dir', 'b.txt')) as fp:
+            self.assertEquals(fp.read(), 'b')
+
+    def test_extract_zip_limits(self):
+        self.create_zip([ ('a.bin', bytes(1024 * 1024)), ('b.bin', bytes(1024 * 1024)) ])
+        with self.assertRaises(ArchiveRejected):
+            extract_zip(self.archive_path, self.target_dir, ExtractionLimits(max_output_bytes=1024 * 1024 + 1))
+
+        with self.assertRaises(ArchiveRejected):
+            extract_zip(self.archive_path, self.target_dir, ExtractionLimits(max_files=1))
+
+        self.assertEquals(len(extract_zip(self.archive_path, self.target_dir, ExtractionLimits(max_files=2))), 2)
+
+    def test_extract_tar(self):
+        with tarfile.open(self.archive_path, 'w') as tfile:
+            for name, data in [ ('a.txt', b'a'), ('../evil.txt', b'evil') ]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tfile.addfile(info, io.BytesIO(data))
+
+            info = tarfile.TarInfo('link')
+            info.type = tarfile.SYMTYPE
+            info.linkname = '/etc/passwd'
+            tfile.addfile(info)
+
+        self.assertEquals(len(list_tar(self.archive_path)), 2)
+        self.assertEquals(extract_tar(self.archive_path, self.target_dir, ExtractionLimits()),
+                          [ os.path.join(self.target_dir, 'a.txt') ])
+        self.assertFalse(os.path.lexists(os.path.join(self.target_dir, 'link')))
+
+    def test_limited_command(self):
+        # a program that writes more than it is allowed to is stopped
+        target_path = os.path.join(saq.TEMP_DIR, 'extraction_unittest.out')
+        self.tracked_test_files.append(target_path)
+        p = Popen(limited_command([ 'dd', 'if=/dev/zero', 'of={}'.format(target_path), 'bs=1024', 'count=1024' ],
+                                  ExtractionLimits(max_output_bytes=64 * 1024, timeout=10)), stdout=PIPE, stderr=PIPE)
+        p.communicate()
+        self.assertNotEquals(p.returncode, 0)
+        self.assertTrue(os.path.getsize(target_path) <= 64 * 1024 + 512)
+
+        # and so is a program that runs too long
+        p = Popen(limited_command([ 'sleep', '30' ], ExtractionLimits(timeout=1)), stdout=PIPE, stderr=PIPE)
+        p.communicate(timeout=10)
+        self.assertNotEquals(p.returncode, 0)
+
+    def test_extraction_slot(self):
+        with ExtractionSlot(self.slot_dir, 1, 0):
+            # the only slot is taken
+            with self.assertRaises(TimeoutError):
+                ExtractionSlot(self.slot_dir, 1, 0).acquire()
+
+        # and then released
+        with ExtractionSlot(self.slot_dir, 1, 0):
+            pass
+
+        # no limit
+        with ExtractionSlot(self.slot_dir, 0, 0):
+            with ExtractionSlot(self.slot_dir, 0, 0):
+                pass
@@ -0,0 +1,90 @@
+# vim: sw=4:ts=4:et
+
+import hashlib
+import io
+import os
+import os.path
+
+import saq
+from saq.analysis import RootAnalysis
+from saq.constants import *
+from saq.hashing import *
+from saq.test import *
+
+class HashingTestCase(ACEBasicTestCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.data = os.urandom(1024 * 1024 * 3 + 17)
+        self.source_path = os.path.join(saq.TEMP_DIR, 'hashing_unittest.bin')
+        self.target_path = os.path.join(saq.TEMP_DIR, 'hashing_unittest.copy')
+        self.tracked_test_files.extend([ self.source_path, self.target_path ])
+        with open(self.source_path, 'wb') as fp:
+            fp.write(self.data)
+
+    def assert_digests(self, digests):
+        self.assertEquals(digests[DIGEST_MD5], hashlib.md5(self.data).hexdigest())
+        self.assertEquals(digests[DIGEST_SHA1], hashlib.sha1(self.data).hexdigest())
+        self.assertEquals(digests[DIGEST_SHA256], hashlib.sha256(self.data).hexdigest())
+
+    def test_compute_file_digests(self):
+        self.assert_digests(compute_file_digests(self.source_path, buffer_size=65536, thread_threshold=0))
+
+    def test_compute_file_digests_threaded(self):
+        # the threads start part of the way through the file
+        digest = MultiDigest(thread_threshold=1024 * 1024)
+        with open(self.source_path, 'rb') as fp:
+            while True:
+                data = fp.read(65536)
+                if not data:
+                    break
+
+                digest.update(data)
+
+        self.assertTrue(digest.threaded)
+        digests = digest.digests()
+        self.assertFalse(digest.threaded)
+        self.assert_digests(digests)
+
+        self.assert_digests(compute_file_digests(self.source_path, buffer_size=65536, thread_threshold=1))
+
+    def test_ssdeep(self):
+        digests = compute_file_digests(self.source_path, ssdeep=False)
+        self.assertFalse(DIGEST_SSDEEP in digests)
+
+        try:
+            import ssdeep
+        except ImportError:
+            return
+
+        # the same hash whether or not threads are used
+        self.assertEquals(compute_file_digests(self.source_path, thread_threshold=0)[DIGEST_SSDEEP], ssdeep.hash(self.data))
+        self.assertEquals(compute_file_digests(self.source_path, thread_threshold=1)[DIGEST_SSDEEP], ssdeep.hash(self.data))
+
+    def test_copy_with_digests(self):
+        self.assert_digests(copy_with_digests(io.BytesIO(self.data), self.target_path, buffer_size=65536, thread_threshold=1))
+        with open(self.target_path, 'rb') as fp:
+            self.assertEquals(fp.read(), self.data)
+
+    def test_file_observable_digests(self):
+        root = create_root_analysis()
+        root.initialize_storage()
+        target_path = os.path.join(root.storage_dir, 'sample.bin')
+        with open(self.source_path, 'rb') as fp:
+            digests = copy_with_digests(fp, target_path)
+
+        _file = root.add_observable(F_FILE, 'sample.bin')
+        _file.set_digests(digests)
+
+        # the digests are used as is (the file is not read again)
+        os.remove(target_path)
+        self.assertTrue(_file.compute_hashes())
+        self.assertEquals(_file.sha256_hash, hashlib.sha256(self.data).hexdigest())
+
+        # and are carried with the observable
+        root.save()
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        _file = root.get_observable(_file.id)
+        self.assertEquals(_file.md5_hash, hashlib.md5(self.data).hexdigest())
+        self.assertEquals(_file.ssdeep_hash, digests.get(DIGEST_SSDEEP))
@@ -0,0 +1,154 @@
+# vim: sw=4:ts=4:et
+
+import datetime
+import uuid
+
+import saq
+import saq.test
+from saq.constants import *
+from saq.database import Alert, get_db_connection
+from saq.metrics import *
+from saq.test import *
+
+class MetricsTestCase(ACEBasicTestCase):
+
+    def insert_alert(self, insert_date, disposition=None, disposition_time=None):
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        root.save()
+
+        alert = Alert(storage_dir=root.storage_dir)
+        alert.load()
+        alert.sync()
+
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("""UPDATE alerts SET insert_date = %s, disposition = %s, disposition_time = %s,
+                         disposition_user_id = %s WHERE id = %s""",
+                     (insert_date, disposition, disposition_time,
+                      saq.test.UNITTEST_USER_ID if disposition else None, alert.id))
+            db.commit()
+
+        return alert
+
+    def get_counts(self, start, end, **kwargs):
+        """Returns a dict of disposition -> (alert_count, cycle_time) of the alert metrics from start to end."""
+        result = {}
+        for (bucket_start, alert_type, company_id, disposition, disposition_user_id), alert_metrics \
+        in get_alert_metrics(start, end, **kwargs).items():
+            alert_count, cycle_time = result.get(disposition, (0, 0))
+            result[disposition] = (alert_count + alert_metrics.alert_count, cycle_time + alert_metrics.cycle_time)
+
+        return result
+
+    def test_alert_metrics_percentile(self):
+        alert_metrics = AlertMetrics()
+        self.assertIsNone(alert_metrics.percentile(50))
+
+        insert_date = datetime.datetime(2019, 4, 1, 12, 0, 0)
+        for minutes in [ 5, 10, 20, 90, 90, 90, 180, 600, 3000, 60000 ]:
+            alert_metrics.add_alert(insert_date, insert_date + datetime.timedelta(minutes=minutes))
+
+        self.assertEquals(alert_metrics.alert_count, 10)
+        self.assertEquals(alert_metrics.dispositioned_count, 10)
+        self.assertTrue(1 <= alert_metrics.percentile(50) <= 2)
+        self.assertTrue(alert_metrics.percentile(10) <= alert_metrics.percentile(50) <= alert_metrics.percentile(90))
+        self.assertEquals(alert_metrics.percentile(100), CYCLE_TIME_BINS[-1])
+
+        # open alerts count but have no cycle time
+        alert_metrics.add_alert(insert_date, None)
+        self.assertEquals(alert_metrics.alert_count, 11)
+        self.assertEquals(alert_metrics.dispositioned_count, 10)
+
+        merged = AlertMetrics()
+        merged.merge(alert_metrics)
+        merged.merge(alert_metrics)
+        self.assertEquals(merged.alert_count, 22)
+        self.assertEquals(merged.cycle_time, alert_metrics.cycle_time * 2)
+        self.assertEquals(merged.percentile(50), alert_metrics.percentile(50))
+
+    def test_rollup_metrics(self):
+        day = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        rows = []
+        for hour in range(24):
+            insert_date = day + datetime.timedelta(hours=hour, minutes=30)
+            rows.append((insert_date, 'test', 1, DISPOSITION_FALSE_POSITIVE, 1, insert_date + datetime.timedelta(hours=1)))
+            rows.append((insert_date, 'test', 1, None, None, None))
+
+        hour_metrics = aggregate_alerts(rows, PERIOD_HOUR)
+        self.assertEquals(len(hour_metrics), 48)
+        day_metrics = rollup_metrics(hour_metrics, PERIOD_DAY)
+        self.assertEquals(len(day_metrics), 2)
+        self.assertEquals(day_metrics[(day, 'test', 1, DISPOSITION_FALSE_POSITIVE, 1)].alert_count, 24)
+        self.assertEquals(day_metrics[(day, 'test', 1, '', 0)].alert_count, 24)
+        self.assertEquals(day_metrics[(day, 'test', 1, '', 0)].dispositioned_count, 0)
+        self.assertEquals(aggregate_alerts(rows, PERIOD_DAY).keys(), day_metrics.keys())
+
+    def test_update_metrics_rollup(self):
+        now = datetime.datetime.now().replace(microsecond=0)
+        today = now.replace(hour=0, minute=0, second=0)
+        start = today - datetime.timedelta(days=7)
+
+        for days in range(1, 6):
+            insert_date = today - datetime.timedelta(days=days, hours=-10, minutes=-15)
+            self.insert_alert(insert_date, DISPOSITION_FALSE_POSITIVE, insert_date + datetime.timedelta(hours=2))
+            self.insert_alert(insert_date, DISPOSITION_DELIVERY, insert_date + datetime.timedelta(hours=30))
+
+        open_alert = self.insert_alert(today - datetime.timedelta(days=3, hours=-8))
+
+        # without the rollups everything is read from the alerts table
+        self.assertIsNone(get_last_update())
+        expected = self.get_counts(start, now)
+        self.assertEquals(expected[DISPOSITION_FALSE_POSITIVE], (5, 5 * 2 * 3600))
+        self.assertEquals(expected[DISPOSITION_DELIVERY], (5, 5 * 30 * 3600))
+        self.assertFalse('' in expected)
+        self.assertEquals(self.get_counts(start, now, dispositioned_only=False)[''][0], 1)
+
+        self.assertEquals(update_metrics_rollup(), 5)
+        self.assertIsNotNone(get_last_update())
+        self.assertEquals(self.get_counts(start, now), expected)
+        self.assertEquals(self.get_counts(start, now, period=PERIOD_HOUR), expected)
+        self.assertEquals(self.get_counts(start, now, excluded_dispositions=[ DISPOSITION_DELIVERY ]),
+                          { DISPOSITION_FALSE_POSITIVE: expected[DISPOSITION_FALSE_POSITIVE] })
+
+        # ranges that start and end in the middle of hours and days
+        self.assertEquals(self.get_counts(today - datetime.timedelta(days=2, hours=-10, minutes=-30), now),
+                          { DISPOSITION_FALSE_POSITIVE: (1, 2 * 3600), DISPOSITION_DELIVERY: (1, 30 * 3600) })
+
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("SELECT COUNT(*) FROM metrics_alert_rollup WHERE period = %s", (PERIOD_DAY,))
+            # two dispositions on five days plus the open alert
+            self.assertEquals(c.fetchone()[0], 11)
+
+        # nothing changed since the last update
+        self.assertEquals(update_metrics_rollup(), 0)
+
+        # dispositioning an old alert updates the day it was inserted on
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("""UPDATE alerts SET disposition = %s, disposition_time = %s, disposition_user_id = %s
+                         WHERE id = %s""", (DISPOSITION_FALSE_POSITIVE, now, saq.test.UNITTEST_USER_ID, open_alert.id))
+            c.execute("UPDATE metrics_rollup_status SET last_update = %s", (now - datetime.timedelta(hours=1),))
+            db.commit()
+
+        self.assertEquals(update_metrics_rollup(), 1)
+        self.assertEquals(self.get_counts(start, now)[DISPOSITION_FALSE_POSITIVE][0], 6)
+        self.assertEquals(update_metrics_rollup(rebuild=True), 5)
+        self.assertEquals(self.get_counts(start, now)[DISPOSITION_FALSE_POSITIVE][0], 6)
+
+        # a rebuild that does not finish leaves the metrics to be read from the alerts table
+        import saq.metrics
+        _aggregate_alerts = saq.metrics.aggregate_alerts
+        def _fail(*args, **kwargs):
+            raise RuntimeError("rebuild failed")
+
+        saq.metrics.aggregate_alerts = _fail
+        try:
+            with self.assertRaises(RuntimeError):
+                update_metrics_rollup(rebuild=True)
+        finally:
+            saq.metrics.aggregate_alerts = _aggregate_alerts
+
+        self.assertIsNone(get_last_update())
+        self.assertEquals(self.get_counts(start, now)[DISPOSITION_FALSE_POSITIVE][0], 6)
@@ -0,0 +1,118 @@
+# vim: sw=4:ts=4:et
+
+import os
+import os.path
+import random
+import shutil
+
+import saq
+from saq.intervals import IntervalIndex
+from saq.refdata import ReferenceData, ipv4_range, ipv4_to_int
+from saq.test import *
+
+class ReferenceDataTestCase(ACEBasicTestCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.source_path = os.path.join(saq.TEMP_DIR, 'refdata_unittest.txt')
+        self.tracked_test_files.append(self.source_path)
+        self.write_source([])
+        self.reference_data = ReferenceData('unittest', [ self.source_path ], self.compile_source)
+        if os.path.exists(self.reference_data.data_dir):
+            shutil.rmtree(self.reference_data.data_dir)
+
+    def compile_source(self):
+        with open(self.source_path, 'r') as fp:
+            for line in fp:
+                cidr, name = line.split()
+                yield ipv4_range(cidr) + (name,)
+
+    def write_source(self, lines):
+        with open(self.source_path, 'w') as fp:
+            fp.write('\n'.join(lines))
+
+        # make sure the change is detected even if it happens within the same timestamp
+        s = os.stat(self.source_path)
+        os.utime(self.source_path, ns=(s.st_atime_ns, s.st_mtime_ns + 1000000000))
+
+    def test_ipv4_conversion(self):
+        self.assertEquals(ipv4_to_int('10.0.0.1'), 167772161)
+        self.assertEquals(ipv4_range('10.0.0.0/8'), (167772160, 184549375))
+        self.assertEquals(ipv4_range('10.0.0.1'), (167772161, 167772161))
+        with self.assertRaises(ValueError):
+            ipv4_to_int('10.0.0.256')
+
+    def test_lookup(self):
+        self.write_source([
+            '10.0.0.0/8 ten',
+            '10.1.0.0/16 ten_one',
+            '10.1.2.0/24 ten_one_two',
+            '10.1.2.3/32 host',
+            '192.168.0.0/16 private',
+            '10.1.0.0/16 ten_one_again', ])
+
+        self.assertTrue(self.reference_data.load())
+        self.assertEquals(len(self.reference_data), 6)
+        self.assertTrue(os.path.exists(self.reference_data.compiled_path))
+
+        # most specific first, later duplicates before earlier ones
+        self.assertEquals(self.reference_data.lookup('10.1.2.3'), [ 'host', 'ten_one_two', 'ten_one_again', 'ten_one', 'ten' ])
+        self.assertEquals(self.reference_data.lookup('10.1.2.4'), [ 'ten_one_two', 'ten_one_again', 'ten_one', 'ten' ])
+        self.assertEquals(self.reference_data.lookup('10.2.0.1'), [ 'ten' ])
+        self.assertEquals(self.reference_data.lookup('192.168.1.1'), [ 'private' ])
+        self.assertEquals(self.reference_data.lookup('8.8.8.8'), [])
+        self.assertEquals(self.reference_data.lookup('255.255.255.255'), [])
+        self.assertEquals(self.reference_data.lookup('0.0.0.0'), [])
+
+    def test_empty(self):
+        self.write_source([])
+        self.assertTrue(self.reference_data.load())
+        self.assertEquals(len(self.reference_data), 0)
+        self.assertEquals(self.reference_data.lookup('10.0.0.1'), [])
+
+    def test_shared_and_reloaded(self):
+        self.write_source([ '10.0.0.0/8 ten' ])
+        self.assertTrue(self.reference_data.load())
+        # nothing changed so nothing is reloaded
+        self.assertFalse(self.reference_data.load())
+
+        # another reader uses the already compiled data without calling the compiler
+        other = ReferenceData('unittest', [ self.source_path ], None)
+        self.assertTrue(other.load())
+        self.assertEquals(other.lookup('10.0.0.1'), [ 'ten' ])
+
+        # a change to the source is compiled and mapped on the next load
+        self.write_source([ '10.0.0.0/8 eleven' ])
+        self.assertTrue(self.reference_data.load())
+        self.assertEquals(self.reference_data.lookup('10.0.0.1'), [ 'eleven' ])
+
+        # and the other reader picks up the new file without compiling it again
+        self.assertEquals(other.lookup('10.0.0.1'), [ 'ten' ])
+        self.assertTrue(other.load())
+        self.assertEquals(other.lookup('10.0.0.1'), [ 'eleven' ])
+
+class IntervalIndexTestCase(ACEBasicTestCase):
+
+    def test_nested(self):
+        index, order = IntervalIndex.build([ (0, 100), (10, 20), (10, 20), (12, 15), (30, 40), (50, 50) ])
+        self.assertEquals(len(index), 6)
+        self.assertEquals([ order[i] for i in index.find(13) ], [ 3, 2, 1, 0 ])
+        self.assertEquals([ order[i] for i in index.find(21) ], [ 0 ])
+        self.assertEquals([ order[i] for i in index.find(50) ], [ 5, 0 ])
+        self.assertEquals(index.find(101), [])
+
+    def test_overlapping(self):
+        # compare against a linear scan for intervals that are not nested
+        intervals = []
+        for i in range(200):
+            start = random.randint(0, 1000)
+            intervals.append((start, start + random.randint(0, 200)))
+
+        index, order = IntervalIndex.build(intervals)
+        for value in range(0, 1300, 7):
+            expected = [ i for i, (start, end) in enumerate(intervals) if start <= value <= end ]
+            self.assertEquals(sorted([ order[i] for i in index.find(value) ]), expected)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            IntervalIndex.build([ (10, 5) ])
@@ -0,0 +1,118 @@
+# vim: sw=4:ts=4:et
+
+import datetime
+import os
+import os.path
+import shutil
+import uuid
+
+import saq
+from saq.constants import *
+from saq.database import get_db_connection, add_delayed_analysis_request
+from saq.engine import load_module
+from saq.sandbox_poller import SandboxPoller, register_sandbox_jobs
+from saq.test import *
+
+class SandboxPollerTestCase(ACEBasicTestCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        saq.CONFIG['sandbox_poller']['enabled'] = 'yes'
+        saq.CONFIG['sandbox_poller']['fallback_frequency'] = '3600'
+        self.job_dir = os.path.join(saq.DATA_DIR, saq.CONFIG['analysis_module_test_sandbox']['job_dir'])
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+        os.makedirs(self.job_dir)
+
+    def tearDown(self, *args, **kwargs):
+        super().tearDown(*args, **kwargs)
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+    def finish_job(self, job_id):
+        with open(os.path.join(self.job_dir, job_id), 'w'):
+            pass
+
+    def query(self, sql, params=None):
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute(sql, params)
+            result = c.fetchall()
+            db.commit()
+            return result
+
+    def test_wake_delayed_analysis(self):
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'job_a,job_b')
+        root.save()
+
+        analysis_module = load_module('analysis_module_test_sandbox')
+        self.assertTrue(register_sandbox_jobs(root, observable, analysis_module, [ 'job_a', 'job_b' ]))
+        # registering the same jobs again is harmless
+        self.assertTrue(register_sandbox_jobs(root, observable, analysis_module, [ 'job_a' ]))
+        add_delayed_analysis_request(root, observable, analysis_module,
+                                     datetime.datetime.now() + datetime.timedelta(hours=1))
+
+        poller = SandboxPoller()
+        self.assertEquals(poller.execute(), 0)
+
+        # nothing happens until every job is finished
+        self.finish_job('job_a')
+        self.assertEquals(poller.execute(), 0)
+        self.assertEquals(self.query("SELECT job_id, finished FROM sandbox_jobs ORDER BY job_id"),
+                          (('job_a', 1), ('job_b', 0)))
+
+        self.finish_job('job_b')
+        self.assertEquals(poller.execute(), 1)
+        self.assertEquals(self.query("SELECT COUNT(*) FROM sandbox_jobs")[0][0], 0)
+        self.assertEquals(self.query("""SELECT COUNT(*) FROM delayed_analysis
+                                        WHERE uuid = %s AND delayed_until <= NOW()""", (root.uuid,))[0][0], 1)
+
+    def test_orphaned_jobs(self):
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'job_a')
+        root.save()
+
+        # the jobs are kept until the delayed analysis waiting on them shows up
+        analysis_module = load_module('analysis_module_test_sandbox')
+        register_sandbox_jobs(root, observable, analysis_module, [ 'job_a' ])
+        self.finish_job('job_a')
+        poller = SandboxPoller()
+        self.assertEquals(poller.execute(), 0)
+        self.assertEquals(self.query("SELECT COUNT(*) FROM sandbox_jobs")[0][0], 1)
+
+        # or until they are too old
+        poller.orphan_timeout = 0
+        self.query("UPDATE sandbox_jobs SET insert_date = NOW() - INTERVAL 1 MINUTE")
+        poller.execute()
+        self.assertEquals(self.query("SELECT COUNT(*) FROM sandbox_jobs")[0][0], 0)
+
+    def test_engine(self):
+        root = create_root_analysis(uuid=str(uuid.uuid4()), analysis_mode='test_groups')
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'job_a,job_b')
+        root.save()
+        root.schedule()
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_test_sandbox', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+
+        # the module hands both jobs to the poller
+        self.assertTrue(wait_for(lambda: len(self.query("SELECT id FROM sandbox_jobs")) == 2))
+
+        poller = SandboxPoller()
+        self.finish_job('job_a')
+        self.finish_job('job_b')
+        # the analysis was delayed for an hour and is woken up as soon as the jobs are finished
+        self.assertTrue(wait_for(lambda: poller.execute() == 1, interval=0.1))
+        engine.wait()
+
+        from saq.modules.test import SandboxTestAnalysis
+
+        root.load()
+        analysis = root.get_observable(observable.id).get_analysis(SandboxTestAnalysis)
+        self.assertIsNotNone(analysis)
+        self.assertEquals(analysis.request_count, 2)
+        self.assertIsNotNone(analysis.complete_time)
@@ -0,0 +1,298 @@
+# vim: sw=4:ts=4:et
+
+import datetime
+import http.server
+import json
+import os.path
+import re
+import shutil
+import socketserver
+import threading
+import time
+import urllib.parse
+import uuid
+
+import saq
+from saq.constants import *
+from saq.splunk import *
+from saq.test import *
+
+LOCAL_PORT = 43126
+
+# the events the stub searches
+EVENTS = [
+    { 'domain': 'a.com', 'src_ip': '10.0.0.1', 'rcptto': 'alice@local' },
+    { 'domain': 'a.com', 'src_ip': '10.0.0.2', 'rcptto': [ 'bob@local', 'carol@local' ] },
+    { 'domain': 'b.com', 'src_ip': '10.0.0.3', 'rcptto': 'Carol@Local' },
+]
+
+# the parameters of each search the stub received
+splunk_requests = []
+web_server = None
+
+class _SplunkStubHandler(http.server.BaseHTTPRequestHandler):
+    """Answers oneshot searches like the splunk REST api does. The results are the EVENTS
+       that match any of the field="value" conditions in the search (the first N for each value
+       when the search has a dedup N of the searched values.)"""
+    def do_POST(self):
+        params = urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        params = { key: value[0] for key, value in params.items() }
+        splunk_requests.append(params)
+
+        conditions = re.findall(r'(\w+)="([^"]+)"', params['search'])
+        limit = re.search(r'dedup (\d+) {}'.format(SEARCHED_VALUE_FIELD), params['search'])
+
+        results = []
+        if limit:
+            for field, value in conditions:
+                search = SplunkSearch('', field, wildcard=value.startswith('*'))
+                matched = [ event for event in EVENTS if search.matches(event, value.strip('*')) ]
+                for event in matched[:int(limit.group(1))]:
+                    results.append(dict(event, **{ SEARCHED_VALUE_FIELD: value.strip('*') }))
+        else:
+            for event in EVENTS:
+                for field, value in conditions:
+                    search = SplunkSearch('', field, wildcard=value.startswith('*'))
+                    if search.matches(event, value.strip('*')):
+                        results.append(event)
+                        break
+
+        content = json.dumps({ 'results': results }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args, **kwargs):
+        pass
+
+def start_splunk_stub():
+    global web_server
+
+    class _customTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+        allow_reuse_address = True
+
+    web_server = _customTCPServer(('127.0.0.1', LOCAL_PORT), _SplunkStubHandler)
+    web_server_thread = threading.Thread(target=web_server.serve_forever)
+    web_server_thread.daemon = True
+    web_server_thread.start()
+
+def stop_splunk_stub():
+    web_server.shutdown()
+    web_server.server_close()
+
+class SplunkTestCase(ACEBasicTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        start_splunk_stub()
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_splunk_stub()
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        del splunk_requests[:]
+        saq.CONFIG['splunk']['uri'] = 'http://127.0.0.1:{}'.format(LOCAL_PORT)
+        self.cache_dir = os.path.join(saq.TEMP_DIR, 'splunk_unittest')
+        self.earliest = datetime.datetime(2019, 4, 1, 12, 0, 10)
+        self.latest = datetime.datetime(2019, 4, 1, 12, 14, 50)
+
+    def tearDown(self, *args, **kwargs):
+        super().tearDown(*args, **kwargs)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def execute(self, query, earliest, latest, value_count):
+        return execute_splunk_search(query, earliest, latest, max_result_count=100 * value_count)
+
+    def test_format(self):
+        search = SplunkSearch('index=dns_logs {terms} | search {conditions} | fields *', 'domain')
+        self.assertEquals(search.format([ 'a.com' ]), 'index=dns_logs "a.com" | search domain="a.com" | fields *')
+        self.assertEquals(search.format([ 'b.com', 'a.com' ]),
+                          'index=dns_logs ("a.com" OR "b.com") | search (domain="a.com" OR domain="b.com") | fields *')
+
+        search = SplunkSearch('{terms} | search {conditions}', 'rcptto', wildcard=True)
+        self.assertEquals(search.format([ 'a"b' ]), r'"a\"b" | search rcptto="*a\"b*"')
+
+        # the limit applies to each of the values
+        search = SplunkSearch('{terms} | search {conditions} {limit} | sort _time', 'rcptto', limit=5)
+        self.assertEquals(search.format([ 'bob', 'alice' ]),
+                          '("alice" OR "bob") | search (rcptto="alice" OR rcptto="bob") '
+                          '| eval ace_searched_value=mvappend('
+                          'if(isnotnull(mvfind(rcptto, "(?i)^alice$")), "alice", null()), '
+                          'if(isnotnull(mvfind(rcptto, "(?i)^bob$")), "bob", null())) '
+                          '| mvexpand ace_searched_value | dedup 5 ace_searched_value | sort _time')
+
+    def test_split(self):
+        search = SplunkSearch('', 'rcptto', wildcard=True)
+        results = search.split(EVENTS, [ 'carol@local', 'alice', 'dave@local' ])
+        self.assertEquals(results['carol@local'], EVENTS[1:])
+        self.assertEquals(results['alice'], EVENTS[:1])
+        self.assertEquals(results['dave@local'], [])
+
+    def test_limit(self):
+        search = SplunkSearch('index=smtp {terms} | search {conditions} {limit}', 'rcptto', wildcard=True, limit=1)
+        coalescer = SplunkSearchCoalescer(cache_dir=self.cache_dir, coalesce_window=1, cache_ttl=60, timeout=10)
+
+        results = {}
+        def _search(value):
+            results[value] = coalescer.search(search, value, self.earliest, self.latest, self.execute)
+
+        threads = [ threading.Thread(target=_search, args=(value,)) for value in [ 'carol@local', 'alice@local' ] ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # carol has two events but the search for alice still gets hers
+        self.assertEquals(len(splunk_requests), 1)
+        self.assertEquals(len(results['carol@local']), 1)
+        self.assertTrue(search.matches(results['carol@local'][0], 'carol@local'))
+        self.assertEquals(len(results['alice@local']), 1)
+        self.assertTrue(search.matches(results['alice@local'][0], 'alice@local'))
+
+    def test_time_window(self):
+        coalescer = SplunkSearchCoalescer(cache_dir=self.cache_dir, time_bucket=300)
+        self.assertEquals(coalescer.get_time_window(self.earliest, self.latest),
+                          ( datetime.datetime(2019, 4, 1, 12, 0, 0), datetime.datetime(2019, 4, 1, 12, 15, 0) ))
+
+        coalescer = SplunkSearchCoalescer(cache_dir=self.cache_dir, time_bucket=0)
+        self.assertEquals(coalescer.get_time_window(self.earliest, self.latest), ( self.earliest, self.latest ))
+
+    def test_coalesce(self):
+        search = SplunkSearch('index=dns_logs {terms} | search {conditions}', 'domain')
+        coalescer = SplunkSearchCoalescer(cache_dir=self.cache_dir, coalesce_window=1, cache_ttl=60, timeout=10)
+
+        results = {}
+        def _search(value):
+            results[value] = coalescer.search(search, value, self.earliest, self.latest, self.execute)
+
+        threads = [ threading.Thread(target=_search, args=(value,)) for value in [ 'a.com', 'b.com', 'c.com', 'a.com' ] ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # one search for all of the values
+        self.assertEquals(len(splunk_requests), 1)
+        self.assertEquals(splunk_requests[0]['count'], '300')
+        self.assertEquals(results['a.com'], EVENTS[:2])
+        self.assertEquals(results['b.com'], EVENTS[2:])
+        self.assertEquals(results['c.com'], [])
+
+    def test_cache(self):
+        search = SplunkSearch('index=dns_logs {terms} | search {conditions}', 'domain')
+        coalescer = SplunkSearchCoalescer(cache_dir=self.cache_dir, coalesce_window=0, cache_ttl=60, timeout=10)
+        self.assertEquals(coalescer.search(search, 'a.com', self.earliest, self.latest, self.execute), EVENTS[:2])
+        # the same search a little later (in the same time bucket) uses the results from the first one
+        self.assertEquals(coalescer.search(search, 'A.com', self.earliest + datetime.timedelta(seconds=30),
+                                           self.latest + datetime.timedelta(seconds=5), self.execute), EVENTS[:2])
+        self.assertEquals(len(splunk_requests), 1)
+
+        # a different search does not
+        search = SplunkSearch('index=dns_logs {terms} | search {conditions} | fields *', 'domain')
+        coalescer.search(search, 'a.com', self.earliest, self.latest, self.execute)
+        self.assertEquals(len(splunk_requests), 2)
+
+        # and results expire
+        coalescer.cache_ttl = 0
+        coalescer.search(search, 'a.com', self.earliest, self.latest, self.execute)
+        self.assertEquals(len(splunk_requests), 3)
+
+    def test_failed_search(self):
+        def _execute(*args, **kwargs):
+            raise RuntimeError("splunk is down")
+
+        search = SplunkSearch('index=dns_logs {terms} | search {conditions}', 'domain')
+        coalescer = SplunkSearchCoalescer(cache_dir=self.cache_dir, coalesce_window=0, cache_ttl=60, timeout=10)
+        self.assertIsNone(coalescer.search(search, 'a.com', self.earliest, self.latest, _execute))
+
+        # failures are not cached
+        self.assertEquals(coalescer.search(search, 'a.com', self.earliest, self.latest, self.execute), EVENTS[:2])
+
+        # and searches waiting on another batch do not use a failure from an earlier batch
+        self.assertIsNone(coalescer.search(search, 'b.com', self.earliest, self.latest, _execute))
+        coalescer.coalesce_window = 1
+        results = {}
+        def _search(value):
+            results[value] = coalescer.search(search, value, self.earliest, self.latest, self.execute)
+
+        leader = threading.Thread(target=_search, args=('c.com',))
+        leader.start()
+        time.sleep(0.2)
+        _search('b.com')
+        leader.join()
+        self.assertEquals(results['b.com'], EVENTS[2:])
+
+class SplunkModuleTestCase(ACEModuleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        start_splunk_stub()
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_splunk_stub()
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        del splunk_requests[:]
+        saq.CONFIG['splunk']['uri'] = 'http://127.0.0.1:{}'.format(LOCAL_PORT)
+        shutil.rmtree(os.path.join(saq.DATA_DIR, saq.CONFIG['splunk']['cache_dir']), ignore_errors=True)
+
+    def test_email_history_analyzer_v1(self):
+        from saq.modules.email import EmailHistoryAnalysis_v1
+
+        roots = []
+        for i in range(2):
+            root = create_root_analysis(uuid=str(uuid.uuid4()))
+            root.initialize_storage()
+            observable = root.add_observable(F_EMAIL_ADDRESS, 'carol@local')
+            root.save()
+            root.schedule()
+            roots.append((root, observable))
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_email_history_analyzer_v1', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        # both alerts got their results from the same search
+        self.assertEquals(len(splunk_requests), 1)
+        for root, observable in roots:
+            root.load()
+            analysis = root.get_observable(observable.id).get_analysis(EmailHistoryAnalysis_v1)
+            self.assertIsNotNone(analysis)
+            self.assertEquals(len(analysis.emails), 2)
+
+    def test_email_history_analyzer_v1_limit(self):
+        from saq.modules.email import EmailHistoryAnalysis_v1
+
+        # one result for each of the addresses searched for together
+        saq.CONFIG['splunk']['max_result_count'] = '1'
+
+        roots = []
+        for address in [ 'carol@local', 'alice@local' ]:
+            root = create_root_analysis(uuid=str(uuid.uuid4()))
+            root.initialize_storage()
+            observable = root.add_observable(F_EMAIL_ADDRESS, address)
+            root.save()
+            root.schedule()
+            roots.append((root, observable))
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_email_history_analyzer_v1', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        # carol has two emails but alice still gets hers
+        self.assertEquals(len(splunk_requests), 1)
+        for root, observable in roots:
+            root.load()
+            analysis = root.get_observable(observable.id).get_analysis(EmailHistoryAnalysis_v1)
+            self.assertIsNotNone(analysis)
+            self.assertEquals(len(analysis.emails), 1)
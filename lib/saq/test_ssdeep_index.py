@@ -0,0 +1,103 @@
+# vim: sw=4:ts=4:et
+
+import os
+import os.path
+
+import saq
+from saq.ssdeep_index import SsdeepHashFile, SsdeepIndex, compare, parse_hash, parse_line
+from saq.test import *
+
+HASH_A = '192:g0X4yK2OFF3b2fIb/PutCDhVw+1loneB4QpJ+Eu85XkASku+:bZAZbnb/PutCDhX1qEpJ75Xk8u+'
+# HASH_A with 100 bytes changed in the middle
+HASH_B = '192:g0X4yK2OFF3b2fIb/PutCDhVw+KloneB4QpJ+Eu85XkASku+:bZAZbnb/PutCDhXKqEpJ75Xk8u+'
+# unrelated data of the same size
+HASH_C = '192:PAOwiDTKhLnAaUiB7bOwx73CvL7ki3dBdu1E+:IOwiShEDrwugi3xgf'
+# HASH_A followed by the same amount of unrelated data (twice the block size)
+HASH_D = '384:bZAZbnb/PutCDhX1qEpJ75Xk8uKiKajs52fkyOvW1KB0/M9fPZ9I/G63+2:bKzTutCDhX1z75U8ojW2fkyuB0KHZ9IX'
+
+class SsdeepIndexTestCase(ACEBasicTestCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.hash_path = os.path.join(saq.TEMP_DIR, 'ssdeep_unittest.txt')
+        self.tracked_test_files.append(self.hash_path)
+
+    def write_hashes(self, lines, mode='w'):
+        with open(self.hash_path, mode) as fp:
+            for line in lines:
+                fp.write('{}\n'.format(line))
+
+    def test_parse(self):
+        self.assertEquals(parse_hash('3:aaaaaab:cc'), (3, 'aaab', 'cc'))
+        with self.assertRaises(ValueError):
+            parse_hash('not a hash')
+
+        self.assertIsNone(parse_line('ssdeep,1.1--blocksize:hash:hash,filename'))
+        self.assertIsNone(parse_line(''))
+        self.assertEquals(parse_line('{},"/malware/a,b.exe"'.format(HASH_A)), (HASH_A, '/malware/a,b.exe'))
+
+    def test_compare(self):
+        self.assertEquals(compare(HASH_A, HASH_A), 100)
+        self.assertEquals(compare(HASH_A, HASH_B), 99)
+        self.assertEquals(compare(HASH_A, HASH_C), 0)
+        # different block sizes are compared using the double signature of the smaller one
+        self.assertEquals(compare(HASH_A, HASH_D), 65)
+        self.assertEquals(compare(HASH_D, HASH_A), 65)
+
+    def test_search(self):
+        index = SsdeepIndex()
+        self.assertTrue(index.add(HASH_A, 'a'))
+        self.assertTrue(index.add(HASH_C, 'c'))
+        self.assertTrue(index.add(HASH_D, 'd'))
+        self.assertFalse(index.add(HASH_A, 'a'))
+        self.assertEquals(len(index), 3)
+
+        with self.assertRaises(ValueError):
+            index.add('invalid', 'invalid')
+
+        # unrelated hashes are never scored
+        self.assertEquals(index.candidates(HASH_B), { 0, 2 })
+        self.assertEquals(index.search(HASH_B), [ ('a', 99), ('d', 63) ])
+        self.assertEquals(index.search(HASH_B, 90), [ ('a', 99) ])
+        self.assertEquals(index.search(HASH_C), [ ('c', 100) ])
+
+        # hashes can be added at any time
+        index.add(HASH_B, 'b')
+        self.assertEquals(index.search(HASH_B, 90), [ ('b', 100), ('a', 99) ])
+
+    def test_hash_file(self):
+        self.write_hashes([ 'ssdeep,1.1--blocksize:hash:hash,filename',
+                            '{},"a"'.format(HASH_A),
+                            '{},"c"'.format(HASH_C) ])
+
+        hash_file = SsdeepHashFile(self.hash_path)
+        self.assertEquals(hash_file.load(), 2)
+        index = hash_file.index
+        self.assertEquals(index.search(HASH_B, 90), [ ('a', 99) ])
+
+        # appended lines are added to the same index
+        self.write_hashes([ '{},"b"'.format(HASH_B) ], mode='a')
+        self.assertEquals(hash_file.load(), 1)
+        self.assertIs(hash_file.index, index)
+        self.assertEquals(len(index), 3)
+
+        # a line that is still being written is skipped until it is complete
+        with open(self.hash_path, 'a') as fp:
+            fp.write('{},"d'.format(HASH_D))
+
+        self.assertEquals(hash_file.load(), 0)
+        with open(self.hash_path, 'a') as fp:
+            fp.write('"\n')
+
+        self.assertEquals(hash_file.load(), 1)
+        self.assertIs(hash_file.index, index)
+
+        # a rewritten file is loaded into a new index
+        self.write_hashes([ '{},"c"'.format(HASH_C),
+                            '{},"d"'.format(HASH_D),
+                            '{},"e"'.format(HASH_B),
+                            '{},"f"'.format(HASH_A) ])
+
+        self.assertEquals(hash_file.load(), 4)
+        self.assertIsNot(hash_file.index, index)
+        self.assertEquals(hash_file.index.search(HASH_B, 90), [ ('e', 100), ('f', 99) ])
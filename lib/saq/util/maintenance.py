@@ -1,17 +1,180 @@
 # vim: sw=4:ts=4:et
+import concurrent.futures
 import datetime
+import json
+import os
 import os.path
 import logging
 import shutil
+import threading
+import time
 
 import saq
 
+class RateLimiter(object):
+    """Limits how many times per second acquire() returns across all the threads that share it."""
+
+    def __init__(self, rate):
+        # the most calls per second (0 for no limit)
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def acquire(self):
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(self.next_time, now) + 1.0 / self.rate
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+def remove_directory(target_path, rate_limiter=None):
+    """Removes the given directory and everything in it, one file at a time at the rate allowed by rate_limiter."""
+    for dir_path, dir_names, file_names in os.walk(target_path, topdown=False):
+        for file_name in file_names:
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+
+            os.remove(os.path.join(dir_path, file_name))
+
+        # symlinks to directories show up as directories but are removed like files
+        for dir_name in dir_names:
+            if os.path.islink(os.path.join(dir_path, dir_name)):
+                os.remove(os.path.join(dir_path, dir_name))
+
+        os.rmdir(dir_path)
+
+def archive_storage_dir(storage_dir, rate_limiter=None):
+    """Does what RootAnalysis.archive does to the alert in the given storage directory but only works with the json,
+       without loading the alert. Deletes the details of all analysis (except the root) and every file that did not come
+       with the alert. Keeps the observables and tags."""
+    from saq.analysis import Analysis, Observable, RootAnalysis
+    from saq.constants import F_FILE
+
+    json_path = os.path.join(storage_dir, 'data.json')
+    with open(json_path, 'r') as fp:
+        root_json = json.load(fp)
+
+    # the F_FILE observables that came with the alert are kept
+    retained_files = set()
+    for observable_id in root_json.get(Analysis.KEY_OBSERVABLES, []):
+        observable = root_json[RootAnalysis.KEY_OBSERVABLE_STORE].get(observable_id)
+        if observable and observable.get(Observable.KEY_TYPE) == F_FILE:
+            retained_files.add(os.path.normpath(os.path.join(storage_dir, observable[Observable.KEY_VALUE])))
+
+    removed_paths = []
+    def _remove(path):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        try:
+            os.remove(path)
+            removed_paths.append(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(f"unable to remove {path}: {e}")
+
+    for observable in root_json.get(RootAnalysis.KEY_OBSERVABLE_STORE, {}).values():
+        # clear external details storage for all analysis
+        for analysis in (observable.get(Observable.KEY_ANALYSIS) or {}).values():
+            if not isinstance(analysis, dict):
+                continue
+
+            details = analysis.get(Analysis.KEY_DETAILS)
+            if isinstance(details, dict) and details.get(Analysis.KEY_FILE_PATH):
+                _remove(os.path.join(storage_dir, '.ace', details[Analysis.KEY_FILE_PATH]))
+                details[Analysis.KEY_FILE_PATH] = None
+
+        if observable.get(Observable.KEY_TYPE) == F_FILE:
+            target_path = os.path.normpath(os.path.join(storage_dir, observable[Observable.KEY_VALUE]))
+            if target_path not in retained_files:
+                _remove(target_path)
+
+    # anything else in the subdirectories (other than .ace) that did not come with the alert
+    for dir_path, dir_names, file_names in os.walk(storage_dir):
+        if dir_path == storage_dir:
+            dir_names[:] = [ _ for _ in dir_names if _ != '.ace' ]
+            continue
+
+        for file_name in file_names:
+            file_path = os.path.normpath(os.path.join(dir_path, file_name))
+            if file_path not in retained_files:
+                _remove(file_path)
+
+    # remove any empty directories left behind
+    for dir_path, dir_names, file_names in os.walk(storage_dir, topdown=False):
+        if dir_path != storage_dir and dir_path != os.path.join(storage_dir, '.ace'):
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                pass
+
+    temp_path = '{}.tmp'.format(json_path)
+    with open(temp_path, 'w') as fp:
+        json.dump(root_json, fp)
+
+    shutil.move(temp_path, json_path)
+    return removed_paths
+
+class CleanupCheckpoint(object):
+    """Keeps track of the last alert id each step of the cleanup finished so an interrupted cleanup can resume."""
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        try:
+            with open(self.path, 'r') as fp:
+                self.state = json.load(fp)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"unable to load cleanup checkpoint {self.path}: {e}")
+
+    def get(self, step):
+        return self.state.get(step, 0)
+
+    def set(self, step, alert_id):
+        if alert_id is None:
+            self.state.pop(step, None)
+        else:
+            self.state[step] = alert_id
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = '{}.tmp'.format(self.path)
+        with open(temp_path, 'w') as fp:
+            json.dump(self.state, fp)
+
+        os.rename(temp_path, self.path)
+
+def _iterate_pages(query, id_column, start_id, page_size):
+    """Yields the rows of the given select query in pages of page_size ordered by id_column, starting after start_id."""
+    last_id = start_id
+    while True:
+        rows = saq.db.execute(query.where(id_column > last_id).order_by(id_column).limit(page_size)).fetchall()
+        if not rows:
+            break
+
+        yield rows
+        last_id = rows[-1][0]
+        if len(rows) < page_size:
+            break
+
 def cleanup_alerts(fp_days_old=None, ignore_days_old=None, dry_run=False):
-    """Cleans up the alerts stored in the ACE system. 
+    """Cleans up the alerts stored in the ACE system.
        Alerts dispositioned as FALSE_POSITIVE are archived (see :method:`saq.database.Alert.archive`)
        Alerts dispositioned as IGNORE as deleted.
        This is intended to be called from an external maintenance script.
 
+       The alerts are processed in pages of [cleanup] page_size ordered by id. The directories of the deleted alerts
+       are removed by a pool of [cleanup] threads at no more than [cleanup] max_files_per_second and the alerts are
+       deleted from the database [cleanup] delete_batch_size at a time. The id of the last alert processed is saved
+       in [cleanup] checkpoint_path after each page so an interrupted cleanup picks up where it left off.
+
        :param int fp_days_old: By default the age of the alerts to be considered for cleanup
        is stored in the configuration file. Setting this overrides these settings.
        :param int ignore_days_old: By default the age of the alerts to be considered for cleanup
@@ -20,13 +183,12 @@ def cleanup_alerts(fp_days_old=None, ignore_days_old=None, dry_run=False):
        be archived and deleted. Defaults to False.
     """
 
-    import gc
-    import weakref
-
+    from saq.alert_search import remove_alert, reindex_alert
+    from saq.cold_storage import is_packed, pack_storage_dir, unpack_storage_dir
     from saq.constants import DISPOSITION_FALSE_POSITIVE, DISPOSITION_IGNORE
-    from saq.database import Alert, DatabaseSession, retry_sql_on_deadlock
+    from saq.database import Alert, retry_sql_on_deadlock
 
-    from sqlalchemy.sql.expression import select, delete
+    from sqlalchemy.sql.expression import select, delete, update, func
 
     ignore_days = saq.CONFIG['global'].getint('ignore_days')
     fp_days = saq.CONFIG['global'].getint('fp_days')
@@ -37,54 +199,144 @@ def cleanup_alerts(fp_days_old=None, ignore_days_old=None, dry_run=False):
     if ignore_days_old:
         ignore_days = ignore_days_old
 
-    # delete alerts dispositioned as IGNORE and older than N days
-    dry_run_count = 0
-    for storage_dir, alert_id in saq.db.execute(select([Alert.storage_dir, Alert.id])
+    config = saq.CONFIG['cleanup']
+    page_size = config.getint('page_size')
+    delete_batch_size = config.getint('delete_batch_size')
+    rate_limiter = RateLimiter(config.getint('max_files_per_second'))
+
+    ignore_query = (select([Alert.id, Alert.uuid, Alert.storage_dir])
         .where(Alert.location == saq.CONFIG['global']['node'])
         .where(Alert.disposition == DISPOSITION_IGNORE)
-        .where(Alert.disposition_time < datetime.datetime.now() - datetime.timedelta(days=ignore_days))):
+        .where(Alert.disposition_time < datetime.datetime.now() - datetime.timedelta(days=ignore_days)))
 
-        if dry_run:
-            dry_run_count += 1
-            continue
+    fp_query = (select([Alert.id, Alert.uuid, Alert.storage_dir])
+        .where(Alert.location == saq.CONFIG['global']['node'])
+        .where(Alert.archived == False)
+        .where(Alert.disposition == DISPOSITION_FALSE_POSITIVE)
+        .where(Alert.disposition_time < datetime.datetime.now() - datetime.timedelta(days=fp_days)))
+
+    if dry_run:
+        for step, query in [ ('ignored alerts would be deleted', ignore_query), ('fp alerts would be archived', fp_query) ]:
+            count = saq.db.execute(select([func.count()]).select_from(query.alias())).scalar()
+            logging.info(f"{count} {step}")
 
-        # delete the files backing the alert
+        return
+
+    checkpoint = CleanupCheckpoint(os.path.join(saq.DATA_DIR, config['checkpoint_path']))
+
+    def _delete_alert(alert_id, alert_uuid, storage_dir):
+        target_path = os.path.join(saq.SAQ_HOME, storage_dir)
+        logging.info(f"deleting files {target_path}")
         try:
-            target_path = os.path.join(saq.SAQ_HOME, storage_dir)
-            logging.info(f"deleting files {target_path}")
-            shutil.rmtree(target_path)
-        except Exception as e:
-            logging.error(f"unable to delete alert storage directory {storage_dir}: {e}")
+            remove_directory(target_path, rate_limiter)
+        except FileNotFoundError:
+            pass
 
-        # delete the alert from the database
-        logging.info(f"deleting database entry {alert_id}")
-        retry_sql_on_deadlock(delete(Alert).where(Alert.id == alert_id), commit=True)
+        return alert_id, alert_uuid
 
-    if dry_run:
-        logging.info(f"{dry_run_count} ignored alerts would be deleted")
-
-    # archive alerts dispositioned as False Positive older than N days
-    dry_run_count = 0
-    for alert in saq.db.query(Alert).filter(
-        Alert.location == saq.CONFIG['global']['node'],
-        Alert.archived == False,
-        Alert.disposition == DISPOSITION_FALSE_POSITIVE,
-        Alert.disposition_time < datetime.datetime.now() - datetime.timedelta(days=fp_days)):
-    
-        if dry_run:
-            dry_run_count += 1
-            continue
+    def _archive_alert(alert_id, alert_uuid, storage_dir):
+        target_path = os.path.join(saq.SAQ_HOME, storage_dir)
+        logging.info(f"archiving {target_path}")
 
-        logging.info(f"resetting false positive {alert}")
+        # alerts in cold storage are archived unpacked and then packed again
+        packed = is_packed(target_path)
+        if packed:
+            unpack_storage_dir(target_path)
 
-        try:
-            alert.load()
-        except Exception as e:
-            logging.error(f"unable to load {alert}: {e}")
-            continue
+        archive_storage_dir(target_path, rate_limiter)
+        reindex_alert(alert_uuid, target_path)
+
+        if packed:
+            pack_storage_dir(target_path)
+
+        return alert_id, alert_uuid
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.getint('threads'),
+                                               thread_name_prefix='Alert Cleanup') as executor:
+
+        # delete alerts dispositioned as IGNORE and older than N days
+        # and then archive alerts dispositioned as False Positive older than N days
+        for step, query, _process, statement in [
+            ('ignore', ignore_query, _delete_alert, lambda ids: delete(Alert).where(Alert.id.in_(ids))),
+            ('fp', fp_query, _archive_alert, lambda ids: update(Alert).where(Alert.id.in_(ids)).values(archived=True)) ]:
+
+            start_id = checkpoint.get(step)
+            if start_id:
+                logging.info(f"resuming {step} cleanup after alert id {start_id}")
+
+            count = 0
+            for rows in _iterate_pages(query, Alert.id, start_id, page_size):
+                futures = [ executor.submit(_process, *row) for row in rows ]
+                completed = []
+                for future in futures:
+                    try:
+                        completed.append(future.result())
+                    except Exception as e:
+                        logging.error(f"unable to clean up alert: {e}")
+
+                # the alerts that failed stay in the database and are tried again the next time
+                for index in range(0, len(completed), delete_batch_size):
+                    batch = completed[index:index + delete_batch_size]
+                    retry_sql_on_deadlock(statement([ alert_id for alert_id, alert_uuid in batch ]), commit=True)
+                    if step == 'ignore':
+                        for alert_id, alert_uuid in batch:
+                            remove_alert(alert_uuid)
+
+                count += len(completed)
+                checkpoint.set(step, rows[-1][0])
+
+            # the next cleanup starts from the beginning
+            checkpoint.set(step, None)
+            logging.info(f"cleaned up {count} {step} alerts")
+
+def pack_alerts(days_old=None, dry_run=False):
+    """Packs the storage directories of the alerts older than [cold_storage] days_old into cold storage
+       (see :mod:`saq.cold_storage`). Alerts that are locked (being analyzed) are skipped until the next time.
+
+       :param int days_old: Overrides [cold_storage] days_old.
+       :param bool dry_run: Setting this to True will simply report how many alerts would be packed.
+    """
+
+    from saq.cold_storage import is_packed, pack_storage_dir
+    from saq.database import Alert, acquire_lock, release_lock
+
+    from sqlalchemy.sql.expression import select
+
+    if days_old is None:
+        days_old = saq.CONFIG['cold_storage'].getint('days_old')
+
+    query = (select([Alert.id, Alert.uuid, Alert.storage_dir])
+        .where(Alert.location == saq.CONFIG['global']['node'])
+        .where(Alert.insert_date < datetime.datetime.now() - datetime.timedelta(days=days_old)))
+
+    count = 0
+    file_count = 0
+    for rows in _iterate_pages(query, Alert.id, 0, saq.CONFIG['cleanup'].getint('page_size')):
+        for alert_id, alert_uuid, storage_dir in rows:
+            target_path = os.path.join(saq.SAQ_HOME, storage_dir)
+            if not os.path.isdir(target_path) or is_packed(target_path):
+                continue
+
+            if dry_run:
+                count += 1
+                continue
+
+            lock_uuid = acquire_lock(alert_uuid)
+            if not lock_uuid:
+                logging.info(f"skipping locked alert {alert_uuid}")
+                continue
+
+            try:
+                file_count += pack_storage_dir(target_path)
+                count += 1
+            except Exception as e:
+                logging.error(f"unable to pack {target_path}: {e}")
+            finally:
+                release_lock(alert_uuid, lock_uuid)
 
-        alert.archive()
-        alert.sync()
-        
     if dry_run:
-        logging.info(f"{dry_run_count} fp alerts would be archived")
+        logging.info(f"{count} alerts would be packed")
+    else:
+        logging.info(f"packed {file_count} files of {count} alerts")
+
+    return count
@@ -0,0 +1,156 @@
+# vim: sw=4:ts=4:et
+#
+# shared virus total report cache
+#
+# virus total reports are stored in the result_cache table of the vt_hash_cache database
+# (the vt_hash_cache gui blueprint stores everything it looks up there) keyed by the hashes of the file
+#
+# a report for a file virus total knows about is used for [vt_hash_cache] positive_ttl seconds
+# and a report for a file it does not know about is only used for negative_ttl seconds
+# since unknown files tend to show up in virus total later
+#
+# NOTE hashes are stored and compared in LOWER CASE
+#
+
+import json
+import logging
+
+import saq
+from saq.database import use_db, execute_with_retry
+
+__all__ = [
+    'get_hash_column',
+    'is_known_report',
+    'lookup_reports',
+    'match_reports',
+    'not_found_report',
+    'parse_reports',
+    'store_reports',
+]
+
+# virus total uses 1 for known files, 0 for unknown files and -2 for files that are queued for analysis
+VT_RESPONSE_CODE_KNOWN = 1
+
+def get_hash_column(_hash):
+    """Returns the result_cache column for the given hash (by length), or None if it is not a valid hash."""
+    try:
+        int(_hash, 16)
+    except ValueError:
+        return None
+
+    return { 32: 'md5', 40: 'sha1', 64: 'sha2' }.get(len(_hash))
+
+def parse_reports(content):
+    """Returns the list of reports (dicts) in the given JSON content (virus total returns a list when asked for more than one hash.)"""
+    reports = json.loads(content)
+    if isinstance(reports, dict):
+        reports = [ reports ]
+
+    return [ report for report in reports if isinstance(report, dict) ]
+
+def is_known_report(report):
+    """Returns True if the report is for a file virus total knows about."""
+    return report.get('response_code') == VT_RESPONSE_CODE_KNOWN
+
+def _report_hashes(report):
+    """Returns the set of (lower case) hashes the report is for."""
+    result = set()
+    for key in [ 'resource', 'md5', 'sha1', 'sha256' ]:
+        if isinstance(report.get(key), str):
+            result.add(report[key].lower())
+
+    return result
+
+def not_found_report(_hash):
+    """Returns the report virus total gives for a hash it does not know about."""
+    return { 'response_code': 0, 'resource': _hash,
+             'verbose_msg': 'The requested resource is not among the finished, queued or pending scans' }
+
+def match_reports(hashes, reports):
+    """Returns a dict of each of the given hashes matched to its report."""
+    result = {}
+    for report in reports:
+        report_hashes = _report_hashes(report)
+        for _hash in hashes:
+            if _hash in report_hashes and _hash not in result:
+                result[_hash] = report
+
+    return result
+
+@use_db(name='vt_hash_cache')
+def lookup_reports(hashes, positive_ttl=None, negative_ttl=None, db=None, c=None):
+    """Returns a dict of each of the given (lower case) hashes that has a cached report
+       that is not older than the ttl for its kind of report, matched to its report."""
+    if positive_ttl is None:
+        positive_ttl = saq.CONFIG['vt_hash_cache'].getint('positive_ttl')
+    if negative_ttl is None:
+        negative_ttl = saq.CONFIG['vt_hash_cache'].getint('negative_ttl')
+
+    hashes = set(hashes)
+    columns = {}
+    for _hash in hashes:
+        column = get_hash_column(_hash)
+        if column is not None:
+            columns.setdefault(column, []).append(_hash)
+
+    if not columns:
+        return {}
+
+    clauses = []
+    params = []
+    for column, column_hashes in columns.items():
+        clauses.append('{} IN ( {} )'.format(column, ','.join(['%s' for _ in column_hashes])))
+        params.extend(column_hashes)
+
+    # the newest report for each hash is used
+    c.execute("""SELECT TIMESTAMPDIFF(SECOND, insert_date, NOW()), result, md5, sha1, sha2 FROM result_cache
+                 WHERE {} ORDER BY insert_date DESC""".format(' OR '.join(clauses)), tuple(params))
+
+    result = {}
+    checked = set()
+    for age, vt_result, md5_hash, sha1_hash, sha2_hash in c:
+        row_hashes = [ h for h in ( md5_hash, sha1_hash, sha2_hash ) if h in hashes and h not in checked ]
+        if not row_hashes:
+            continue
+
+        checked.update(row_hashes)
+
+        try:
+            report = parse_reports(vt_result)[0]
+        except Exception as e:
+            logging.warning("invalid cached vt result for {}: {}".format(','.join(row_hashes), e))
+            continue
+
+        if age > (positive_ttl if is_known_report(report) else negative_ttl):
+            continue
+
+        for _hash in row_hashes:
+            result[_hash] = report
+
+    return result
+
+@use_db(name='vt_hash_cache')
+def store_reports(reports, db=None, c=None):
+    """Stores the given reports in the cache. Returns the number of reports stored."""
+    rows = []
+    for report in reports:
+        columns = { 'md5': None, 'sha1': None, 'sha2': None }
+        # reports for unknown files only have the hash that was asked for
+        for _hash in _report_hashes(report):
+            column = get_hash_column(_hash)
+            if column is not None:
+                columns[column] = _hash
+
+        if not any(columns.values()):
+            logging.warning("vt report does not reference any hashes: {}".format(report))
+            continue
+
+        rows.append(( json.dumps(report), columns['md5'], columns['sha1'], columns['sha2'] ))
+
+    if not rows:
+        return 0
+
+    sql = "INSERT INTO result_cache ( result, md5, sha1, sha2 ) VALUES {}".format(
+          ','.join(['( %s, %s, %s, %s )' for _ in rows]))
+    execute_with_retry(db, c, sql, tuple([value for row in rows for value in row]), commit=True)
+    return len(rows)
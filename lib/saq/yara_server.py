@@ -0,0 +1,537 @@
+# vim: sw=4:ts=4:et
+#
+# yara scanner server
+#
+# an alternative to yss (the server that comes with the yara_scanner package) that keeps client
+# connections open and accepts any number of files in a single request
+#
+# the server runs a pool of scanner processes that each load the yara rules
+# every request goes to the scanner with the fewest files waiting on it (rather than the first one that is free)
+# and the server keeps track of how often each rule matches and how long the scans take
+#
+# protocol (over a unix socket that stays open for any number of requests)
+# each message is a 4 byte (network order) length followed by that many bytes of utf-8 json
+# CLIENT SEND -> { "command": "scan", "paths": [ path, ... ] }
+# SERVER SEND -> { "results": [ result, ... ] } where each result is the list of yara matches for the path at the same index
+#                or { "error": message } if that file could not be scanned
+# CLIENT SEND -> { "command": "stats" }
+# SERVER SEND -> { "scanners": [ ... ], "rules": { ... }, "sources": { ... } }
+#
+
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import socket
+import struct
+import threading
+import time
+
+from collections import defaultdict
+from threading import Thread
+
+import saq
+from saq.error import report_exception
+
+__all__ = [
+    'YaraScannerClient',
+    'YaraScannerServer',
+    'create_yara_scanner',
+    'get_signature_sources',
+    'recv_message',
+    'send_message',
+]
+
+HEADER = struct.Struct('!I')
+
+# yara string matches are bytes which json cannot store directly
+class _Encoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, bytes):
+            return { '__bytes__': base64.b64encode(obj).decode('ascii') }
+
+        return super().default(obj)
+
+def _decode_object(obj):
+    if len(obj) == 1 and '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+
+    return obj
+
+def _recv_exactly(sock, size):
+    result = bytearray()
+    while len(result) < size:
+        data = sock.recv(size - len(result))
+        if data == b'':
+            if not result:
+                return None
+
+            raise ConnectionError("connection closed in the middle of a message")
+
+        result.extend(data)
+
+    return bytes(result)
+
+def send_message(sock, message):
+    """Sends the given json-able message over the given socket."""
+    data = json.dumps(message, cls=_Encoder).encode('utf8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+def recv_message(sock):
+    """Returns the next message from the given socket, or None if the other side closed the connection."""
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+
+    size, = HEADER.unpack(header)
+    data = _recv_exactly(sock, size)
+    if data is None:
+        raise ConnectionError("connection closed in the middle of a message")
+
+    return json.loads(data.decode('utf8'), object_hook=_decode_object)
+
+def get_signature_sources():
+    """Returns a list of (type, path) for the yara signatures configured in [yara] where type is dir, repo or file."""
+    result = []
+    for option in saq.CONFIG['yara'].keys():
+        for source_type in [ 'dir', 'repo', 'file' ]:
+            if option.startswith('signature_{}'.format(source_type)):
+                result.append((source_type, os.path.join(saq.SAQ_HOME, saq.CONFIG['yara'][option])))
+
+    return result
+
+def create_yara_scanner(sources):
+    """Returns a new yara_scanner.YaraScanner with the rules from the given (type, path) sources loaded."""
+    import yara_scanner
+
+    scanner = yara_scanner.YaraScanner()
+    for source_type, path in sources:
+        if source_type == 'dir':
+            scanner.track_yara_dir(path)
+        elif source_type == 'repo':
+            scanner.track_yara_repository(path)
+        elif source_type == 'file':
+            scanner.track_yara_file(path)
+
+    scanner.load_rules()
+    return scanner
+
+def _split_sources(sources):
+    """Splits the given sources into one source for each yara file."""
+    result = []
+    for source_type, path in sources:
+        if source_type == 'file':
+            result.append((source_type, path))
+            continue
+
+        for dir_path, dir_names, file_names in os.walk(path):
+            # skip .git and friends
+            dir_names[:] = sorted([d for d in dir_names if not d.startswith('.')])
+            for file_name in sorted(file_names):
+                if file_name.endswith('.yar') or file_name.endswith('.yara'):
+                    result.append(('file', os.path.join(dir_path, file_name)))
+
+    return result
+
+def _scanner_loop(connection, sources, profile_rules, rule_check_frequency):
+    """Executed by each scanner process. Scans the batches of files sent over the connection."""
+    # when profiling each yara file is loaded into a scanner of its own so it can be timed separately
+    if profile_rules:
+        scanners = [ (path, create_yara_scanner([ (source_type, path) ])) for source_type, path in _split_sources(sources) ]
+    else:
+        scanners = [ (None, create_yara_scanner(sources)) ]
+
+    next_rule_check = time.time() + rule_check_frequency
+
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+
+        if request is None:
+            break
+
+        if time.time() >= next_rule_check:
+            next_rule_check = time.time() + rule_check_frequency
+            for source, scanner in scanners:
+                if scanner.check_rules():
+                    logging.info("detected yara rules modification - reloading")
+                    scanner.load_rules()
+
+        request_id, paths = request
+        results = []
+        # key = source, value = [ scans, seconds, max_seconds ]
+        source_times = defaultdict(lambda: [ 0, 0.0, 0.0 ])
+        for path in paths:
+            try:
+                matches = []
+                for source, scanner in scanners:
+                    start = time.time()
+                    if scanner.scan(path):
+                        matches.extend(scanner.scan_results)
+
+                    elapsed = time.time() - start
+                    source_times[source][0] += 1
+                    source_times[source][1] += elapsed
+                    source_times[source][2] = max(source_times[source][2], elapsed)
+
+                results.append(matches)
+
+            except Exception as e:
+                logging.error("unable to scan {}: {}".format(path, e))
+                results.append({ 'error': str(e) })
+
+        connection.send((request_id, results, dict(source_times)))
+
+class _Scanner(object):
+    """A scanner process and the requests waiting on it."""
+
+    def __init__(self, scanner_id, server):
+        self.scanner_id = scanner_id
+        self.server = server
+        self.process = None
+        self.connection = None
+        self.reader_thread = None
+
+        # the number of files sent to this scanner that have not been scanned yet
+        self.queue_depth = 0
+        # key = request_id, value = [ threading.Event, result ]
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        parent_connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_scanner_loop,
+                                               args=(child_connection, self.server.sources,
+                                                     self.server.profile_rules, self.server.rule_check_frequency),
+                                               name="Yara Scanner {}".format(self.scanner_id))
+        self.process.start()
+        child_connection.close()
+        with self.lock:
+            self.connection = parent_connection
+
+        self.reader_thread = Thread(target=self.reader_loop, name="Yara Scanner Reader {}".format(self.scanner_id))
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+        logging.info("started yara scanner {} pid {}".format(self.scanner_id, self.process.pid))
+
+    def stop(self):
+        try:
+            with self.lock:
+                self.connection.send(None)
+        except Exception:
+            pass
+
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    def submit(self, request_id, paths):
+        """Sends the given paths to the scanner process. Returns the threading.Event that is set when the results are available."""
+        event = threading.Event()
+        with self.lock:
+            self.requests[request_id] = [ event, None ]
+            try:
+                self.connection.send((request_id, paths))
+            except Exception:
+                del self.requests[request_id]
+                raise
+
+        return event
+
+    def take_result(self, request_id):
+        with self.lock:
+            return self.requests.pop(request_id, [ None, None ])[1]
+
+    def reader_loop(self):
+        while True:
+            try:
+                request_id, results, source_times = self.connection.recv()
+            except (EOFError, OSError):
+                break
+
+            self.server.record_results(results, source_times)
+            with self.lock:
+                if request_id in self.requests:
+                    self.requests[request_id][1] = results
+                    self.requests[request_id][0].set()
+
+        # the scanner process is gone, fail everything that was waiting on it
+        with self.lock:
+            for event, result in self.requests.values():
+                event.set()
+
+        if not self.server.shutdown:
+            self.process.join()
+            logging.error("yara scanner {} exited unexpectedly (exit code {}) - restarting".format(
+                          self.scanner_id, self.process.exitcode))
+            self.start()
+
+class YaraScannerServer(object):
+    def __init__(self):
+        self.config = saq.CONFIG['yara_server']
+
+        # set to True to gracefully shutdown
+        self.shutdown = False
+
+        self.socket_path = os.path.join(saq.DATA_DIR, self.config['socket_path'])
+        self.scanner_count = self.config.getint('scanner_count') or multiprocessing.cpu_count()
+        self.profile_rules = self.config.getboolean('profile_rules')
+        self.rule_check_frequency = self.config.getint('rule_check_frequency')
+        self.sources = get_signature_sources()
+
+        self.scanners = [] # of _Scanner
+        self.server_thread = None
+        self.server_socket = None
+
+        # used to pick scanners and to track statistics
+        self.lock = threading.Lock()
+        self.next_request_id = 0
+
+        # key = rule name, value = number of files it matched
+        self.rule_matches = defaultdict(int)
+        # key = yara file (or None when not profiling), value = [ scans, seconds, max_seconds ]
+        self.source_times = defaultdict(lambda: [ 0, 0.0, 0.0 ])
+        self.scan_count = 0
+        self.error_count = 0
+
+    def start(self):
+        for scanner_id in range(self.scanner_count):
+            scanner = _Scanner(scanner_id, self)
+            scanner.start()
+            self.scanners.append(scanner)
+
+        self.server_thread = Thread(target=self.server_loop, name="Yara Scanner Server")
+        self.server_thread.start()
+
+    def stop(self):
+        logging.info("shutting down")
+        self.shutdown = True
+
+        # force the accept() call to break
+        try:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(self.socket_path)
+            s.close()
+        except Exception:
+            pass
+
+        if self.server_thread:
+            logging.info("waiting for main thread to exit...")
+            self.server_thread.join()
+
+        for scanner in self.scanners:
+            scanner.stop()
+
+    def wait(self):
+        self.server_thread.join()
+
+    def server_loop(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.server_socket.listen(50)
+        logging.info("waiting for clients on {}".format(self.socket_path))
+
+        try:
+            while not self.shutdown:
+                client_socket, _ = self.server_socket.accept()
+                if self.shutdown:
+                    client_socket.close()
+                    break
+
+                t = Thread(target=self.client_loop, args=(client_socket,), name="Yara Scanner Client")
+                t.daemon = True
+                t.start()
+        finally:
+            self.server_socket.close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    def client_loop(self, client_socket):
+        try:
+            while not self.shutdown:
+                message = recv_message(client_socket)
+                if message is None:
+                    break
+
+                command = message.get('command')
+                if command == 'scan':
+                    send_message(client_socket, { 'results': self.scan(message['paths']) })
+                elif command == 'stats':
+                    send_message(client_socket, self.get_stats())
+                else:
+                    send_message(client_socket, { 'error': 'unknown command {}'.format(command) })
+
+        except Exception as e:
+            logging.error("error handling client: {}".format(e))
+            report_exception()
+        finally:
+            client_socket.close()
+
+    def scan(self, paths):
+        """Scans the given paths, spreading them over the scanners with the shortest queues. Returns the list of results."""
+        if not paths:
+            return []
+
+        # split the work into one batch for each scanner
+        batch_size = -(-len(paths) // len(self.scanners))
+        submitted = [] # of (scanner, request_id, event, start, end)
+
+        for start in range(0, len(paths), batch_size):
+            end = min(start + batch_size, len(paths))
+            with self.lock:
+                scanner = min(self.scanners, key=lambda s: s.queue_depth)
+                scanner.queue_depth += end - start
+                request_id = self.next_request_id
+                self.next_request_id += 1
+
+            try:
+                event = scanner.submit(request_id, paths[start:end])
+            except Exception as e:
+                logging.error("unable to submit request to yara scanner {}: {}".format(scanner.scanner_id, e))
+                event = None
+
+            submitted.append((scanner, request_id, event, start, end))
+
+        results = [ None ] * len(paths)
+        for scanner, request_id, event, start, end in submitted:
+            if event is not None:
+                event.wait()
+
+            with self.lock:
+                scanner.queue_depth -= end - start
+
+            batch_results = scanner.take_result(request_id)
+            if batch_results is None:
+                batch_results = [ { 'error': 'scanner {} failed'.format(scanner.scanner_id) } ] * (end - start)
+
+            results[start:end] = batch_results
+
+        return results
+
+    def record_results(self, results, source_times):
+        with self.lock:
+            for result in results:
+                self.scan_count += 1
+                if isinstance(result, dict):
+                    self.error_count += 1
+                    continue
+
+                for match in result:
+                    self.rule_matches[match['rule']] += 1
+
+            for source, (scans, seconds, max_seconds) in source_times.items():
+                stats = self.source_times[source]
+                stats[0] += scans
+                stats[1] += seconds
+                stats[2] = max(stats[2], max_seconds)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'scans': self.scan_count,
+                'errors': self.error_count,
+                'scanners': [ { 'scanner_id': s.scanner_id,
+                                'pid': s.process.pid,
+                                'alive': s.process.is_alive(),
+                                'queue_depth': s.queue_depth } for s in self.scanners ],
+                'rules': dict(self.rule_matches),
+                'sources': { str(source) if source else 'all': { 'scans': scans, 'seconds': seconds, 'max_seconds': max_seconds }
+                             for source, (scans, seconds, max_seconds) in self.source_times.items() },
+            }
+
+class YaraScannerClient(object):
+    """Keeps a pool of open connections to the yara scanner server."""
+
+    def __init__(self, socket_path, pool_size=1, timeout=None):
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.pool = []
+        self.lock = threading.Lock()
+        # connections are not shared with forked processes
+        self.pid = os.getpid()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except Exception:
+            sock.close()
+            raise
+
+        return sock
+
+    def acquire(self):
+        """Returns a tuple of (socket, pooled) where pooled is True if the connection was already open."""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pool = []
+                self.pid = os.getpid()
+
+            if self.pool:
+                return self.pool.pop(), True
+
+        return self.connect(), False
+
+    def release(self, sock):
+        with self.lock:
+            if self.pid == os.getpid() and len(self.pool) < self.pool_size:
+                self.pool.append(sock)
+                return
+
+        sock.close()
+
+    def close(self):
+        with self.lock:
+            for sock in self.pool:
+                sock.close()
+
+            self.pool = []
+
+    def request(self, message):
+        """Sends the given message and returns the response. Raises socket.error if the server is unavailable."""
+        while True:
+            sock, pooled = self.acquire()
+            try:
+                send_message(sock, message)
+                response = recv_message(sock)
+                if response is None:
+                    raise ConnectionError("yara scanner server closed the connection")
+            except OSError:
+                sock.close()
+                # the server may have closed an idle connection, try again with a new one
+                if pooled:
+                    continue
+
+                raise
+            except:
+                sock.close()
+                raise
+
+            self.release(sock)
+            return response
+
+    def scan_files(self, paths):
+        """Scans the given (absolute) paths. Returns a list with the yara matches of each path
+           or { 'error': message } for paths that could not be scanned."""
+        response = self.request({ 'command': 'scan', 'paths': paths })
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+
+        return response['results']
+
+    def get_stats(self):
+        return self.request({ 'command': 'stats' })
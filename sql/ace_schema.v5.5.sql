@@ -47,6 +47,8 @@ CREATE TABLE `alerts` (
   `company_id` int(11) DEFAULT NULL,
   `location` varchar(1024) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_520_ci NOT NULL,
   `detection_count` int(11) DEFAULT '0',
+  `sla_warning_time` timestamp NULL DEFAULT NULL COMMENT 'When the alert starts approaching SLA (NULL if no SLA applies.)',
+  `sla_deadline` timestamp NULL DEFAULT NULL COMMENT 'When the alert is over SLA (NULL if no SLA applies.)',
   PRIMARY KEY (`id`),
   UNIQUE KEY `uuid` (`uuid`),
   KEY `insert_date` (`insert_date`),
@@ -57,6 +59,8 @@ CREATE TABLE `alerts` (
   KEY `idx_disposition` (`disposition`),
   KEY `idx_alert_type` (`alert_type`),
   KEY `idx_location` (`location`(767)),
+  KEY `idx_sla` (`disposition`,`sla_warning_time`),
+  KEY `idx_disposition_time` (`disposition_time`),
   CONSTRAINT `fk_company` FOREIGN KEY (`company_id`) REFERENCES `company` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
@@ -347,6 +351,43 @@ CREATE TABLE `malware_threat_mapping` (
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `metrics_alert_rollup`
+--
+
+DROP TABLE IF EXISTS `metrics_alert_rollup`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `metrics_alert_rollup` (
+  `period` enum('HOUR','DAY') NOT NULL,
+  `bucket_start` datetime NOT NULL COMMENT 'The start of the hour or day the alerts were inserted in.',
+  `alert_type` varchar(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_520_ci NOT NULL,
+  `company_id` int(11) NOT NULL DEFAULT '0' COMMENT '0 for alerts without a company.',
+  `disposition` varchar(32) CHARACTER SET ascii NOT NULL DEFAULT '' COMMENT 'Empty for open alerts.',
+  `disposition_user_id` int(11) NOT NULL DEFAULT '0' COMMENT '0 for alerts that have not been dispositioned.',
+  `alert_count` int(11) NOT NULL DEFAULT '0',
+  `cycle_time` bigint(20) NOT NULL DEFAULT '0' COMMENT 'The total number of seconds between insert and disposition of the dispositioned alerts.',
+  `business_cycle_time` bigint(20) NOT NULL DEFAULT '0' COMMENT 'The total number of business hour seconds between insert and disposition of the dispositioned alerts.',
+  `cycle_time_histogram` varchar(255) CHARACTER SET ascii NOT NULL COMMENT 'Comma separated counts of the dispositioned alerts in each of saq.metrics.CYCLE_TIME_BINS.',
+  PRIMARY KEY (`period`,`bucket_start`,`alert_type`,`company_id`,`disposition`,`disposition_user_id`),
+  KEY `idx_bucket_start` (`bucket_start`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `metrics_rollup_status`
+--
+
+DROP TABLE IF EXISTS `metrics_rollup_status`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `metrics_rollup_status` (
+  `id` int(11) NOT NULL,
+  `last_update` datetime NOT NULL COMMENT 'metrics_alert_rollup is complete for the alerts inserted before this time.',
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `node_modes`
 --
@@ -443,6 +484,30 @@ CREATE TABLE `remediation` (
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `sandbox_jobs`
+--
+
+DROP TABLE IF EXISTS `sandbox_jobs`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `sandbox_jobs` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `uuid` varchar(36) CHARACTER SET ascii NOT NULL,
+  `observable_uuid` char(36) CHARACTER SET ascii NOT NULL,
+  `analysis_module` varchar(255) CHARACTER SET ascii NOT NULL COMMENT 'The config section of the sandbox analysis module waiting on the job (matches delayed_analysis.analysis_module.)',
+  `job_id` varchar(255) CHARACTER SET ascii NOT NULL COMMENT 'The id the sandbox uses for the job.',
+  `node_id` int(11) NOT NULL,
+  `finished` tinyint(1) NOT NULL DEFAULT '0' COMMENT 'Set to 1 once the sandbox reports the job is done (or failed.)',
+  `insert_date` datetime NOT NULL,
+  `last_checked` datetime DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `idx_job` (`uuid`,`observable_uuid`,`analysis_module`,`job_id`),
+  KEY `idx_node_finished` (`node_id`,`finished`),
+  CONSTRAINT `fk_sandbox_jobs_node_id` FOREIGN KEY (`node_id`) REFERENCES `nodes` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `tag_mapping`
 --
@@ -14,6 +14,8 @@
 /*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;
 /*!40101 SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;
 /*!40111 SET @OLD_SQL_NOTES=@@SQL_NOTES, SQL_NOTES=0 */;
+-- the ngram parser drops every token that contains a stopword (which includes single letters like "a")
+/*!50600 SET SESSION innodb_ft_enable_stopword = 0 */;
 
 --
 -- Table structure for table `archive`
@@ -35,40 +37,48 @@ CREATE TABLE `archive` (
 /*!40101 SET character_set_client = @saved_cs_client */;
 
 --
--- Table structure for table `archive_index`
+-- Table structure for table `archive_content`
 --
 
-DROP TABLE IF EXISTS `archive_index`;
+DROP TABLE IF EXISTS `archive_content`;
 /*!40101 SET @saved_cs_client     = @@character_set_client */;
 /*!40101 SET character_set_client = utf8 */;
-CREATE TABLE `archive_index` (
-  `field` enum('env_from','env_to','body_from','body_to','subject','decoded_subject','message_id','content','url') NOT NULL,
-  `hash` binary(16) NOT NULL,
+CREATE TABLE `archive_content` (
   `archive_id` int(11) NOT NULL,
-  PRIMARY KEY (`hash`,`archive_id`,`field`),
-  KEY `archive_id` (`archive_id`),
-  KEY `hash` (`hash`),
-  CONSTRAINT `fk_archive_index_1` FOREIGN KEY (`archive_id`) REFERENCES `archive` (`archive_id`) ON DELETE CASCADE ON UPDATE CASCADE
+  `md5` binary(16) NOT NULL,
+  PRIMARY KEY (`archive_id`,`md5`),
+  KEY `idx_md5` (`md5`),
+  CONSTRAINT `fk_archive_content_1` FOREIGN KEY (`archive_id`) REFERENCES `archive` (`archive_id`) ON DELETE CASCADE ON UPDATE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
 --
--- Table structure for table `archive_search`
+-- Table structure for table `archive_message`
 --
 
-DROP TABLE IF EXISTS `archive_search`;
+DROP TABLE IF EXISTS `archive_message`;
 /*!40101 SET @saved_cs_client     = @@character_set_client */;
 /*!40101 SET character_set_client = utf8 */;
-CREATE TABLE `archive_search` (
-  `field` enum('env_from','env_to','body_from','body_to','subject','decoded_subject','message_id','content','url') NOT NULL,
-  `value` varbinary(512) NOT NULL,
+CREATE TABLE `archive_message` (
   `archive_id` int(11) NOT NULL,
-  PRIMARY KEY (`field`,`value`,`archive_id`),
-  KEY `value` (`value`),
-  KEY `field_value` (`field`,`value`),
-  KEY `archive_id` (`archive_id`),
-  CONSTRAINT `fk_archive_search_1` FOREIGN KEY (`archive_id`) REFERENCES `archive` (`archive_id`) ON DELETE CASCADE ON UPDATE CASCADE
-) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+  `message_id` varchar(512) DEFAULT NULL,
+  `message_id_hash` binary(16) DEFAULT NULL,
+  `env_to` varchar(512) DEFAULT NULL,
+  `env_to_hash` binary(16) DEFAULT NULL,
+  `body_from` varchar(512) DEFAULT NULL,
+  `body_from_hash` binary(16) DEFAULT NULL,
+  `body_to` varchar(512) DEFAULT NULL,
+  `body_to_hash` binary(16) DEFAULT NULL,
+  `subject` text,
+  `decoded_subject` text,
+  PRIMARY KEY (`archive_id`),
+  KEY `idx_message_id_hash` (`message_id_hash`),
+  KEY `idx_env_to_hash` (`env_to_hash`),
+  KEY `idx_body_from_hash` (`body_from_hash`),
+  KEY `idx_body_to_hash` (`body_to_hash`),
+  FULLTEXT KEY `ft_subject` (`subject`,`decoded_subject`) /*!50100 WITH PARSER `ngram` */ ,
+  CONSTRAINT `fk_archive_message_1` FOREIGN KEY (`archive_id`) REFERENCES `archive` (`archive_id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
 --
@@ -85,6 +95,24 @@ CREATE TABLE `archive_server` (
   UNIQUE KEY `hostname` (`hostname`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `archive_url`
+--
+
+DROP TABLE IF EXISTS `archive_url`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `archive_url` (
+  `archive_id` int(11) NOT NULL,
+  `url_hash` binary(16) NOT NULL,
+  `url` text NOT NULL,
+  PRIMARY KEY (`archive_id`,`url_hash`),
+  KEY `idx_url_hash` (`url_hash`),
+  FULLTEXT KEY `ft_url` (`url`) /*!50100 WITH PARSER `ngram` */ ,
+  CONSTRAINT `fk_archive_url_1` FOREIGN KEY (`archive_id`) REFERENCES `archive` (`archive_id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+/*!40101 SET character_set_client = @saved_cs_client */;
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
 
 /*!40101 SET SQL_MODE=@OLD_SQL_MODE */;
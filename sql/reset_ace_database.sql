@@ -4,9 +4,12 @@ DELETE FROM comments;
 DELETE FROM delayed_analysis;
 DELETE FROM incoming_workload;
 DELETE FROM locks;
+DELETE FROM metrics_alert_rollup;
+DELETE FROM metrics_rollup_status;
 DELETE FROM nodes;
 DELETE FROM observables;
 DELETE FROM remediation;
+DELETE FROM sandbox_jobs;
 DELETE FROM tags;
 DELETE FROM work_distribution_groups;
 DELETE FROM workload;
@@ -0,0 +1,15 @@
+CREATE TABLE `ace`.`sandbox_jobs` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `uuid` varchar(36) CHARACTER SET ascii NOT NULL,
+  `observable_uuid` char(36) CHARACTER SET ascii NOT NULL,
+  `analysis_module` varchar(255) CHARACTER SET ascii NOT NULL COMMENT 'The config section of the sandbox analysis module waiting on the job (matches delayed_analysis.analysis_module.)',
+  `job_id` varchar(255) CHARACTER SET ascii NOT NULL COMMENT 'The id the sandbox uses for the job.',
+  `node_id` int(11) NOT NULL,
+  `finished` tinyint(1) NOT NULL DEFAULT '0' COMMENT 'Set to 1 once the sandbox reports the job is done (or failed.)',
+  `insert_date` datetime NOT NULL,
+  `last_checked` datetime DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `idx_job` (`uuid`,`observable_uuid`,`analysis_module`,`job_id`),
+  KEY `idx_node_finished` (`node_id`,`finished`),
+  CONSTRAINT `fk_sandbox_jobs_node_id` FOREIGN KEY (`node_id`) REFERENCES `nodes` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
@@ -0,0 +1,45 @@
+-- run this against each email archive database (email-archive by default)
+-- then backfill the new tables from archive_index and archive_search with ace migrate-email-archive-search
+-- archive_index and archive_search are no longer used and can be dropped once the migration is done
+
+-- the ngram parser drops every token that contains a stopword (which includes single letters like "a")
+SET SESSION innodb_ft_enable_stopword = 0;
+
+CREATE TABLE `archive_content` (
+  `archive_id` int(11) NOT NULL,
+  `md5` binary(16) NOT NULL,
+  PRIMARY KEY (`archive_id`,`md5`),
+  KEY `idx_md5` (`md5`),
+  CONSTRAINT `fk_archive_content_1` FOREIGN KEY (`archive_id`) REFERENCES `archive` (`archive_id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+CREATE TABLE `archive_message` (
+  `archive_id` int(11) NOT NULL,
+  `message_id` varchar(512) DEFAULT NULL,
+  `message_id_hash` binary(16) DEFAULT NULL,
+  `env_to` varchar(512) DEFAULT NULL,
+  `env_to_hash` binary(16) DEFAULT NULL,
+  `body_from` varchar(512) DEFAULT NULL,
+  `body_from_hash` binary(16) DEFAULT NULL,
+  `body_to` varchar(512) DEFAULT NULL,
+  `body_to_hash` binary(16) DEFAULT NULL,
+  `subject` text,
+  `decoded_subject` text,
+  PRIMARY KEY (`archive_id`),
+  KEY `idx_message_id_hash` (`message_id_hash`),
+  KEY `idx_env_to_hash` (`env_to_hash`),
+  KEY `idx_body_from_hash` (`body_from_hash`),
+  KEY `idx_body_to_hash` (`body_to_hash`),
+  FULLTEXT KEY `ft_subject` (`subject`,`decoded_subject`) WITH PARSER `ngram`,
+  CONSTRAINT `fk_archive_message_1` FOREIGN KEY (`archive_id`) REFERENCES `archive` (`archive_id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE `archive_url` (
+  `archive_id` int(11) NOT NULL,
+  `url_hash` binary(16) NOT NULL,
+  `url` text NOT NULL,
+  PRIMARY KEY (`archive_id`,`url_hash`),
+  KEY `idx_url_hash` (`url_hash`),
+  FULLTEXT KEY `ft_url` (`url`) WITH PARSER `ngram`,
+  CONSTRAINT `fk_archive_url_1` FOREIGN KEY (`archive_id`) REFERENCES `archive` (`archive_id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,6 @@
+ALTER TABLE `ace`.`alerts` 
+ADD COLUMN `sla_warning_time` timestamp NULL DEFAULT NULL COMMENT 'When the alert starts approaching SLA (NULL if no SLA applies.)',
+ADD COLUMN `sla_deadline` timestamp NULL DEFAULT NULL COMMENT 'When the alert is over SLA (NULL if no SLA applies.)',
+ADD INDEX `idx_sla` (`disposition`, `sla_warning_time`);
+
+-- then run ace update-alert-sla to compute the SLA of the alerts that are already open
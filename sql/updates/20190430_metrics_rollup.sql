@@ -0,0 +1,25 @@
+ALTER TABLE `ace`.`alerts` 
+ADD INDEX `idx_disposition_time` (`disposition_time`);
+
+CREATE TABLE `ace`.`metrics_alert_rollup` (
+  `period` enum('HOUR','DAY') NOT NULL,
+  `bucket_start` datetime NOT NULL COMMENT 'The start of the hour or day the alerts were inserted in.',
+  `alert_type` varchar(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_520_ci NOT NULL,
+  `company_id` int(11) NOT NULL DEFAULT '0' COMMENT '0 for alerts without a company.',
+  `disposition` varchar(32) CHARACTER SET ascii NOT NULL DEFAULT '' COMMENT 'Empty for open alerts.',
+  `disposition_user_id` int(11) NOT NULL DEFAULT '0' COMMENT '0 for alerts that have not been dispositioned.',
+  `alert_count` int(11) NOT NULL DEFAULT '0',
+  `cycle_time` bigint(20) NOT NULL DEFAULT '0' COMMENT 'The total number of seconds between insert and disposition of the dispositioned alerts.',
+  `business_cycle_time` bigint(20) NOT NULL DEFAULT '0' COMMENT 'The total number of business hour seconds between insert and disposition of the dispositioned alerts.',
+  `cycle_time_histogram` varchar(255) CHARACTER SET ascii NOT NULL COMMENT 'Comma separated counts of the dispositioned alerts in each of saq.metrics.CYCLE_TIME_BINS.',
+  PRIMARY KEY (`period`,`bucket_start`,`alert_type`,`company_id`,`disposition`,`disposition_user_id`),
+  KEY `idx_bucket_start` (`bucket_start`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+CREATE TABLE `ace`.`metrics_rollup_status` (
+  `id` int(11) NOT NULL,
+  `last_update` datetime NOT NULL COMMENT 'metrics_alert_rollup is complete for the alerts inserted before this time.',
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+-- then run ace update-metrics to compute the rollups of the existing alerts (and then from cron)